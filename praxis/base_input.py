@@ -18,11 +18,17 @@
 from __future__ import annotations
 
 import abc
+from concurrent import futures
 import copy
 import dataclasses
+import glob
 import inspect
+import json
 import math
+import queue
 import re
+import threading
+import time
 from typing import Any, Dict, Optional, Sequence
 
 from absl import logging
@@ -175,18 +181,21 @@ class BaseInput(base_hyperparams.FiddleBaseParameterizable):
       The padded example from the data pipeline.
     """
     if self._peek is None:
-      unpadded = self.get_next()
-      pad_size = self.batch_padding_size
-      if pad_size == 0:
-        return unpadded
-      return jax.tree_util.tree_map(
-          lambda x: np.pad(x, [[0, pad_size]] + [[0, 0]] * (x.ndim - 1)),
-          unpadded,
-      )
+      return self._pad_batch(self.get_next())
     peek = self._peek
     self._peek = None
     return peek
 
+  def _pad_batch(self, unpadded: NestedJTensor) -> NestedJTensor:
+    """Right-pads the batch dimension with `batch_padding_size` zeros."""
+    pad_size = self.batch_padding_size
+    if pad_size == 0:
+      return unpadded
+    return jax.tree_util.tree_map(
+        lambda x: np.pad(x, [[0, pad_size]] + [[0, 0]] * (x.ndim - 1)),
+        unpadded,
+    )
+
   def peek_padded(self) -> Optional[NestedJTensor]:
     """Peeks into the current input data pipeline."""
     if self._peek is None:
@@ -815,12 +824,23 @@ class MultiInput(BaseInput):
 
   The model code is responsible for collapsing the two batch_size dimensions.
 
+  With parallel_fetch, the children batches are fetched concurrently, so that
+  the latency of get_next() is the max rather than the sum of the children
+  latencies. Children can also be prefetched on background threads (see
+  PrefetchInput) with input_to_prefetch_depth. The latency of the last fetch of
+  each child is returned by fetch_latency_metrics().
+
   Attributes:
     input_to_params: Dict from input names to input generator parameter
       definitions for each input. Input generators need to implement BaseInput.
       Required.
     default_input: Default input to use for ids_to_strings or other input
       generator methods.
+    parallel_fetch: Whether to fetch the children batches concurrently, on a
+      thread pool. The pool is shut down by reset(), and restarted by the next
+      get_next().
+    input_to_prefetch_depth: Optional dict from input names to the number of
+      batches prefetched by the input on a background thread.
   """
 
   _VALIDATE_BATCH_SIZE_NOT_NONE = False  # Validated separately for children.
@@ -828,7 +848,11 @@ class MultiInput(BaseInput):
 
   input_to_params: Optional[Dict[str, pax_fiddle.Config[BaseInput]]] = None
   default_input: Optional[str] = None
+  parallel_fetch: bool = False
+  input_to_prefetch_depth: Optional[Dict[str, int]] = None
   _inputs: Any = dataclasses.field(init=False, repr=False)
+  _executor: Any = dataclasses.field(init=False, repr=False)
+  _fetch_latency: Any = dataclasses.field(init=False, repr=False)
 
   def __post_init__(self):
     if self._VALIDATE_BATCH_SIZE_NONE and self.batch_size is not None:
@@ -854,6 +878,12 @@ class MultiInput(BaseInput):
           'Only 1 input can be specified when using reset_for_eval.'
       )
 
+    prefetch_depths = self.input_to_prefetch_depth or {}
+    for input_name in prefetch_depths:
+      if input_name not in self.input_to_params:
+        raise ValueError(f'Unknown input in input_to_prefetch_depth: '
+                         f'{input_name}.')
+
     self._inputs = {}
     for input_name, input_params in self.input_to_params.items():
       # Overriding params for children to match parent.
@@ -864,7 +894,21 @@ class MultiInput(BaseInput):
       input_params.eval_loop_num_batches = self.eval_loop_num_batches
       input_params.name = self.name + '_' + input_name
 
+      if prefetch_depths.get(input_name, 0) > 0:
+        input_params = pax_fiddle.Config(
+            PrefetchInput,
+            input_tpl=input_params,
+            prefetch_depth=prefetch_depths[input_name],
+            name=input_params.name,
+            num_infeed_hosts=self.num_infeed_hosts,
+            infeed_host_index=self.infeed_host_index,
+            is_training=self.is_training,
+            reset_for_eval=self.reset_for_eval,
+            eval_loop_num_batches=self.eval_loop_num_batches,
+        )
       self._inputs[input_name] = instantiate(input_params)
+    self._executor = None
+    self._fetch_latency = {}
 
   @classmethod
   def get_batch_size(cls, hparams: pax_fiddle.Config[MultiInput]) -> int:
@@ -883,10 +927,29 @@ class MultiInput(BaseInput):
       return children_batch_sizes[0]
     return math.gcd(*children_batch_sizes)
 
+  def _fetch(self, input_name: str) -> NestedJTensor:
+    start = time.time()
+    batch = self._inputs[input_name].get_next()
+    self._fetch_latency[input_name] = time.time() - start
+    return batch
+
   def get_next(self) -> NestedJTensor:
-    input_batches = {}
-    for input_name, input_gen in self._inputs.items():
-      input_batches[input_name] = input_gen.get_next()
+    if self.parallel_fetch:
+      if self._executor is None:
+        self._executor = futures.ThreadPoolExecutor(
+            max_workers=len(self._inputs), thread_name_prefix=self.name)
+      fetches = {
+          input_name: self._executor.submit(self._fetch, input_name)
+          for input_name in self._inputs
+      }
+      # Raises the exception of the first failed input, if any.
+      input_batches = {
+          input_name: fetch.result() for input_name, fetch in fetches.items()
+      }
+    else:
+      input_batches = {
+          input_name: self._fetch(input_name) for input_name in self._inputs
+      }
     combined_batch = NestedMap(input_batches)
     outer_batch_size = self.hparams.cls.get_batch_size(self.hparams)
     return combined_batch.Transform(
@@ -895,10 +958,29 @@ class MultiInput(BaseInput):
   def get_child(self, input_name: str) -> NestedJTensor:
     return self._inputs[input_name]
 
+  def fetch_latency_metrics(self) -> Dict[str, float]:
+    """Returns the latency in seconds of the last fetch of each input."""
+    return {
+        f'fetch_latency_secs/{input_name}': latency
+        for input_name, latency in self._fetch_latency.items()
+    }
+
+  def _shutdown_executor(self) -> None:
+    if self._executor is None:
+      return
+    self._executor.shutdown()
+    self._executor = None
+
   def reset(self) -> None:
+    self._shutdown_executor()
     for _, input_gen in self._inputs.items():
       input_gen.reset()
 
+  def __del__(self):
+    # The executor is not set if __post_init__() failed.
+    if getattr(self, '_executor', None) is not None:
+      self._executor.shutdown(wait=False)
+
   def ids_to_strings(self,
                      ids: pytypes.NpTensor,
                      lengths: pytypes.NpTensor,
@@ -928,6 +1010,741 @@ class MultiInput(BaseInput):
     return self._inputs[input_name].ids_to_strings(ids, lengths, key)
 
 
+class PrefetchInput(BaseInput):
+  """Prefetches the batches of a child input on a background thread.
+
+  A background thread calls get_next() of the child input, pads the batches
+  with `batch_padding_size` like BaseInput.get_next_padded() and keeps up to
+  `prefetch_depth` ready batches in a queue, in the order they are produced by
+  the child. get_next() returns the unpadded batches and get_next_padded() the
+  padded ones; the latter is overridden so that the padding is done on the
+  background thread too, hence overriding get_next_padded() in the child has
+  no effect. Once reshard_for_spmd() has been called, the background thread
+  also reshards the following batches with the same mesh and partition specs,
+  so that the device transfer overlaps with the training step too, and
+  reshard_for_spmd() returns the prefetched device arrays.
+
+  Exceptions raised by the child, e.g. tf.errors.OutOfRangeError at the end of
+  an eval epoch, are raised by get_next() in order, after the batches produced
+  before them. reset() stops the background thread, discards the prefetched
+  batches and resets the child, which is then read again from the start.
+
+  Attributes:
+    input_tpl: Parameterization of the child input. Sharding, eval and padding
+      attributes are overridden to match this input.
+    prefetch_depth: Max number of batches prefetched.
+    prefetch_to_device: Whether to reshard the prefetched batches on the
+      background thread, once the mesh and partition specs are known.
+  """
+
+  _VALIDATE_BATCH_SIZE_NOT_NONE = False  # Set on the child input.
+
+  input_tpl: Optional[pax_fiddle.Config[BaseInput]] = None
+  prefetch_depth: int = 2
+  prefetch_to_device: bool = True
+  _input: Any = dataclasses.field(init=False, repr=False)
+  _queue: Any = dataclasses.field(init=False, repr=False)
+  _thread: Any = dataclasses.field(init=False, repr=False)
+  _stop: Any = dataclasses.field(init=False, repr=False)
+  _lock: Any = dataclasses.field(init=False, repr=False)
+  _reshard_args: Any = dataclasses.field(init=False, repr=False)
+  _last_batch: Any = dataclasses.field(init=False, repr=False)
+
+  def __post_init__(self):
+    if self.input_tpl is None:
+      raise ValueError('Need to define input_tpl.')
+    if self.prefetch_depth < 1:
+      raise ValueError(
+          f'prefetch_depth must be >= 1, got {self.prefetch_depth}.')
+    super().__post_init__()
+    input_p = self.input_tpl.clone()
+    # Overriding params for the child to match parent.
+    input_p.num_infeed_hosts = self.num_infeed_hosts
+    input_p.infeed_host_index = self.infeed_host_index
+    input_p.is_training = self.is_training
+    input_p.reset_for_eval = self.reset_for_eval
+    input_p.eval_loop_num_batches = self.eval_loop_num_batches
+    input_p.batch_padding_size = self.batch_padding_size
+    input_p.custom_device_order = self.custom_device_order
+    input_p.name = self.name
+    self._input = instantiate(input_p)
+    self.batch_size = self._input.batch_size
+    self._queue = None
+    self._thread = None
+    self._stop = None
+    self._lock = threading.Lock()
+    self._reshard_args = None
+    self._last_batch = None
+
+  @classmethod
+  def get_batch_size(cls, hparams: pax_fiddle.Config[PrefetchInput]) -> int:
+    assert hparams.input_tpl is not None
+    return hparams.input_tpl.cls.get_batch_size(hparams.input_tpl)
+
+  def _produce(self, batches: queue.Queue, stop: threading.Event) -> None:
+    """Runs on the background thread until stopped or the child raises."""
+
+    def _put(item) -> bool:
+      while not stop.is_set():
+        try:
+          batches.put(item, timeout=0.1)
+          return True
+        except queue.Full:
+          continue
+      return False
+
+    while not stop.is_set():
+      try:
+        batch = self._input.get_next()
+        padded_batch = self._pad_batch(batch)
+        with self._lock:
+          reshard_args = self._reshard_args
+        device_batch = None
+        if reshard_args is not None:
+          device_batch = self._input.reshard_for_spmd(
+              padded_batch, *reshard_args
+          )
+      except Exception as e:  # pylint: disable=broad-except
+        # Raised in order by the consumer.
+        _put((None, None, None, e))
+        return
+      if not _put((batch, padded_batch, device_batch, None)):
+        return
+
+  def _start(self) -> None:
+    self._queue = queue.Queue(maxsize=self.prefetch_depth)
+    self._stop = threading.Event()
+    self._thread = threading.Thread(
+        target=self._produce,
+        args=(self._queue, self._stop),
+        name=f'prefetch_{self.name}',
+        daemon=True,
+    )
+    self._thread.start()
+
+  def _shutdown(self) -> None:
+    if self._thread is None:
+      return
+    self._stop.set()
+    self._thread.join()
+    self._thread = None
+    self._queue = None
+
+  def get_next(self) -> NestedJTensor:
+    """Returns the next prefetched batch, without padding."""
+    if self._queue is None:
+      self._start()
+    batch, padded_batch, device_batch, error = self._queue.get()
+    if error is not None:
+      # The background thread stopped, it is restarted by the next call.
+      self._shutdown()
+      raise error
+    self._last_batch = (padded_batch, device_batch)
+    return batch
+
+  def get_next_padded(self) -> NestedJTensor:
+    """Returns the next prefetched batch, padded on the background thread."""
+    if self._peek is None:
+      self.get_next()
+      return self._last_batch[0]
+    peek = self._peek
+    self._peek = None
+    return peek
+
+  def get_child(self, input_name: str) -> NestedJTensor:
+    return self._input.get_child(input_name)
+
+  def reset(self) -> None:
+    self._shutdown()
+    self._peek = None
+    self._last_batch = None
+    self._input.reset()
+
+  def ids_to_strings(self,
+                     ids: pytypes.NpTensor,
+                     lengths: pytypes.NpTensor,
+                     key: Optional[str] = None) -> Sequence[str]:
+    return self._input.ids_to_strings(ids, lengths, key)
+
+  def reshard_for_pmap(self, arrays: NestedJTensor) -> NestedJTensor:
+    return self._input.reshard_for_pmap(arrays)
+
+  def reshard_for_spmd(self, arrays: NestedJTensor,
+                       global_mesh: jax.sharding.Mesh,
+                       pspecs: NestedPartitionSpec) -> NestedJTensor:
+    if self.prefetch_to_device:
+      with self._lock:
+        reshard_args = self._reshard_args
+        self._reshard_args = (global_mesh, pspecs)
+      if self._last_batch is not None:
+        batch, device_batch = self._last_batch
+        if (
+            batch is arrays
+            and device_batch is not None
+            and reshard_args is not None
+            and reshard_args[0] is global_mesh
+            and reshard_args[1] == pspecs
+        ):
+          return device_batch
+    return self._input.reshard_for_spmd(arrays, global_mesh, pspecs)
+
+
+class PackedSequenceInput(BaseInput):
+  """Packs the variable-length examples of a child input into fixed rows.
+
+  The child input returns batches of right-padded examples with `ids`,
+  `labels` and `paddings` of shape [child_batch_size, max_len]. The examples
+  are split from the child batches into a buffer of at least `lookahead`
+  examples, from which each row of `seq_len` tokens is filled:
+
+  - 'greedy': the examples are taken in order, skipping the ones which do not
+    fit in the remaining space of the row (first-fit).
+  - 'best_fit': the longest example that fits in the remaining space of the
+    row is taken, until none fits.
+
+  Examples longer than seq_len are split into several examples. Each returned
+  batch has `ids`, `labels`, `paddings`, `weights`, `segment_ids` (1-based
+  within each row, 0 for padding) and `segment_pos` of shape
+  [batch_size, seq_len], as expected by the packed inputs of TransformerLm.
+
+  When the child input raises tf.errors.OutOfRangeError or StopIteration, the
+  buffered examples are packed first, rows without examples being all padding,
+  and then the exception is raised until reset().
+
+  Attributes:
+    input_tpl: Parameterization of the child input. Sharding and eval
+      attributes are overridden to match this input.
+    seq_len: Length of the packed rows.
+    packing_method: 'greedy' or 'best_fit'.
+    lookahead: Min number of buffered examples when filling a row.
+  """
+
+  input_tpl: Optional[pax_fiddle.Config[BaseInput]] = None
+  seq_len: int = 0
+  packing_method: str = 'greedy'
+  lookahead: int = 64
+  _input: Any = dataclasses.field(init=False, repr=False)
+  _buffer: Any = dataclasses.field(init=False, repr=False)
+  _error: Any = dataclasses.field(init=False, repr=False)
+  _stats: Any = dataclasses.field(init=False, repr=False)
+
+  def __post_init__(self):
+    if self.input_tpl is None:
+      raise ValueError('Need to define input_tpl.')
+    if self.seq_len <= 0:
+      raise ValueError(f'seq_len must be > 0, got {self.seq_len}.')
+    if self.packing_method not in ('greedy', 'best_fit'):
+      raise ValueError(f'Unsupported packing_method: {self.packing_method}.')
+    super().__post_init__()
+    input_p = self.input_tpl.clone()
+    # Overriding params for the child to match parent.
+    input_p.num_infeed_hosts = self.num_infeed_hosts
+    input_p.infeed_host_index = self.infeed_host_index
+    input_p.is_training = self.is_training
+    input_p.reset_for_eval = self.reset_for_eval
+    input_p.eval_loop_num_batches = self.eval_loop_num_batches
+    input_p.name = self.name + '_unpacked'
+    self._input = instantiate(input_p)
+    self._buffer = []
+    self._error = None
+    self._stats = NestedMap(num_rows=0, num_examples=0, num_tokens=0)
+
+  def _fill_buffer(self) -> None:
+    """Reads child batches until `lookahead` examples are buffered."""
+    while len(self._buffer) < self.lookahead and self._error is None:
+      try:
+        batch = self._input.get_next()
+      except (tf.errors.OutOfRangeError, StopIteration) as e:
+        self._error = e
+        return
+      lengths = np.sum(1 - np.asarray(batch.paddings), axis=1).astype(np.int32)
+      for ids, labels, length in zip(batch.ids, batch.labels, lengths):
+        for start in range(0, length, self.seq_len):
+          end = min(start + self.seq_len, length)
+          self._buffer.append((ids[start:end], labels[start:end]))
+
+  def _pack_row(self) -> Sequence[Any]:
+    """Removes the examples of the next row from the buffer."""
+    row = []
+    remaining = self.seq_len
+    if self.packing_method == 'greedy':
+      unused = []
+      for example in self._buffer:
+        if len(example[0]) <= remaining:
+          row.append(example)
+          remaining -= len(example[0])
+        else:
+          unused.append(example)
+      self._buffer = unused
+      return row
+    while True:
+      best = None
+      for i, example in enumerate(self._buffer):
+        length = len(example[0])
+        if length <= remaining and (
+            best is None or length > len(self._buffer[best][0])
+        ):
+          best = i
+      if best is None:
+        return row
+      example = self._buffer.pop(best)
+      row.append(example)
+      remaining -= len(example[0])
+
+  def get_next(self) -> NestedJTensor:
+    rows = []
+    for _ in range(self.batch_size):
+      self._fill_buffer()
+      if not self._buffer:
+        break
+      rows.append(self._pack_row())
+    if not rows:
+      raise self._error
+
+    shape = [self.batch_size, self.seq_len]
+    ids = np.zeros(shape, dtype=np.int32)
+    labels = np.zeros(shape, dtype=np.int32)
+    segment_ids = np.zeros(shape, dtype=np.int32)
+    segment_pos = np.zeros(shape, dtype=np.int32)
+    for i, row in enumerate(rows):
+      start = 0
+      for segment, (example_ids, example_labels) in enumerate(row):
+        end = start + len(example_ids)
+        ids[i, start:end] = example_ids
+        labels[i, start:end] = example_labels
+        segment_ids[i, start:end] = segment + 1
+        segment_pos[i, start:end] = np.arange(end - start)
+        start = end
+      self._stats.num_examples += len(row)
+      self._stats.num_tokens += start
+    self._stats.num_rows += self.batch_size
+    paddings = (segment_ids == 0).astype(np.float32)
+    return NestedMap(
+        ids=ids,
+        labels=labels,
+        paddings=paddings,
+        weights=1.0 - paddings,
+        segment_ids=segment_ids,
+        segment_pos=segment_pos,
+    )
+
+  def packing_stats(self) -> NestedMap:
+    """Returns the packing statistics since the last reset().
+
+    Returns:
+      A NestedMap with the number of packed rows, examples and non-padding
+      tokens, and `efficiency`, the fraction of non-padding tokens.
+    """
+    stats = self._stats.DeepCopy()
+    num_slots = stats.num_rows * self.seq_len
+    stats.efficiency = stats.num_tokens / num_slots if num_slots else 0.0
+    return stats
+
+  def get_child(self, input_name: str) -> NestedJTensor:
+    return self._input.get_child(input_name)
+
+  def reset(self) -> None:
+    self._input.reset()
+    self._peek = None
+    self._buffer = []
+    self._error = None
+    self._stats = NestedMap(num_rows=0, num_examples=0, num_tokens=0)
+
+  def ids_to_strings(self,
+                     ids: pytypes.NpTensor,
+                     lengths: pytypes.NpTensor,
+                     key: Optional[str] = None) -> Sequence[str]:
+    return self._input.ids_to_strings(ids, lengths, key)
+
+
+def _fit_to_length(x: np.ndarray, length: int, pad_value: Any) -> np.ndarray:
+  """Truncates or pads the leading dim of x to length."""
+  x = x[:length]
+  return np.pad(
+      x,
+      [[0, length - x.shape[0]]] + [[0, 0]] * (x.ndim - 1),
+      constant_values=pad_value,
+  )
+
+
+class BucketedSequenceInput(BaseInput):
+  """Batches the examples of a child input by sequence length buckets.
+
+  The child input returns batches of right-padded examples with `paddings` of
+  shape [child_batch_size, max_len]. Each example goes to the shortest bucket
+  of `bucket_seq_lens` not shorter than it (or the longest bucket, truncating
+  it), and a batch is returned as soon as a bucket has enough examples. The
+  `paddings` and the `time_dim_keys` fields of an example are truncated or
+  padded to the bucket length when it is added to the bucket, so max_len may
+  vary across child batches.
+
+  The batch size of each bucket defaults to keep the number of tokens per
+  batch roughly constant: batch_size for the longest bucket and proportionally
+  more for shorter ones, rounded down to a multiple of batch_size_multiple but
+  at least batch_size_multiple.
+  get_bucket_shapes() returns the [batch_size, seq_len] of each bucket, e.g. to
+  compile the step function once per bucket, and get_bucket_index() the bucket
+  of a batch.
+
+  When the child input raises tf.errors.OutOfRangeError or StopIteration, the
+  incomplete buckets are returned first, padded with empty examples (all
+  paddings), and then the exception is raised until reset(). The batches have
+  an `eval_sample_weights` field, 0.0 for the padded examples.
+
+  The hosts would return batches of different buckets at the same step, so only
+  a single infeed host is supported.
+
+  Attributes:
+    input_tpl: Parameterization of the child input. Sharding and eval
+      attributes are overridden to match this input.
+    bucket_seq_lens: Increasing sequence lengths of the buckets.
+    bucket_batch_sizes: Optional batch size of each bucket.
+    batch_size_multiple: Multiple of the default bucket batch sizes, e.g. the
+      number of devices.
+    time_dim_keys: Flattened keys (see NestedMap.FlattenItems()) of the fields
+      besides `paddings` with a time dim, i.e. of shape [child_batch_size,
+      max_len, ...]. The other fields are batched as is.
+  """
+
+  input_tpl: Optional[pax_fiddle.Config[BaseInput]] = None
+  bucket_seq_lens: Sequence[int] = ()
+  bucket_batch_sizes: Optional[Sequence[int]] = None
+  batch_size_multiple: int = 1
+  time_dim_keys: Sequence[str] = ()
+  _input: Any = dataclasses.field(init=False, repr=False)
+  _batch_sizes: Any = dataclasses.field(init=False, repr=False)
+  _buckets: Any = dataclasses.field(init=False, repr=False)
+  _error: Any = dataclasses.field(init=False, repr=False)
+
+  def __post_init__(self):
+    if self.input_tpl is None:
+      raise ValueError('Need to define input_tpl.')
+    if not self.bucket_seq_lens or list(self.bucket_seq_lens) != sorted(
+        set(self.bucket_seq_lens)):
+      raise ValueError(
+          f'bucket_seq_lens must be increasing, got {self.bucket_seq_lens}.')
+    super().__post_init__()
+    if self.num_infeed_hosts > 1:
+      raise NotImplementedError(
+          'BucketedSequenceInput does not support multiple infeed hosts.')
+    if self.bucket_batch_sizes is not None:
+      if len(self.bucket_batch_sizes) != len(self.bucket_seq_lens):
+        raise ValueError(
+            'bucket_batch_sizes and bucket_seq_lens must have the same length.')
+      self._batch_sizes = list(self.bucket_batch_sizes)
+    else:
+      max_tokens = self.batch_size * self.bucket_seq_lens[-1]
+      multiple = self.batch_size_multiple
+      self._batch_sizes = [
+          max(max_tokens // seq_len // multiple, 1) * multiple
+          for seq_len in self.bucket_seq_lens
+      ]
+    input_p = self.input_tpl.clone()
+    # Overriding params for the child to match parent.
+    input_p.num_infeed_hosts = self.num_infeed_hosts
+    input_p.infeed_host_index = self.infeed_host_index
+    input_p.is_training = self.is_training
+    input_p.reset_for_eval = self.reset_for_eval
+    input_p.eval_loop_num_batches = self.eval_loop_num_batches
+    input_p.name = self.name + '_unbucketed'
+    self._input = instantiate(input_p)
+    self._buckets = [[] for _ in self.bucket_seq_lens]
+    self._error = None
+
+  def get_bucket_shapes(self) -> Sequence[Sequence[int]]:
+    """Returns the [batch_size, seq_len] of the batches of each bucket."""
+    return [
+        [batch_size, seq_len]
+        for batch_size, seq_len in zip(self._batch_sizes, self.bucket_seq_lens)
+    ]
+
+  def get_bucket_index(self, batch: NestedJTensor) -> int:
+    """Returns the bucket of a batch returned by get_next()."""
+    return self.get_bucket_shapes().index(list(batch.paddings.shape))
+
+  def _read_child_batch(self) -> None:
+    try:
+      batch = self._input.get_next()
+    except (tf.errors.OutOfRangeError, StopIteration) as e:
+      self._error = e
+      return
+    lengths = np.sum(1 - np.asarray(batch.paddings), axis=1).astype(np.int32)
+    buckets = np.minimum(
+        np.searchsorted(self.bucket_seq_lens, lengths),
+        len(self.bucket_seq_lens) - 1)
+    for i, bucket in enumerate(buckets):
+      example = jax.tree_util.tree_map(lambda x, i=i: np.asarray(x)[i], batch)
+      seq_len = self.bucket_seq_lens[bucket]
+      example.paddings = _fit_to_length(example.paddings, seq_len, 1)
+      for key in self.time_dim_keys:
+        example.Set(key, _fit_to_length(example.GetItem(key), seq_len, 0))
+      self._buckets[bucket].append(example)
+
+  def _make_batch(self, bucket: int) -> NestedMap:
+    """Removes the examples of a batch of the given bucket."""
+    batch_size = self._batch_sizes[bucket]
+    examples = self._buckets[bucket][:batch_size]
+    self._buckets[bucket] = self._buckets[bucket][batch_size:]
+    num_padded = batch_size - len(examples)
+
+    def _batch_field(*xs):
+      x = np.stack(xs)
+      return np.pad(x, [[0, num_padded]] + [[0, 0]] * (x.ndim - 1))
+
+    batch = jax.tree_util.tree_map(_batch_field, *examples)
+    valid = np.arange(batch_size) < len(examples)
+    batch.paddings = np.where(valid[:, np.newaxis], batch.paddings,
+                              1).astype(batch.paddings.dtype)
+    batch.eval_sample_weights = valid.astype(np.float32)
+    return batch
+
+  def get_next(self) -> NestedJTensor:
+    while True:
+      for bucket, examples in enumerate(self._buckets):
+        if len(examples) >= self._batch_sizes[bucket]:
+          return self._make_batch(bucket)
+      if self._error is not None:
+        for bucket, examples in enumerate(self._buckets):
+          if examples:
+            return self._make_batch(bucket)
+        raise self._error
+      self._read_child_batch()
+
+  def get_child(self, input_name: str) -> NestedJTensor:
+    return self._input.get_child(input_name)
+
+  def reset(self) -> None:
+    self._input.reset()
+    self._peek = None
+    self._buckets = [[] for _ in self.bucket_seq_lens]
+    self._error = None
+
+  def ids_to_strings(self,
+                     ids: pytypes.NpTensor,
+                     lengths: pytypes.NpTensor,
+                     key: Optional[str] = None) -> Sequence[str]:
+    return self._input.ids_to_strings(ids, lengths, key)
+
+
+class MemmapNumpyInput(BaseInput):
+  """Reads pre-tokenized examples from memory-mapped numpy files.
+
+  Each field of the examples is stored in a list of .npy shards, e.g.
+  {'ids': '/data/ids-*.npy', 'labels': '/data/labels-*.npy'}. The sorted shards
+  of all fields must have the same number of rows, the i-th row of every field
+  being the same example. The shards are memory-mapped, so that only the rows
+  of each batch are read, and no tf.data graph is built.
+
+  Each epoch reads the examples in the order of a permutation seeded by
+  input_random_seed and the epoch (or in file order if shuffle is False), the
+  i-th host reading every num_infeed_hosts-th example of it, so that the hosts
+  read disjoint examples and the same number of batches. The rows of a batch
+  are gathered from the shards on `num_threads` threads, each copying a chunk
+  of the rows of every field. A batch of consecutive rows of a single shard is
+  a view of the memory-mapped shard.
+
+  The read position (epoch and example index) is saved by save() and restored
+  by restore(), so that training resumes from the next batch.
+
+  Attributes:
+    file_patterns: Dict from field names to glob patterns of the .npy shards.
+    shuffle: Whether to shuffle the examples at every epoch.
+    num_epochs: Number of epochs to read before raising StopIteration, or None
+      to repeat forever. Set to 1 if reset_for_eval.
+    drop_remainder: Whether to drop the last incomplete batch of each epoch.
+      Otherwise it is padded with zeros and the batches have an
+      `eval_sample_weights` field, 0.0 for the padded examples.
+    num_threads: Number of threads gathering the rows of a batch. The threads
+      are shut down by reset(), and restarted by the next get_next().
+  """
+
+  file_patterns: Optional[Dict[str, str]] = None
+  shuffle: bool = True
+  num_epochs: Optional[int] = None
+  drop_remainder: bool = True
+  num_threads: int = 4
+  _arrays: Any = dataclasses.field(init=False, repr=False)
+  _offsets: Any = dataclasses.field(init=False, repr=False)
+  _order: Any = dataclasses.field(init=False, repr=False)
+  _epoch: int = dataclasses.field(init=False, repr=False)
+  _position: int = dataclasses.field(init=False, repr=False)
+  _peek_state: Any = dataclasses.field(init=False, repr=False)
+  _executor: Any = dataclasses.field(init=False, repr=False)
+
+  def __post_init__(self):
+    super().__post_init__()
+    if not self.file_patterns:
+      raise ValueError('Need to define file_patterns.')
+    self._arrays = {}
+    num_rows = None
+    for field, pattern in self.file_patterns.items():
+      files = sorted(glob.glob(pattern))
+      if not files:
+        raise ValueError(f'No file matches {pattern} for field {field}.')
+      arrays = [np.load(f, mmap_mode='r') for f in files]
+      field_num_rows = [a.shape[0] for a in arrays]
+      if num_rows is None:
+        num_rows = field_num_rows
+      elif field_num_rows != num_rows:
+        raise ValueError(
+            f'The shards of field {field} have {field_num_rows} rows, '
+            f'expected {num_rows}.')
+      self._arrays[field] = arrays
+    self._offsets = np.cumsum([0] + num_rows)
+    if self._offsets[-1] < self.num_infeed_hosts:
+      raise ValueError(
+          f'{self._offsets[-1]} examples can not be sharded across '
+          f'{self.num_infeed_hosts} hosts.')
+    self._order = None
+    self._epoch = 0
+    self._position = 0
+    self._peek_state = None
+    self._executor = None
+
+  def _host_order(self, epoch: int) -> np.ndarray:
+    """Returns the examples read by this host in the given epoch."""
+    num_examples = int(self._offsets[-1])
+    if self.shuffle:
+      seed = self.input_random_seed or 0
+      order = np.random.default_rng([seed, epoch]).permutation(num_examples)
+    else:
+      order = np.arange(num_examples)
+    num_host_examples = num_examples // self.num_infeed_hosts
+    return order[self.infeed_host_index::self.num_infeed_hosts][
+        :num_host_examples]
+
+  def _gather_rows(
+      self,
+      field: str,
+      shards: np.ndarray,
+      rows: np.ndarray,
+      out: np.ndarray,
+      positions: np.ndarray,
+  ) -> None:
+    """Copies the given rows of a field to out[positions]."""
+    arrays = self._arrays[field]
+    for shard in np.unique(shards):
+      (selected,) = np.nonzero(shards == shard)
+      # Reads the rows of a shard in increasing order.
+      selected = selected[np.argsort(rows[selected])]
+      out[positions[selected]] = arrays[shard][rows[selected]]
+
+  def get_next(self) -> NestedJTensor:
+    while True:
+      if self._order is None:
+        self._order = self._host_order(self._epoch)
+      remaining = len(self._order) - self._position
+      if remaining >= self.batch_size or (
+          remaining > 0 and not self.drop_remainder):
+        break
+      num_epochs = 1 if self.reset_for_eval else self.num_epochs
+      if num_epochs is not None and self._epoch + 1 >= num_epochs:
+        raise StopIteration
+      self._epoch += 1
+      self._position = 0
+      self._order = None
+
+    indices = self._order[self._position:self._position + self.batch_size]
+    self._position += len(indices)
+    if self._executor is None:
+      self._executor = futures.ThreadPoolExecutor(
+          max_workers=self.num_threads,
+          thread_name_prefix=f'memmap_{self.name}')
+    shards = np.searchsorted(self._offsets, indices, side='right') - 1
+    rows = indices - self._offsets[shards]
+    batch = NestedMap()
+    if shards[0] == shards[-1] and np.all(np.diff(rows) == 1):
+      # Consecutive rows of a single shard are views of the shard.
+      for field, arrays in self._arrays.items():
+        batch[field] = arrays[shards[0]][rows[0]:rows[-1] + 1]
+    else:
+      # Each field is gathered in `num_threads` chunks of rows.
+      chunks = [
+          c for c in np.array_split(np.arange(len(indices)), self.num_threads)
+          if c.size
+      ]
+      pending = []
+      for field, arrays in self._arrays.items():
+        batch[field] = np.empty(
+            (len(indices),) + arrays[0].shape[1:], dtype=arrays[0].dtype)
+        for chunk in chunks:
+          pending.append(
+              self._executor.submit(
+                  self._gather_rows,
+                  field,
+                  shards[chunk],
+                  rows[chunk],
+                  batch[field],
+                  chunk,
+              )
+          )
+      for future in pending:
+        future.result()
+    if not self.drop_remainder:
+      num_padded = self.batch_size - len(indices)
+      batch = jax.tree_util.tree_map(
+          lambda x: np.pad(x, [[0, num_padded]] + [[0, 0]] * (x.ndim - 1)),
+          batch,
+      )
+      batch.eval_sample_weights = np.pad(
+          np.ones([len(indices)], dtype=np.float32), [[0, num_padded]])
+    return batch
+
+  def peek_padded(self) -> Optional[NestedJTensor]:
+    if self._peek is None:
+      # Position of the peeked batch, for save().
+      self._peek_state = (self._epoch, self._position)
+    return super().peek_padded()
+
+  def _shutdown_executor(self) -> None:
+    if self._executor is None:
+      return
+    self._executor.shutdown()
+    self._executor = None
+
+  def reset(self) -> None:
+    self._shutdown_executor()
+    self._peek = None
+    self._order = None
+    self._epoch = 0
+    self._position = 0
+
+  def __del__(self):
+    # The executor is not set if __post_init__() failed.
+    if getattr(self, '_executor', None) is not None:
+      self._executor.shutdown(wait=False)
+
+  def save(self, checkpoint_path: Any):
+    """Saves the position of the next batch to a json file."""
+    epoch, position = self._epoch, self._position
+    if self._peek is not None:
+      epoch, position = self._peek_state
+    state = dict(
+        epoch=epoch,
+        position=position,
+        num_infeed_hosts=self.num_infeed_hosts,
+        infeed_host_index=self.infeed_host_index,
+    )
+    with tf.io.gfile.GFile(checkpoint_path, 'w') as f:
+      json.dump(state, f)
+
+  def restore(self, checkpoint_path: Any):
+    """Restores the position saved by save()."""
+    with tf.io.gfile.GFile(checkpoint_path) as f:
+      state = json.load(f)
+    if (state['num_infeed_hosts'], state['infeed_host_index']) != (
+        self.num_infeed_hosts, self.infeed_host_index):
+      raise ValueError(
+          f'Checkpoint {checkpoint_path} was saved by host '
+          f'{state["infeed_host_index"]} of {state["num_infeed_hosts"]}, '
+          f'restoring host {self.infeed_host_index} of '
+          f'{self.num_infeed_hosts}.')
+    self._peek = None
+    self._order = None
+    self._epoch = state['epoch']
+    self._position = state['position']
+
+
 class BaseInputSpecsProvider(
     base_hyperparams.FiddleBaseParameterizable, metaclass=abc.ABCMeta
 ):
@@ -17,11 +17,13 @@
 
 import dataclasses
 import os
-from typing import Any
+import threading
+from typing import Any, Optional
 
 from absl import flags
 from absl.testing import absltest
 import fiddle as fdl
+import jax
 from lingvo.core import base_input_generator
 from lingvo.core import generic_input
 from lingvo.core import py_utils as tf_py_utils
@@ -101,6 +103,60 @@ class LingvoInput(base_input_generator.BaseInputGeneratorFromFiles):
     return inputs
 
 
+class VariableLengthInput(base_input.BaseInput):
+  """Returns batches of examples with the given lengths, then raises.
+
+  The batches have max_len steps, or as many as their longest example if
+  trim_batches.
+  """
+  lengths: Any = None
+  max_len: int = 8
+  trim_batches: bool = False
+  _index: int = dataclasses.field(init=False, repr=False, default=0)
+
+  def get_next(self) -> py_utils.NestedMap:
+    if self._index >= len(self.lengths):
+      raise StopIteration
+    lengths = self.lengths[self._index:self._index + self.batch_size]
+    self._index += self.batch_size
+    max_len = max(lengths) if self.trim_batches else self.max_len
+    ids = np.zeros([len(lengths), max_len], dtype=np.int32)
+    paddings = np.ones([len(lengths), max_len], dtype=np.float32)
+    for i, length in enumerate(lengths):
+      # Example ids are 10 * length + position.
+      ids[i, :length] = 10 * length + np.arange(length)
+      paddings[i, :length] = 0.0
+    return py_utils.NestedMap(ids=ids, labels=ids + 1, paddings=paddings)
+
+  def reset(self) -> None:
+    self._index = 0
+
+
+# Waited on by the children of test_multi_input_parallel_fetch, which times
+# out unless both children are fetched at the same time.
+_FETCH_BARRIER = threading.Barrier(2, timeout=10)
+
+
+class CountingInput(base_input.BaseInput):
+  """Returns batches of consecutive counts."""
+  wait_for_barrier: bool = False
+  num_batches: Optional[int] = None
+  _index: int = dataclasses.field(init=False, repr=False, default=0)
+
+  def get_next(self) -> py_utils.NestedMap:
+    if self.num_batches is not None and self._index >= self.num_batches:
+      raise StopIteration
+    if self.wait_for_barrier:
+      _FETCH_BARRIER.wait()
+    start = self._index * self.batch_size
+    self._index += 1
+    return py_utils.NestedMap(
+        num=np.arange(start, start + self.batch_size, dtype=np.int32))
+
+  def reset(self) -> None:
+    self._index = 0
+
+
 def _get_test_dataset(num: int) -> tf.data.Dataset:
 
   def to_map(i: int):
@@ -707,5 +763,367 @@ class InputTest(test_utils.TestCase):
     # Batch size should be greatest common factor of children batch sizes.
     self.assertEqual(multi_bs, 2)
 
+  def test_prefetch_input(self):
+    p = TestInput.HParams(batch_size=2, input_random_seed=345)
+    expected = instantiate(p)
+    prefetch_p = base_input.PrefetchInput.HParams(
+        input_tpl=p.clone(), prefetch_depth=3)
+    self.assertEqual(base_input.PrefetchInput.get_batch_size(prefetch_p), 2)
+    inp = instantiate(prefetch_p)
+    self.assertEqual(inp.batch_size, 2)
+    for i in range(10):
+      if i % 3 == 0:
+        peeked = inp.peek_padded()
+        batch = inp.get_next_padded()
+        self.assertIs(batch, peeked)
+      else:
+        batch = inp.get_next_padded()
+      self.assertArraysEqual(batch.data, expected.get_next().data)
+
+  def test_prefetch_input_eval(self):
+    p = TestInput.HParams(batch_size=2, input_random_seed=345)
+    prefetch_p = base_input.PrefetchInput.HParams(
+        input_tpl=p, reset_for_eval=True, batch_padding_size=1)
+    inp = instantiate(prefetch_p)
+    for _ in range(2):
+      batches = [inp.get_next_padded() for _ in range(2)]
+      for batch in batches:
+        self.assertEqual(batch.data.shape, (3, 4))
+        self.assertArraysEqual(batch.data[2], np.zeros([4], np.int32))
+      with self.assertRaisesRegex(tf.errors.OutOfRangeError, 'End of sequence'):
+        inp.get_next_padded()
+      # The input is still out of range until reset.
+      with self.assertRaisesRegex(tf.errors.OutOfRangeError, 'End of sequence'):
+        inp.get_next_padded()
+      inp.reset()
+
+  def test_prefetch_input_padding(self):
+    p = TestInput.HParams(batch_size=2, input_random_seed=345)
+    expected = instantiate(p)
+    inp = instantiate(
+        base_input.PrefetchInput.HParams(input_tpl=p, batch_padding_size=1)
+    )
+    # get_next() does not pad, as for other inputs.
+    batch = inp.get_next()
+    self.assertEqual(batch.data.shape, (2, 4))
+    self.assertArraysEqual(batch.data, expected.get_next().data)
+    padded = inp.get_next_padded()
+    self.assertEqual(padded.data.shape, (3, 4))
+    self.assertArraysEqual(padded.data[:2], expected.get_next().data)
+    self.assertArraysEqual(padded.data[2], np.zeros([4], np.int32))
+
+  def test_prefetch_input_reshard_for_spmd(self):
+    p = TestInput.HParams(batch_size=2, input_random_seed=345)
+    inp = instantiate(base_input.PrefetchInput.HParams(input_tpl=p))
+    global_mesh = jax.sharding.Mesh(np.array(jax.devices()[:1]), ('data',))
+    pspecs = py_utils.NestedMap(data=jax.sharding.PartitionSpec('data'))
+    for _ in range(4):
+      batch = inp.get_next_padded()
+      device_batch = inp.reshard_for_spmd(batch, global_mesh, pspecs)
+      self.assertIsInstance(device_batch.data, jax.Array)
+      self.assertArraysEqual(np.asarray(device_batch.data), batch.data)
+    # Batches produced after the first resharding are resharded in advance.
+    self.assertIsNotNone(inp._last_batch[1])
+
+  def _packed_rows(self, batch):
+    """Returns the lengths of the examples of each row of a packed batch."""
+    rows = []
+    for segment_ids in batch.segment_ids:
+      rows.append([
+          int(np.sum(segment_ids == i))
+          for i in range(1, np.max(segment_ids) + 1)
+      ])
+    return rows
+
+  def test_packed_sequence_input(self):
+    child_p = VariableLengthInput.HParams(
+        batch_size=2, lengths=[5, 3, 4, 2, 6, 1, 8, 2])
+    p = base_input.PackedSequenceInput.HParams(
+        input_tpl=child_p, batch_size=2, seq_len=8, lookahead=4)
+    inp = instantiate(p)
+
+    batch = inp.get_next_padded()
+    self.assertEqual(self._packed_rows(batch), [[5, 3], [4, 2, 1]])
+    self.assertArraysEqual(batch.ids[0],
+                            np.array([50, 51, 52, 53, 54, 30, 31, 32], np.int32))
+    self.assertArraysEqual(batch.labels[0], batch.ids[0] + 1)
+    self.assertArraysEqual(batch.segment_ids[1],
+                            np.array([1, 1, 1, 1, 2, 2, 3, 0], np.int32))
+    self.assertArraysEqual(batch.segment_pos[1],
+                            np.array([0, 1, 2, 3, 0, 1, 0, 0], np.int32))
+    self.assertArraysEqual(batch.paddings[1],
+                            np.array([0, 0, 0, 0, 0, 0, 0, 1], np.float32))
+    self.assertArraysEqual(batch.weights, 1.0 - batch.paddings)
+
+    batch = inp.get_next_padded()
+    self.assertEqual(self._packed_rows(batch), [[6, 2], [8]])
+    # The remaining rows are empty once all examples are packed.
+    with self.assertRaises(StopIteration):
+      inp.get_next_padded()
+    with self.assertRaises(StopIteration):
+      inp.get_next_padded()
+
+    stats = inp.packing_stats()
+    self.assertEqual(stats.num_rows, 4)
+    self.assertEqual(stats.num_examples, 8)
+    self.assertEqual(stats.num_tokens, 31)
+    self.assertAllClose(stats.efficiency, 31 / 32)
+
+    inp.reset()
+    self.assertEqual(inp.packing_stats().num_rows, 0)
+    batch = inp.get_next_padded()
+    self.assertEqual(self._packed_rows(batch), [[5, 3], [4, 2, 1]])
+
+  def test_packed_sequence_input_best_fit(self):
+    child_p = VariableLengthInput.HParams(
+        batch_size=4, lengths=[3, 2, 7, 1, 5, 4, 6])
+    p = base_input.PackedSequenceInput.HParams(
+        input_tpl=child_p,
+        batch_size=2,
+        seq_len=8,
+        lookahead=8,
+        packing_method='best_fit')
+    inp = instantiate(p)
+    batch = inp.get_next_padded()
+    self.assertEqual(self._packed_rows(batch), [[7, 1], [6, 2]])
+    batch = inp.get_next_padded()
+    # The last row is all padding.
+    self.assertEqual(self._packed_rows(batch), [[5, 3], [4]])
+    with self.assertRaises(StopIteration):
+      inp.get_next_padded()
+
+  def test_packed_sequence_input_splits_long_examples(self):
+    child_p = VariableLengthInput.HParams(
+        batch_size=1, lengths=[7], max_len=8)
+    p = base_input.PackedSequenceInput.HParams(
+        input_tpl=child_p, batch_size=2, seq_len=4)
+    inp = instantiate(p)
+    batch = inp.get_next_padded()
+    self.assertEqual(self._packed_rows(batch), [[4], [3]])
+    self.assertArraysEqual(batch.ids[1], np.array([74, 75, 76, 0], np.int32))
+    self.assertArraysEqual(batch.segment_pos[1], np.array([0, 1, 2, 0], np.int32))
+
+  def _write_shards(self, name, num_rows_per_shard):
+    """Writes ids (example index) and labels shards, returns their patterns."""
+    tmp_dir = os.path.join(FLAGS.test_tmpdir, name)
+    os.makedirs(tmp_dir, exist_ok=True)
+    start = 0
+    for shard, num_rows in enumerate(num_rows_per_shard):
+      ids = np.arange(start, start + num_rows, dtype=np.int32)
+      ids = np.tile(ids[:, np.newaxis], [1, 3])
+      np.save(os.path.join(tmp_dir, f'ids-{shard:05d}.npy'), ids)
+      np.save(os.path.join(tmp_dir, f'labels-{shard:05d}.npy'), ids + 1)
+      start += num_rows
+    return {
+        'ids': os.path.join(tmp_dir, 'ids-*.npy'),
+        'labels': os.path.join(tmp_dir, 'labels-*.npy'),
+    }
+
+  def test_memmap_numpy_input(self):
+    p = base_input.MemmapNumpyInput.HParams(
+        file_patterns=self._write_shards('memmap', [5, 3, 4]),
+        batch_size=2,
+        num_infeed_hosts=2,
+        shuffle=False,
+        num_epochs=1)
+    host_ids = []
+    for i in range(2):
+      inp = instantiate(p.clone().set(infeed_host_index=i))
+      ids = []
+      for _ in range(3):
+        batch = inp.get_next()
+        self.assertArraysEqual(batch.labels, batch.ids + 1)
+        ids.extend(batch.ids[:, 0])
+      with self.assertRaises(StopIteration):
+        inp.get_next()
+      host_ids.append(ids)
+    self.assertEqual(host_ids, [[0, 2, 4, 6, 8, 10], [1, 3, 5, 7, 9, 11]])
+
+  def test_memmap_numpy_input_shuffle(self):
+    p = base_input.MemmapNumpyInput.HParams(
+        file_patterns=self._write_shards('memmap_shuffle', [5, 3, 4]),
+        batch_size=4,
+        input_random_seed=1234)
+    inp = instantiate(p)
+    epochs = [
+        np.concatenate([inp.get_next().ids[:, 0] for _ in range(3)])
+        for _ in range(2)
+    ]
+    for epoch in epochs:
+      self.assertCountEqual(epoch, range(12))
+    self.assertNotEqual(list(epochs[0]), list(epochs[1]))
+    # The order is deterministic.
+    inp2 = instantiate(p)
+    self.assertArraysEqual(inp2.get_next().ids[:, 0], epochs[0][:4])
+
+  def test_memmap_numpy_input_eval(self):
+    p = base_input.MemmapNumpyInput.HParams(
+        file_patterns=self._write_shards('memmap_eval', [5]),
+        batch_size=2,
+        shuffle=False,
+        reset_for_eval=True,
+        drop_remainder=False)
+    inp = instantiate(p)
+    for _ in range(2):
+      batches = [inp.get_next_padded() for _ in range(3)]
+      with self.assertRaises(StopIteration):
+        inp.get_next_padded()
+      self.assertArraysEqual(batches[2].ids[:, 0], np.array([4, 0], np.int32))
+      self.assertArraysEqual(batches[2].eval_sample_weights,
+                             np.array([1.0, 0.0], np.float32))
+      inp.reset()
+
+  def test_memmap_numpy_input_save_restore(self):
+    p = base_input.MemmapNumpyInput.HParams(
+        file_patterns=self._write_shards('memmap_ckpt', [5, 3, 4]),
+        batch_size=3,
+        input_random_seed=1234)
+    inp = instantiate(p)
+    for _ in range(5):
+      inp.get_next()
+    peeked = inp.peek_padded()
+    checkpoint_path = os.path.join(FLAGS.test_tmpdir, 'memmap_ckpt.json')
+    inp.save(checkpoint_path)
+    expected = [inp.get_next_padded().ids for _ in range(4)]
+    self.assertIs(expected[0], peeked.ids)
+
+    restored = instantiate(p)
+    restored.restore(checkpoint_path)
+    for ids in expected:
+      self.assertArraysEqual(restored.get_next_padded().ids, ids)
+
+    with self.assertRaisesRegex(ValueError, 'was saved by host 0 of 1'):
+      instantiate(p.clone().set(num_infeed_hosts=2)).restore(checkpoint_path)
+
+  def test_multi_input_parallel_fetch(self):
+    inputs = {
+        'input_1': CountingInput.HParams(batch_size=2, wait_for_barrier=True),
+        'input_2': CountingInput.HParams(batch_size=4, wait_for_barrier=True),
+    }
+    multi_p = base_input.MultiInput.HParams(
+        input_to_params=inputs, parallel_fetch=True)
+    inp = instantiate(multi_p)
+    for i in range(3):
+      # The children are fetched concurrently, or they would time out on the
+      # barrier.
+      batch = inp.get_next()
+      self.assertArraysEqual(
+          batch.input_1.num, np.array([[2 * i], [2 * i + 1]], np.int32))
+      self.assertArraysEqual(
+          batch.input_2.num,
+          np.array([[4 * i, 4 * i + 1], [4 * i + 2, 4 * i + 3]], np.int32))
+    metrics = inp.fetch_latency_metrics()
+    self.assertCountEqual(
+        metrics,
+        ['fetch_latency_secs/input_1', 'fetch_latency_secs/input_2'])
+    self.assertGreaterEqual(metrics['fetch_latency_secs/input_1'], 0.0)
+
+    # reset() shuts the thread pool down, a new one is started by get_next().
+    executor = inp._executor
+    inp.reset()
+    self.assertIsNone(inp._executor)
+    with self.assertRaises(RuntimeError):
+      executor.submit(lambda: None)
+    batch = inp.get_next()
+    self.assertArraysEqual(
+        batch.input_1.num, np.array([[0], [1]], np.int32))
+
+  def test_multi_input_prefetch(self):
+    inputs = {
+        'input_1': CountingInput.HParams(batch_size=2, num_batches=3),
+    }
+    multi_p = base_input.MultiInput.HParams(
+        input_to_params=inputs,
+        input_to_prefetch_depth={'input_1': 2},
+        parallel_fetch=True,
+        reset_for_eval=True)
+    inp = instantiate(multi_p)
+    self.assertIsInstance(inp.get_child('input_1'), base_input.PrefetchInput)
+    for _ in range(2):
+      for i in range(3):
+        batch = inp.get_next()
+        self.assertArraysEqual(
+            batch.input_1.num, np.array([[2 * i], [2 * i + 1]], np.int32))
+      with self.assertRaises(StopIteration):
+        inp.get_next()
+      inp.reset()
+
+    with self.assertRaisesRegex(ValueError, 'Unknown input'):
+      instantiate(
+          base_input.MultiInput.HParams(
+              input_to_params=inputs,
+              input_to_prefetch_depth={'input_2': 2}))
+
+  def test_bucketed_sequence_input(self):
+    child_p = VariableLengthInput.HParams(
+        batch_size=2, lengths=[2, 7, 3, 1, 8, 4, 2, 5])
+    p = base_input.BucketedSequenceInput.HParams(
+        input_tpl=child_p, batch_size=1, bucket_seq_lens=[4, 8],
+        time_dim_keys=['ids', 'labels'], reset_for_eval=True)
+    inp = instantiate(p)
+    self.assertEqual(inp.get_bucket_shapes(), [[2, 4], [1, 8]])
+
+    batch = inp.get_next_padded()
+    self.assertEqual(inp.get_bucket_index(batch), 1)
+    self.assertArraysEqual(
+        batch.ids[0], np.array([70, 71, 72, 73, 74, 75, 76, 0], np.int32))
+    batch = inp.get_next_padded()
+    self.assertEqual(inp.get_bucket_index(batch), 0)
+    self.assertEqual(batch.ids.shape, (2, 4))
+    self.assertArraysEqual(batch.ids[:, 0], np.array([20, 30], np.int32))
+    self.assertArraysEqual(
+        batch.paddings,
+        np.array([[0, 0, 1, 1], [0, 0, 0, 1]], np.float32))
+    self.assertArraysEqual(batch.eval_sample_weights,
+                           np.array([1, 1], np.float32))
+
+    lengths = []
+    while True:
+      try:
+        batch = inp.get_next_padded()
+      except StopIteration:
+        break
+      lengths.append(
+          list(np.sum(1 - batch.paddings, axis=1).astype(np.int32)))
+    self.assertEqual(lengths, [[1, 4], [8], [5], [2, 0]])
+    inp.reset()
+    self.assertEqual(inp.get_bucket_index(inp.get_next_padded()), 1)
+
+  def test_bucketed_sequence_input_variable_max_len(self):
+    child_p = VariableLengthInput.HParams(
+        batch_size=2, lengths=[2, 7, 3, 1], trim_batches=True)
+    p = base_input.BucketedSequenceInput.HParams(
+        input_tpl=child_p, batch_size=1, bucket_seq_lens=[4, 8],
+        time_dim_keys=['ids', 'labels'])
+    inp = instantiate(p)
+
+    batch = inp.get_next()
+    self.assertEqual(inp.get_bucket_index(batch), 1)
+    self.assertEqual(batch.ids.shape, (1, 8))
+    # The examples of the bucket come from child batches with different
+    # max_len.
+    batch = inp.get_next()
+    self.assertEqual(inp.get_bucket_index(batch), 0)
+    self.assertArraysEqual(
+        batch.ids, np.array([[20, 21, 0, 0], [30, 31, 32, 0]], np.int32))
+    self.assertArraysEqual(
+        batch.paddings, np.array([[0, 0, 1, 1], [0, 0, 0, 1]], np.float32))
+
+  def test_bucketed_sequence_input_batch_sizes(self):
+    child_p = VariableLengthInput.HParams(batch_size=2, lengths=[1] * 8)
+    p = base_input.BucketedSequenceInput.HParams(
+        input_tpl=child_p,
+        batch_size=2,
+        bucket_seq_lens=[2, 3, 8],
+        batch_size_multiple=4)
+    self.assertEqual(
+        instantiate(p).get_bucket_shapes(), [[8, 2], [4, 3], [4, 8]])
+    p.bucket_batch_sizes = [6, 4, 2]
+    self.assertEqual(
+        instantiate(p).get_bucket_shapes(), [[6, 2], [4, 3], [2, 8]])
+    with self.assertRaises(NotImplementedError):
+      instantiate(p.clone().set(num_infeed_hosts=2))
+
+
 if __name__ == '__main__':
   absltest.main()
@@ -281,17 +281,9 @@ def beam_search_after_prefix_fprop(
     val.hyp_scores = final_topk_value
     hyp_id = final_topk_indices // beam_size
 
-    # Shuffle at beam dimension for the cache states using hyp_id.
-    def _shuffle_state_fn(x, batch_dim, time_dim):
-      del time_dim
-      x_shape = x.shape
-      new_shape = list(x_shape)
-      new_shape.insert(batch_dim + 1, beam_size)
-      new_shape[batch_dim] = x_shape[batch_dim] // beam_size
-      new_state = shuffle_state(jnp.reshape(x, new_shape), hyp_id)
-      return jnp.reshape(new_state, x_shape)
-
-    transform_state_fn(model, _shuffle_state_fn)
+    # Shuffle at beam dimension for the cache states using hyp_id. Layers that
+    # read their cache through beam back-pointers only update the pointers.
+    transform_state_fn(model, decoder_utils.BeamReorderStateFn(hyp_id))
 
     # Gather output ids
     # new_ids [batch_size, beam_size]
@@ -0,0 +1,139 @@
+# coding=utf-8
+# Copyright 2022 The Pax Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+r"""Benchmarks beam search with and without KV cache beam indirection.
+
+Compares vanilla beam search on a TransformerLm whose self attention reorders
+the key/value cache after every step (DotProductAttention) against the same
+model reading the cache through beam back-pointers
+(DotProductAttentionWithBeamIndirection).
+
+Example:
+  python -m praxis.beam_search_benchmark --beam_sizes=2,4,8,16
+"""
+
+import time
+from typing import Sequence, Type
+
+from absl import app
+from absl import flags
+import jax
+from jax import numpy as jnp
+from praxis import base_layer
+from praxis import pax_fiddle
+from praxis import py_utils
+from praxis.layers import attentions
+from praxis.layers import models
+from praxis.layers import transformer_models
+
+NestedMap = py_utils.NestedMap
+instantiate = base_layer.instantiate
+
+_BEAM_SIZES = flags.DEFINE_list('beam_sizes', ['2', '4', '8', '16'],
+                                'Beam sizes to benchmark.')
+_BATCH_SIZE = flags.DEFINE_integer('batch_size', 4, 'Batch size.')
+_NUM_LAYERS = flags.DEFINE_integer('num_layers', 4, 'Number of layers.')
+_MODEL_DIMS = flags.DEFINE_integer('model_dims', 256, 'Model dims.')
+_NUM_HEADS = flags.DEFINE_integer('num_heads', 4, 'Number of heads.')
+_VOCAB_SIZE = flags.DEFINE_integer('vocab_size', 1024, 'Vocabulary size.')
+_PREFIX_LEN = flags.DEFINE_integer('prefix_len', 16, 'Prefix length.')
+_MAX_DECODE_STEPS = flags.DEFINE_integer('max_decode_steps', 128,
+                                         'Number of decoding steps.')
+_NUM_ITERS = flags.DEFINE_integer('num_iters', 5, 'Timed iterations.')
+
+
+def _lm_config(atten_cls: Type[attentions.DotProductAttention],
+               beam_size: int) -> pax_fiddle.Config[models.LanguageModel]:
+  """Returns a LanguageModel config decoding with vanilla beam search."""
+  seqlen = _PREFIX_LEN.value + _MAX_DECODE_STEPS.value
+  p = pax_fiddle.Config(
+      models.LanguageModel,
+      name='lm',
+      lm_tpl=pax_fiddle.Config(
+          transformer_models.TransformerLm,
+          model_dims=_MODEL_DIMS.value,
+          vocab_size=_VOCAB_SIZE.value,
+      ),
+      decoder_tpl=models.BeamSearchHParams(
+          beam_size=beam_size,
+          eos_id=_VOCAB_SIZE.value - 1,
+          fprop_for_prefix=True,
+          max_decode_steps=_MAX_DECODE_STEPS.value,
+          seqlen=seqlen,
+      ),
+  )
+  stacked_p = p.lm_tpl.stacked_transformer_tpl
+  stacked_p.model_dims = _MODEL_DIMS.value
+  stacked_p.hidden_dims = 4 * _MODEL_DIMS.value
+  stacked_p.num_heads = _NUM_HEADS.value
+  stacked_p.num_layers = _NUM_LAYERS.value
+  stacked_p.transformer_layer_params_tpl.tr_atten_tpl.cls = atten_cls
+  return p
+
+
+def _time_beam_search(atten_cls: Type[attentions.DotProductAttention],
+                      beam_size: int) -> float:
+  """Returns the average wall time in seconds of one beam search decode."""
+  lm = instantiate(_lm_config(atten_cls, beam_size))
+  batch_size = _BATCH_SIZE.value
+  prefix_len = _PREFIX_LEN.value
+  prng_key = jax.random.PRNGKey(1234)
+  input_batch = NestedMap(
+      ids=jax.random.randint(prng_key, [batch_size, prefix_len], 1,
+                             _VOCAB_SIZE.value - 1),
+      paddings=jnp.zeros([batch_size, prefix_len], dtype=jnp.float32),
+      prefix_lengths=jnp.full([batch_size], prefix_len, dtype=jnp.int32),
+      weights=jnp.ones([batch_size, prefix_len], dtype=jnp.float32),
+      labels=jnp.zeros([batch_size, prefix_len], dtype=jnp.int32),
+  )
+  with base_layer.JaxContext.new_context():
+    initial_vars = lm.init(prng_key, input_batch)
+
+  @jax.jit
+  def _decode(mdl_vars, input_batch):
+    with base_layer.JaxContext.new_context():
+      (_, results, _), _ = lm.apply(
+          mdl_vars,
+          input_batch,
+          rngs={base_layer.RANDOM: prng_key},
+          method=lm.decode,
+          mutable=[base_layer.DECODE_CACHE])
+    return results.output_ids
+
+  # Compile and warm up.
+  jax.block_until_ready(_decode(initial_vars, input_batch))
+  start = time.time()
+  for _ in range(_NUM_ITERS.value):
+    jax.block_until_ready(_decode(initial_vars, input_batch))
+  return (time.time() - start) / _NUM_ITERS.value
+
+
+def main(argv: Sequence[str]) -> None:
+  del argv
+  print(f'{"beam_size":>10} {"shuffle (ms)":>14} {"indirection (ms)":>18} '
+        f'{"speedup":>8}')
+  for beam_size in _BEAM_SIZES.value:
+    beam_size = int(beam_size)
+    shuffle_time = _time_beam_search(attentions.DotProductAttention,
+                                     beam_size)
+    indirection_time = _time_beam_search(
+        attentions.DotProductAttentionWithBeamIndirection, beam_size)
+    print(f'{beam_size:>10} {shuffle_time * 1e3:>14.2f} '
+          f'{indirection_time * 1e3:>18.2f} '
+          f'{shuffle_time / indirection_time:>8.2f}')
+
+
+if __name__ == '__main__':
+  app.run(main)
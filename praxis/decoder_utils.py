@@ -216,6 +216,32 @@ def batch_broadcast_state_fn(
   return _broadcast_state_fn
 
 
+@dataclasses.dataclass(frozen=True)
+class BeamReorderStateFn:
+  """A DecodeStateTransformFn that reorders decode states on the beam dim.
+
+  The batch dimension of a decode state is the merged [batch_size, beam_size]
+  dimension, and new hyp j of each batch element takes the state of hyp
+  `hyp_id[:, j]`. Layers that read their cache through per-beam back-pointers
+  (e.g. attentions.DotProductAttentionWithBeamIndirection) recognize this
+  transform and only update the back-pointers instead of gathering the cache.
+  """
+
+  # The desired beam ids with shape [batch_size, beam_size].
+  hyp_id: JTensor
+
+  def __call__(self, x: JTensor, batch_dim: int, time_dim: int) -> JTensor:
+    del time_dim
+    if batch_dim < 0:
+      return x
+    batch_size, beam_size = self.hyp_id.shape
+    x = jnp.moveaxis(x, batch_dim, 0)
+    x_shape = x.shape
+    x = jnp.reshape(x, (batch_size, beam_size) + x_shape[1:])
+    x = jax.vmap(lambda s, i: jnp.take(s, i, axis=0))(x, self.hyp_id)
+    return jnp.moveaxis(jnp.reshape(x, x_shape), 0, batch_dim)
+
+
 def right_align_tensors(
     x: JTensor, lengths: JTensor, align_dim: int = 1
 ) -> JTensor:
@@ -97,6 +97,19 @@ class DecoderUtilsTest(test_utils.TestCase):
     self.assertArraysEqual(output_logprobs, np.array(
         [[3, 0, 1], [3, 3, 2]], dtype=np.float32))
 
+  def test_beam_reorder_state_fn(self):
+    # [batch_size * beam_size, time, 1]
+    state = jnp.array(
+        [[[0], [1]], [[2], [3]], [[4], [5]], [[6], [7]]], dtype=np.float32)
+    hyp_ids = jnp.array([[1, 1], [1, 0]], dtype=np.int32)
+    reorder_fn = decoder_utils.BeamReorderStateFn(hyp_ids)
+    self.assertArraysEqual(
+        reorder_fn(state, batch_dim=0, time_dim=1),
+        np.array([[[2], [3]], [[2], [3]], [[6], [7]], [[4], [5]]],
+                 dtype=np.float32))
+    # States without a batch dim are unchanged.
+    self.assertArraysEqual(reorder_fn(state, batch_dim=-1, time_dim=1), state)
+
   def test_right_align_tensors(self):
     long_output_ids = jnp.array(
         [[5, 3, 2, 5, 0, 0], [0, 6, 7, 0, 0, 0], [1, 3, 9, 5, 6, 2]],
@@ -15,6 +15,8 @@
 
 """Utilities to handle XLA sharding annotations."""
 
+from typing import NamedTuple
+
 from absl import logging
 import jax
 from jax import lax
@@ -74,6 +76,134 @@ def _create_over_capacity_ratio_summary(mask, position_in_expert, capacity,
   return over_capacity_ratio
 
 
+class SparseDispatch(NamedTuple):
+  """Expert assignments of each token, used for sort-based dispatch.
+
+  Attributes:
+    expert_index: G`SK int32 tensor, the k-th expert assigned to each token, or
+      experts_dim if the assignment was dropped (padding or over capacity).
+    expert_gate: G`SK tensor, the combine weight of each assignment. Zero for
+      dropped assignments.
+    expert_capacity_dim: the (possibly automatically determined) capacity.
+  """
+  expert_index: jnp.ndarray
+  expert_gate: jnp.ndarray
+  expert_capacity_dim: int
+
+
+def _sparse_dispatch(index_list, gates_list, mask_flat_list, experts_dim,
+                     expert_capacity_dim, fprop_dtype):
+  """Packs the per-k gating decisions into a SparseDispatch."""
+  expert_index = jnp.stack([
+      jnp.where(mask_flat > 0, index, experts_dim)
+      for index, mask_flat in zip(index_list, mask_flat_list)
+  ], axis=-1).astype(jnp.int32)
+  expert_gate = jnp.stack([
+      gate * mask_flat.astype(gate.dtype)
+      for gate, mask_flat in zip(gates_list, mask_flat_list)
+  ], axis=-1).astype(fprop_dtype)
+  return SparseDispatch(expert_index, expert_gate, expert_capacity_dim)
+
+
+def _sort_based_slots(expert_index, experts_dim, expert_capacity_dim):
+  """Assigns expert capacity slots to the assignments of one group.
+
+  Assignments are stably sorted by expert, with all top-1 assignments of the
+  group before all top-2 assignments, etc. This matches the cumsum based
+  position_in_expert of the gating functions, so capacity dropping is the same.
+
+  Args:
+    expert_index: SK int32 tensor, the expert of each assignment, or experts_dim
+      for dropped assignments.
+    experts_dim: number of experts.
+    expert_capacity_dim: number of slots per expert.
+
+  Returns:
+    A tuple (slot, sorted_slot, token). slot is a SK int32 tensor of the
+    flattened E*C slot of each assignment, or E*C if it is dropped. sorted_slot
+    and token are [S*K] int32 tensors of the slots and token indices of the
+    assignments in sorted order.
+  """
+  group_size, k = expert_index.shape
+  num_slots = experts_dim * expert_capacity_dim
+  # [K*S], k-major.
+  flat_index = jnp.reshape(jnp.transpose(expert_index), [-1])
+  sorted_index, order = lax.sort_key_val(
+      flat_index, jnp.arange(group_size * k, dtype=jnp.int32))
+  # Start of each expert in the sorted assignments.
+  starts = jnp.searchsorted(
+      sorted_index, jnp.arange(experts_dim, dtype=jnp.int32), side='left')
+  expert_of_sorted = jnp.minimum(sorted_index, experts_dim - 1)
+  rank = jnp.arange(group_size * k, dtype=jnp.int32) - starts[expert_of_sorted]
+  valid = jnp.logical_and(sorted_index < experts_dim,
+                          rank < expert_capacity_dim)
+  sorted_slot = jnp.where(valid, sorted_index * expert_capacity_dim + rank,
+                          num_slots)
+  # Sort back to the original assignment order.
+  _, slot = lax.sort_key_val(order, sorted_slot)
+  slot = jnp.transpose(jnp.reshape(slot, [k, group_size]))
+  return slot, sorted_slot, order % group_size
+
+
+def sort_based_dispatch(inputs, sparse, experts_dim):
+  """Dispatches tokens to expert capacity slots by sorting.
+
+  This is equivalent to einsum('GSEC,GSM->GECM', dispatch_tensor, inputs), but
+  avoids materializing the G`SEC dispatch tensor.
+
+  Args:
+    inputs: G`SM tensor.
+    sparse: a SparseDispatch from the gating function.
+    experts_dim: number of experts.
+
+  Returns:
+    A tuple (expert_inputs, slot). expert_inputs is a G`ECM tensor. slot is a
+    G`SK int32 tensor of the flattened E*C slot of each assignment, or E*C if
+    it is dropped, to be passed to sort_based_combine().
+  """
+  capacity = sparse.expert_capacity_dim
+
+  def _dispatch_one_group(x, expert_index):
+    slot, sorted_slot, token = _sort_based_slots(expert_index, experts_dim,
+                                                 capacity)
+    expert_inputs = jnp.zeros([experts_dim * capacity, x.shape[-1]], x.dtype)
+    # Dropped assignments have an out of bound slot and are skipped.
+    expert_inputs = expert_inputs.at[sorted_slot].set(
+        jnp.take(x, token, axis=0), mode='drop')
+    return expert_inputs, slot
+
+  expert_inputs, slot = jax.vmap(_dispatch_one_group)(inputs,
+                                                      sparse.expert_index)
+  expert_inputs = jnp.reshape(
+      expert_inputs, [inputs.shape[0], experts_dim, capacity, -1])
+  return expert_inputs, slot
+
+
+def sort_based_combine(expert_outputs, sparse, slot):
+  """Combines expert outputs by gathering the slots of each token.
+
+  This is equivalent to einsum('GECM,GSEC->GSM', expert_outputs,
+  combine_tensor), but avoids materializing the G`SEC combine tensor.
+
+  Args:
+    expert_outputs: G`ECM tensor.
+    sparse: a SparseDispatch from the gating function.
+    slot: G`SK int32 tensor returned by sort_based_dispatch().
+
+  Returns:
+    A G`SM tensor.
+  """
+  num_groups, experts_dim, capacity, m_dim = expert_outputs.shape
+  flat_outputs = jnp.reshape(expert_outputs,
+                             [num_groups, experts_dim * capacity, m_dim])
+  # GSKM. Dropped assignments read zeros.
+  gathered = jax.vmap(
+      lambda x, i: jnp.take(x, i, axis=0, mode='fill', fill_value=0))(
+          flat_outputs, slot)
+  return jnp.einsum('GSKM,GSK->GSM', gathered,
+                    sparse.expert_gate.astype(gathered.dtype))
+
+
 # Close adaptation of the original gshard_layers.Top2GatingOnLogits TPU-specific
 # implementation of the Algorithm 2 from the http://arxiv.org/abs/2006.16668
 #
@@ -96,7 +226,8 @@ def top2_gating_on_logits(paddings,
                           capacity_factor=None,
                           importance=None,
                           mask_dtype=jnp.int32,
-                          gating_logit_cap=0.0):
+                          gating_logit_cap=0.0,
+                          sparse_dispatch=False):
   """Computes Top-2 gating for Mixture-of-Experts.
 
   This function takes gating logits, potentially sharded across tpu cores as
@@ -142,6 +273,9 @@ def top2_gating_on_logits(paddings,
       tensors, mask_dtype overrides dtype for such tensors
     gating_logit_cap: soft cap, applied for gating logits, this is a stability
       fix to avoid extreme values during initial steps. Defaults to 50.0.
+    sparse_dispatch: if True, returns the selected expert indices and gates per
+      token instead of the G`SEC combine and dispatch tensors. See
+      sort_based_dispatch() and sort_based_combine().
 
   Returns:
     A tuple (aux_loss, combine_tensor, dispatch_tensor, over_capacity ratios).
@@ -152,6 +286,9 @@ def top2_gating_on_logits(paddings,
     - over_capacity ratios: tuple that represents the ratio of tokens that
       were not dispatched due to lack of capcity for top_1 and top_2 expert
       respectively, e.g. (over_capacity_1, over_capacity_2)
+
+    If sparse_dispatch is True, a tuple (aux_loss, sparse, over_capacity ratios)
+    is returned instead, where sparse is a SparseDispatch.
   """
   assert (capacity_factor or expert_capacity_dim)
   if mask_dtype is None:
@@ -340,6 +477,18 @@ def top2_gating_on_logits(paddings,
     gate_1 /= denom
     gate_2 /= denom
 
+  if sparse_dispatch:
+    sparse = _sparse_dispatch(
+        [index_1, index_2],
+        [gate_1, gate_2],
+        [mask_1_flat, mask_2_flat],
+        experts_dim,
+        expert_capacity_dim,
+        fprop_dtype,
+    )
+    return aux_loss.astype(fprop_dtype), sparse, (over_capacity_1,
+                                                  over_capacity_2)
+
   # GSC tensor
   b = jax.nn.one_hot(
       position_in_expert_1.astype(np.int32),
@@ -605,8 +754,13 @@ def compute_gating(paddings,
                    legacy_mtf_behavior=True,
                    capacity_factor=None,
                    mask_dtype=jnp.int32,
-                   gating_logit_cap=0.0):
+                   gating_logit_cap=0.0,
+                   sparse_dispatch=False):
   """Compute gating."""
+  if sparse_dispatch and gating_func != 'top2':
+    raise ValueError(
+        'sparse_dispatch is only supported by top2 gating, got: %s' %
+        gating_func)
   if gating_func == 'top2':
     gating = top2_gating_on_logits(
         paddings=paddings,
@@ -625,7 +779,8 @@ def compute_gating(paddings,
         # *2.0 because we choose top-2 experts per example
         capacity_factor=capacity_factor,
         mask_dtype=mask_dtype,
-        gating_logit_cap=gating_logit_cap)
+        gating_logit_cap=gating_logit_cap,
+        sparse_dispatch=sparse_dispatch)
   elif gating_func == 'expert_choice':
     gating = expert_choice_gating_on_logits(
         logits=logits.astype(jnp.float32),
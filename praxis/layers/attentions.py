@@ -22,16 +22,19 @@ from typing import Callable, Dict, Mapping, Optional, Sequence, Tuple, Union, An
 
 from absl import logging
 from flax import linen as nn
+from flax import struct
 import jax
 from jax import numpy as jnp
 from jax.ad_checkpoint import checkpoint_name
 import numpy as np
 from praxis import asserts
 from praxis import base_layer
+from praxis import decoder_utils
 from praxis import pax_fiddle
 from praxis import py_utils
 from praxis import pytypes
 from praxis.layers import embedding_softmax
+from praxis.layers import normalizations
 from praxis.layers import stochastics
 
 NestedMap = py_utils.NestedMap
@@ -175,6 +178,79 @@ def convert_paddings_to_mask(paddings: JTensor,
   return attention_mask
 
 
+@struct.dataclass
+class ImplicitAttentionMask:
+  """Self attention mask kept in factored form instead of a dense JTensor.
+
+  Dense masks of shape [B, 1, T, T] grow quadratically with the sequence length
+  and are read from memory by every attention layer. This class keeps the
+  factors the mask is derived from and builds the boolean mask from broadcasted
+  iota comparisons right where it is applied, which XLA fuses into the masking
+  of the logits. Layers which need a dense mask call `to_dense()`.
+
+  Attributes:
+    paddings: Optional 0/1 JTensor of shape [B, S], with 1 denoting padded
+      source tokens which are never attended to.
+    segment_ids: Optional JTensor of shape [B, T], the segment that each token
+      belongs to. Tokens only attend to tokens of the same segment. This is
+      only supported for self attention, i.e. T == S.
+    causal: If True, tokens do not attend to later tokens.
+    local_window: If not None, tokens only attend to tokens less than
+      `local_window` positions away.
+  """
+  paddings: Optional[JTensor] = None
+  segment_ids: Optional[JTensor] = None
+  causal: bool = struct.field(pytree_node=False, default=False)
+  local_window: Optional[int] = struct.field(pytree_node=False, default=None)
+
+  def valid_mask(self, query_len: int, key_len: int) -> JTensor:
+    """Returns a bool JTensor of shape [1|B, 1, 1|T, S], True where valid."""
+    valid = jnp.ones([1, 1, 1, key_len], dtype=jnp.bool_)
+    if self.paddings is not None:
+      valid = jnp.equal(self.paddings, 0)[:, jnp.newaxis, jnp.newaxis, :]
+    if self.segment_ids is not None:
+      valid = valid & jnp.equal(
+          self.segment_ids[:, jnp.newaxis, :, jnp.newaxis],
+          self.segment_ids[:, jnp.newaxis, jnp.newaxis, :],
+      )
+    if self.causal or self.local_window is not None:
+      row_idx = jax.lax.broadcasted_iota(jnp.int32, (query_len, key_len), 0)
+      col_idx = jax.lax.broadcasted_iota(jnp.int32, (query_len, key_len), 1)
+      if self.causal:
+        valid = valid & (col_idx <= row_idx)[jnp.newaxis, jnp.newaxis]
+      if self.local_window is not None:
+        local = jnp.abs(row_idx - col_idx) < self.local_window
+        valid = valid & local[jnp.newaxis, jnp.newaxis]
+    return valid
+
+  def apply_to_logits(self, logits: JTensor) -> JTensor:
+    """Masks logits of shape [B, N, T, S], see `py_utils.apply_mask_to_logits`."""
+    valid = self.valid_mask(logits.shape[-2], logits.shape[-1])
+    return jnp.where(
+        valid, logits, py_utils.get_large_negative_number(logits.dtype)
+    )
+
+  def to_dense(
+      self, query_len: int, key_len: int, dtype: jnp.dtype = jnp.float32
+  ) -> JTensor:
+    """Returns the mask of shape [1|B, 1, 1|T, S] ready to add to logits."""
+    valid = self.valid_mask(query_len, key_len)
+    large_negative_number = py_utils.get_large_negative_number(dtype)
+    return jnp.where(valid, 0, large_negative_number).astype(dtype)
+
+
+def maybe_materialize_attention_mask(
+    atten_mask: Union[JTensor, ImplicitAttentionMask],
+    query_len: int,
+    key_len: int,
+    dtype: jnp.dtype = jnp.float32,
+) -> JTensor:
+  """Returns `atten_mask` as a dense JTensor ready to add to logits."""
+  if isinstance(atten_mask, ImplicitAttentionMask):
+    return atten_mask.to_dense(query_len, key_len, dtype)
+  return atten_mask
+
+
 def shift_1d(inputs: JTensor, offset: int, axis: int):
   """Shifts the input tensor by offset in the dimension axis.
 
@@ -732,6 +808,12 @@ class CombinedQKVProjectionLayer(base_layer.BaseLayer):
     attention_combine_dims: If set, the heads and key/value dimensions are
       combined in the variables and the computation.
     explicit_fan_in_fan_out_axes: Set true except for backward compatibility.
+    folded_norm_epsilon: If set, the scale and bias of a preceding LayerNorm or
+      RmsNorm with this epsilon are folded into the weights (see
+      `fold_norm_scale`) and the inputs are expected to be the
+      `fused_projection_inputs` of the norm. Only the normalizing factor is then
+      applied, to the projected outputs, which saves materializing the
+      normalized inputs.
   """
   input_dim: int = 0
   num_heads: int = 0
@@ -740,6 +822,7 @@ class CombinedQKVProjectionLayer(base_layer.BaseLayer):
   attention_combine_dims: bool = False
   explicit_fan_in_fan_out_axes: bool = False  # TODO(b/232864754) switch to True
   make_dot_general_tpl: LayerTpl = template_field(base_layer.MakeDotGeneral)
+  folded_norm_epsilon: Optional[float] = None
 
   def setup(self) -> None:
     # Sharding has the same convention of AttentionProjection, which doesn't
@@ -841,6 +924,11 @@ class CombinedQKVProjectionLayer(base_layer.BaseLayer):
     # K indexes qkv.
     eqn = f'{batch_eqn}D,KDNH->K{batch_eqn}NH'
     ret = jnp.einsum(eqn, inputs, w, _dot_general=self.make_dot_general())
+    if self.folded_norm_epsilon is not None:
+      factor = normalizations.rms_normalizing_factor(
+          inputs, self.folded_norm_epsilon
+      )
+      ret *= factor[jnp.newaxis, ..., jnp.newaxis].astype(ret.dtype)
     ret = checkpoint_name(ret, 'combined_qkv_proj')
     if self.use_bias:
       # Add newaxis to bias weight for each batch dim since ret is K...NH
@@ -861,6 +949,38 @@ class CombinedQKVProjectionLayer(base_layer.BaseLayer):
     del time_step  # Not used.
     return self.__call__(inputs)  # pytype: disable=bad-return-type  # jax-ndarray
 
+  def fold_norm_scale(
+      self, scale: Optional[JTensor], bias: Optional[JTensor]
+  ) -> NestedJTensor:
+    """Returns the variables with the scale and bias of a norm folded in.
+
+    Args:
+      scale: The [input_dim] scale of the preceding norm, if any.
+      bias: The [input_dim] bias of the preceding norm, if any.
+
+    Returns:
+      The folded variables of this layer, to be used with folded_norm_epsilon
+      set to the epsilon of the norm.
+    """
+    w = self.theta.w.astype(jnp.float32)
+    folded = {}
+    if scale is not None:
+      scale = scale.astype(jnp.float32)
+      folded['w'] = w * jnp.reshape(scale, [1, -1] + [1] * (w.ndim - 2))
+    else:
+      folded['w'] = w
+    if self.use_bias:
+      folded['b'] = self.theta.b.astype(jnp.float32)
+    if bias is not None:
+      if not self.use_bias:
+        raise ValueError('Folding a norm bias requires use_bias=True.')
+      folded['b'] += jnp.tensordot(
+          bias.astype(jnp.float32), w, axes=([0], [1])
+      )
+    return {
+        k: v.astype(getattr(self.theta, k).dtype) for k, v in folded.items()
+    }
+
 
 class DotProductAttention(base_layer.BaseLayer):
   """Dot-product attention with multiple attention heads.
@@ -1286,9 +1406,16 @@ class DotProductAttention(base_layer.BaseLayer):
     # source tokens. In this case tiling is inefficient and unnecessary.
     # If there is no padding mask, and only causal mask then the shape can be
     # [1, 1, T, S]
-    base_layer.assert_has_shape(atten_mask, [-1, 1, -1, s])
-    asserts.in_set(atten_mask.shape[2], [t, 1])
-    asserts.in_set(atten_mask.shape[0], [b, 1])
+    if isinstance(atten_mask, ImplicitAttentionMask):
+      # The mask is generated next to the logits it is applied to.
+      apply_mask = atten_mask.apply_to_logits
+    else:
+      base_layer.assert_has_shape(atten_mask, [-1, 1, -1, s])
+      asserts.in_set(atten_mask.shape[2], [t, 1])
+      asserts.in_set(atten_mask.shape[0], [b, 1])
+      apply_mask = functools.partial(
+          py_utils.apply_mask_to_logits, mask=atten_mask
+      )
 
     query = self._scale_query(query)
     logits = self._atten_logits(query, key)
@@ -1303,7 +1430,7 @@ class DotProductAttention(base_layer.BaseLayer):
 
     self.add_summary(
         'max_logit_precap',
-        jnp.max(py_utils.apply_mask_to_logits(logits, atten_mask)),
+        jnp.max(apply_mask(logits)),
         verbosity=4,
     )
     self.add_summary(
@@ -1314,9 +1441,11 @@ class DotProductAttention(base_layer.BaseLayer):
     # Attention softmax is always carried out in fp32.
     logits = logits.astype(jnp.float32)
     # Apply attention masking
-    padded_logits = py_utils.apply_mask_to_logits(logits, atten_mask)
+    padded_logits = apply_mask(logits)
     if self.attention_mask_summary:
-      self.add_summary('attention_mask', atten_mask)
+      self.add_summary(
+          'attention_mask', maybe_materialize_attention_mask(atten_mask, t, s)
+      )
     if self.attention_extra_logit is None:
       probs = jax.nn.softmax(padded_logits, axis=-1).astype(key.dtype)
     else:
@@ -1331,10 +1460,16 @@ class DotProductAttention(base_layer.BaseLayer):
 
     if self.zero_fully_masked:
       # Return zeros for tokens which don't attend anything.
-      fully_masked = jnp.all(
-          atten_mask < py_utils.get_large_negative_number(jnp.float32) / 2,
-          axis=-1,
-      )[:, 0, :, jnp.newaxis, jnp.newaxis]
+      if isinstance(atten_mask, ImplicitAttentionMask):
+        fully_masked = jnp.logical_not(
+            jnp.any(atten_mask.valid_mask(t, s), axis=-1)
+        )
+      else:
+        fully_masked = jnp.all(
+            atten_mask < py_utils.get_large_negative_number(jnp.float32) / 2,
+            axis=-1,
+        )
+      fully_masked = fully_masked[:, 0, :, jnp.newaxis, jnp.newaxis]
       encoded *= 1 - fully_masked
 
     encoded = checkpoint_name(encoded, 'context')
@@ -1345,6 +1480,22 @@ class DotProductAttention(base_layer.BaseLayer):
     """Returns the length of full decoding sequences."""
     return self.get_decode_state('key_state').shape[1]
 
+  def _relative_bias_one_step(self, time_step: JTensor) -> JTensor:
+    """Returns the relative bias of the query at time_step over decode states.
+
+    Args:
+      time_step: A scalar. The time step which is being decoded.
+
+    Returns:
+      A JTensor of shape [1, N, 1, S], where S is the decode state length.
+    """
+    return self.relative_bias.extend_step(
+        seq_length=self.decoding_state_sequence_length(), time_step=time_step)
+
+  def _read_decode_kv_state(self, name: str) -> JTensor:
+    """Reads a key/value decode state of shape [B, S, N, H] for attention."""
+    return self._shard_blnh(self.get_decode_state(name))
+
   def _dot_atten_one_step(self,
                           query: JTensor,
                           key_state_name: str,
@@ -1371,37 +1522,40 @@ class DotProductAttention(base_layer.BaseLayer):
       probs: JTensor of shape [B, N, S].
     """
     del time_step
-    key = self._shard_blnh(self.get_decode_state(key_state_name))
-    value = self._shard_blnh(self.get_decode_state(value_state_name))
+    key = self._read_decode_kv_state(key_state_name)
+    value = self._read_decode_kv_state(value_state_name)
     k_b = key.shape[0]
     q_b = query.shape[0]
-    if q_b != k_b:
-      if q_b % k_b != 0:
-        raise ValueError(
-            f'q batch size {q_b} is not divisible by state batch size {k_b}')
-      key = jnp.repeat(key, q_b // k_b, axis=0)
-      value = jnp.repeat(value, q_b // k_b, axis=0)
+    if q_b % k_b != 0:
+      raise ValueError(
+          f'q batch size {q_b} is not divisible by state batch size {k_b}')
+    # Each consecutive (q_b // k_b) queries share the same key/value states.
+    # Instead of repeating the states, queries are reshaped into groups of
+    # num_samples = q_b // k_b.
+    num_samples = q_b // k_b
     if atten_mask.shape[0] != q_b and atten_mask.shape[0] != 1:
       assert atten_mask.shape[0] == k_b, (atten_mask.shape, k_b)
-      atten_mask = jnp.repeat(atten_mask, q_b // k_b, axis=0)
+      atten_mask = jnp.repeat(atten_mask, num_samples, axis=0)
     # query is 3d.
     query = self._shard_bnh(query)
 
     b, s, n, h = key.shape
     base_layer.assert_has_shape(value, [b, s, n, h])
-    base_layer.assert_has_shape(query, [b, n, h])
+    base_layer.assert_has_shape(query, [q_b, n, h])
     base_layer.assert_has_shape(atten_mask, [-1, 1, s])
-    asserts.in_set(atten_mask.shape[0], [b, 1])
+    asserts.in_set(atten_mask.shape[0], [q_b, 1])
     query = self._scale_query(query)
+    query = jnp.reshape(query, (b, num_samples, n, h))
     logits = jnp.einsum(
-        'BNH,BSNH->BNS',
+        'BRNH,BSNH->BRNS',
         query,
         key,
         _dot_general=self.make_qk_dot_general(),
     )
+    logits = jnp.reshape(logits, (q_b, n, s))
     if relative_bias is not None:
       base_layer.assert_has_shape(relative_bias, [-1, n, 1, s])
-      asserts.in_set(relative_bias.shape[0], [b, 1])
+      asserts.in_set(relative_bias.shape[0], [q_b, 1])
       relative_bias = jnp.squeeze(relative_bias, axis=2)
       logits += relative_bias
     logits = self._cap_logits(logits)
@@ -1409,7 +1563,7 @@ class DotProductAttention(base_layer.BaseLayer):
     logits = logits.astype(jnp.float32)
     # Apply attention masking
     padded_logits = py_utils.apply_mask_to_logits(logits, atten_mask)
-    # Of shape [b, n, s]
+    # Of shape [q_b, n, s]
     if self.attention_extra_logit is None:
       probs = jax.nn.softmax(padded_logits, axis=-1).astype(key.dtype)
     else:
@@ -1417,11 +1571,12 @@ class DotProductAttention(base_layer.BaseLayer):
           key.dtype)
     # Compute the attention context.
     encoded = jnp.einsum(
-        'BNS,BSNH->BNH',
-        probs,
+        'BRNS,BSNH->BRNH',
+        jnp.reshape(probs, (b, num_samples, n, s)),
         value,
         _dot_general=self.make_pv_dot_general(),
     )
+    encoded = jnp.reshape(encoded, (q_b, n, h))
 
     if self.zero_fully_masked:
       # Return zeros for tokens which don't attend anything.
@@ -1503,6 +1658,11 @@ class DotProductAttention(base_layer.BaseLayer):
     else:
       relative_bias = None
 
+    if type(self)._dot_atten is not DotProductAttention._dot_atten:
+      # Subclasses overriding the attention computation take a dense mask.
+      atten_mask = maybe_materialize_attention_mask(
+          atten_mask, query_proj.shape[1], key_proj.shape[1], query_vec.dtype
+      )
     encoded, atten_probs = self._dot_atten(query_proj, key_proj, value_proj,
                                            atten_mask, relative_bias)
 
@@ -1598,10 +1758,10 @@ class DotProductAttention(base_layer.BaseLayer):
 
     For cross attention, the key/value cache may have a smaller batch size b
     than inputs batch size B. In this case, we require B % b == 0, and this
-    corresponds to multi-sample decoding for each input in b, and cross-
-    attention states will be repeated by (B // b) times. Each consecutive
+    corresponds to multi-sample decoding for each input in b. Each consecutive
     (B // b) chunk in B correspond to multiple samples for the same cross
-    inputs.
+    inputs; their queries are grouped to attend to the shared cross-attention
+    states, without repeating the states (B // b) times.
 
     Args:
       query_vec: JTensor of shape [B, D] corresponding to query vector at index
@@ -1702,8 +1862,7 @@ class DotProductAttention(base_layer.BaseLayer):
 
     if self.relative_bias_tpl:
       # Relative bias uses time_step instead of segment_pos.
-      relative_bias = self.relative_bias.extend_step(
-          seq_length=self.decoding_state_sequence_length(), time_step=time_step)
+      relative_bias = self._relative_bias_one_step(time_step)
     else:
       relative_bias = None
 
@@ -2451,6 +2610,135 @@ class DotProductAttentionWithLPB(DotProductAttention):
     return encoded
 
 
+class DotProductAttentionWithBeamIndirection(DotProductAttention):
+  """DotProductAttention that reads its decode cache through beam pointers.
+
+  Beam search reorders every decode state on the beam dimension after each
+  step, which copies the whole key/value cache of every layer per step. This
+  layer instead keeps a per-hyp back-pointer for every time step in the
+  `beam_offsets` decode state of shape [B, S]: at time t, hyp b reads its
+  keys/values from row `b + beam_offsets[b, t]` of the cache. When it receives
+  a decoder_utils.BeamReorderStateFn, only the back-pointers are reordered and
+  the key/value cache stays in place. All other decode state transforms
+  (padding, batch broadcasting, etc.) are applied as usual.
+
+  The back-pointers are stored as row offsets rather than absolute rows so that
+  they stay valid under batch broadcasting and time padding. Each step gathers
+  the rows the back-pointers refer to, a read of the cache rather than the
+  read-modify-write of a reorder. Folding the lookup into the logits and
+  context einsums instead multiplies their FLOPs by the beam size, which was
+  measured slower than this gather.
+
+  To use this layer, replace the Transformer layer's attention template:
+    bi_tr_atten_tpl = attentions.DotProductAttentionWithBeamIndirection.HParams()
+    if transformer_layer_p.tr_atten_tpl.cls == attentions.DotProductAttention:
+      bi_tr_atten_tpl.copy_fields_from(transformer_layer_p.tr_atten_tpl)
+      transformer_layer_p.tr_atten_tpl = bi_tr_atten_tpl
+  """
+
+  _BEAM_OFFSETS = 'beam_offsets'
+
+  def setup(self) -> None:
+    super().setup()
+    # These read the cache history of a hyp directly in extend_step.
+    if self.dconv_qkv:
+      raise NotImplementedError(
+          'DotProductAttentionWithBeamIndirection does not support dconv_qkv.')
+    if self.ngrammer_tpl is not None:
+      raise NotImplementedError(
+          'DotProductAttentionWithBeamIndirection does not support ngrammer.')
+
+  def __call__(
+      self,
+      query_vec: JTensor,
+      key_vec: JTensor,
+      value_vec: JTensor,
+      atten_mask: JTensor,
+      query_segment_pos: Optional[JTensor] = None,
+      key_segment_pos: Optional[JTensor] = None) -> Tuple[JTensor, JTensor]:
+    encoded, atten_probs = super().__call__(query_vec, key_vec, value_vec,
+                                            atten_mask, query_segment_pos,
+                                            key_segment_pos)
+    self._fprop_update_decode_state(
+        self._BEAM_OFFSETS, jnp.zeros(key_vec.shape[:2], dtype=jnp.int32))
+    return encoded, atten_probs
+
+  def _read_decode_kv_state(self, name: str) -> JTensor:
+    """Gathers a key/value decode state of hyps through the back-pointers."""
+    state = self.get_decode_state(name)
+    offsets = self.get_decode_state(self._BEAM_OFFSETS)
+    b, s = offsets.shape
+    rows = jnp.arange(b, dtype=jnp.int32)[:, jnp.newaxis] + offsets
+    state = state[rows, jnp.arange(s, dtype=jnp.int32)[jnp.newaxis, :]]
+    return self._shard_blnh(state)
+
+  def extend_step(self,
+                  query_vec: JTensor,
+                  *,
+                  atten_mask: JTensor,
+                  time_step: JTensor,
+                  segment_pos: Optional[JTensor],
+                  is_cross_attention: bool = False) -> JTensor:
+    """Computes the value vector given the query of the current step.
+
+    Args:
+      query_vec: JTensor of shape [B, D] corresponding to query vector at index
+        time_step.
+      atten_mask: JTensor of shape [1|b|B, 1, S]. atten_mask should have already
+        taken care of causal masking for decoding, plus other maskings
+        necessary.
+      time_step: A scalar or JTensor. Current time-step, 0-based.
+      segment_pos: An optional JTensor of shape [B]. Current position in the
+        same segment. If unspecified, time_step will be used.
+      is_cross_attention: Whether this is a cross-attention layer. Not
+        supported.
+
+    Returns:
+      encoded: JTensor of shape [B, D] which returns the attention output at
+        `time_step`.
+    """
+    if is_cross_attention:
+      raise NotImplementedError(
+          'DotProductAttentionWithBeamIndirection does not support cross '
+          'attention.')
+    # Keys/values of time_step are written to the hyp's own row.
+    offsets = self.get_decode_state(self._BEAM_OFFSETS)
+    offsets = jax.lax.dynamic_update_slice(
+        offsets,
+        jnp.zeros((offsets.shape[0], 1), dtype=offsets.dtype),
+        [0, jnp.array(time_step).astype(jnp.int32)])
+    self.update_decode_state(self._BEAM_OFFSETS, offsets)
+    return super().extend_step(
+        query_vec,
+        atten_mask=atten_mask,
+        time_step=time_step,
+        segment_pos=segment_pos,
+        is_cross_attention=is_cross_attention)
+
+  def transform_decode_state(self,
+                             transform_fn: base_layer.DecodeStateTransformFn):
+    """Transforms all decode state variables based on transform_fn."""
+    batch_dim = 0
+    time_dim = 1
+    if isinstance(transform_fn, decoder_utils.BeamReorderStateFn):
+      # New hyp j takes the back-pointers of hyp_id[:, j], which is
+      # hyp_id[:, j] - j rows away from it.
+      offsets = transform_fn(
+          self.get_decode_state(self._BEAM_OFFSETS), batch_dim, time_dim)
+      batch_size, beam_size = transform_fn.hyp_id.shape
+      delta = transform_fn.hyp_id - jnp.arange(beam_size, dtype=jnp.int32)
+      delta = jnp.reshape(delta, (batch_size * beam_size, 1))
+      self.update_decode_state(self._BEAM_OFFSETS, offsets + delta)
+      return
+    for name, state in self.variables[base_layer.DECODE_CACHE].items():
+      if not isinstance(state, JTensor):
+        continue
+      new_state = transform_fn(state, batch_dim, time_dim)
+      if name != self._BEAM_OFFSETS:
+        new_state = self._shard_blnh(new_state)
+      self.update_decode_state(name, new_state)
+
+
 # TODO(b/249483164): Rename BaseLayerApi->BaseLayer after Fiddle migration.
 def create_relative_positional_embedding(
     layer: base_layer.BaseLayerApi) -> None:
@@ -2719,16 +3007,149 @@ class LocalSelfAttention(DotProductAttention):
   Note: Key and query need to have the same length. Ideally one can support
   cross attention. So far this class is only used for encoder in speech models.
 
+  Decoding:
+  extend_step only attends to the last L positions. By default the decode
+  states still cover the full target length. With ring_buffer_decode_cache,
+  they are instead kept in a ring buffer of L slots, where position p is
+  stored at slot p % L, so that memory does not grow with the decoded length.
+  An int8 [B, T] `decode_length` state keeps track of the target length T, so
+  that decoding_sequence_length() and the extend_step attention masks still
+  cover the full target, and the mask of each slot is read at the position it
+  holds. Keys are cached after rotary position embedding, and relative biases
+  are rotated into slot order, so both stay position-correct. Since the ring
+  buffer has no linear time dimension, time-dimension decode state transforms
+  (e.g., padding after prefix fprop) only change the target length, and the
+  prefix fprop must not cover positions after the first extend_step time step.
+
   Attributes:
     block_size: Size of a processing block,
       if unset, default to max(1, right_context, left_context-1).
     left_context: Number of left positions to attend (including current
       position).
     right_context: Number of right positions to attend.
+    ring_buffer_decode_cache: If True, keeps decode states in a ring buffer of
+      left_context + right_context positions instead of the full target length.
+      Decoding requires right_context == 0.
   """
   block_size: Optional[int] = None
   left_context: Optional[int] = None
   right_context: Optional[int] = None
+  ring_buffer_decode_cache: bool = False
+
+  # Decode state of shape [B, T] only recording the target length T.
+  _DECODE_LENGTH_STATE = 'decode_length'
+
+  def setup(self) -> None:
+    super().setup()
+    if self.ring_buffer_decode_cache:
+      if not self.left_context:
+        raise ValueError(
+            'ring_buffer_decode_cache requires a positive left_context, got '
+            f'{self.left_context}.'
+        )
+      if self.dconv_qkv:
+        raise NotImplementedError(
+            'dconv_qkv is not supported with ring_buffer_decode_cache.'
+        )
+
+  @property
+  def _ring_buffer_size(self) -> int:
+    """Returns the number of slots in the ring buffer decode cache."""
+    return self.left_context + (self.right_context or 0)
+
+  def _to_ring_buffer(self, x: JTensor) -> JTensor:
+    """Converts a [B, T, ...] decode state into ring buffer slot order.
+
+    Args:
+      x: A JTensor of shape [B, T, ...] holding positions [0, T).
+
+    Returns:
+      A JTensor of shape [B, L, ...] where slot j holds the last position p < T
+      with p % L == j, or zeros if there is no such position.
+    """
+    size = self._ring_buffer_size
+    t = x.shape[1]
+    if t < size:
+      paddings = [[0, 0]] * x.ndim
+      paddings[1] = [0, size - t]
+      return jnp.pad(x, paddings)
+    return jnp.roll(x[:, t - size:], t % size, axis=1)
+
+  def _ring_buffer_positions(self, time_step: JTensor) -> JTensor:
+    """Returns the position stored in each ring buffer slot at time_step.
+
+    Args:
+      time_step: A scalar. The time step which is being decoded.
+
+    Returns:
+      An int32 JTensor of shape [L]. Negative values are slots which have not
+      been written yet.
+    """
+    size = self._ring_buffer_size
+    slots = jnp.arange(size, dtype=jnp.int32)
+    time_step = jnp.asarray(time_step, dtype=jnp.int32)
+    return time_step - jnp.mod(time_step - slots, size)
+
+  @nn.nowrap
+  def _fprop_update_decode_state(self, name: str, value: JTensor) -> None:
+    """Updates decode state in fprop, in ring buffer order if enabled."""
+    if (
+        self.ring_buffer_decode_cache
+        and self.is_mutable_collection(base_layer.DECODE_CACHE)
+    ):
+      if name == 'key_state':
+        super()._fprop_update_decode_state(
+            self._DECODE_LENGTH_STATE,
+            jnp.zeros(value.shape[:2], dtype=jnp.int8),
+        )
+      value = self._to_ring_buffer(value)
+    super()._fprop_update_decode_state(name, value)
+
+  def decoding_state_sequence_length(self):
+    """Returns the length of full decoding sequences."""
+    if not self.ring_buffer_decode_cache:
+      return super().decoding_state_sequence_length()
+    return self.get_decode_state(self._DECODE_LENGTH_STATE).shape[1]
+
+  @nn.nowrap
+  def extend_decode_state(self, name: str, value: JTensor, time_step: JTensor,
+                          time_dim: int) -> JTensor:
+    """Extends decode state at time_step, in its ring buffer slot if enabled."""
+    if self.ring_buffer_decode_cache:
+      time_step = jnp.mod(time_step, self._ring_buffer_size)
+    return super().extend_decode_state(name, value, time_step, time_dim)
+
+  def transform_decode_state(self,
+                             transform_fn: base_layer.DecodeStateTransformFn):
+    """Transforms all decode state variables based on transform_fn."""
+    if not self.ring_buffer_decode_cache:
+      super().transform_decode_state(transform_fn)
+      return
+    # Ring buffer slots are not ordered by time, so only the batch dim is
+    # exposed to transform_fn. The target length follows the time dim
+    # transforms.
+    batch_dim = 0
+    for name, state in self.variables[base_layer.DECODE_CACHE].items():
+      if not isinstance(state, JTensor):
+        continue
+      if name == self._DECODE_LENGTH_STATE:
+        self.update_decode_state(name, transform_fn(state, batch_dim, 1))
+        continue
+      new_state = transform_fn(state, batch_dim, -1)
+      new_state = self._shard_blnh(new_state)
+      self.update_decode_state(name, new_state)
+
+  def _relative_bias_one_step(self, time_step: JTensor) -> JTensor:
+    """Returns the relative bias of the query at time_step over decode states."""
+    if not self.ring_buffer_decode_cache:
+      return super()._relative_bias_one_step(time_step)
+    # Relative bias only depends on relative positions: the bias over the last
+    # L positions is computed as if decoding position L - 1, then rotated from
+    # time order into slot order.
+    size = self._ring_buffer_size
+    relative_bias = self.relative_bias.extend_step(
+        seq_length=size, time_step=size - 1)
+    return jnp.roll(relative_bias, jnp.mod(time_step + 1, size), axis=-1)
 
   def _atten_logits(self, query: JTensor, key: JTensor) -> JTensor:
     """Computes logits from query and key."""
@@ -2915,15 +3336,15 @@ class LocalSelfAttention(DotProductAttention):
     value = self._shard_blnh(self.get_decode_state(value_state_name))
     k_b = key.shape[0]
     q_b = query.shape[0]
-    if q_b != k_b:
-      if q_b % k_b != 0:
-        raise ValueError(
-            f'q batch size {q_b} is not divisible by state batch size {k_b}')
-      key = jnp.repeat(key, q_b // k_b, axis=0)
-      value = jnp.repeat(value, q_b // k_b, axis=0)
+    if q_b % k_b != 0:
+      raise ValueError(
+          f'q batch size {q_b} is not divisible by state batch size {k_b}')
+    # Each consecutive (q_b // k_b) queries share the same key/value states.
+    # Queries are grouped per state row instead of repeating the states.
+    num_samples = q_b // k_b
     if atten_mask.shape[0] != q_b and atten_mask.shape[0] != 1:
       assert atten_mask.shape[0] == k_b, (atten_mask.shape, k_b)
-      atten_mask = jnp.repeat(atten_mask, q_b // k_b, axis=0)
+      atten_mask = jnp.repeat(atten_mask, num_samples, axis=0)
     # query is 3d.
     query = self._shard_bnh(query)
 
@@ -2958,34 +3379,48 @@ class LocalSelfAttention(DotProductAttention):
           long_x, time_step + 1, slice_size, axis=axis
       )
 
-    key = context_slice(key, 1, 0.0, time_step, self.left_context)
-    value = context_slice(value, 1, 0.0, time_step, self.left_context)
-    atten_mask = context_slice(
-        atten_mask,
-        -1,
-        py_utils.get_large_negative_number(jnp.float32),
-        time_step,
-        self.left_context,
-    )
+    if self.ring_buffer_decode_cache:
+      # Key/value states and relative bias are already in ring buffer slot
+      # order; gather the mask at the position held by each slot. The mask
+      # covers the full target length, see decoding_state_sequence_length().
+      positions = self._ring_buffer_positions(time_step)
+      atten_mask = jnp.where(
+          positions >= 0,
+          jnp.take(atten_mask, jnp.maximum(positions, 0), axis=-1),
+          py_utils.get_large_negative_number(atten_mask.dtype),
+      )
+    else:
+      key = context_slice(key, 1, 0.0, time_step, self.left_context)
+      value = context_slice(value, 1, 0.0, time_step, self.left_context)
+      atten_mask = context_slice(
+          atten_mask,
+          -1,
+          py_utils.get_large_negative_number(jnp.float32),
+          time_step,
+          self.left_context,
+      )
+      if relative_bias is not None:
+        relative_bias = context_slice(
+            relative_bias, -1, 0.0, time_step, self.left_context
+        )
 
     b, l, n, h = key.shape
     base_layer.assert_has_shape(value, [b, l, n, h])
-    base_layer.assert_has_shape(query, [b, n, h])
+    base_layer.assert_has_shape(query, [q_b, n, h])
     base_layer.assert_has_shape(atten_mask, [-1, 1, l])
-    asserts.in_set(atten_mask.shape[0], [b, 1])
+    asserts.in_set(atten_mask.shape[0], [q_b, 1])
     query = self._scale_query(query)
+    query = jnp.reshape(query, (b, num_samples, n, h))
     logits = jnp.einsum(
-        'BNH,BLNH->BNL',
+        'BRNH,BLNH->BRNL',
         query,
         key,
         _dot_general=self.make_qk_dot_general(),
     )
+    logits = jnp.reshape(logits, (q_b, n, l))
     if relative_bias is not None:
-      relative_bias = context_slice(
-          relative_bias, -1, 0.0, time_step, self.left_context
-      )
       base_layer.assert_has_shape(relative_bias, [-1, n, 1, l])
-      asserts.in_set(relative_bias.shape[0], [b, 1])
+      asserts.in_set(relative_bias.shape[0], [q_b, 1])
       relative_bias = jnp.squeeze(relative_bias, axis=2)
       logits += relative_bias
     logits = self._cap_logits(logits)
@@ -3001,11 +3436,12 @@ class LocalSelfAttention(DotProductAttention):
           key.dtype)
     # Compute the attention context.
     encoded = jnp.einsum(
-        'BNL,BLNH->BNH',
-        probs,
+        'BRNL,BLNH->BRNH',
+        jnp.reshape(probs, (b, num_samples, n, l)),
         value,
         _dot_general=self.make_pv_dot_general(),
     )
+    encoded = jnp.reshape(encoded, (q_b, n, h))
 
     if self.zero_fully_masked:
       # Return zeros for tokens which don't attend anything.
@@ -3018,11 +3454,36 @@ class LocalSelfAttention(DotProductAttention):
     encoded = self._shard_bnh(encoded)
     return encoded, probs  # pytype: disable=bad-return-type  # jax-ndarray
 
-  def init_states(self, target_batch_size: int,  # pytype: disable=signature-mismatch  # overriding-return-type-checks
-                  target_max_length: int) -> NestedMap:
+  def init_states(self, target_batch_size: int,
+                  target_max_length: int) -> None:
+    """Initializes the ring buffer decode cache.
 
-    raise NotImplementedError('init_states is not implemented for %s' %
-                              self.__name__)
+    Args:
+      target_batch_size: The batch size of the target to be decoded.
+      target_max_length: The sequence length of the target to be decoded. Only
+        recorded for decoding_state_sequence_length(), since the ring buffer
+        size only depends on the context size.
+
+    Returns:
+      None.
+    """
+    if not self.ring_buffer_decode_cache:
+      raise NotImplementedError('init_states is not implemented for %s' %
+                                self.__name__)
+    self.update_decode_state(
+        self._DECODE_LENGTH_STATE,
+        jnp.zeros([target_batch_size, target_max_length], dtype=jnp.int8),
+    )
+    dim_per_head = self.dim_per_head or self.hidden_dim // self.num_heads
+    state = jnp.zeros(
+        [target_batch_size, self._ring_buffer_size, self.num_heads,
+         dim_per_head],
+        dtype=self.fprop_dtype)
+    state_names = ['key_state', 'value_state']
+    if self.use_rotary_position_emb:
+      state_names.append('key_post_rotary_pos_emb')
+    for name in state_names:
+      self.update_decode_state(name, self._shard_blnh(state))
 
 
 class LocalSelfAttentionXL(LocalSelfAttention):
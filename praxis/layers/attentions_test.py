@@ -325,6 +325,89 @@ class AttentionsTest(test_utils.TestCase):
                [[[0, 0, 0, -1, -1], [0, 0, 0, -1, -1], [0, 0, 0, -1, -1],
                  [0, 0, 0, 0, -1], [0, 0, 0, 0, 0]]]])
 
+  @parameterized.product(
+      causal=[True, False],
+      use_segment_ids=[True, False],
+      local_window=[None, 3],
+  )
+  def test_implicit_attention_mask(self, causal, use_segment_ids,
+                                   local_window):
+    seq_len = 12
+    paddings = np.zeros([2, seq_len], np.float32)
+    paddings[0, 9:] = 1.0
+    segment_ids = np.array([[1] * 5 + [2] * 4 + [0] * 3, [1] * 7 + [2] * 5])
+    implicit_mask = attentions.ImplicitAttentionMask(
+        paddings=paddings,
+        segment_ids=segment_ids if use_segment_ids else None,
+        causal=causal,
+        local_window=local_window,
+    )
+    dense_mask = attentions.convert_paddings_to_mask(paddings)
+    if use_segment_ids:
+      dense_mask = jnp.minimum(
+          dense_mask, attentions.segment_mask(segment_ids))
+    if causal:
+      dense_mask = jnp.minimum(
+          dense_mask, attentions.causal_mask(jnp.zeros([2, seq_len, 1])))
+    if local_window is not None:
+      dense_mask = jnp.minimum(
+          dense_mask,
+          attentions.limited_context_mask(local_window, local_window - 1,
+                                          seq_len))
+    dense_mask = jnp.broadcast_to(dense_mask, [2, 1, seq_len, seq_len])
+    self.assertAllClose(
+        jnp.broadcast_to(
+            implicit_mask.to_dense(seq_len, seq_len), [2, 1, seq_len, seq_len]
+        ),
+        dense_mask,
+    )
+    logits = np.random.normal(size=[2, 4, seq_len, seq_len]).astype(np.float32)
+    self.assertAllClose(
+        implicit_mask.apply_to_logits(logits),
+        py_utils.apply_mask_to_logits(logits, dense_mask),
+    )
+
+  @parameterized.parameters([(True, False), (False, True), (True, True)])
+  def test_mha_implicit_attention_mask(self, causal, zero_fully_masked):
+    mdl_dim = 16
+    num_heads = 4
+    test_layer_p = pax_fiddle.Config(
+        attentions.DotProductAttention,
+        name='mh',
+        input_dim=mdl_dim,
+        hidden_dim=32,
+        num_heads=num_heads,
+        atten_logit_cap=20.0,
+        zero_fully_masked=zero_fully_masked,
+    )
+    layer = instantiate(test_layer_p)
+    batch_size, seq_len = 3, 10
+    query_vec = np.random.normal(
+        size=[batch_size, seq_len, mdl_dim]).astype(np.float32)
+    paddings = np.zeros([batch_size, seq_len], np.float32)
+    paddings[1, 6:] = 1.0
+    paddings[2, :] = 1.0
+    segment_ids = np.array([[1] * 4 + [2] * 6] * batch_size)
+    implicit_mask = attentions.ImplicitAttentionMask(
+        paddings=paddings, segment_ids=segment_ids, causal=causal)
+    dense_mask = jnp.minimum(
+        attentions.convert_paddings_to_mask(paddings),
+        attentions.segment_mask(segment_ids))
+    if causal:
+      dense_mask = jnp.minimum(dense_mask, attentions.causal_mask(query_vec))
+
+    with base_layer.JaxContext.new_context():
+      initial_vars = layer.init(
+          jax.random.PRNGKey(seed=123), query_vec, query_vec, query_vec,
+          dense_mask)
+      dense_out, dense_probs = layer.apply(
+          initial_vars, query_vec, query_vec, query_vec, dense_mask)
+      implicit_out, implicit_probs = jax.jit(layer.apply)(
+          initial_vars, query_vec, query_vec, query_vec, implicit_mask)
+
+    self.assertAllClose(implicit_out, dense_out)
+    self.assertAllClose(implicit_probs, dense_probs)
+
   @parameterized.parameters([
       (False, True, 3, True, True, True),
       (True, True, 3, True, True, True),
@@ -1375,6 +1458,147 @@ class AttentionsTest(test_utils.TestCase):
         logging.info('fprop_out[:, t, :]: %s', fprop_out[:, t, :])
         self.assertAllClose(fprop_out[:, t, :], encoded)
 
+  @parameterized.parameters([
+      (False, True, 1, 1),
+      (True, True, 2, 1),
+      (False, False, 3, 3),
+      (True, True, 4, 9),
+      (False, True, 5, 2),
+      (True, False, 8, 6),
+  ])
+  def test_local_attention_extend_step_ring_buffer(
+      self,
+      combine_qkv,
+      use_rotary_position_emb,
+      left_context,
+      prefix_len,
+  ):
+    mdl_dim = 16
+    hidden_dim = 32
+    num_heads = 4
+    test_layer_p = attentions.LocalSelfAttention.config(
+        left_context=left_context,
+        right_context=0,
+        ring_buffer_decode_cache=True,
+        name='mh',
+        input_dim=mdl_dim,
+        hidden_dim=hidden_dim,
+        num_heads=num_heads,
+        dim_per_head=16 if use_rotary_position_emb else None,
+        atten_logit_cap=20.0,
+        combine_qkv=combine_qkv,
+        use_rotary_position_emb=use_rotary_position_emb)
+    layer = instantiate(test_layer_p)
+    target_batch_size = 3
+    target_max_length = 16
+    query_vec = np.random.normal(
+        size=[target_batch_size, target_max_length, mdl_dim]).astype(np.float32)
+    prefix = query_vec[:, :prefix_len, :]
+    atten_mask = jnp.tile(
+        attentions.causal_mask(query_vec), (target_batch_size, 1, 1, 1)
+    )
+
+    with base_layer.JaxContext.new_context():
+      prng_key = jax.random.PRNGKey(seed=123)
+      initial_vars = layer.init(prng_key, query_vec, query_vec, query_vec,
+                                atten_mask)
+      fprop_out, _ = layer.apply(initial_vars, query_vec, query_vec, query_vec,
+                                 atten_mask)
+      # Updates decode states in fprop.
+      _, attention_states = layer.apply(
+          initial_vars,
+          prefix,
+          prefix,
+          prefix,
+          atten_mask[:, :, :prefix_len, :prefix_len],
+          mutable=[base_layer.DECODE_CACHE])
+
+      for t in range(prefix_len, target_max_length):
+        updated_vars = py_utils.merge_dict(attention_states, initial_vars)
+        encoded, attention_states = layer.apply(
+            updated_vars,
+            query_vec=query_vec[:, t, :],
+            atten_mask=atten_mask[:, :, t, :],
+            time_step=t,
+            segment_pos=None,
+            method=layer.extend_step,
+            mutable=[base_layer.DECODE_CACHE])
+        self.assertAllClose(fprop_out[:, t, :], encoded)
+        for name, state in attention_states[base_layer.DECODE_CACHE].items():
+          if name == 'decode_length':
+            self.assertEqual(state.shape[1], prefix_len)
+            continue
+          # The decode states never grow beyond the context size.
+          self.assertEqual(state.shape[1], left_context)
+
+  @parameterized.parameters([2, 5])
+  def test_local_attention_ring_buffer_relative_bias(self, left_context):
+    mdl_dim = 16
+    hidden_dim = 32
+    num_heads = 4
+    relative_bias_p = pax_fiddle.Config(
+        attentions.RelativeBias,
+        relative_attention_num_buckets=8,
+        relative_attention_max_distance=16,
+    )
+    test_layer_p = pax_fiddle.Config(
+        attentions.LocalSelfAttention,
+        name='mh',
+        left_context=left_context,
+        right_context=0,
+        ring_buffer_decode_cache=True,
+        input_dim=mdl_dim,
+        hidden_dim=hidden_dim,
+        num_heads=num_heads,
+        relative_bias_tpl=relative_bias_p,
+    )
+    # Full attention with a limited context mask as the reference.
+    ref_layer_p = pax_fiddle.Config(
+        attentions.DotProductAttention,
+        name='mh',
+        input_dim=mdl_dim,
+        hidden_dim=hidden_dim,
+        num_heads=num_heads,
+        relative_bias_tpl=relative_bias_p,
+    )
+    layer = instantiate(test_layer_p)
+    ref_layer = instantiate(ref_layer_p)
+    target_batch_size = 2
+    target_max_length = 9
+    query_vec = np.random.normal(
+        size=[target_batch_size, target_max_length, mdl_dim]).astype(np.float32)
+    atten_mask = attentions.limited_context_mask(
+        left_context, 0, target_max_length)[jnp.newaxis, jnp.newaxis]
+
+    # Decoding relative bias depends on time_step only in eval mode.
+    context_p = base_layer.JaxContext.HParams(do_eval=True)
+    with base_layer.JaxContext.new_context(hparams=context_p):
+      prng_key = jax.random.PRNGKey(seed=123)
+      segment_pos = jnp.tile(
+          jnp.arange(target_max_length)[jnp.newaxis], [target_batch_size, 1])
+      initial_vars = ref_layer.init(prng_key, query_vec, query_vec, query_vec,
+                                    atten_mask, segment_pos, segment_pos)
+      ref_out, _ = ref_layer.apply(initial_vars, query_vec, query_vec,
+                                   query_vec, atten_mask, segment_pos,
+                                   segment_pos)
+      _, attention_states = layer.apply(
+          initial_vars,
+          target_batch_size,
+          target_max_length,
+          method=layer.init_states,
+          mutable=[base_layer.DECODE_CACHE])
+      for t in range(target_max_length):
+        updated_vars = py_utils.merge_dict(attention_states, initial_vars)
+        encoded, attention_states = layer.apply(
+            updated_vars,
+            query_vec=query_vec[:, t, :],
+            atten_mask=attentions.causal_mask(query_vec)[:, :, t, :],
+            time_step=t,
+            segment_pos=None,
+            method=layer.extend_step,
+            mutable=[base_layer.DECODE_CACHE])
+        self.assertAllClose(ref_out[:, t, :], encoded)
+
   @parameterized.parameters([(False, True, 3, True), (True, True, 3, True),
                              (False, True, 4, False), (True, True, 4, True),
                              (False, False, 1, False), (True, False, 1, True),
@@ -1753,6 +1977,156 @@ class AttentionsTest(test_utils.TestCase):
           attention_states[base_layer.PREFIX_DECODE_CACHE]['key_state_0_pfx'],
           jnp.zeros((2, 0), jnp.int32))
 
+  @parameterized.parameters(*list(itertools.product([1, 3], [False, True])))
+  def test_mha_cross_attention_extend_step_multi_sample(self, num_samples,
+                                                        local_attention):
+    mdl_dim = 16
+    num_heads = 4
+    test_layer_p = pax_fiddle.Config(
+        attentions.DotProductAttention,
+        name='mh',
+        input_dim=mdl_dim,
+        hidden_dim=mdl_dim,
+        num_heads=num_heads,
+    )
+    if local_attention:
+      test_layer_p = pax_fiddle.Config(
+          attentions.LocalSelfAttention,
+          name='local',
+          input_dim=mdl_dim,
+          hidden_dim=mdl_dim,
+          num_heads=num_heads,
+          block_size=3,
+          left_context=3,
+          right_context=0,
+      )
+    layer = instantiate(test_layer_p)
+    batch_size = 2
+    source_len = 5
+    source_vec = np.random.normal(
+        size=[batch_size, source_len, mdl_dim]).astype(np.float32)
+    query_vec = np.random.normal(
+        size=[batch_size * num_samples, mdl_dim]).astype(np.float32)
+    source_paddings = np.zeros([batch_size, source_len], dtype=np.float32)
+    source_paddings[0, -2:] = 1.0
+    atten_mask = attentions.convert_paddings_to_mask(source_paddings)
+
+    with base_layer.JaxContext.new_context():
+      prng_key = jax.random.PRNGKey(seed=123)
+      initial_vars = layer.init(prng_key, source_vec, source_vec, source_vec,
+                                atten_mask)
+      _, attention_states = layer.apply(
+          initial_vars,
+          source_vec,
+          source_vec,
+          source_vec,
+          atten_mask,
+          mutable=[base_layer.DECODE_CACHE])
+      updated_vars = py_utils.merge_dict(attention_states, initial_vars)
+      encoded = layer.apply(
+          updated_vars,
+          method=layer.extend_step,
+          query_vec=query_vec,
+          atten_mask=atten_mask[:, :, 0],
+          time_step=source_len - 1,
+          segment_pos=None,
+          is_cross_attention=True)
+      # Reference: explicitly repeat the cross-attention states per sample.
+      repeated_states = jax.tree_map(
+          lambda x: jnp.repeat(x, num_samples, axis=0), attention_states)
+      repeated_vars = py_utils.merge_dict(repeated_states, initial_vars)
+      expected = layer.apply(
+          repeated_vars,
+          method=layer.extend_step,
+          query_vec=query_vec,
+          atten_mask=jnp.repeat(atten_mask[:, :, 0], num_samples, axis=0),
+          time_step=source_len - 1,
+          segment_pos=None,
+          is_cross_attention=True)
+    self.assertSequenceEqual(encoded.shape,
+                             [batch_size * num_samples, mdl_dim])
+    self.assertAllClose(expected, encoded)
+
+  @parameterized.parameters(*list(itertools.product([True, False], repeat=2)))
+  def test_mha_extend_step_with_beam_indirection(self, combine_qkv,
+                                                 use_rotary_position_emb):
+    mdl_dim = 4
+    hidden_dim = 8
+    num_heads = 2
+    layer_kwargs = dict(
+        name='mh',
+        input_dim=mdl_dim,
+        hidden_dim=hidden_dim,
+        num_heads=num_heads,
+        dim_per_head=4,
+        combine_qkv=combine_qkv,
+        use_rotary_position_emb=use_rotary_position_emb)
+    ref_layer = instantiate(
+        pax_fiddle.Config(attentions.DotProductAttention, **layer_kwargs))
+    test_layer = instantiate(
+        pax_fiddle.Config(attentions.DotProductAttentionWithBeamIndirection,
+                          **layer_kwargs))
+    batch_size = 2
+    beam_size = 3
+    prefix_len = 3
+    max_len = 8
+    prefix = np.random.normal(
+        size=[batch_size, prefix_len, mdl_dim]).astype(np.float32)
+    step_vecs = np.random.normal(
+        size=[max_len, batch_size * beam_size, mdl_dim]).astype(np.float32)
+    hyp_ids = np.random.randint(
+        0, beam_size, size=[max_len, batch_size, beam_size]).astype(np.int32)
+    prefix_atten_mask = attentions.causal_mask(prefix)
+    atten_mask = attentions.causal_mask(
+        np.zeros([1, max_len, mdl_dim], dtype=np.float32))
+
+    def _run_decode(layer, initial_vars):
+      _, states = layer.apply(
+          initial_vars,
+          prefix,
+          prefix,
+          prefix,
+          prefix_atten_mask,
+          mutable=[base_layer.DECODE_CACHE])
+      updated_vars = py_utils.merge_dict(states, initial_vars)
+      for transform_fn in (
+          decoder_utils.pad_state_fn(max_len - prefix_len),
+          decoder_utils.batch_broadcast_state_fn(beam_size)):
+        _, states = layer.apply(
+            updated_vars,
+            transform_fn,
+            method=layer.transform_decode_state,
+            mutable=[base_layer.DECODE_CACHE])
+        updated_vars = py_utils.merge_dict(states, initial_vars)
+      outputs = []
+      for t in range(prefix_len, max_len):
+        encoded, states = layer.apply(
+            updated_vars,
+            query_vec=step_vecs[t],
+            atten_mask=atten_mask[:, :, t, :],
+            time_step=t,
+            segment_pos=None,
+            method=layer.extend_step,
+            mutable=[base_layer.DECODE_CACHE])
+        updated_vars = py_utils.merge_dict(states, initial_vars)
+        outputs.append(encoded)
+        _, states = layer.apply(
+            updated_vars,
+            decoder_utils.BeamReorderStateFn(hyp_ids[t]),
+            method=layer.transform_decode_state,
+            mutable=[base_layer.DECODE_CACHE])
+        updated_vars = py_utils.merge_dict(states, initial_vars)
+      return outputs
+
+    with base_layer.JaxContext.new_context():
+      initial_vars = ref_layer.init(
+          jax.random.PRNGKey(seed=123), prefix, prefix, prefix,
+          prefix_atten_mask)
+      ref_outputs = _run_decode(ref_layer, initial_vars)
+      test_outputs = _run_decode(test_layer, initial_vars)
+    for ref_encoded, test_encoded in zip(ref_outputs, test_outputs):
+      self.assertAllClose(ref_encoded, test_encoded)
+
   def test_no_attention_decode_state(self):
     mdl_dim = 16
     hidden_dim = 32
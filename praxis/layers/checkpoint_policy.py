@@ -15,7 +15,11 @@
 
 """Gradient checkpoint policies that are supported by the `checkpoint` transform."""
 
+import dataclasses
 import enum
+from typing import Any, Callable, Dict, Optional, Sequence, Tuple
+
+from absl import logging
 import jax
 
 
@@ -34,10 +38,116 @@ class AutodiffCheckpointType(str, enum.Enum):
   SAVE_ITERATION_INPUT = 'save_iteration_input'
   SAVE_TRANSFORMER_LAYER_OUTPUT = 'save_transformer_layer_output'
   SAVE_QUANTIZED = 'save_quantized'
+  SAVE_NAMES = 'save_names'
+  OFFLOAD_ITERATION_INPUT = 'offload_iteration_input'
+  OFFLOAD_TRANSFORMER_LAYER_OUTPUT = 'offload_transformer_layer_output'
+  SAVE_AND_OFFLOAD_NAMES = 'save_and_offload_names'
+
+
+# `checkpoint_name` tags emitted by the attention and feed-forward layers.
+CHECKPOINT_NAMES_BY_LAYER_TYPE = {
+    'attention': (
+        'combined_qkv_proj',
+        'query_proj',
+        'key_proj',
+        'value_proj',
+        'logits',
+        'context',
+        'out_proj',
+    ),
+    'ffn': ('ffn1', 'ffn2'),
+}
+
+# Default order in which `select_checkpoint_plan` tries to save the names:
+# projections first as they are the most expensive to recompute per saved byte,
+# attention logits last as they grow quadratically with the sequence length and
+# only take a softmax to recompute from the projections.
+DEFAULT_CANDIDATE_NAMES = (
+    'combined_qkv_proj',
+    'query_proj',
+    'key_proj',
+    'value_proj',
+    'out_proj',
+    'ffn2',
+    'ffn1',
+    'context',
+    'logits',
+)
+
+
+def offloaded_names(
+    checkpoint_policy: AutodiffCheckpointType,
+    offloaded_checkpoint_names: Sequence[str] = (),
+) -> Tuple[str, ...]:
+  """Returns the `checkpoint_name` tags offloaded to host by the policy."""
+  if checkpoint_policy == AutodiffCheckpointType.OFFLOAD_ITERATION_INPUT:
+    return ('iteration_input',)
+  if checkpoint_policy == AutodiffCheckpointType.OFFLOAD_TRANSFORMER_LAYER_OUTPUT:
+    return ('transformer_layer_out',)
+  if checkpoint_policy == AutodiffCheckpointType.SAVE_AND_OFFLOAD_NAMES:
+    return tuple(offloaded_checkpoint_names)
+  return ()
+
+
+def supports_host_offloading() -> bool:
+  """Returns whether the JAX version and the devices can offload to host."""
+  if not hasattr(jax.checkpoint_policies, 'save_and_offload_only_these_names'):
+    return False
+  try:
+    memories = jax.devices()[0].addressable_memories()
+  except NotImplementedError:
+    return False
+  return any(m.kind == 'pinned_host' for m in memories)
+
+
+def save_and_offload_only_these_names(
+    names_which_can_be_saved: Sequence[str],
+    names_which_can_be_offloaded: Sequence[str],
+):
+  """Saves some names in device memory and offloads others to host memory.
+
+  The offloaded residuals are moved to pinned host memory during the forward
+  pass and brought back to the device when the backward pass needs them.
+
+  Args:
+    names_which_can_be_saved: Names to save in device memory.
+    names_which_can_be_offloaded: Names to offload to host memory.
+
+  Returns:
+    A JAX Autodiff checkpointing policy. When offloading is not supported, e.g.
+    on CPU, the offloaded names are saved in device memory instead.
+  """
+  if supports_host_offloading():
+    return jax.checkpoint_policies.save_and_offload_only_these_names(
+        names_which_can_be_saved=list(names_which_can_be_saved),
+        names_which_can_be_offloaded=list(names_which_can_be_offloaded),
+        offload_src='device',
+        offload_dst='pinned_host',
+    )
+  logging.warning(
+      'Offloading %s to host memory is not supported, they are saved in '
+      'device memory instead.',
+      names_which_can_be_offloaded,
+  )
+  return jax.checkpoint_policies.save_only_these_names(
+      *names_which_can_be_saved, *names_which_can_be_offloaded
+  )
 
 
-def custom_policy(checkpoint_policy: AutodiffCheckpointType):
-  """Returns a JAX Autodiff checkpointing policy from the enum value."""
+def custom_policy(
+    checkpoint_policy: AutodiffCheckpointType,
+    checkpoint_names: Sequence[str] = (),
+    offloaded_checkpoint_names: Sequence[str] = (),
+):
+  """Returns a JAX Autodiff checkpointing policy from the enum value.
+
+  Args:
+    checkpoint_policy: The checkpoint policy type.
+    checkpoint_names: The `checkpoint_name` tags to save in device memory, only
+      used with AutodiffCheckpointType.SAVE_NAMES and SAVE_AND_OFFLOAD_NAMES.
+    offloaded_checkpoint_names: The `checkpoint_name` tags to offload to host
+      memory, only used with AutodiffCheckpointType.SAVE_AND_OFFLOAD_NAMES.
+  """
   # TODO(zhangqiaorjc): Configure custom checkpoint policy in expt config
   # without introducing enum.
   if checkpoint_policy == AutodiffCheckpointType.SAVE_EVERYTHING:
@@ -69,6 +179,19 @@ def custom_policy(checkpoint_policy: AutodiffCheckpointType):
         'lhs_scale',
         'rhs_scale',
     )
+  if checkpoint_policy == AutodiffCheckpointType.SAVE_NAMES:
+    return jax.checkpoint_policies.save_only_these_names(*checkpoint_names)
+  if checkpoint_policy in (
+      AutodiffCheckpointType.OFFLOAD_ITERATION_INPUT,
+      AutodiffCheckpointType.OFFLOAD_TRANSFORMER_LAYER_OUTPUT,
+  ):
+    return save_and_offload_only_these_names(
+        (), offloaded_names(checkpoint_policy)
+    )
+  if checkpoint_policy == AutodiffCheckpointType.SAVE_AND_OFFLOAD_NAMES:
+    return save_and_offload_only_these_names(
+        checkpoint_names, offloaded_checkpoint_names
+    )
   if checkpoint_policy == AutodiffCheckpointType.SAVE_ITERATION_INPUT:
     return jax.checkpoint_policies.save_only_these_names('iteration_input')
   if checkpoint_policy == AutodiffCheckpointType.SAVE_TRANSFORMER_LAYER_OUTPUT:
@@ -76,3 +199,230 @@ def custom_policy(checkpoint_policy: AutodiffCheckpointType):
         'transformer_layer_out')
   assert checkpoint_policy == AutodiffCheckpointType.SAVE_NOTHING
   return jax.checkpoint_policies.nothing_saveable
+
+
+def compiled_activation_bytes(loss_fn: Callable[..., Any], *args) -> int:
+  """Returns the temporary memory of the gradient step as compiled by XLA.
+
+  Args:
+    loss_fn: A scalar loss function, differentiated w.r.t. its first argument.
+    *args: Example arguments, arrays or jax.ShapeDtypeStruct.
+
+  Returns:
+    The per-device temporary buffer size from the XLA memory analysis of the
+    compiled gradient step, or 0 if the backend does not provide one.
+  """
+  compiled = jax.jit(jax.grad(loss_fn)).lower(*args).compile()
+  memory_analysis = compiled.memory_analysis()
+  if memory_analysis is None:
+    return 0
+  return int(memory_analysis.temp_size_in_bytes)
+
+
+def residual_bytes(loss_fn: Callable[..., Any], *args) -> int:
+  """Returns the size of the residuals saved by `loss_fn` for the backward pass.
+
+  Unlike compiled_activation_bytes, this does not account for the buffers of
+  the backward pass itself but is independent of the backend.
+
+  Args:
+    loss_fn: A loss function.
+    *args: Example arguments, arrays or jax.ShapeDtypeStruct.
+  """
+  residuals = jax.eval_shape(
+      lambda *a: jax.tree_util.tree_leaves(jax.vjp(loss_fn, *a)[1]), *args
+  )
+  return sum(r.size * r.dtype.itemsize for r in residuals)
+
+
+def _iterate_eqns(jaxpr: jax.core.Jaxpr, multiplier: int = 1):
+  """Yields the equations of `jaxpr` and of its sub-jaxprs.
+
+  Args:
+    jaxpr: The jaxpr to iterate over.
+    multiplier: The number of times `jaxpr` is executed.
+
+  Yields:
+    Tuples of an equation and of the number of times it is executed, i.e.
+    multiplied by the length of the enclosing scans.
+  """
+  for eqn in jaxpr.eqns:
+    yield eqn, multiplier
+    sub_multiplier = multiplier
+    if eqn.primitive.name == 'scan':
+      sub_multiplier *= eqn.params['length']
+    for param in eqn.params.values():
+      for sub_jaxpr in param if isinstance(param, (list, tuple)) else [param]:
+        if isinstance(sub_jaxpr, jax.core.ClosedJaxpr):
+          sub_jaxpr = sub_jaxpr.jaxpr
+        if isinstance(sub_jaxpr, jax.core.Jaxpr):
+          yield from _iterate_eqns(sub_jaxpr, sub_multiplier)
+
+
+def named_activation_bytes(fn: Callable[..., Any], *args) -> Dict[str, int]:
+  """Returns the total size of the activations tagged by `checkpoint_name`.
+
+  Activations tagged inside a scan, e.g. in the body of a `Repeat` layer, are
+  counted once per iteration.
+
+  Args:
+    fn: The function to trace.
+    *args: Example arguments, arrays or jax.ShapeDtypeStruct.
+  """
+  sizes = {}
+  for eqn, multiplier in _iterate_eqns(jax.make_jaxpr(fn)(*args).jaxpr):
+    if eqn.primitive.name == 'name':
+      aval = eqn.outvars[0].aval
+      sizes[eqn.params['name']] = sizes.get(eqn.params['name'], 0) + (
+          multiplier * aval.size * aval.dtype.itemsize
+      )
+  return sizes
+
+
+def _host_transfer_bytes(eqn: jax.core.JaxprEqn) -> int:
+  """Returns the bytes moved to pinned host memory by a `device_put`."""
+  if eqn.primitive.name != 'device_put':
+    return 0
+  # Newer JAX versions batch several operands in a single device_put.
+  devices = eqn.params.get('devices', [eqn.params.get('device')])
+  host_bytes = 0
+  for device, outvar in zip(devices, eqn.outvars):
+    if getattr(device, 'memory_kind', None) == 'pinned_host':
+      host_bytes += outvar.aval.size * outvar.aval.dtype.itemsize
+  return host_bytes
+
+
+def offload_residual_bytes(
+    loss_fn: Callable[..., Any], *args
+) -> Tuple[int, int]:
+  """Splits the residuals of `loss_fn` between device and host memory.
+
+  The host residuals are the ones the checkpoint policy of `loss_fn` moves to
+  pinned host memory in the forward pass. When offloading is not supported,
+  the policy saves them in device memory instead.
+
+  Args:
+    loss_fn: A loss function, rematerialized with an offloading policy.
+    *args: Example arguments, arrays or jax.ShapeDtypeStruct.
+
+  Returns:
+    A tuple of the residual bytes kept in device memory and of the ones
+    offloaded to host memory.
+  """
+  total_bytes = residual_bytes(loss_fn, *args)
+  if not supports_host_offloading():
+    return total_bytes, 0
+  jaxpr = jax.make_jaxpr(
+      lambda *a: jax.tree_util.tree_leaves(jax.vjp(loss_fn, *a)[1])
+  )(*args)
+  host_bytes = sum(
+      multiplier * _host_transfer_bytes(eqn)
+      for eqn, multiplier in _iterate_eqns(jaxpr.jaxpr)
+  )
+  return total_bytes - host_bytes, host_bytes
+
+
+@dataclasses.dataclass(frozen=True)
+class CheckpointPlan:
+  """A selection of `checkpoint_name` tags to save for the backward pass.
+
+  Attributes:
+    saved_names: The names to save, all others are rematerialized.
+    activation_bytes: The estimated activation memory of the plan.
+    memory_budget_bytes: The budget the plan was selected for.
+    candidate_bytes: The estimated activation memory when adding each tried
+      candidate name to the plan, in the order they were tried.
+  """
+  saved_names: Tuple[str, ...]
+  activation_bytes: int
+  memory_budget_bytes: int
+  candidate_bytes: Tuple[Tuple[str, int], ...] = ()
+
+  def policy(self):
+    """Returns the JAX Autodiff checkpointing policy of the plan."""
+    return custom_policy(AutodiffCheckpointType.SAVE_NAMES, self.saved_names)
+
+  def names_by_layer_type(self) -> Dict[str, Tuple[str, ...]]:
+    """Returns the saved names grouped by the layer type emitting them."""
+    grouped = {}
+    for layer_type, names in CHECKPOINT_NAMES_BY_LAYER_TYPE.items():
+      grouped[layer_type] = tuple(n for n in names if n in self.saved_names)
+    others = tuple(
+        n
+        for n in self.saved_names
+        if not any(n in v for v in CHECKPOINT_NAMES_BY_LAYER_TYPE.values())
+    )
+    if others:
+      grouped['other'] = others
+    return grouped
+
+
+def select_checkpoint_plan(
+    loss_fn_for_names: Callable[[Tuple[str, ...]], Callable[..., Any]],
+    args: Sequence[Any],
+    memory_budget_bytes: int,
+    candidate_names: Sequence[str] = DEFAULT_CANDIDATE_NAMES,
+    memory_fn: Optional[Callable[..., int]] = None,
+) -> CheckpointPlan:
+  """Greedily selects the names to save under an activation memory budget.
+
+  Starting from rematerializing everything, the candidate names are tried in
+  order and each is kept if the activation memory of the gradient step still
+  fits in the budget. Names earlier in `candidate_names` are hence preferred.
+  This takes one compilation per candidate.
+
+  Args:
+    loss_fn_for_names: Builds a scalar loss function `loss_fn(*args)` saving
+      only the given names, e.g. by setting them as the checkpoint_names of a
+      `Repeat` layer with the SAVE_NAMES policy. It is differentiated w.r.t.
+      its first argument.
+    args: Example arguments of the loss function, arrays or
+      jax.ShapeDtypeStruct.
+    memory_budget_bytes: The per-device activation memory budget.
+    candidate_names: The `checkpoint_name` tags to consider, by preference.
+    memory_fn: Estimates the activation memory of a loss function for example
+      arguments. Defaults to compiled_activation_bytes, residual_bytes can be
+      used on backends without memory analysis.
+
+  Returns:
+    The selected CheckpointPlan.
+
+  Raises:
+    ValueError: if the budget is exceeded even when saving nothing.
+  """
+  if memory_fn is None:
+    memory_fn = compiled_activation_bytes
+
+  def _activation_bytes(names):
+    return memory_fn(loss_fn_for_names(names), *args)
+
+  saved_names = ()
+  activation_bytes = _activation_bytes(saved_names)
+  if activation_bytes > memory_budget_bytes:
+    raise ValueError(
+        f'Activation memory of {activation_bytes} bytes when saving nothing '
+        f'exceeds the budget of {memory_budget_bytes} bytes.'
+    )
+  candidate_bytes = []
+  for name in candidate_names:
+    if name in saved_names:
+      continue
+    new_bytes = _activation_bytes(saved_names + (name,))
+    candidate_bytes.append((name, new_bytes))
+    if new_bytes <= memory_budget_bytes:
+      saved_names += (name,)
+      activation_bytes = new_bytes
+
+  plan = CheckpointPlan(
+      saved_names=saved_names,
+      activation_bytes=activation_bytes,
+      memory_budget_bytes=memory_budget_bytes,
+      candidate_bytes=tuple(candidate_bytes),
+  )
+  logging.info(
+      'Selected checkpoint plan %s using %d of %d bytes.',
+      plan.names_by_layer_type(),
+      activation_bytes,
+      memory_budget_bytes,
+  )
+  return plan
@@ -0,0 +1,254 @@
+# coding=utf-8
+# Copyright 2022 The Pax Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for Praxis checkpoint policies."""
+
+from unittest import mock
+
+from absl.testing import absltest
+from absl.testing import parameterized
+import jax
+from jax import numpy as jnp
+import numpy as np
+from praxis import base_layer
+from praxis import pax_fiddle
+from praxis import test_utils
+from praxis.layers import checkpoint_policy
+from praxis.layers import transformers
+
+instantiate = base_layer.instantiate
+AutodiffCheckpointType = checkpoint_policy.AutodiffCheckpointType
+
+
+class CheckpointPolicyTest(test_utils.TestCase, parameterized.TestCase):
+
+  def setUp(self):
+    super().setUp()
+    np.random.seed(123456)
+
+  def _loss_fn_for_names(
+      self,
+      names,
+      policy=AutodiffCheckpointType.SAVE_NAMES,
+      offloaded_names=(),
+  ):
+    p = pax_fiddle.Config(
+        transformers.StackedTransformerRepeated,
+        name='repeated',
+        x_times=2,
+        checkpoint_policy=policy,
+        checkpoint_names=names,
+        offloaded_checkpoint_names=offloaded_names,
+        block=pax_fiddle.Config(
+            transformers.StackedTransformer,
+            model_dims=16,
+            hidden_dims=32,
+            num_heads=2,
+            num_layers=1,
+        ),
+    )
+    layer = instantiate(p)
+
+    def loss_fn(mdl_vars, inputs, paddings):
+      with base_layer.JaxContext.new_context():
+        outputs = layer.apply(mdl_vars, inputs, paddings)
+      return jnp.mean(outputs**2)
+
+    return layer, loss_fn
+
+  def _inputs(self):
+    inputs = jnp.asarray(np.random.normal(size=[2, 32, 16]), jnp.float32)
+    paddings = jnp.zeros([2, 32], jnp.float32)
+    layer, _ = self._loss_fn_for_names(())
+    with base_layer.JaxContext.new_context():
+      mdl_vars = layer.init(jax.random.PRNGKey(1234), inputs, paddings)
+    return mdl_vars, inputs, paddings
+
+  def test_save_names_policy(self):
+    def fn(x):
+      h = jax.ad_checkpoint.checkpoint_name(jnp.sin(x), 'h')
+      return jnp.sum(jnp.sin(h))
+
+    x = jnp.ones([8, 4], jnp.float32)
+    nothing_bytes = checkpoint_policy.residual_bytes(
+        jax.checkpoint(
+            fn,
+            policy=checkpoint_policy.custom_policy(
+                AutodiffCheckpointType.SAVE_NAMES
+            ),
+        ),
+        x,
+    )
+    saved_bytes = checkpoint_policy.residual_bytes(
+        jax.checkpoint(
+            fn,
+            policy=checkpoint_policy.custom_policy(
+                AutodiffCheckpointType.SAVE_NAMES, ['h']
+            ),
+        ),
+        x,
+    )
+    self.assertEqual(saved_bytes - nothing_bytes, 8 * 4 * 4)
+
+  def test_select_checkpoint_plan(self):
+    args = self._inputs()
+    loss_fn_for_names = lambda names: self._loss_fn_for_names(names)[1]
+    # A budget that fits everything but the attention logits.
+    names = tuple(
+        n for n in checkpoint_policy.DEFAULT_CANDIDATE_NAMES if n != 'logits'
+    )
+    budget = checkpoint_policy.residual_bytes(loss_fn_for_names(names), *args)
+    plan = checkpoint_policy.select_checkpoint_plan(
+        loss_fn_for_names,
+        args,
+        budget,
+        memory_fn=checkpoint_policy.residual_bytes,
+    )
+    self.assertEqual(plan.saved_names, names)
+    self.assertLessEqual(plan.activation_bytes, budget)
+    self.assertEqual(
+        [n for n, _ in plan.candidate_bytes],
+        list(checkpoint_policy.DEFAULT_CANDIDATE_NAMES),
+    )
+    self.assertGreater(plan.candidate_bytes[-1][1], budget)
+    self.assertEqual(
+        plan.names_by_layer_type(),
+        {
+            'attention': (
+                'combined_qkv_proj',
+                'query_proj',
+                'key_proj',
+                'value_proj',
+                'context',
+                'out_proj',
+            ),
+            'ffn': ('ffn1', 'ffn2'),
+        },
+    )
+
+    # Rematerialization does not change the gradients.
+    grads = jax.grad(loss_fn_for_names(plan.saved_names))(*args)
+    expected_grads = jax.grad(loss_fn_for_names(()))(*args)
+    for g, e in zip(
+        jax.tree_util.tree_leaves(grads),
+        jax.tree_util.tree_leaves(expected_grads),
+    ):
+      self.assertAllClose(g, e)
+
+  def test_select_checkpoint_plan_prefers_earlier_names(self):
+    sizes = {'a': 3, 'b': 2, 'c': 1}
+    loss_fn_for_names = lambda names: names
+    memory_fn = lambda names: sum(sizes[n] for n in names)
+    plan = checkpoint_policy.select_checkpoint_plan(
+        loss_fn_for_names,
+        (),
+        4,
+        candidate_names=('b', 'a', 'c'),
+        memory_fn=memory_fn,
+    )
+    self.assertEqual(plan.saved_names, ('b', 'c'))
+    self.assertEqual(plan.activation_bytes, 3)
+    self.assertEqual(plan.candidate_bytes, (('b', 2), ('a', 5), ('c', 3)))
+    self.assertEqual(
+        plan.names_by_layer_type(),
+        {'attention': (), 'ffn': (), 'other': ('b', 'c')},
+    )
+
+  def test_select_checkpoint_plan_over_budget(self):
+    with self.assertRaisesRegex(ValueError, 'exceeds the budget'):
+      checkpoint_policy.select_checkpoint_plan(
+          lambda names: names, (), 0, memory_fn=lambda names: 1
+      )
+
+  def test_compiled_activation_bytes(self):
+    args = self._inputs()
+    _, loss_fn = self._loss_fn_for_names(('query_proj',))
+    self.assertGreaterEqual(
+        checkpoint_policy.compiled_activation_bytes(loss_fn, *args), 0
+    )
+
+  @parameterized.parameters(
+      (AutodiffCheckpointType.OFFLOAD_ITERATION_INPUT, (), ()),
+      (AutodiffCheckpointType.OFFLOAD_TRANSFORMER_LAYER_OUTPUT, (), ()),
+      (
+          AutodiffCheckpointType.SAVE_AND_OFFLOAD_NAMES,
+          ('out_proj',),
+          ('ffn1', 'iteration_input'),
+      ),
+  )
+  def test_offload_policy(self, policy, names, offloaded_names):
+    args = self._inputs()
+    _, loss_fn = self._loss_fn_for_names(names, policy, offloaded_names)
+    _, expected_loss_fn = self._loss_fn_for_names(
+        (), AutodiffCheckpointType.SAVE_NOTHING
+    )
+    loss, grads = jax.jit(jax.value_and_grad(loss_fn))(*args)
+    expected_loss, expected_grads = jax.value_and_grad(expected_loss_fn)(*args)
+    self.assertAllClose(loss, expected_loss)
+    for g, e in zip(
+        jax.tree_util.tree_leaves(grads),
+        jax.tree_util.tree_leaves(expected_grads),
+    ):
+      self.assertAllClose(g, e)
+
+  @parameterized.parameters(
+      (AutodiffCheckpointType.OFFLOAD_ITERATION_INPUT, ()),
+      (AutodiffCheckpointType.OFFLOAD_TRANSFORMER_LAYER_OUTPUT, ()),
+      (AutodiffCheckpointType.SAVE_AND_OFFLOAD_NAMES, ('ffn1',)),
+  )
+  def test_offload_fallback_saves_on_device(self, policy, offloaded_names):
+    args = self._inputs()
+    names = checkpoint_policy.offloaded_names(policy, offloaded_names)
+    _, loss_fn = self._loss_fn_for_names((), policy, offloaded_names)
+    _, save_loss_fn = self._loss_fn_for_names(names)
+    with mock.patch.object(
+        checkpoint_policy, 'supports_host_offloading', return_value=False
+    ):
+      with self.assertLogs(level='WARNING') as logs:
+        device_bytes, host_bytes = checkpoint_policy.offload_residual_bytes(
+            loss_fn, *args
+        )
+    self.assertIn('is not supported', logs.output[0])
+    # The offloaded names are saved in device memory instead.
+    self.assertEqual(host_bytes, 0)
+    self.assertEqual(
+        device_bytes, checkpoint_policy.residual_bytes(save_loss_fn, *args)
+    )
+
+  @parameterized.parameters(
+      (AutodiffCheckpointType.OFFLOAD_ITERATION_INPUT, (), 2 * 32 * 16),
+      (AutodiffCheckpointType.OFFLOAD_TRANSFORMER_LAYER_OUTPUT, (), 2 * 32 * 16),
+      (AutodiffCheckpointType.SAVE_AND_OFFLOAD_NAMES, ('ffn1',), 2 * 32 * 32),
+  )
+  def test_offload_residual_bytes(self, policy, offloaded_names, elements):
+    if not checkpoint_policy.supports_host_offloading():
+      self.skipTest('Host offloading is not supported.')
+    args = self._inputs()
+    _, loss_fn = self._loss_fn_for_names((), policy, offloaded_names)
+    names = checkpoint_policy.offloaded_names(policy, offloaded_names)
+    device_bytes, host_bytes = checkpoint_policy.offload_residual_bytes(
+        loss_fn, *args
+    )
+    # Offloaded once per repeated layer.
+    self.assertEqual(host_bytes, 2 * elements * 4)
+    # Offloading frees the device memory of saving the same names.
+    _, save_loss_fn = self._loss_fn_for_names(names)
+    self.assertEqual(
+        device_bytes + host_bytes,
+        checkpoint_policy.residual_bytes(save_loss_fn, *args),
+    )
+
+if __name__ == '__main__':
+  absltest.main()
@@ -15,7 +15,7 @@
 
 """Conformer-related layers."""
 
-from typing import Optional, Tuple
+from typing import Callable, Optional, Tuple
 
 import fiddle as fdl
 import jax.numpy as jnp
@@ -86,6 +86,101 @@ class DotProductAttentionWithContext(attentions.DotProductAttention):
       atten_mask = jnp.minimum(atten_mask, input_atten_mask)
     return super()._dot_atten(query, key, value, atten_mask, relative_bias)
 
+  def _streaming_cache_size(self) -> int:
+    assert self.left_context is not None and self.right_context == 0, (
+        'Streaming requires a bounded left_context and right_context=0.'
+    )
+    return self.left_context - 1
+
+  def init_states(
+      self, target_batch_size: int, target_max_length: Optional[int] = None
+  ) -> None:
+    """Initializes the bounded key/value cache for `extend_chunk`.
+
+    The cache keeps the projected keys and values of the last
+    `left_context - 1` frames, independently of the sequence length.
+
+    Args:
+      target_batch_size: The batch size of the streamed inputs.
+      target_max_length: Unused, the cache size only depends on left_context.
+    """
+    del target_max_length
+    cache_size = self._streaming_cache_size()
+    dim_per_head = self.dim_per_head or self.hidden_dim // self.num_heads
+    shape = [target_batch_size, cache_size, self.num_heads, dim_per_head]
+    self.update_decode_state(
+        'stream_key_state', jnp.zeros(shape, self.fprop_dtype))
+    self.update_decode_state(
+        'stream_value_state', jnp.zeros(shape, self.fprop_dtype))
+    # The cache starts empty, all of its frames are padded.
+    self.update_decode_state(
+        'stream_paddings',
+        jnp.ones([target_batch_size, cache_size], self.fprop_dtype))
+
+  def extend_chunk(self, query_vec: JTensor, paddings: JTensor) -> JTensor:
+    """Self attention on the next chunk of a streamed sequence.
+
+    Each frame attends to itself and the previous `left_context - 1` frames of
+    the sequence, so the outputs match the corresponding frames of a full
+    sequence self attention with the same context.
+
+    Args:
+      query_vec: Input chunk JTensor of shape [B, C, D].
+      paddings: Input chunk paddings JTensor of shape [B, C].
+
+    Returns:
+      The attention output of the chunk with shape [B, C, D].
+    """
+    assert not (
+        self.dconv_qkv
+        or self.use_rotary_position_emb
+        or self.relative_bias_tpl
+        or self.ngrammer_tpl
+    ), 'Streaming only supports plain dot-product self attention.'
+    cache_size = self._streaming_cache_size()
+    chunk_size = query_vec.shape[1]
+    if self.combine_qkv:
+      query_proj, key_proj, value_proj = self.combined_qkv(query_vec)
+    else:
+      query_proj = self.query(query_vec)
+      key_proj = self.key(query_vec)
+      value_proj = self.value(query_vec)
+
+    key_state = self.get_decode_state('stream_key_state')
+    value_state = self.get_decode_state('stream_value_state')
+    key_paddings = self.get_decode_state('stream_paddings')
+    key_proj = jnp.concatenate(
+        [key_state.astype(key_proj.dtype), key_proj], axis=1)
+    value_proj = jnp.concatenate(
+        [value_state.astype(value_proj.dtype), value_proj], axis=1)
+    key_paddings = jnp.concatenate(
+        [key_paddings, paddings.astype(key_paddings.dtype)], axis=1)
+
+    # Frame t of the chunk is frame cache_size + t of the keys.
+    query_pos = cache_size + jnp.arange(chunk_size)[:, jnp.newaxis]
+    key_pos = jnp.arange(cache_size + chunk_size)[jnp.newaxis, :]
+    in_context = (key_pos <= query_pos) & (
+        query_pos - key_pos < self.left_context)
+    context_mask = jnp.where(
+        in_context, 0.0, py_utils.get_large_negative_number(query_vec.dtype)
+    ).astype(query_vec.dtype)
+    atten_mask = jnp.minimum(
+        attentions.convert_paddings_to_mask(key_paddings, query_vec.dtype),
+        context_mask[jnp.newaxis, jnp.newaxis],
+    )
+    encoded, _ = super()._dot_atten(
+        query_proj, key_proj, value_proj, atten_mask)
+    encoded = self.post(encoded)
+    encoded = self._shard_bld(encoded)
+
+    self.update_decode_state(
+        'stream_key_state', key_proj[:, chunk_size:].astype(key_state.dtype))
+    self.update_decode_state(
+        'stream_value_state',
+        value_proj[:, chunk_size:].astype(value_state.dtype))
+    self.update_decode_state('stream_paddings', key_paddings[:, chunk_size:])
+    return encoded
+
 
 class DotProductAttentionWithContextXL(attentions.DotProductAttentionXL):
   """Dot-product attention with given left and right context.
@@ -223,7 +318,37 @@ class SelfAttentionWithNormAndResidual(base_layer.BaseLayer):
         key_vec=inputs,
         value_vec=inputs,
         atten_mask=atten_mask)[0]
+    return self._add_residual(result, unnormalized_inputs)
+
+  def init_states(self, batch_size: int) -> None:
+    """Initializes the attention cache for streaming with `extend_step`.
+
+    Args:
+      batch_size: The batch size of the streamed inputs.
+    """
+    self.self_atten.init_states(batch_size)
+
+  def extend_step(self, inputs: JTensor, paddings: JTensor) -> JTensor:
+    """Self attention sub-layer on the next chunk of a streamed sequence.
+
+    Requires a `DotProductAttentionWithContext` self attention with a bounded
+    left_context and right_context=0.
+
+    Args:
+      inputs: Input chunk JTensor of shape [B, C, D].
+      paddings: Input chunk paddings JTensor of shape [B, C].
 
+    Returns:
+      The output of the chunk with shape [B, C, D].
+    """
+    unnormalized_inputs = inputs
+    if self.pre_layer_norm:
+      inputs = self.norm(inputs)
+    result = self.self_atten.extend_chunk(inputs, paddings)
+    return self._add_residual(result, unnormalized_inputs)
+
+  def _add_residual(self, result: JTensor,
+                    unnormalized_inputs: JTensor) -> JTensor:
     result = (
         self.residual_dropout(result) * self.residual_weight
         + unnormalized_inputs * self.input_weight
@@ -438,23 +563,69 @@ class Conformer(base_layer.BaseLayer):
     if atten_mask is not None and 'mhsa' not in self.layer_order:
       raise RuntimeError('Attention mask is provided but no attention layer.')
 
+    return self._conformer(
+        inputs,
+        paddings,
+        atten_fn=lambda x, p: self.trans_atten(  # pylint: disable=g-long-lambda
+            inputs=x, paddings=p, atten_mask=atten_mask),
+        lconv_fn=lambda x, p: self.lconv(x, p),
+    )
+
+  def init_states(self, batch_size: int) -> None:
+    """Initializes the attention and conv caches for `extend_step`.
+
+    Args:
+      batch_size: The batch size of the streamed inputs.
+    """
+    if 'mhsa' in self.layer_order:
+      self.trans_atten.init_states(batch_size)
+    if 'conv' in self.layer_order:
+      self.lconv.init_states(batch_size)
+
+  def extend_step(self, inputs: JTensor, paddings: JTensor) -> JTensor:
+    """Conformer layer on the next chunk of a streamed sequence.
+
+    Each chunk costs O(chunk size * left_context) instead of re-running the
+    whole sequence. Streaming requires a causal `lconv_tpl` with a frame-wise
+    conv norm (e.g. BatchNorm in eval mode), and an attention with a bounded
+    left_context and right_context=0. The outputs then match the corresponding
+    frames of `__call__` on the whole sequence.
+
+    Args:
+      inputs: Input chunk JTensor of shape [B, C, H].
+      paddings: Input chunk paddings JTensor of shape [B, C].
+
+    Returns:
+      The conformer output of the chunk with shape [B, C, D].
+    """
+    return self._conformer(
+        inputs,
+        paddings,
+        atten_fn=lambda x, p: self.trans_atten.extend_step(x, p),
+        lconv_fn=lambda x, p: self.lconv.extend_step(x, p),
+    )
+
+  def _conformer(
+      self,
+      inputs: JTensor,
+      paddings: JTensor,
+      atten_fn: Callable[[JTensor, JTensor], JTensor],
+      lconv_fn: Callable[[JTensor, JTensor], JTensor],
+  ) -> JTensor:
     if self.has_fflayer_start:
       inputs = self.fflayer_start(inputs, paddings)
 
     if self.layer_order == 'mhsa':
-      inputs = self.trans_atten(
-          inputs=inputs, paddings=paddings, atten_mask=atten_mask)
+      inputs = atten_fn(inputs, paddings)
     elif self.layer_order == 'conv':
-      inputs = self.lconv(inputs, paddings)
+      inputs = lconv_fn(inputs, paddings)
     elif self.layer_order == 'mhsa_before_conv':
-      inputs = self.trans_atten(
-          inputs=inputs, paddings=paddings, atten_mask=atten_mask)
-      inputs = self.lconv(inputs, paddings)
+      inputs = atten_fn(inputs, paddings)
+      inputs = lconv_fn(inputs, paddings)
     else:
       assert self.layer_order == 'conv_before_mhsa'
-      inputs = self.lconv(inputs, paddings)
-      inputs = self.trans_atten(
-          inputs=inputs, paddings=paddings, atten_mask=atten_mask)
+      inputs = lconv_fn(inputs, paddings)
+      inputs = atten_fn(inputs, paddings)
 
     if self.has_fflayer_end:
       inputs = self.fflayer_end(inputs, paddings)
@@ -301,6 +301,61 @@ class ConformerTest(test_utils.TestCase):
                         mask.shape + (1,) * (out_local.ndim - mask.ndim))
       self.assertAllClose(out_local * mask, out_global * mask, atol=1e-5)
 
+  @parameterized.parameters(
+      ('mhsa_before_conv', 1, 3, False),
+      ('mhsa_before_conv', 4, 5, True),
+      ('conv_before_mhsa', 3, 2, False),
+      ('mhsa', 12, 4, True),
+      ('conv', 2, None, False),
+  )
+  def test_conformer_extend_step(self, layer_order, chunk_size, left_context,
+                                 combine_qkv):
+    p = pax_fiddle.Config(
+        conformers.Conformer,
+        name='jax_conformer_layer',
+        input_dims=8,
+        model_dims=8,
+        kernel_size=3,
+        atten_num_heads=2,
+        layer_order=layer_order,
+    )
+    p.lconv_tpl.is_causal = True
+    p.trans_atten_tpl.self_atten_tpl.set(
+        left_context=left_context, right_context=0, combine_qkv=combine_qkv)
+    conformer = instantiate(p)
+    batch_size, seq_len = 2, 12
+    inputs = np.random.normal(
+        1.0, 0.5, [batch_size, seq_len, 8]).astype(np.float32)
+    paddings = np.zeros([batch_size, seq_len], np.float32)
+    paddings[1, 9:] = 1.0
+
+    context_p = base_layer.JaxContext.HParams(do_eval=True)
+    with base_layer.JaxContext.new_context(hparams=context_p):
+      initial_vars = conformer.init(
+          jax.random.PRNGKey(seed=123), inputs, paddings)
+      output = conformer.apply(initial_vars, inputs, paddings)
+      _, decode_cache = conformer.apply(
+          initial_vars, batch_size, method=conformer.init_states,
+          mutable=[base_layer.DECODE_CACHE])
+      streamed_output = []
+      for start in range(0, seq_len, chunk_size):
+        chunk_output, decode_cache = conformer.apply(
+            {**initial_vars, **decode_cache},
+            inputs[:, start:start + chunk_size],
+            paddings[:, start:start + chunk_size],
+            method=conformer.extend_step,
+            mutable=[base_layer.DECODE_CACHE])
+        streamed_output.append(chunk_output)
+    streamed_output = jnp.concatenate(streamed_output, axis=1)
+
+    if left_context is not None:
+      # The cache holds the keys of the last left_context - 1 frames only.
+      key_state = decode_cache[base_layer.DECODE_CACHE]['trans_atten'][
+          'self_atten']['stream_key_state']
+      self.assertEqual(key_state.shape, (batch_size, left_context - 1, 2, 4))
+    mask = (1.0 - paddings)[:, :, np.newaxis]
+    self.assertAllClose(output * mask, streamed_output * mask, atol=1e-5)
+
 
 if __name__ == '__main__':
   absltest.main()
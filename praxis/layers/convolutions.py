@@ -16,7 +16,7 @@
 """Convolutional layers."""
 
 import math
-from typing import Optional, Sequence, Tuple
+from typing import Callable, Optional, Sequence, Tuple, Union
 
 import jax
 from jax import numpy as jnp
@@ -615,6 +615,29 @@ class BaseDepthwiseConv1D(base_layer.BaseLayer):
     """
     raise NotImplementedError()
 
+  def init_states(self, batch_size: int) -> None:
+    """Initializes the input cache for streaming with `extend_step`.
+
+    Args:
+      batch_size: The batch size of the streamed inputs.
+    """
+    raise NotImplementedError()
+
+  def extend_step(self,
+                  inputs: JTensor,
+                  paddings: Optional[JTensor] = None) -> JTensor:
+    """Causal depthwise convolution of the next chunk of a streamed sequence.
+
+    Args:
+      inputs: Input chunk JTensor of shape [B, C, H].
+      paddings: Input chunk paddings JTensor of shape [B, C].
+
+    Returns:
+      The depthwise conv output of the chunk with shape
+        [B, C, H * channel_multipliers].
+    """
+    raise NotImplementedError()
+
 
 class DepthwiseConv1D(BaseDepthwiseConv1D):
   """Depthwise 1D convolution based on lax implementation."""
@@ -699,16 +722,21 @@ class DepthwiseConv1D(BaseDepthwiseConv1D):
     if paddings is not None:
       inputs = py_utils.apply_padding(inputs, paddings[:, :, None])
 
-    dn = jax.lax.conv_dimension_numbers(inputs.shape,
-                                        self.get_w().shape,
-                                        ('NHC', 'HIO', 'NHC'))
-
     if self.is_causal:
-      causal_pad_size = self.rhs_dilation_rate * (self.filter_shape[0] - 1)
-      padding = [(causal_pad_size, 0)]
+      padding = [(self._causal_pad_size(), 0)]
     else:
       padding = 'SAME'
+    return self._conv(inputs, padding)
+
+  def _causal_pad_size(self) -> int:
+    return self.rhs_dilation_rate * (self.filter_shape[0] - 1)
 
+  def _conv(
+      self, inputs: JTensor, padding: Union[str, Sequence[Tuple[int, int]]]
+  ) -> JTensor:
+    dn = jax.lax.conv_dimension_numbers(inputs.shape,
+                                        self.get_w().shape,
+                                        ('NHC', 'HIO', 'NHC'))
     out = jax.lax.conv_general_dilated(
         lhs=inputs,
         rhs=self.get_w(),
@@ -723,6 +751,49 @@ class DepthwiseConv1D(BaseDepthwiseConv1D):
       out = out + self.theta.b
     return out
 
+  def init_states(self, batch_size: int) -> None:
+    """Initializes the input cache for streaming with `extend_step`.
+
+    The cache holds the last `rhs_dilation_rate * (kernel_size - 1)` inputs,
+    zeros at the start of the sequence like the causal padding of `__call__`.
+
+    Args:
+      batch_size: The batch size of the streamed inputs.
+    """
+    assert self.is_causal, 'Streaming requires a causal depthwise conv.'
+    self.update_decode_state(
+        'conv_state',
+        jnp.zeros(
+            [batch_size, self._causal_pad_size(), self._input_channels()],
+            self.fprop_dtype,
+        ),
+    )
+
+  def extend_step(self,
+                  inputs: JTensor,
+                  paddings: Optional[JTensor] = None) -> JTensor:
+    """Causal depthwise convolution of the next chunk of a streamed sequence.
+
+    Outputs match the corresponding frames of `__call__` on the whole sequence.
+
+    Args:
+      inputs: Input chunk JTensor of shape [B, C, H].
+      paddings: Input chunk paddings JTensor of shape [B, C].
+
+    Returns:
+      The depthwise conv output of the chunk with shape [B, C, H].
+    """
+    assert self.is_causal, 'Streaming requires a causal depthwise conv.'
+    if paddings is not None:
+      inputs = py_utils.apply_padding(inputs, paddings[:, :, None])
+    state = self.get_decode_state('conv_state')
+    inputs = jnp.concatenate([state.astype(inputs.dtype), inputs], axis=1)
+    self.update_decode_state(
+        'conv_state',
+        inputs[:, inputs.shape[1] - state.shape[1]:].astype(state.dtype),
+    )
+    return self._conv(inputs, 'VALID')
+
 
 class LightConv1D(base_layer.BaseLayer):
   """Lightweight conv layer.
@@ -882,6 +953,37 @@ class LightConv1D(base_layer.BaseLayer):
     Returns:
       The lconv output with shape [B, T, H].
     """
+    return self._lconv(inputs, paddings, self.depthwise_conv1d)
+
+  def init_states(self, batch_size: int) -> None:
+    """Initializes the depthwise conv cache for streaming with `extend_step`.
+
+    Args:
+      batch_size: The batch size of the streamed inputs.
+    """
+    self.depthwise_conv1d.init_states(batch_size)
+
+  def extend_step(self, inputs: JTensor, paddings: JTensor) -> JTensor:
+    """Lightweight conv layer on the next chunk of a streamed sequence.
+
+    Requires `is_causal` and a frame-wise conv norm, e.g. BatchNorm in eval
+    mode, for the outputs to match the corresponding frames of `__call__`.
+
+    Args:
+      inputs: Input chunk JTensor of shape [B, C, H].
+      paddings: Input chunk paddings JTensor of shape [B, C].
+
+    Returns:
+      The lconv output of the chunk with shape [B, C, H].
+    """
+    return self._lconv(inputs, paddings, self.depthwise_conv1d.extend_step)
+
+  def _lconv(
+      self,
+      inputs: JTensor,
+      paddings: JTensor,
+      depthwise_conv_fn: Callable[[JTensor, JTensor], JTensor],
+  ) -> JTensor:
     ap = self.activation_split_dims_mapping
 
     unnormalized_inputs = inputs
@@ -891,7 +993,7 @@ class LightConv1D(base_layer.BaseLayer):
     gated_inputs = self.linear_start_gated(inputs)
     inputs = act_inputs * jax.nn.sigmoid(gated_inputs)
 
-    inputs = self.depthwise_conv1d(inputs, paddings)
+    inputs = depthwise_conv_fn(inputs, paddings)
     inputs = base_layer.maybe_shard(inputs, ap.blf, self.mesh_axis_names)
 
     inputs = self._conv_norm(inputs, paddings)
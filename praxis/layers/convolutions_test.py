@@ -37,6 +37,24 @@ instantiate = base_layer.instantiate
 
 PARAMS = base_layer.PARAMS
 NON_TRAINABLE = base_layer.NON_TRAINABLE
+DECODE_CACHE = base_layer.DECODE_CACHE
+
+
+def _stream(layer, mdl_vars, inputs, paddings, chunk_size):
+  """Runs `layer.extend_step` on consecutive chunks of the inputs."""
+  _, decode_cache = layer.apply(
+      mdl_vars, inputs.shape[0], method=layer.init_states,
+      mutable=[DECODE_CACHE])
+  outputs = []
+  for start in range(0, inputs.shape[1], chunk_size):
+    output, decode_cache = layer.apply(
+        {**mdl_vars, **decode_cache},
+        inputs[:, start:start + chunk_size],
+        paddings[:, start:start + chunk_size],
+        method=layer.extend_step,
+        mutable=[DECODE_CACHE])
+    outputs.append(output)
+  return jnp.concatenate(outputs, axis=1)
 
 
 class ConvolutionsTest(test_utils.TestCase):
@@ -187,6 +205,53 @@ class ConvolutionsTest(test_utils.TestCase):
     tf_np_output = to_np(tf_output[0])[:, :, 0, :]
     self.assertAllClose(tf_np_output, np_output)
 
+  @parameterized.parameters(
+      (3, 1, 1, False),
+      (3, 2, 4, True),
+      (4, 1, 3, False),
+      (5, 2, 12, True),
+      (1, 1, 2, False),
+  )
+  def test_depthwise_conv1d_extend_step(self, kernel_size, rhs_dilation_rate,
+                                        chunk_size, bias):
+    p = pax_fiddle.Config(
+        convolutions.DepthwiseConv1D,
+        name='jax_depthwise_conv1d',
+        filter_shape=(kernel_size, 4, 1),
+        rhs_dilation_rate=rhs_dilation_rate,
+        bias=bias,
+        is_causal=True,
+    )
+    layer = instantiate(p)
+    inputs = np.random.normal(size=[2, 12, 4]).astype(np.float32)
+    paddings = np.random.randint(0, 2, [2, 12]).astype(np.float32)
+
+    initial_vars = layer.init(jax.random.PRNGKey(seed=123), inputs, paddings)
+    output = layer.apply(initial_vars, inputs, paddings)
+    streamed_output = _stream(layer, initial_vars, inputs, paddings, chunk_size)
+    self.assertAllClose(output, streamed_output)
+
+  @parameterized.parameters(1, 4, 5)
+  def test_light_conv1d_extend_step(self, chunk_size):
+    p = pax_fiddle.Config(
+        convolutions.LightConv1D,
+        name='jax_light_conv1d_layer',
+        input_dims=8,
+        kernel_size=3,
+        is_causal=True,
+    )
+    lconv = instantiate(p)
+    inputs = np.random.normal(1.0, 0.5, [2, 10, 8]).astype(np.float32)
+    paddings = np.random.randint(0, 2, [2, 10]).astype(np.float32)
+
+    context_p = base_layer.JaxContext.HParams(do_eval=True)
+    with base_layer.JaxContext.new_context(hparams=context_p):
+      initial_vars = lconv.init(jax.random.PRNGKey(seed=123), inputs, paddings)
+      output = lconv.apply(initial_vars, inputs, paddings)
+      streamed_output = _stream(
+          lconv, initial_vars, inputs, paddings, chunk_size)
+    self.assertAllClose(output, streamed_output)
+
   @parameterized.product(
       batch_size=[2, 7],
       seq_len=[7, 12],
@@ -15,8 +15,9 @@
 
 """Embedding and softmax layers."""
 
+import functools
 import math
-from typing import Optional, Union, Callable
+from typing import Callable, Optional, Sequence, Tuple, Union
 
 import jax
 from jax import numpy as jnp
@@ -49,6 +50,262 @@ def _compute_z_loss(logits):
   return jnp.square(log_z)
 
 
+def _capped_logits(
+    inputs: JTensor,
+    weights: JTensor,
+    bias: Optional[JTensor],
+    soft_cap_logits: Optional[float],
+    logits_abs_max: Optional[float],
+    logits_split_dims_mapping: SplitDimsMapping = None,
+    mesh_axis_names: Optional[Sequence[str]] = None,
+) -> JTensor:
+  """Returns float32 logits of [N, D] inputs and [D, V] weights."""
+  logits = jnp.einsum('nd,dv->nv', inputs, weights)
+  if bias is not None:
+    logits += bias
+  logits = base_layer.maybe_shard(
+      logits, logits_split_dims_mapping, mesh_axis_names
+  )
+  logits = logits.astype(jnp.float32)
+  if soft_cap_logits:
+    logits = soft_cap_logits * jnp.tanh(logits / soft_cap_logits)
+  if logits_abs_max:
+    logits = jnp.clip(logits, -logits_abs_max, logits_abs_max)
+  return logits
+
+
+def _to_chunks(x: JTensor, chunk_size: int, axis: int) -> JTensor:
+  """Splits `axis` of x into a new leading axis of chunks of `chunk_size`."""
+  x = jnp.moveaxis(x, axis, 0)
+  x = jnp.reshape(x, (-1, chunk_size) + x.shape[1:])
+  return jnp.moveaxis(x, 1, axis + 1)
+
+
+def _from_chunks(x: JTensor, axis: int) -> JTensor:
+  """Inverse of `_to_chunks`."""
+  x = jnp.moveaxis(x, axis + 1, 1)
+  x = jnp.reshape(x, (-1,) + x.shape[2:])
+  return jnp.moveaxis(x, 0, axis)
+
+
+def _chunked_xent_fwd_stats(inputs, weights, bias, class_ids, *,
+                            token_chunk_size, vocab_chunk_size, label_on_value,
+                            label_off_value, soft_cap_logits, logits_abs_max,
+                            logits_split_dims_mapping, mesh_axis_names):
+  """Returns the per token xent, log_z, argmax and label logit of the logits."""
+  num_classes = weights.shape[-1]
+  w_chunks = _to_chunks(weights, vocab_chunk_size, axis=1)
+  b_chunks = None if bias is None else _to_chunks(bias, vocab_chunk_size, 0)
+  offsets = jnp.arange(0, num_classes, vocab_chunk_size, dtype=jnp.int32)
+
+  def _token_chunk(unused_carry, xs):
+    x, ids = xs
+
+    def _vocab_chunk(carry, ws):
+      max_logit, sum_exp, label_logit, sum_logits, best, best_idx = carry
+      w, b, offset = ws
+      logits = _capped_logits(x, w, b, soft_cap_logits, logits_abs_max,
+                              logits_split_dims_mapping, mesh_axis_names)
+      # Online logsumexp.
+      chunk_max = jnp.max(logits, axis=-1)
+      new_max = jnp.maximum(max_logit, chunk_max)
+      sum_exp = sum_exp * jnp.exp(max_logit - new_max) + jnp.sum(
+          jnp.exp(logits - new_max[:, jnp.newaxis]), axis=-1)
+      local_ids = ids - offset
+      in_chunk = (local_ids >= 0) & (local_ids < vocab_chunk_size)
+      label_logit += jnp.where(
+          in_chunk,
+          jnp.take_along_axis(
+              logits,
+              jnp.clip(local_ids, 0, vocab_chunk_size - 1)[:, jnp.newaxis],
+              axis=-1)[:, 0],
+          0.0)
+      sum_logits += jnp.sum(logits, axis=-1)
+      # Ties are resolved to the lowest class id like jnp.argmax.
+      is_better = chunk_max > best
+      best = jnp.where(is_better, chunk_max, best)
+      best_idx = jnp.where(
+          is_better, jnp.argmax(logits, axis=-1) + offset, best_idx)
+      return (new_max, sum_exp, label_logit, sum_logits, best, best_idx), None
+
+    n = x.shape[0]
+    init = (jnp.full([n], -jnp.inf, jnp.float32), jnp.zeros([n], jnp.float32),
+            jnp.zeros([n], jnp.float32), jnp.zeros([n], jnp.float32),
+            jnp.full([n], -jnp.inf, jnp.float32), jnp.zeros([n], jnp.int32))
+    (max_logit, sum_exp, label_logit, sum_logits, _, argmax), _ = (
+        jax.lax.scan(_vocab_chunk, init, (w_chunks, b_chunks, offsets)))
+    log_z = max_logit + jnp.log(sum_exp)
+    xent = (log_z - (label_on_value - label_off_value) * label_logit -
+            label_off_value * sum_logits)
+    return None, (xent, log_z, argmax, label_logit)
+
+  _, outputs = jax.lax.scan(
+      _token_chunk, None, (_to_chunks(inputs, token_chunk_size, 0),
+                           _to_chunks(class_ids, token_chunk_size, 0)))
+  return jax.tree_map(lambda x: _from_chunks(x, 0), outputs)
+
+
+@functools.partial(jax.custom_vjp, nondiff_argnums=(4, 5, 6, 7, 8, 9, 10, 11))
+def _chunked_softmax_cross_entropy(inputs, weights, bias, class_ids,
+                                   token_chunk_size, vocab_chunk_size,
+                                   label_on_value, label_off_value,
+                                   soft_cap_logits, logits_abs_max,
+                                   logits_split_dims_mapping, mesh_axis_names):
+  return _chunked_xent_fwd_stats(
+      inputs, weights, bias, class_ids,
+      token_chunk_size=token_chunk_size, vocab_chunk_size=vocab_chunk_size,
+      label_on_value=label_on_value, label_off_value=label_off_value,
+      soft_cap_logits=soft_cap_logits, logits_abs_max=logits_abs_max,
+      logits_split_dims_mapping=logits_split_dims_mapping,
+      mesh_axis_names=mesh_axis_names)
+
+
+def _chunked_softmax_cross_entropy_fwd(inputs, weights, bias, class_ids,
+                                       token_chunk_size, vocab_chunk_size,
+                                       label_on_value, label_off_value,
+                                       soft_cap_logits, logits_abs_max,
+                                       logits_split_dims_mapping,
+                                       mesh_axis_names):
+  outputs = _chunked_xent_fwd_stats(
+      inputs, weights, bias, class_ids,
+      token_chunk_size=token_chunk_size, vocab_chunk_size=vocab_chunk_size,
+      label_on_value=label_on_value, label_off_value=label_off_value,
+      soft_cap_logits=soft_cap_logits, logits_abs_max=logits_abs_max,
+      logits_split_dims_mapping=logits_split_dims_mapping,
+      mesh_axis_names=mesh_axis_names)
+  # Only the [N] log normalizers are kept, the logits are recomputed.
+  return outputs, (inputs, weights, bias, class_ids, outputs[1])
+
+
+def _chunked_softmax_cross_entropy_bwd(token_chunk_size, vocab_chunk_size,
+                                       label_on_value, label_off_value,
+                                       soft_cap_logits, logits_abs_max,
+                                       logits_split_dims_mapping,
+                                       mesh_axis_names, residuals, cotangents):
+  inputs, weights, bias, class_ids, log_z = residuals
+  xent_grad, log_z_grad, _, label_logit_grad = cotangents
+  w_chunks = _to_chunks(weights, vocab_chunk_size, axis=1)
+  b_chunks = None if bias is None else _to_chunks(bias, vocab_chunk_size, 0)
+  offsets = jnp.arange(0, weights.shape[-1], vocab_chunk_size, dtype=jnp.int32)
+
+  def _token_chunk(carry, xs):
+    x, ids, x_log_z, x_xent_grad, x_log_z_grad, x_label_logit_grad = xs
+
+    def _vocab_chunk(x_grad, ws):
+      w, b, offset = ws
+      logits, logits_vjp = jax.vjp(
+          functools.partial(
+              _capped_logits,
+              soft_cap_logits=soft_cap_logits,
+              logits_abs_max=logits_abs_max,
+              logits_split_dims_mapping=logits_split_dims_mapping,
+              mesh_axis_names=mesh_axis_names),
+          x, w, b)
+      probs = jnp.exp(logits - x_log_z[:, jnp.newaxis])
+      one_hot = jax.nn.one_hot(ids - offset, vocab_chunk_size,
+                               dtype=jnp.float32)
+      targets = label_off_value + (label_on_value - label_off_value) * one_hot
+      logits_grad = (x_xent_grad[:, jnp.newaxis] * (probs - targets) +
+                     x_log_z_grad[:, jnp.newaxis] * probs +
+                     x_label_logit_grad[:, jnp.newaxis] * one_hot)
+      chunk_x_grad, w_grad, b_grad = logits_vjp(logits_grad)
+      return x_grad + chunk_x_grad, (w_grad, b_grad)
+
+    x_grad, (w_grads, b_grads) = jax.lax.scan(
+        _vocab_chunk, jnp.zeros_like(x), (w_chunks, b_chunks, offsets))
+    w_grad_sum, b_grad_sum = carry
+    carry = (w_grad_sum + w_grads,
+             None if b_grads is None else b_grad_sum + b_grads)
+    return carry, x_grad
+
+  init = (jnp.zeros_like(w_chunks),
+          None if b_chunks is None else jnp.zeros_like(b_chunks))
+  (w_grad, b_grad), x_grads = jax.lax.scan(
+      _token_chunk, init,
+      jax.tree_map(lambda x: _to_chunks(x, token_chunk_size, 0),
+                   (inputs, class_ids, log_z, xent_grad, log_z_grad,
+                    label_logit_grad)))
+  w_grad = _from_chunks(w_grad, axis=1)
+  if b_grad is not None:
+    b_grad = _from_chunks(b_grad, axis=0)
+  return (_from_chunks(x_grads, 0), w_grad, b_grad, None)
+
+
+_chunked_softmax_cross_entropy.defvjp(_chunked_softmax_cross_entropy_fwd,
+                                      _chunked_softmax_cross_entropy_bwd)
+
+
+def chunked_softmax_cross_entropy(
+    inputs: JTensor,
+    weights: JTensor,
+    bias: Optional[JTensor],
+    class_ids: JTensor,
+    token_chunk_size: int,
+    vocab_chunk_size: Optional[int] = None,
+    label_on_value: float = 1.0,
+    label_off_value: float = 0.0,
+    soft_cap_logits: Optional[float] = None,
+    logits_abs_max: Optional[float] = None,
+    logits_split_dims_mapping: SplitDimsMapping = None,
+    mesh_axis_names: Optional[Sequence[str]] = None,
+) -> Tuple[JTensor, JTensor, JTensor, JTensor]:
+  """Softmax cross entropy computed without materializing the full logits.
+
+  The logits of a chunk of `token_chunk_size` tokens, and optionally
+  `vocab_chunk_size` classes with an online logsumexp, are computed and reduced
+  at a time. The backward pass recomputes the logits chunk by chunk, so only
+  the log normalizers are kept for it.
+
+  Args:
+    inputs: JTensor of shape [N, D].
+    weights: Softmax weights of shape [D, V].
+    bias: Optional softmax bias of shape [V].
+    class_ids: int32 JTensor of shape [N], the target labels.
+    token_chunk_size: Number of tokens per chunk. N is padded to a multiple.
+    vocab_chunk_size: Number of classes per chunk, must divide V. If None, the
+      whole vocabulary is a single chunk.
+    label_on_value: Target probability of the label class.
+    label_off_value: Target probability of every other class.
+    soft_cap_logits: If not None logits are soft capped to this value.
+    logits_abs_max: If not None logits are clipped to this absolute value after
+      soft capping.
+    logits_split_dims_mapping: Optional sharding of the [N, V] logits, applied
+      to the logits of each chunk.
+    mesh_axis_names: Mesh axis names of logits_split_dims_mapping.
+
+  Returns:
+    A tuple (per_example_xent, log_z, per_example_argmax, label_logit) of
+    JTensors of shape [N]. log_z is the logsumexp of the logits of each token,
+    which is used for the z-loss, and label_logit the logit of its label, e.g.
+    log_z - label_logit is the cross entropy without label smoothing.
+  """
+  n, _ = inputs.shape
+  num_classes = weights.shape[-1]
+  vocab_chunk_size = vocab_chunk_size or num_classes
+  if num_classes % vocab_chunk_size:
+    raise ValueError(f'vocab_chunk_size={vocab_chunk_size} must divide '
+                     f'num_classes={num_classes}.')
+  token_chunk_size = min(token_chunk_size, n)
+  padded_n = -(-n // token_chunk_size) * token_chunk_size
+  if padded_n != n:
+    inputs = jnp.pad(inputs, [[0, padded_n - n], [0, 0]])
+    class_ids = jnp.pad(class_ids, [[0, padded_n - n]])
+  if logits_split_dims_mapping is not None:
+    # Nondiff arguments must be hashable.
+    logits_split_dims_mapping = tuple(
+        tuple(axis) if isinstance(axis, list) else axis
+        for axis in logits_split_dims_mapping
+    )
+  if mesh_axis_names is not None:
+    mesh_axis_names = tuple(mesh_axis_names)
+  xent, log_z, argmax, label_logit = _chunked_softmax_cross_entropy(
+      inputs, weights, bias, class_ids.astype(jnp.int32), token_chunk_size,
+      vocab_chunk_size, label_on_value, label_off_value, soft_cap_logits,
+      logits_abs_max, logits_split_dims_mapping, mesh_axis_names)
+  return (xent[:n], log_z[:n], jax.lax.stop_gradient(argmax[:n]),
+          label_logit[:n])
+
+
 class TokenCounter(base_layer.BaseLayer):
   """Keep track of total tokens seen during training."""
 
@@ -183,6 +440,11 @@ class FullSoftmax(base_layer.BaseLayer):
     bias_init: Init scale (constant) of bias terms.
     feed_forward_tpl: Sub configurable field for the feed-forward layer. If
       None, skip feedforward layer and directly apply softmax to the input.
+    xent_token_chunk_size: If not None, the cross entropy against class_ids is
+      computed by `chunked_softmax_cross_entropy` on chunks of this many
+      tokens, and logits and log_probs are not returned.
+    xent_vocab_chunk_size: Optional number of classes per chunk of the chunked
+      cross entropy. Must divide num_classes.
   """
   input_dims: int = 0
   num_classes: int = 0
@@ -193,8 +455,23 @@ class FullSoftmax(base_layer.BaseLayer):
   z_loss_weight: float = 0.
   bias_init: Optional[float] = 0.0
   feed_forward_tpl: LayerTpl = template_field(linears.FeedForward)
+  xent_token_chunk_size: Optional[int] = None
+  xent_vocab_chunk_size: Optional[int] = None
 
   def setup(self) -> None:
+    if self.xent_token_chunk_size is not None:
+      # The chunked cross entropy reads the float weights of the layer.
+      if (
+          self.feed_forward_tpl is None
+          or self.feed_forward_tpl.cls is not linears.FeedForward
+          or self.feed_forward_tpl.linear_tpl.cls is not linears.Linear
+          or self.bi_tempered_loss_tpl
+      ):
+        raise ValueError(
+            'Chunked cross entropy requires a linears.FeedForward '
+            'feed_forward_tpl with a linears.Linear linear_tpl, and no '
+            'bi_tempered_loss_tpl.'
+        )
     if self.feed_forward_tpl is not None:
       wp = self.weight_split_dims_mapping
       ap = self.activation_split_dims_mapping
@@ -262,6 +539,8 @@ class FullSoftmax(base_layer.BaseLayer):
       - avg_xent: A scalar. total_loss / total_weight.
       - z_loss: (optional) a scalar, the square of logsum logits when
         z_loss_weight > 0.
+
+      logits and log_probs are omitted when the cross entropy is chunked.
     """
     # pyformat:enable
 
@@ -269,6 +548,9 @@ class FullSoftmax(base_layer.BaseLayer):
     if class_ids is None and class_probabilities is None:
       raise ValueError('One of class_ids or class_probabilities must be given.')
 
+    if self.xent_token_chunk_size is not None and class_probabilities is None:
+      return self._chunked_xent(inputs, class_weights, class_ids)
+
     # Compute logits
     inputs_dtype = inputs.dtype
     logits = self.get_logits(inputs)
@@ -328,6 +610,54 @@ class FullSoftmax(base_layer.BaseLayer):
       output_nmap['z_loss'] = z_loss
     return output_nmap
 
+  def _chunked_xent(self, inputs: JTensor, class_weights: JTensor,
+                    class_ids: JTensor) -> NestedMap:
+    """Same as __call__ with chunked_softmax_cross_entropy and no logits."""
+    label_on_value, label_off_value = 1.0, 0.0
+    if self.label_smoothing_prob > 0.0 and (
+        not self.do_eval or self.label_smoothing_apply_for_eval):
+      label_on_value = 1.0 - self.label_smoothing_prob
+      label_off_value = self.label_smoothing_prob / (self.num_classes - 1)
+    bias = None
+    if self.logits_ffn.has_bias:
+      bias = self.logits_ffn.bias.theta.b
+    per_example_xent, log_z, per_example_argmax, _ = (
+        chunked_softmax_cross_entropy(
+            jnp.reshape(inputs, [-1, self.input_dims]),
+            self.logits_ffn.linear.theta.w,
+            bias,
+            jnp.reshape(class_ids, [-1]),
+            self.xent_token_chunk_size,
+            self.xent_vocab_chunk_size,
+            label_on_value,
+            label_off_value,
+            soft_cap_logits=self.soft_cap_logits,
+        )
+    )
+    per_example_xent = jnp.reshape(per_example_xent, inputs.shape[:-1])
+    log_z = jnp.reshape(log_z, inputs.shape[:-1])
+    per_example_argmax = jnp.reshape(per_example_argmax, inputs.shape[:-1])
+
+    total_xent = jnp.sum(
+        jnp.expand_dims(per_example_xent, axis=-1) * class_weights,
+        dtype=jnp.float32)
+    total_weight = jnp.sum(class_weights, dtype=jnp.float32)
+    output_nmap = NestedMap(
+        per_example_argmax=per_example_argmax,
+        per_example_xent=per_example_xent,
+        total_xent=total_xent,
+        total_weight=total_weight,
+        avg_xent=(total_xent / (total_weight + 1e-6)).astype(jnp.float32))
+    if self.z_loss_weight > 0.0:
+      z_loss = jnp.sum(
+          jnp.square(log_z)[..., jnp.newaxis] * class_weights,
+          dtype=jnp.float32) / total_weight
+      z_loss *= self.z_loss_weight
+      self.add_summary('aux_z_loss', z_loss)
+      self.add_aux_loss('aux_z_loss', z_loss)
+      output_nmap['z_loss'] = z_loss
+    return output_nmap
+
 
 class SharedEmbeddingSoftmax(FullSoftmax):
   """A softmax layer that also supports embedding lookups.
@@ -557,6 +887,11 @@ class GShardSharedEmbeddingSoftmax(base_layer.BaseLayer):
     z_loss_weight: If z_loss_weight is nonzero, we add a loss equal to
       z_loss_weight * square(logsumexp(logits, -1))
     label_smoothing_prob: Optional label smoothing.
+    xent_token_chunk_size: If not None, the cross entropy against class_ids is
+      computed by `chunked_softmax_cross_entropy` on chunks of this many
+      tokens, and logits and log_probs are not returned.
+    xent_vocab_chunk_size: Optional number of classes per chunk of the chunked
+      cross entropy. Must divide num_classes.
   """
   input_dims: int = 0
   num_classes: int = 0
@@ -565,6 +900,8 @@ class GShardSharedEmbeddingSoftmax(base_layer.BaseLayer):
   logits_abs_max: Optional[float] = 0.0
   z_loss_weight: float = 0.
   label_smoothing_prob: float = 0.0
+  xent_token_chunk_size: Optional[int] = None
+  xent_vocab_chunk_size: Optional[int] = None
 
   class ActivationSharding(base_layer.BaseLayer.ActivationSharding):
     """Represents how intermediate values should be partitioned across a mesh.
@@ -658,11 +995,16 @@ class GShardSharedEmbeddingSoftmax(base_layer.BaseLayer):
       - total_xent: A scalar. The sum of per_example_weight * per_example_xent.
       - total_weight: A scalar. The sum of per_example_weight.
       - avg_xent: A scalar. total_loss / total_weight.
+
+      logits is omitted when the cross entropy is chunked.
     """
     # Assert one of class_ids or class_probabilities is not None
     if class_ids is None and class_probabilities is None:
       raise ValueError('One of class_ids or class_probabilities must be given.')
 
+    if self.xent_token_chunk_size is not None and class_probabilities is None:
+      return self._chunked_xent(inputs, class_weights, class_ids)
+
     # Compute logits
     inputs_dtype = inputs.dtype
     logits = self.get_logits(inputs)
@@ -739,6 +1081,74 @@ class GShardSharedEmbeddingSoftmax(base_layer.BaseLayer):
 
     return output_nmap
 
+  def _chunked_xent(self, inputs: JTensor, class_weights: JTensor,
+                    class_ids: JTensor) -> NestedMap:
+    """Same as __call__ with chunked_softmax_cross_entropy and no logits."""
+    label_on_value, label_off_value = 1.0, 0.0
+    if self.label_smoothing_prob > 0.0 and not self.do_eval:
+      label_off_value = self.label_smoothing_prob / self.num_classes
+      label_on_value = 1.0 - self.label_smoothing_prob + label_off_value
+    # activations are scaled with 1/sqrt(input_dims)
+    inputs *= self.input_dims**-0.5
+    # The [..., V] sharding of get_logits, on the flattened tokens.
+    ap_out = self.activation_split_dims_mapping.out
+    if ap_out is not None:
+      ap_out = [ap_out[0], ap_out[-1]]
+    per_example_xent, log_z, per_example_argmax, label_logit = (
+        chunked_softmax_cross_entropy(
+            jnp.reshape(inputs, [-1, self.input_dims]),
+            jnp.transpose(self.embedding.theta.w),
+            None,
+            jnp.reshape(class_ids, [-1]),
+            self.xent_token_chunk_size,
+            self.xent_vocab_chunk_size,
+            label_on_value,
+            label_off_value,
+            soft_cap_logits=self.soft_cap_logits,
+            logits_abs_max=self.logits_abs_max,
+            logits_split_dims_mapping=ap_out,
+            mesh_axis_names=self.mesh_axis_names,
+        )
+    )
+    per_example_xent = jnp.reshape(per_example_xent, inputs.shape[:-1])
+    log_z = jnp.reshape(log_z, inputs.shape[:-1])
+    label_logit = jnp.reshape(label_logit, inputs.shape[:-1])
+    per_example_argmax = jnp.reshape(per_example_argmax, inputs.shape[:-1])
+
+    total_xent = jnp.sum(
+        jnp.expand_dims(per_example_xent, axis=-1) * class_weights,
+        dtype=jnp.float32)
+    total_weight = jnp.sum(class_weights, dtype=jnp.float32)
+    if self.use_tgt_labels_size_as_loss_denominator:
+      loss_denominator = jnp.sum(
+          jnp.ones_like(class_weights), dtype=jnp.float32)
+    else:
+      loss_denominator = total_weight
+    z_loss = (
+        jnp.sum(jnp.square(log_z)[..., jnp.newaxis] * class_weights) /
+        loss_denominator)
+    z_loss *= self.z_loss_weight
+    self.add_summary('aux_z_loss', z_loss)
+    self.add_aux_loss('aux_z_loss', z_loss)
+
+    if self.label_smoothing_prob > 0.0 and not self.do_eval:
+      total_xent_prior_to_label_smoothing = jnp.sum(
+          jnp.expand_dims(log_z - label_logit, axis=-1) * class_weights,
+          dtype=jnp.float32)
+      avg_xent_prior_to_label_smoothing = (
+          total_xent_prior_to_label_smoothing /
+          loss_denominator).astype(inputs.dtype)
+      self.add_summary('avg_xent_prior_to_label_smoothing',
+                       avg_xent_prior_to_label_smoothing)
+
+    return NestedMap(
+        per_example_argmax=per_example_argmax,
+        per_example_xent=per_example_xent,
+        total_xent=total_xent.astype(inputs.dtype),
+        avg_xent_weight=loss_denominator,
+        avg_xent=(total_xent / loss_denominator).astype(jnp.float32),
+        total_weight=total_weight)
+
   def extend_step(self, ids: JTensor, *, time_step: JTensor) -> JTensor:
     del time_step  # Not used.
     return self.emb_lookup(ids)
@@ -891,6 +1301,65 @@ class PositionalEmbedding2D(base_layer.BaseLayer):
     return pos_emb
 
 
+@functools.lru_cache(maxsize=None)
+def _rotary_sin_cos_tables(
+    embedding_dims: int,
+    min_timescale: float,
+    max_timescale: float,
+    max_position: int,
+) -> Tuple[np.ndarray, np.ndarray]:
+  """Returns the rotary cos and signed sin tables of the first positions.
+
+  The tables are computed once per configuration on host. All the layers of a
+  model (e.g. of a StackedTransformer) use the same arrays, which are lowered
+  to a single constant of the compiled program rather than one per layer.
+
+  Args:
+    embedding_dims: Dimension of the rotary embedding.
+    min_timescale: Start of the geometric index.
+    max_timescale: End of the geometric index.
+    max_position: Number of positions in the tables.
+
+  Returns:
+    A tuple (cos, sin) of float32 arrays of shape [max_position,
+    embedding_dims], laid out for `_apply_rotary`: cos is repeated over both
+    halves and sin is negated on the first half.
+  """
+  half_embedding_dim = embedding_dims // 2
+  fraction = 2 * np.arange(0, half_embedding_dim) / embedding_dims
+  timescale = min_timescale * (max_timescale / min_timescale) ** fraction
+  sinusoid_inp = np.arange(max_position)[:, np.newaxis] / timescale
+  sin = np.sin(sinusoid_inp)
+  cos = np.cos(sinusoid_inp)
+  cos = np.concatenate([cos, cos], axis=-1).astype(np.float32)
+  sin = np.concatenate([-sin, sin], axis=-1).astype(np.float32)
+  cos.flags.writeable = False
+  sin.flags.writeable = False
+  return cos, sin
+
+
+def _apply_rotary(inputs: JTensor, cos: JTensor, sin: JTensor) -> JTensor:
+  """Rotates the halves of the last dim of inputs, see `_rotary_sin_cos_tables`.
+
+  Computes `[x1 * cos - x2 * sin, x2 * cos + x1 * sin]` on the full width with a
+  single multiply-add, the halves being swapped by a reverse of a [2, H / 2]
+  view instead of a split and a concatenation.
+
+  Args:
+    inputs: JTensor of shape [..., H].
+    cos: cos table broadcastable to inputs, repeated over both halves.
+    sin: sin table broadcastable to inputs, negated on the first half.
+
+  Returns:
+    The rotated inputs, of shape [..., H].
+  """
+  shape = inputs.shape
+  rotated = jnp.flip(
+      jnp.reshape(inputs, shape[:-1] + (2, shape[-1] // 2)), axis=-2
+  ).reshape(shape)
+  return inputs * cos + rotated * sin
+
+
 class RotaryPositionalEmbedding(PositionalEmbedding):
   """Applies rotary position embedding for a given 1-d sequence.
 
@@ -899,8 +1368,15 @@ class RotaryPositionalEmbedding(PositionalEmbedding):
   Attributes:
     cast_as_fprop_dtype: If True, the returned vars are cast as fprop_dtype
     to save some memory.
+    max_position: If set, sin and cos are gathered by position from tables
+      precomputed for positions [0, max_position) instead of being recomputed
+      at every call. The tables are shared by all the layers with the same
+      configuration. Positions must be integers smaller than max_position:
+      larger positions raise a ValueError when they are known at trace time,
+      and give NaN outputs otherwise (e.g. under jit).
   """
   cast_as_fprop_dtype: bool = True
+  max_position: Optional[int] = None
 
   def setup(self) -> None:
     if self.embedding_dims % 2:
@@ -932,6 +1408,20 @@ class RotaryPositionalEmbedding(PositionalEmbedding):
     if self.embedding_dims != inputs.shape[3]:
       raise ValueError('The embedding dims of the rotary position embedding'
                        'must match the hidden dimension of the inputs.')
+    if self.max_position is not None:
+      cos, sin = self._gather_sin_cos_tables(inputs.shape[1], position)
+    else:
+      cos, sin = self._compute_sin_cos(inputs.shape[1], position)
+    outputs = _apply_rotary(inputs, cos, sin)
+    # TODO(b/252874053): Clean this up after phase 3 is done.
+    if self.cast_as_fprop_dtype:
+      outputs = outputs.astype(self.fprop_dtype)
+    return outputs
+
+  def _compute_sin_cos(
+      self, seq_length: int, position: Optional[JTensor]
+  ) -> Tuple[JTensor, JTensor]:
+    """Returns the [B|1, S, 1, H] cos and signed sin for `_apply_rotary`."""
     half_embedding_dim = self.embedding_dims // 2
     fraction = 2 * jnp.arange(0, half_embedding_dim) / self.embedding_dims
     timescale = (
@@ -939,21 +1429,51 @@ class RotaryPositionalEmbedding(PositionalEmbedding):
         * (self.max_timescale / self.min_timescale) ** fraction
     )
     if position is None:
-      seq_length = inputs.shape[1]
       position = jnp.arange(seq_length, dtype=jnp.float32)[jnp.newaxis, :]
     position = position[:, :, jnp.newaxis, jnp.newaxis]
     timescale = timescale[jnp.newaxis, jnp.newaxis, jnp.newaxis, :]
     sinusoid_inp = position / timescale
     sin = jnp.sin(sinusoid_inp)
     cos = jnp.cos(sinusoid_inp)
-    first_half, second_half = jnp.split(inputs, 2, axis=-1)
-    first_part = (first_half * cos - second_half * sin)
-    second_part = (second_half * cos + first_half * sin)
-    # TODO(b/252874053): Clean this up after phase 3 is done.
-    if self.cast_as_fprop_dtype:
-      first_part = first_part.astype(self.fprop_dtype)
-      second_part = second_part.astype(self.fprop_dtype)
-    return jnp.concatenate([first_part, second_part], axis=-1)
+    return (jnp.concatenate([cos, cos], axis=-1),
+            jnp.concatenate([-sin, sin], axis=-1))
+
+  def _gather_sin_cos_tables(
+      self, seq_length: int, position: Optional[JTensor]
+  ) -> Tuple[JTensor, JTensor]:
+    """Returns the [B|1, S, 1, H] cos and signed sin from the cached tables."""
+    cos, sin = _rotary_sin_cos_tables(
+        self.embedding_dims,
+        self.min_timescale,
+        self.max_timescale,
+        self.max_position,
+    )
+    if position is None:
+      if seq_length > self.max_position:
+        raise ValueError(
+            f'Sequence length {seq_length} exceeds max_position '
+            f'{self.max_position}.'
+        )
+      cos = jnp.asarray(cos[:seq_length])[jnp.newaxis]
+      sin = jnp.asarray(sin[:seq_length])[jnp.newaxis]
+    else:
+      if not isinstance(position, jax.core.Tracer) and np.any(
+          np.asarray(position) >= self.max_position
+      ):
+        raise ValueError(
+            f'Position {np.max(position)} exceeds max_position '
+            f'{self.max_position}.'
+        )
+      position = jnp.asarray(position).astype(jnp.int32)
+      # Out of range positions, which are only known at run time, are not
+      # clamped to the last entry but give NaN outputs.
+      cos = jnp.take(
+          jnp.asarray(cos), position, axis=0, mode='fill', fill_value=jnp.nan
+      )
+      sin = jnp.take(
+          jnp.asarray(sin), position, axis=0, mode='fill', fill_value=jnp.nan
+      )
+    return cos[:, :, jnp.newaxis, :], sin[:, :, jnp.newaxis, :]
 
   def extend_step(self,
                   inputs: JTensor,
@@ -29,6 +29,7 @@ from praxis import pax_fiddle
 from praxis import py_utils
 from praxis import test_utils
 from praxis.layers import embedding_softmax
+from praxis.layers import linears
 import tensorflow.compat.v2 as tf
 
 instantiate = base_layer.instantiate
@@ -38,6 +39,10 @@ NON_TRAINABLE = base_layer.NON_TRAINABLE
 SUMMARIES = base_layer.SUMMARIES
 
 
+class _LinearSubclass(linears.Linear):
+  pass
+
+
 class TokenCounterTest(test_utils.TestCase):
 
   def setUp(self):
@@ -458,6 +463,150 @@ class EmbeddingSoftmaxTest(test_utils.TestCase):
     self.assertAllClose(
         tf_np_emb_lookup_output, np_emb_lookup_output, atol=1e-6)
 
+  @parameterized.parameters(
+      (None, None, None, True),
+      (4, 2.0, None, True),
+      (6, 2.0, 1.5, False),
+  )
+  def test_chunked_softmax_cross_entropy(self, vocab_chunk_size,
+                                         soft_cap_logits, logits_abs_max,
+                                         use_bias):
+    num_tokens, input_dims, num_classes = 10, 8, 12
+    inputs = np.random.normal(size=[num_tokens, input_dims]).astype(np.float32)
+    weights = np.random.normal(size=[input_dims, num_classes]).astype(
+        np.float32)
+    bias = np.random.normal(size=[num_classes]).astype(np.float32)
+    if not use_bias:
+      bias = None
+    class_ids = np.random.randint(0, num_classes, [num_tokens])
+    token_weights = np.random.uniform(size=[num_tokens]).astype(np.float32)
+    label_on_value, label_off_value = 0.8, 0.2 / (num_classes - 1)
+
+    def _dense_xent(inputs, weights, bias):
+      logits = inputs @ weights
+      if bias is not None:
+        logits += bias
+      if soft_cap_logits:
+        logits = soft_cap_logits * jnp.tanh(logits / soft_cap_logits)
+      if logits_abs_max:
+        logits = jnp.clip(logits, -logits_abs_max, logits_abs_max)
+      targets = label_off_value + (label_on_value - label_off_value) * (
+          jax.nn.one_hot(class_ids, num_classes))
+      xent = -jnp.sum(jax.nn.log_softmax(logits) * targets, axis=-1)
+      log_z = jax.nn.logsumexp(logits, axis=-1)
+      label_logit = jnp.take_along_axis(
+          logits, class_ids[:, np.newaxis], axis=-1)[:, 0]
+      loss = (jnp.sum(xent * token_weights) + jnp.sum(jnp.square(log_z)) +
+              jnp.sum(label_logit))
+      return loss, (xent, log_z, jnp.argmax(logits, axis=-1), label_logit)
+
+    def _chunked_xent(inputs, weights, bias):
+      xent, log_z, argmax, label_logit = (
+          embedding_softmax.chunked_softmax_cross_entropy(
+              inputs, weights, bias, class_ids, token_chunk_size=4,
+              vocab_chunk_size=vocab_chunk_size, label_on_value=label_on_value,
+              label_off_value=label_off_value, soft_cap_logits=soft_cap_logits,
+              logits_abs_max=logits_abs_max))
+      loss = (jnp.sum(xent * token_weights) + jnp.sum(jnp.square(log_z)) +
+              jnp.sum(label_logit))
+      return loss, (xent, log_z, argmax, label_logit)
+
+    (dense_loss, dense_outputs), dense_grads = jax.value_and_grad(
+        _dense_xent, argnums=(0, 1, 2), has_aux=True)(inputs, weights, bias)
+    (chunked_loss, chunked_outputs), chunked_grads = jax.jit(
+        jax.value_and_grad(_chunked_xent, argnums=(0, 1, 2), has_aux=True))(
+            inputs, weights, bias)
+
+    self.assertAllClose(chunked_loss, dense_loss)
+    self.assertAllClose(chunked_outputs[0], dense_outputs[0])
+    self.assertAllClose(chunked_outputs[1], dense_outputs[1])
+    self.assertArraysEqual(chunked_outputs[2], dense_outputs[2])
+    self.assertAllClose(chunked_outputs[3], dense_outputs[3])
+    for chunked_grad, dense_grad in zip(chunked_grads, dense_grads):
+      if dense_grad is None:
+        self.assertIsNone(chunked_grad)
+      else:
+        self.assertAllClose(chunked_grad, dense_grad)
+
+  @parameterized.parameters(
+      embedding_softmax.FullSoftmax,
+      embedding_softmax.SharedEmbeddingSoftmax,
+      embedding_softmax.GShardSharedEmbeddingSoftmax,
+  )
+  def test_chunked_xent_softmax_layer(self, softmax_cls):
+    p = pax_fiddle.Config(
+        softmax_cls,
+        name='jax_softmax',
+        num_classes=16,
+        input_dims=8,
+        soft_cap_logits=5.0,
+        label_smoothing_prob=0.1,
+        z_loss_weight=1e-2,
+    )
+    chunked_p = p.clone().set(xent_token_chunk_size=8, xent_vocab_chunk_size=4)
+    softmax_layer = instantiate(p)
+    chunked_softmax_layer = instantiate(chunked_p)
+    inputs = np.random.normal(1.5, 2.0, [2, 10, 8]).astype(np.float32)
+    class_ids = np.random.randint(0, 16, [2, 10, 1])
+    class_weights = np.random.uniform(size=[2, 10, 1]).astype(np.float32)
+
+    def _loss(layer, mdl_vars, inputs):
+      outputs, updated_vars = layer.apply(
+          mdl_vars, inputs, class_weights, class_ids=class_ids,
+          mutable=[base_layer.AUX_LOSS, base_layer.SUMMARIES])
+      aux_loss = sum(
+          jnp.sum(v.value) for v in jax.tree_util.tree_leaves(
+              updated_vars[base_layer.AUX_LOSS],
+              is_leaf=lambda x: isinstance(x, base_layer.AuxLossStruct)))
+      return outputs.avg_xent + aux_loss, (
+          outputs, updated_vars.get(base_layer.SUMMARIES, {}))
+
+    with base_layer.JaxContext.new_context():
+      initial_vars = softmax_layer.init(
+          jax.random.PRNGKey(seed=123), inputs, class_weights,
+          class_ids=class_ids)
+      (loss, (outputs, summaries)), grads = jax.value_and_grad(
+          _loss, argnums=(1, 2), has_aux=True)(
+              softmax_layer, initial_vars, inputs)
+      (chunked_loss, (chunked_outputs, chunked_summaries)), chunked_grads = (
+          jax.value_and_grad(_loss, argnums=(1, 2), has_aux=True)(
+              chunked_softmax_layer, initial_vars, inputs))
+
+    self.assertNotIn('logits', chunked_outputs)
+    self.assertNotIn('log_probs', chunked_outputs)
+    for k in chunked_outputs:
+      self.assertAllClose(chunked_outputs[k], outputs[k])
+    # Including avg_xent_prior_to_label_smoothing.
+    self.assertEqual(
+        jax.tree_util.tree_structure(chunked_summaries),
+        jax.tree_util.tree_structure(summaries))
+    for chunked_summary, summary in zip(
+        jax.tree_util.tree_leaves(chunked_summaries),
+        jax.tree_util.tree_leaves(summaries)):
+      self.assertAllClose(chunked_summary, summary)
+    self.assertAllClose(chunked_loss, loss)
+    for chunked_grad, grad in zip(
+        jax.tree_util.tree_leaves(chunked_grads),
+        jax.tree_util.tree_leaves(grads)):
+      self.assertAllClose(chunked_grad, grad)
+
+  def test_chunked_xent_requires_float_feed_forward(self):
+    p = pax_fiddle.Config(
+        embedding_softmax.FullSoftmax,
+        name='jax_softmax',
+        num_classes=16,
+        input_dims=8,
+        xent_token_chunk_size=8,
+    )
+    # E.g. a quantized Linear, whose `w` is not the float weight.
+    p.feed_forward_tpl.linear_tpl = pax_fiddle.Config(_LinearSubclass)
+    layer = instantiate(p)
+    inputs = np.random.normal(size=[2, 8]).astype(np.float32)
+    with self.assertRaisesRegex(ValueError, 'linears.Linear linear_tpl'):
+      layer.init(jax.random.PRNGKey(seed=123), inputs,
+                 np.ones([2, 1], np.float32),
+                 class_ids=np.zeros([2, 1], np.int32))
+
   @parameterized.parameters((8, 1001), (16, 1024), (32, 30000))
   def test_sigmoid_cross_entropy_class_probs(self, batch_size, num_classes):
     class_probabilities = np.random.normal(1.5, 2.0, [batch_size, num_classes])
@@ -762,6 +911,59 @@ class EmbeddingSoftmaxTest(test_utils.TestCase):
       jax_fprop_slice = output[:, i, :, :]
       self.assertArraysEqual(jax_fprop_slice, jax_np_extend_step_out)
 
+  @parameterized.parameters((1, 1e4, False), (10, 1e5, True))
+  def test_rotary_position_embedding_layer_max_position(
+      self, min_timescale, max_timescale, packed
+  ):
+    embedding_dims = 16
+    p = pax_fiddle.Config(
+        embedding_softmax.RotaryPositionalEmbedding,
+        name='jax_pos',
+        embedding_dims=embedding_dims,
+        min_timescale=min_timescale,
+        max_timescale=max_timescale,
+    )
+    table_p = p.clone().set(max_position=64)
+    pos_layer = instantiate(p)
+    table_pos_layer = instantiate(table_p)
+    inputs = np.random.normal(1.5, 2.5, (2, 8, 4, embedding_dims))
+    position = None
+    if packed:
+      position = np.random.randint(0, 64, (2, 8)).astype(np.int32)
+    prng_key = jax.random.PRNGKey(seed=123)
+    initial_vars = pos_layer.init(prng_key, inputs, position)
+    output = pos_layer.apply(initial_vars, inputs, position)
+    table_output = table_pos_layer.apply(initial_vars, inputs, position)
+    self.assertAllClose(output, table_output, atol=1e-5)
+    for i in range(inputs.shape[1]):
+      extend_step_out = table_pos_layer.apply(
+          initial_vars,
+          inputs[:, i, :, :],
+          position=i if position is None else position[:, i],
+          method=table_pos_layer.extend_step)
+      self.assertAllClose(table_output[:, i], extend_step_out)
+
+    # All the layers with the same configuration share the tables.
+    tables = embedding_softmax._rotary_sin_cos_tables(
+        embedding_dims, min_timescale, max_timescale, 64)
+    self.assertIs(
+        tables,
+        embedding_softmax._rotary_sin_cos_tables(
+            embedding_dims, min_timescale, max_timescale, 64),
+    )
+    with self.assertRaises(ValueError):
+      table_pos_layer.apply(initial_vars, np.zeros([1, 65, 4, embedding_dims]))
+    with self.assertRaises(ValueError):
+      table_pos_layer.apply(
+          initial_vars, inputs[:1, :1], np.array([[64]], np.int32))
+    # Out of range positions only known at run time are not clamped.
+    jit_output = jax.jit(
+        lambda position: table_pos_layer.apply(
+            initial_vars, inputs[:1, :2], position))(
+                np.array([[1, 64]], np.int32))
+    self.assertTrue(np.all(np.isfinite(jit_output[:, 0])))
+    self.assertTrue(np.all(np.isnan(jit_output[:, 1])))
+
   @parameterized.parameters(
       ([0, 1, 0, 1],),
       ([0, 1, 2, 3],),
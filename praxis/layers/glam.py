@@ -48,6 +48,7 @@ def GlamStackedTransformerHParams(
     moe_load_balance_loss_weight=0.01,
     moe_gating_func='top2',
     moe_gating_logit_cap=0.0,
+    moe_sparse_decode=False,
     num_groups=1,
     c_dim=None,
     capacity_factor=0.0,
@@ -89,6 +90,8 @@ def GlamStackedTransformerHParams(
     moe_gating_func: Gating function choice in the MoE Layer.
     moe_gating_logit_cap:  Cap the absolute values of MoE gating logits by tanh.
       Enabled when a positive value is specified.
+    moe_sparse_decode: If True, MoE layers only compute the selected experts of
+      each token without capacity padding during extend_step.
     num_groups: Total number of groups for token dispatching in MoE layer.
     c_dim: Expert capacity.
     capacity_factor: This is the ratio between max allowed examples per expert
@@ -177,6 +180,7 @@ def GlamStackedTransformerHParams(
   moe_p.moe_load_balance_loss_weight = moe_load_balance_loss_weight
   moe_p.gating_func = moe_gating_func
   moe_p.moe_gating_embedding_level = moe_gating_embedding_level
+  moe_p.sparse_decode = moe_sparse_decode
   return p
 
 
@@ -199,6 +203,7 @@ def GlamUniTransformerLmHParams(
     relative_attention_max_distance=128,
     moe_gating_func='top2',
     moe_gating_logit_cap=0.0,
+    moe_sparse_decode=False,
     num_groups=1,
     c_dim=None,
     capacity_factor=0.0,
@@ -247,6 +252,8 @@ def GlamUniTransformerLmHParams(
     moe_gating_func: Gating function choice in the MoE Layer.
     moe_gating_logit_cap:  Cap the absolute values of MoE gating logits by tanh.
       Enabled when a positive value is specified.
+    moe_sparse_decode: If True, MoE layers only compute the selected experts of
+      each token without capacity padding during extend_step.
     num_groups: Total number of groups for token dispatching in MoE layer.
     c_dim: Expert capacity.
     capacity_factor: This is the ratio between max allowed examples per expert
@@ -307,6 +314,7 @@ def GlamUniTransformerLmHParams(
       moe_load_balance_loss_weight=moe_load_balance_loss_weight,
       moe_gating_func=moe_gating_func,
       moe_gating_logit_cap=moe_gating_logit_cap,
+      moe_sparse_decode=moe_sparse_decode,
       num_groups=num_groups,
       c_dim=c_dim,
       capacity_factor=capacity_factor,
@@ -16,7 +16,7 @@
 """Multi-Query Attention layers."""
 
 import math
-from typing import Callable, Dict, Optional, Sequence, Tuple, Union
+from typing import Callable, Dict, List, Optional, Sequence, Tuple, Union
 
 from flax import linen as nn
 import jax
@@ -110,6 +110,10 @@ class OneHeadedAttentionProjection(base_layer.BaseLayer):
 class MultiQueryDotProductAttention(base_layer.BaseLayer):
   """Dot-product attention sharing keys and values across heads.
 
+  Keys and values can also be shared across groups of heads instead of all
+  heads, which is grouped-query attention (https://arxiv.org/abs/2305.13245).
+  Each of the K key/value heads is then shared by G = N / K query heads.
+
   This implementation heavily uses einsum to be efficient on TPUs.  We use the
   following capital letters to denote certain JTensor parameters.
 
@@ -119,6 +123,8 @@ class MultiQueryDotProductAttention(base_layer.BaseLayer):
     D = model dimension
     N = number of attention heads
     H = dimensions of each attention head.
+    K = number of key/value heads.
+    G = number of query heads sharing one key/value head, i.e. N / K.
 
   The algorithm is sketched as follows. Each intermediate JTensor or weight
   JTensor is annotated with its shape. E.g., Wq, the weight JTensor for query's
@@ -141,19 +147,31 @@ class MultiQueryDotProductAttention(base_layer.BaseLayer):
   context:[B, T, N, H] = einsum('BNTS,BSH->BTNH', probs, v_proj)
   Output y:[B, T, D] = einsum('BTNH,DNH>BTD', context, Wout)
 
+  With num_kv_heads = K > 1, Wk, Wv have shape [D, K, H] and the query heads
+  are grouped without repeating keys and values:
+
+  k_proj:[B, S, K, H] = einsum('BSD,DKH->BSKH', x, Wk)
+  v_proj:[B, S, K, H] = einsum('BSD,DKH->BSKH', x, Wv)
+  logits:[B, K, G, T, S] = einsum('BTKGH,BSKH->BKGTS', q_proj, k_proj) / sqrt(H)
+  context:[B, T, K, G, H] = einsum('BKGTS,BSKH->BTKGH', probs, v_proj)
+
   Attributes:
     input_dim: An integer or a dict of integer values as number of input
       nodes. If input_dim is a dict, keys must be key, value and query.
     hidden_dim: Number of hidden nodes.
     num_heads: Number of attention heads.
+    num_kv_heads: Number of key/value heads. Must divide num_heads. 1 means
+      multi-query attention; num_heads means regular multi-head attention;
+      values in between give grouped-query attention.
     dim_per_head: Dimension of each attention head. If None then dim_per_head
       == hidden_dim // num_heads.
     dropout_tpl: Parameterization for the dropout layer.
     atten_dropout_prob: Probability at which we apply dropout to the attention
       weights.
-    proj_tpl: Parameterization for the query projection_tpl layer.
+    proj_tpl: Parameterization for the query projection_tpl layer. Also used for
+      the key/value projections if num_kv_heads > 1.
     headless_proj_tpl: Parameterization for the key/value projection_tpl
-      layer.
+      layer if num_kv_heads == 1.
     use_bias: Whether to use bias for projection_tpl layers.
     output_proj_use_nhd_shape: Whether to use NHD variable shape in output
       projection layer.
@@ -172,6 +190,7 @@ class MultiQueryDotProductAttention(base_layer.BaseLayer):
   input_dim: Union[int, Dict[str, int]] = 0
   hidden_dim: int = 0
   num_heads: int = 1
+  num_kv_heads: int = 1
   dim_per_head: Optional[int] = None
   dropout_tpl: LayerTpl = template_field(stochastics.Dropout)
   atten_dropout_prob: float = 0.0
@@ -218,7 +237,8 @@ class MultiQueryDotProductAttention(base_layer.BaseLayer):
       blnh: Mesh split for query, and encoded tensors with the shape of
         [batch_size, seq_len, num_heads, dim_per_head].
       blh: Mesh split key, value, and encoded tensors with the shape of
-        [batch_size, seq_len, dim_per_head].
+        [batch_size, seq_len, dim_per_head]. If num_kv_heads > 1, key and
+        value tensors use blnh instead.
       bld: Mesh split for output after post projection with the shape of
         [batch_size, seq_len, model_dim].
     """
@@ -233,6 +253,11 @@ class MultiQueryDotProductAttention(base_layer.BaseLayer):
 
     assert not self.dconv_qkv
     assert not self.combine_qkv
+    assert self.num_kv_heads >= 1, f'num_kv_heads is {self.num_kv_heads}'
+    assert self.num_heads % self.num_kv_heads == 0, (
+        f'num_heads {self.num_heads} is not divisible by num_kv_heads '
+        f'{self.num_kv_heads}'
+    )
 
     dim_per_head = self.dim_per_head
     if dim_per_head is None:
@@ -273,9 +298,14 @@ class MultiQueryDotProductAttention(base_layer.BaseLayer):
       proj_p.weight_split_dims_mapping.wt = wp.proj_headless
       return proj_p
 
-    self.create_child('key', project_input_no_heads(key_input_dim))
+    def project_input_kv(input_dim):
+      if self.num_kv_heads == 1:
+        return project_input_no_heads(input_dim)
+      return project_input(input_dim).set(num_heads=self.num_kv_heads)
+
+    self.create_child('key', project_input_kv(key_input_dim))
     self.create_child('query', project_input(query_input_dim))
-    self.create_child('value', project_input_no_heads(value_input_dim))
+    self.create_child('value', project_input_kv(value_input_dim))
 
     if self.use_rotary_position_emb:
       pos_emb_p = pax_fiddle.Config(embedding_softmax.RotaryPositionalEmbedding)
@@ -342,6 +372,20 @@ class MultiQueryDotProductAttention(base_layer.BaseLayer):
     ap = self.activation_split_dims_mapping
     return base_layer.maybe_shard(x, ap.blh, self.mesh_axis_names)
 
+  def _shard_kv(self, x: JTensor) -> JTensor:
+    """Adds sharding annotations to key/value tensors.
+
+    Args:
+      x: A tensor of shape [b, l, h] if num_kv_heads == 1, or [b, l, k, h]
+        otherwise.
+
+    Returns:
+      x with proper sharding annotations.
+    """
+    if self.num_kv_heads == 1:
+      return self._shard_blh(x)
+    return self._shard_blnh(x)
+
   def _shard_bld(self, x: JTensor) -> JTensor:
     """Adds sharding annotations to tensors of shape [b, l, d]."""
     ap = self.activation_split_dims_mapping
@@ -399,16 +443,95 @@ class MultiQueryDotProductAttention(base_layer.BaseLayer):
       sum_exp_x += jnp.exp(extra_logit - max_logit)
     return logits - jnp.log(sum_exp_x) - max_logit
 
+  def _kv_with_heads(self, x: JTensor) -> JTensor:
+    """Returns key/value of shape [..., S, (K,) H] as [..., S, K, H]."""
+    if self.num_kv_heads == 1:
+      return jnp.expand_dims(x, axis=-2)
+    return x
+
   def _atten_logits(self, query: JTensor, key: JTensor) -> JTensor:
-    """Compute logits from query and key."""
-    query = query.transpose(0, 2, 1, 3)
+    """Compute logits from query and key.
+
+    Args:
+      query: JTensor of shape [B, T, N, H].
+      key: JTensor of shape [B, S, H] or [B, S, K, H].
+
+    Returns:
+      logits: JTensor of shape [B, N, T, S].
+    """
+    b, t, n, h = query.shape
+    k = self.num_kv_heads
+    query = jnp.reshape(query, (b, t, k, n // k, h))
     logits = jnp.einsum(
-        'BNTH,BSH->BNTS',
+        'BTKGH,BSKH->BKGTS',
         query,
-        key,
+        self._kv_with_heads(key),
         _dot_general=self.make_qk_dot_general(),
     )
-    return logits
+    return jnp.reshape(logits, (b, n, t, logits.shape[-1]))
+
+  def _atten_context(self, probs: JTensor, value: JTensor) -> JTensor:
+    """Compute the attention context from probs and value.
+
+    Args:
+      probs: JTensor of shape [B, N, T, S].
+      value: JTensor of shape [B, S, H] or [B, S, K, H].
+
+    Returns:
+      encoded: JTensor of shape [B, T, N, H].
+    """
+    b, n, t, s = probs.shape
+    k = self.num_kv_heads
+    probs = jnp.reshape(probs, (b, k, n // k, t, s))
+    encoded = jnp.einsum(
+        'BKGTS,BSKH->BTKGH',
+        probs,
+        self._kv_with_heads(value),
+        _dot_general=self.make_pv_dot_general(),
+    )
+    return jnp.reshape(encoded, (b, t, n, encoded.shape[-1]))
+
+  def _atten_logits_one_step(self, query: JTensor, key: JTensor) -> JTensor:
+    """Compute logits from a single step query and key.
+
+    Args:
+      query: JTensor of shape [B, N, H].
+      key: JTensor of shape [B, S, H] or [B, S, K, H].
+
+    Returns:
+      logits: JTensor of shape [B, N, S].
+    """
+    b, n, h = query.shape
+    k = self.num_kv_heads
+    query = jnp.reshape(query, (b, k, n // k, h))
+    logits = jnp.einsum(
+        'BKGH,BSKH->BKGS',
+        query,
+        self._kv_with_heads(key),
+        _dot_general=self.make_qk_dot_general(),
+    )
+    return jnp.reshape(logits, (b, n, logits.shape[-1]))
+
+  def _atten_context_one_step(self, probs: JTensor, value: JTensor) -> JTensor:
+    """Compute the single step attention context from probs and value.
+
+    Args:
+      probs: JTensor of shape [B, N, S].
+      value: JTensor of shape [B, S, H] or [B, S, K, H].
+
+    Returns:
+      encoded: JTensor of shape [B, N, H].
+    """
+    b, n, s = probs.shape
+    k = self.num_kv_heads
+    probs = jnp.reshape(probs, (b, k, n // k, s))
+    encoded = jnp.einsum(
+        'BKGS,BSKH->BKGH',
+        probs,
+        self._kv_with_heads(value),
+        _dot_general=self.make_pv_dot_general(),
+    )
+    return jnp.reshape(encoded, (b, n, encoded.shape[-1]))
 
   def _dot_atten(
       self,
@@ -421,8 +544,8 @@ class MultiQueryDotProductAttention(base_layer.BaseLayer):
 
     Args:
       query: JTensor of shape [B, T, N, H].
-      key: JTensor of shape [B, S, H].
-      value: JTensor of shape [B, S, H].
+      key: JTensor of shape [B, S, H], or [B, S, K, H] if num_kv_heads > 1.
+      value: JTensor of the same shape as key.
       atten_mask: JTensor of shape [1/B, 1, 1/T, S] which is a mask that is
         applied to prevent attention between unwanted pairs. This has already
         been converted into large negative logits. Note that the first and third
@@ -435,13 +558,13 @@ class MultiQueryDotProductAttention(base_layer.BaseLayer):
       atten_probs: JTensor of shape [B, N, T, S].
     """
     query = self._shard_blnh(query)
-    key = self._shard_blh(key)
-    value = self._shard_blh(value)
+    key = self._shard_kv(key)
+    value = self._shard_kv(value)
 
-    b, s, n, h = query.shape
-    base_layer.assert_has_shape(value, [b, s, h])
-    base_layer.assert_has_shape(query, [b, -1, n, h])
-    t = query.shape[1]
+    b, t, n, h = query.shape
+    s = key.shape[1]
+    base_layer.assert_has_shape(key, self._kv_shape(b, s, h))
+    base_layer.assert_has_shape(value, self._kv_shape(b, s, h))
     # If only padding bias is supplied, then atten_mask can be [B, 1, 1, S]
     # since each target token is prohibited from attending to the same set of
     # source tokens. In this case tiling is inefficient and unnecessary.
@@ -470,17 +593,17 @@ class MultiQueryDotProductAttention(base_layer.BaseLayer):
     # Apply attention dropout.
     probs = self.atten_dropout(probs)
     # Compute the attention context.
-    encoded = jnp.einsum(
-        'BNTS,BSH->BNTH',
-        probs,
-        value,
-        _dot_general=self.make_pv_dot_general(),
-    )
-    encoded = encoded.transpose(0, 2, 1, 3)
+    encoded = self._atten_context(probs, value)
     encoded = checkpoint_name(encoded, 'context')
     encoded = self._shard_blnh(encoded)
     return encoded, probs
 
+  def _kv_shape(self, b: int, s: int, h: int) -> List[int]:
+    """Returns the expected shape of key/value tensors."""
+    if self.num_kv_heads == 1:
+      return [b, s, h]
+    return [b, s, self.num_kv_heads, h]
+
   def decoding_state_sequence_length(self):
     """Returns the length of full decoding sequences."""
     return self.get_decode_state('key_state').shape[1]
@@ -508,23 +631,20 @@ class MultiQueryDotProductAttention(base_layer.BaseLayer):
       encoded: JTensor of shape [B, N, H].
       probs: JTensor of shape [B, N, S].
     """
-    key = self._shard_blh(self.get_decode_state(key_state_name))
-    value = self._shard_blh(self.get_decode_state(value_state_name))
+    key = self._shard_kv(self.get_decode_state(key_state_name))
+    value = self._shard_kv(self.get_decode_state(value_state_name))
     # query is 3d.
     query = self._shard_bnh(query)
 
-    b, s, h = key.shape
-    base_layer.assert_has_shape(value, [b, s, h])
+    b, s = key.shape[:2]
+    h = key.shape[-1]
+    base_layer.assert_has_shape(key, self._kv_shape(b, s, h))
+    base_layer.assert_has_shape(value, self._kv_shape(b, s, h))
     base_layer.assert_has_shape(query, [b, -1, h])
     base_layer.assert_has_shape(atten_mask, [-1, -1, s])
     asserts.in_set(atten_mask.shape[0], [1, b])
     query = self._scale_query(query)
-    logits = jnp.einsum(
-        'BNH,BSH->BNS',
-        query,
-        key,
-        _dot_general=self.make_qk_dot_general(),
-    )
+    logits = self._atten_logits_one_step(query, key)
     if relative_bias is not None:
       base_layer.assert_has_shape(relative_bias, [-1, -1, 1, s])
       asserts.in_set(relative_bias.shape[0], [1, b])
@@ -542,12 +662,7 @@ class MultiQueryDotProductAttention(base_layer.BaseLayer):
       probs = jnp.exp(self._log_softmax_with_extra_logit(padded_logits)).astype(
           key.dtype)
     # Compute the attention context.
-    encoded = jnp.einsum(
-        'BNS,BSH->BNH',
-        probs,
-        value,
-        _dot_general=self.make_pv_dot_general(),
-    )
+    encoded = self._atten_context_one_step(probs, value)
     encoded = self._shard_bnh(encoded)
     return encoded, probs  # pytype: disable=bad-return-type  # jax-ndarray
 
@@ -578,7 +693,7 @@ class MultiQueryDotProductAttention(base_layer.BaseLayer):
       atten_probs: JTensor of shape [B, N, T, S].
     """
     # Project inputs to key, value and query, respectively has shape
-    # [B, S, N, H], [B, S, H], and [B, T, H].
+    # [B, S, (K,) H], [B, S, (K,) H], and [B, T, N, H].
     query_proj = self.query(query_vec)
     key_proj = self.key(key_vec)
     value_proj = self.value(value_vec)
@@ -591,8 +706,8 @@ class MultiQueryDotProductAttention(base_layer.BaseLayer):
     if self.use_rotary_position_emb:
       query_proj = self.rotary_position_emb(query_proj, query_segment_pos)
       key_shape = key_proj.shape
-      # [B, S, H] -> [B, S, N(1), H]
-      key_proj = jnp.expand_dims(key_proj, axis=-2)
+      # [B, S, (K,) H] -> [B, S, K, H]
+      key_proj = self._kv_with_heads(key_proj)
       key_proj = self.rotary_position_emb(key_proj, key_segment_pos)
       key_proj = jnp.reshape(key_proj, key_shape)
       self._fprop_update_decode_state('key_post_rotary_pos_emb', key_proj)
@@ -604,6 +719,9 @@ class MultiQueryDotProductAttention(base_layer.BaseLayer):
     else:
       relative_bias = None
 
+    atten_mask = attentions.maybe_materialize_attention_mask(
+        atten_mask, query_proj.shape[1], key_proj.shape[1], query_vec.dtype
+    )
     encoded, atten_probs = self._dot_atten(query_proj, key_proj, value_proj,
                                            atten_mask, relative_bias)
 
@@ -690,23 +808,23 @@ class MultiQueryDotProductAttention(base_layer.BaseLayer):
     time_dim = 1
     assert time_step.ndim == 0
     # Project inputs to key, value and query. Query has shape [B, N, H],
-    # key/value shapes [B, H]
+    # key/value shapes [B, (K,) H]
     key_proj = self.key(query_vec)
     value_proj = self.value(query_vec)
     query_proj = self.query(query_vec)
 
-    def _extend_decode_state_and_shard_blh(name: str,
-                                           extend_value: JTensor) -> JTensor:
+    def _extend_decode_state_and_shard(name: str,
+                                       extend_value: JTensor) -> JTensor:
       extended_state = self.extend_decode_state(
           name, extend_value, time_step, time_dim=time_dim)
-      return self._shard_blh(extended_state)
+      return self._shard_kv(extended_state)
 
     # Update value state.
     value_state_name = 'value_state'
-    _extend_decode_state_and_shard_blh(value_state_name, value_proj)
+    _extend_decode_state_and_shard(value_state_name, value_proj)
     # Update key state.
     key_state_name = 'key_state'
-    _extend_decode_state_and_shard_blh(key_state_name, key_proj)
+    _extend_decode_state_and_shard(key_state_name, key_proj)
 
     if self.use_rotary_position_emb:
       if segment_pos is None:
@@ -716,12 +834,12 @@ class MultiQueryDotProductAttention(base_layer.BaseLayer):
       query_proj = self.rotary_position_emb.extend_step(
           query_proj, position)
       key_shape = key_proj.shape
-      key_proj = jnp.expand_dims(key_proj, axis=-2)
+      key_proj = self._kv_with_heads(key_proj)
       key_proj = self.rotary_position_emb.extend_step(
           key_proj, position)
       key_proj = jnp.reshape(key_proj, key_shape)
       key_state_name = 'key_post_rotary_pos_emb'
-      _extend_decode_state_and_shard_blh(key_state_name, key_proj)
+      _extend_decode_state_and_shard(key_state_name, key_proj)
 
     if self.relative_bias_tpl:
       # Relative bias uses time_step instead of segment_pos.
@@ -777,6 +895,17 @@ class MultiQueryDotProductAttentionLPB(MultiQueryDotProductAttention):
     blh = [blh[0]] + [None] * (x.ndim - len(blh)) + list(blh[1:])
     return base_layer.maybe_shard(x, blh, self.mesh_axis_names)
 
+  def _shard_kv(self, x: JTensor) -> JTensor:
+    """Adds sharding annotations to key/value tensors."""
+    if self.num_kv_heads == 1:
+      return self._shard_blh(x)
+    blnh = self.activation_split_dims_mapping.blnh
+    if blnh is None:
+      return x
+    # It is possible that we added prefix-broadcast dimensions.
+    blnh = [blnh[0]] + [None] * (x.ndim - len(blnh)) + list(blnh[1:])
+    return base_layer.maybe_shard(x, blnh, self.mesh_axis_names)
+
   def decoding_state_sequence_length(self):
     """Returns the length of full decoding sequences including prefixes."""
     key_state_length = self.get_decode_state('key_state').shape[
@@ -793,7 +922,7 @@ class MultiQueryDotProductAttentionLPB(MultiQueryDotProductAttention):
       if not isinstance(state, JTensor):
         continue
       new_state = transform_fn(state, batch_dim, time_dim)
-      new_state = self._shard_blh(new_state)
+      new_state = self._shard_kv(new_state)
       self.update_decode_state(name, new_state)
 
   def _dot_atten_one_step(self,
@@ -856,14 +985,15 @@ class MultiQueryDotProductAttentionLPB(MultiQueryDotProductAttention):
         rb, *batched_slice = batched_slice
       else:
         rb, *non_batched_slice = non_batched_slice
-      k = self._shard_blh(k)
+      k = self._shard_kv(k)
       # q is 3d.
       if extend_one_step:
         q = self._shard_bnh(q)
       else:
         q = self._shard_blnh(q)
 
-      b, s, h = k.shape
+      b, s = k.shape[:2]
+      h = k.shape[-1]
       n = self.num_heads
       if extend_one_step:
         base_layer.assert_has_shape(q, [b, n, h])
@@ -875,19 +1005,9 @@ class MultiQueryDotProductAttentionLPB(MultiQueryDotProductAttention):
 
       q = self._scale_query(q)
       if extend_one_step:
-        logits = jnp.einsum(
-            'BNH,BSH->BNS',
-            q,
-            k,
-            _dot_general=self.make_qk_dot_general(),
-        )
+        logits = self._atten_logits_one_step(q, k)
       else:
-        logits = jnp.einsum(
-            'BTNH,BSH->BNTS',
-            q,
-            k,
-            _dot_general=self.make_qk_dot_general(),
-        )
+        logits = self._atten_logits(q, k)
       if rb is not None:
         base_layer.assert_has_shape(rb, [-1, n, -1, s])
         asserts.in_set(rb.shape[0], [b, 1])
@@ -946,24 +1066,10 @@ class MultiQueryDotProductAttentionLPB(MultiQueryDotProductAttention):
     # Compute the attention context.
     def _post_softmax(layer, batched, ps, non_batched, states):
       del layer, batched, non_batched
-      v = self._shard_blh(states[0])
+      v = self._shard_kv(states[0])
       if extend_one_step:
-        return self._shard_bnh(
-            jnp.einsum(
-                'BNS,BSH->BNH',
-                ps,
-                v,
-                _dot_general=self.make_pv_dot_general(),
-            )
-        )
-      return self._shard_blnh(
-          jnp.einsum(
-              'BNTS,BSH->BTNH',
-              ps,
-              v,
-              _dot_general=self.make_pv_dot_general(),
-          )
-      )
+        return self._shard_bnh(self._atten_context_one_step(ps, v))
+      return self._shard_blnh(self._atten_context(ps, v))
 
     # Use sum as result combiner since the time dimension is a contracting dim.
     encoded = self._run_with_all_decode_state_chunks(_post_softmax, [], probs,  # pytype: disable=wrong-arg-types  # jax-ndarray
@@ -986,14 +1092,14 @@ class MultiQueryDotProductAttentionLPB(MultiQueryDotProductAttention):
     Returns:
       Updated decode cache state of that variable.
     """
-    if len(value.shape) == time_dim + 1:
+    state = self.get_decode_state(name)
+    assert state is not None
+    if value.ndim == state.ndim - 1:
       extend_value = jnp.expand_dims(value, axis=time_dim)
     else:
       extend_value = value
     indices = [0] * extend_value.ndim
     indices[time_dim] = time_step.astype(jnp.int32)
-    state = self.get_decode_state(name)
-    assert state is not None
     new_state = jax.lax.dynamic_update_slice(state,
                                              extend_value.astype(state.dtype),
                                              indices)
@@ -1266,7 +1372,7 @@ class MultiQueryDotProductAttentionLPB(MultiQueryDotProductAttention):
                                        extend_value: JTensor) -> JTensor:
       extended_state = self.extend_decode_state(
           name, extend_value, time_step - prefix_length, time_dim=1 + pfx_count)
-      return self._shard_blh(extended_state)
+      return self._shard_kv(extended_state)
 
     # Update key_state
     key_state_name = 'key_state'
@@ -1285,7 +1391,8 @@ class MultiQueryDotProductAttentionLPB(MultiQueryDotProductAttention):
         position = segment_pos
 
       def _rotary(layer, q, k, pos):
-        k = jnp.expand_dims(k, axis=-2)
+        k_shape = k.shape
+        k = self._kv_with_heads(k)
 
         if len(query_vec.shape) == pfx_count + 2:
           query_proj = layer.rotary_position_emb.extend_step(q, pos)
@@ -1298,7 +1405,7 @@ class MultiQueryDotProductAttentionLPB(MultiQueryDotProductAttention):
           query_proj = jax.vmap(_get_rotary, in_axes=1, out_axes=1)(q, pos)
           key_proj = jax.vmap(_get_rotary, in_axes=1, out_axes=1)(k, pos)
 
-        key_proj = jnp.squeeze(key_proj, axis=-2)
+        key_proj = jnp.reshape(key_proj, k_shape)
         return query_proj, key_proj
 
       query_proj, key_proj = _vmap_no_state(_rotary)(self,
@@ -126,9 +126,9 @@ class MultiQueryAttentionTest(test_utils.TestCase):
           segment_pos=None)
     self.assertSequenceEqual(encoded.shape, [5, 16])
 
-  @parameterized.parameters([True, False])
+  @parameterized.parameters(*list(itertools.product([True, False], [1, 2])))
   def test_mqa_extend_n_steps_with_lazy_broadcast_state(
-      self, use_rotary_position_emb):
+      self, use_rotary_position_emb, num_kv_heads):
     mdl_dim = 4
     hidden_dim = 8
     num_heads = 2
@@ -138,6 +138,7 @@ class MultiQueryAttentionTest(test_utils.TestCase):
         input_dim=mdl_dim,
         hidden_dim=hidden_dim,
         num_heads=num_heads,
+        num_kv_heads=num_kv_heads,
         dim_per_head=4 if use_rotary_position_emb else None,
         atten_logit_cap=20.0,
         use_rotary_position_emb=use_rotary_position_emb)
@@ -207,8 +208,10 @@ class MultiQueryAttentionTest(test_utils.TestCase):
           encoded,
           _broadcast_sample(fprop_out, num_samples)[:, prefix_len:, :])
 
-  @parameterized.parameters([True, False])
-  def test_mqa_with_lazy_broadcast_state(self, use_rotary_position_emb):
+  @parameterized.parameters(*list(itertools.product([True, False], [1, 2])))
+  def test_mqa_with_lazy_broadcast_state(
+      self, use_rotary_position_emb, num_kv_heads
+  ):
     mdl_dim = 4
     hidden_dim = 8
     num_heads = 2
@@ -218,6 +221,7 @@ class MultiQueryAttentionTest(test_utils.TestCase):
         input_dim=mdl_dim,
         hidden_dim=hidden_dim,
         num_heads=num_heads,
+        num_kv_heads=num_kv_heads,
         dim_per_head=4 if use_rotary_position_emb else None,
         atten_logit_cap=20.0)
     layer = instantiate(test_layer_p)
@@ -327,6 +331,31 @@ class MultiQueryAttentionTest(test_utils.TestCase):
         hidden_dim=50,
         num_heads=10,
     )
+    self._check_fprop_extend_step_consistent(test_layer_p)
+
+  @parameterized.parameters(
+      *list(itertools.product([True, False], [1, 2, 10], [True, False]))
+  )
+  def test_grouped_query_attention_consistent(
+      self, lpb, num_kv_heads, use_rotary_position_emb
+  ):
+    if lpb:
+      mqa = multi_query_attention.MultiQueryDotProductAttentionLPB
+    else:
+      mqa = multi_query_attention.MultiQueryDotProductAttention
+    # Rotary position embedding needs an even dim_per_head.
+    test_layer_p = pax_fiddle.Config(
+        mqa,
+        name='gqa',
+        input_dim=16,
+        hidden_dim=60,
+        num_heads=10,
+        num_kv_heads=num_kv_heads,
+        use_rotary_position_emb=use_rotary_position_emb,
+    )
+    self._check_fprop_extend_step_consistent(test_layer_p)
+
+  def _check_fprop_extend_step_consistent(self, test_layer_p):
     layer = instantiate(test_layer_p)
 
     inputs = np.random.normal(1.5, 2.0, [5, 2, 16]).astype(np.float32)
@@ -364,6 +393,68 @@ class MultiQueryAttentionTest(test_utils.TestCase):
         output = output.at[:, t, :].set(e)
     self.assertAllClose(encoded, output)
 
+  @parameterized.parameters([False, True])
+  def test_grouped_query_attention_shape(self, use_rotary_position_emb):
+    test_layer_p = pax_fiddle.Config(
+        multi_query_attention.MultiQueryDotProductAttention,
+        name='gqa',
+        input_dim=16,
+        hidden_dim=60,
+        num_heads=10,
+        num_kv_heads=5,
+        use_rotary_position_emb=use_rotary_position_emb,
+    )
+    layer = instantiate(test_layer_p)
+    inputs = np.random.normal(1.5, 2.0, [5, 12, 16]).astype(np.float32)
+    atten_mask = jnp.zeros([1, 1, 1, 12])
+    prng_key = jax.random.PRNGKey(seed=123)
+    prng_key, init_key = jax.random.split(prng_key)
+
+    with base_layer.JaxContext.new_context():
+      initial_vars = layer.init(init_key, inputs, inputs, inputs, atten_mask)
+      encoded, attens = layer.apply(initial_vars, inputs, inputs, inputs,
+                                    atten_mask)
+    self.assertSequenceEqual(
+        initial_vars[base_layer.PARAMS]['key']['w'].shape, [16, 5, 6]
+    )
+    self.assertSequenceEqual(encoded.shape, [5, 12, 16])
+    self.assertSequenceEqual(attens.shape, [5, 10, 12, 12])
+
+  def test_grouped_query_attention_all_heads_matches_mha(self):
+    gqa_p = pax_fiddle.Config(
+        multi_query_attention.MultiQueryDotProductAttention,
+        name='gqa',
+        input_dim=16,
+        hidden_dim=32,
+        num_heads=4,
+        num_kv_heads=4,
+    )
+    mha_p = pax_fiddle.Config(
+        attentions.DotProductAttention,
+        name='mha',
+        input_dim=16,
+        hidden_dim=32,
+        num_heads=4,
+        internal_enable_per_dim_scale=False,
+    )
+    gqa = instantiate(gqa_p)
+    mha = instantiate(mha_p)
+    inputs = np.random.normal(1.5, 2.0, [3, 7, 16]).astype(np.float32)
+    mask = attentions.causal_mask(inputs)
+
+    with base_layer.JaxContext.new_context():
+      initial_vars = gqa.init(
+          jax.random.PRNGKey(seed=123), inputs, inputs, inputs, mask
+      )
+      gqa_encoded, gqa_probs = gqa.apply(
+          initial_vars, inputs, inputs, inputs, mask
+      )
+      mha_encoded, mha_probs = mha.apply(
+          initial_vars, inputs, inputs, inputs, mask
+      )
+    self.assertAllClose(mha_encoded, gqa_encoded)
+    self.assertAllClose(mha_probs, gqa_probs)
+
   # TODO(apassos) test the SPMD codepath for deriving sharding annotations.
 
 if __name__ == '__main__':
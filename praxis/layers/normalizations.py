@@ -25,6 +25,7 @@ from praxis import py_utils
 from praxis import pytypes
 
 NestedMap = py_utils.NestedMap
+NestedJTensor = pytypes.NestedJTensor
 WeightInit = base_layer.WeightInit
 WeightHParams = base_layer.WeightHParams
 PMAP_PARALLEL_AXIS_NAME = base_layer.PMAP_PARALLEL_AXIS_NAME
@@ -88,6 +89,27 @@ def compute_moments(
   return mean, variance
 
 
+def rms_normalizing_factor(inputs: JTensor, epsilon: float) -> JTensor:
+  """Returns the reciprocal RMS of inputs over the last dim, in fp32.
+
+  This is the normalizing factor of a LayerNorm or an RmsNorm whose scale and
+  bias have been folded into the following projection: as it is constant over
+  the last dim, it can be applied to the projected outputs instead of the
+  inputs.
+
+  Args:
+    inputs: The inputs JTensor. Shaped [..., dim]. For a LayerNorm, they must
+      have been centered already.
+    epsilon: Tiny value to guard rsqrt.
+
+  Returns:
+    The normalizing factor, shaped [..., 1].
+  """
+  inputs = inputs.astype(jnp.float32)
+  var = jnp.mean(jnp.square(inputs), axis=[-1], keepdims=True)
+  return jax.lax.rsqrt(var + epsilon)
+
+
 class BaseNormalization(base_layer.BaseLayer):
   """Base class for normalization layers.
 
@@ -375,6 +397,37 @@ class LayerNorm(BaseNormalization):
       normed_inputs += self.theta.bias
     return normed_inputs
 
+  def fused_projection_inputs(self, inputs: JTensor) -> JTensor:
+    """Returns the inputs to a projection this norm is folded into.
+
+    See `rms_normalizing_factor` for the factor to apply to its outputs.
+
+    Args:
+      inputs: The inputs JTensor. Shaped [..., dim].
+
+    Returns:
+      The centered inputs, with the same shape and dtype as 'inputs'.
+    """
+    mean = jnp.mean(
+        inputs.astype(jnp.float32), axis=[-1], keepdims=True
+    ).astype(inputs.dtype)
+    return inputs - mean
+
+  def scale_and_bias(self) -> Tuple[Optional[JTensor], Optional[JTensor]]:
+    """Returns the scale and bias applied to the normalized inputs."""
+    scale = 1 + self.theta.scale if self.use_scale else None
+    bias = self.theta.bias if self.use_bias else None
+    return scale, bias
+
+  def folded_vars(self) -> NestedJTensor:
+    """Returns the variables once the scale and bias are folded elsewhere."""
+    folded = {}
+    if self.use_scale:
+      folded['scale'] = jnp.zeros_like(self.theta.scale)
+    if self.use_bias:
+      folded['bias'] = jnp.zeros_like(self.theta.bias)
+    return folded
+
 
 class RmsNorm(BaseNormalization):
   """RMS normalization: https://arxiv.org/abs/1910.07467.
@@ -433,6 +486,29 @@ class RmsNorm(BaseNormalization):
     normed_inputs *= scale
     return normed_inputs
 
+  def fused_projection_inputs(self, inputs: JTensor) -> JTensor:
+    """Returns the inputs to a projection this norm is folded into.
+
+    See `rms_normalizing_factor` for the factor to apply to its outputs.
+
+    Args:
+      inputs: The inputs JTensor. Shaped [..., dim].
+
+    Returns:
+      The inputs unchanged.
+    """
+    return inputs
+
+  def scale_and_bias(self) -> Tuple[Optional[JTensor], Optional[JTensor]]:
+    """Returns the scale and bias applied to the normalized inputs."""
+    scale = self.theta.scale if self.direct_scale else 1 + self.theta.scale
+    return scale, None
+
+  def folded_vars(self) -> NestedJTensor:
+    """Returns the variables once the scale is folded elsewhere."""
+    init_value = 1.0 if self.direct_scale else 0.0
+    return {'scale': jnp.full_like(self.theta.scale, init_value)}
+
 
 class RmsNormNoScale(BaseNormalization):
   """RMS normalization: https://arxiv.org/abs/1910.07467 without scale.
@@ -16,6 +16,7 @@
 """Quantized Attention Layers."""
 
 import copy
+import functools
 import string
 from typing import Any, Optional, Sequence, Tuple
 
@@ -195,10 +196,30 @@ class AttentionProjection(attentions.AttentionProjection):
       w, s, zp = self.get_quantized_weight(
           'w', use_symmetric=self.quantization.weight_params.use_symmetric
       )
+      dequant_upfront = (
+          self.quantization.act_params is None
+          and operations.use_dequant_upfront(
+              eqn,
+              inputs,
+              self.quantization.weight_params.dequant_upfront,
+              self.quantization.weight_params.dequant_upfront_min_tokens,
+          )
+      )
+      einsum_fn = operations.einsum
       if self.quantization.weight_params.precision == 4:
-        w = utils.unpack_4bit(
-            w, self._PACK_4BIT_DIM, self.quantization.weight_params.dtype
-        )
+        if (
+            self.quantization.weight_params.int4_blockwise_unpack
+            and not dequant_upfront
+        ):
+          einsum_fn = functools.partial(
+              operations.einsum_4bit,
+              pack_dim=self._PACK_4BIT_DIM,
+              original_dtype=self.quantization.weight_params.dtype,
+          )
+        else:
+          w = utils.unpack_4bit(
+              w, self._PACK_4BIT_DIM, self.quantization.weight_params.dtype
+          )
 
       if (
           self.quantization.act_params is not None
@@ -212,18 +233,18 @@ class AttentionProjection(attentions.AttentionProjection):
           and self.quantization.act_params.stats_config is None
       ):
         inputs, act_scale = operations.reduce_precision_activation(inputs)
-        ret = operations.einsum(
+        ret = einsum_fn(
             eqn, inputs, w, jnp.multiply(jnp.squeeze(act_scale), s)
         )
+      elif dequant_upfront:
+        w = operations.dequantize_weight(eqn, w, s, zp, dtype=inputs.dtype)
+        ret = jnp.einsum(eqn, inputs, w)
       elif self.quantization.act_params is None:
         if self.quantization.weight_params.use_symmetric:
-          if self.quantization.weight_params.dequant_upfront:
-            raise NotImplementedError('Dequantize upfront not supported.')
-          else:
-            ret = operations.einsum(eqn, inputs, w, s)
+          ret = einsum_fn(eqn, inputs, w, s)
         else:
           assert zp is not None, 'zp cannot be None when use_symmetric=False.'
-          ret = operations.einsum(eqn, inputs, w, s, zp)
+          ret = einsum_fn(eqn, inputs, w, s, zp)
 
     else:
       if self.quantization.quantization_type == QuantizationType.AQT:
@@ -477,10 +498,30 @@ class CombinedQKVProjectionLayer(attentions.CombinedQKVProjectionLayer):
       w, s, zp = self.get_quantized_weight(
           'w', use_symmetric=self.quantization.weight_params.use_symmetric
       )
+      dequant_upfront = (
+          self.quantization.act_params is None
+          and operations.use_dequant_upfront(
+              eqn,
+              inputs,
+              self.quantization.weight_params.dequant_upfront,
+              self.quantization.weight_params.dequant_upfront_min_tokens,
+          )
+      )
+      einsum_fn = operations.einsum
       if self.quantization.weight_params.precision == 4:
-        w = utils.unpack_4bit(
-            w, self._PACK_4BIT_DIM, self.quantization.weight_params.dtype
-        )
+        if (
+            self.quantization.weight_params.int4_blockwise_unpack
+            and not dequant_upfront
+        ):
+          einsum_fn = functools.partial(
+              operations.einsum_4bit,
+              pack_dim=self._PACK_4BIT_DIM,
+              original_dtype=self.quantization.weight_params.dtype,
+          )
+        else:
+          w = utils.unpack_4bit(
+              w, self._PACK_4BIT_DIM, self.quantization.weight_params.dtype
+          )
 
       if (
           self.quantization.act_params is not None
@@ -494,17 +535,17 @@ class CombinedQKVProjectionLayer(attentions.CombinedQKVProjectionLayer):
           and self.quantization.act_params.stats_config is None
       ):
         inputs, act_scale = operations.reduce_precision_activation(inputs)
-        ret = operations.einsum(
+        ret = einsum_fn(
             eqn, inputs, w, jnp.multiply(jnp.squeeze(act_scale), s)
         )
+      elif dequant_upfront:
+        w = operations.dequantize_weight(eqn, w, s, zp, dtype=inputs.dtype)
+        ret = jnp.einsum(eqn, inputs, w)
       elif self.quantization.act_params is None:
         if self.quantization.weight_params.use_symmetric:
-          if self.quantization.weight_params.dequant_upfront:
-            raise NotImplementedError('Dequantize upfront not supported.')
-          else:
-            ret = operations.einsum(eqn, inputs, w, s)
+          ret = einsum_fn(eqn, inputs, w, s)
         else:
-          ret = operations.einsum(eqn, inputs, w, s, zp)
+          ret = einsum_fn(eqn, inputs, w, s, zp)
     else:
       if self.quantization.quantization_type == QuantizationType.AQT:
         ret = operations.aqt_einsum(
@@ -0,0 +1,88 @@
+# coding=utf-8
+# Copyright 2022 The Pax Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Calibration of static activation quantization.
+
+Example usage, for a model whose quantized layers are configured with
+QuantizationMode.TRAINING and act_params.stats_config set:
+
+  variables = model.init(prng_key, input_batch)
+  variables = calibration.calibrate_activation_ranges(
+      model, variables, calibration_input, num_batches=100)
+  quantized, _ = model.apply(
+      variables, mutable=[], method=model.quantize_weight)
+
+The quantized variables then contain the calibrated activation scales used by
+the same model in QuantizationMode.INFERENCE.
+"""
+
+from typing import Any, Callable, Optional
+
+import jax
+from praxis import base_input
+from praxis import base_layer
+from praxis import py_utils
+from praxis import pytypes
+
+NestedJTensor = pytypes.NestedJTensor
+NestedMap = py_utils.NestedMap
+
+FpropFn = Callable[[base_layer.BaseLayer, NestedMap], Any]
+
+
+def default_fprop(layer: base_layer.BaseLayer, input_batch: NestedMap) -> Any:
+  """Calls the layer on the whole input batch."""
+  return layer(input_batch)
+
+
+def calibrate_activation_ranges(
+    layer: base_layer.BaseLayer,
+    variables: NestedJTensor,
+    input_generator: base_input.BaseInput,
+    num_batches: int,
+    fprop_fn: Optional[FpropFn] = None,
+) -> NestedJTensor:
+  """Records the activation ranges of a layer over calibration batches.
+
+  Args:
+    layer: The layer (typically a model) to calibrate, instantiated in
+      QuantizationMode.TRAINING.
+    variables: The variables of the layer.
+    input_generator: The calibration input. Batches are read with
+      get_next_padded().
+    num_batches: Number of calibration batches.
+    fprop_fn: Function calling the layer on an input batch. Defaults to
+      `layer(input_batch)`.
+
+  Returns:
+    The variables with the recorded activation ranges.
+  """
+  fprop_fn = fprop_fn or default_fprop
+
+  @jax.jit
+  def _calibrate_step(variables, input_batch):
+    context_p = base_layer.JaxContext.HParams(do_eval=True)
+    with base_layer.JaxContext.new_context(hparams=context_p):
+      _, updated = layer.apply(
+          variables,
+          input_batch,
+          mutable=[base_layer.NON_TRAINABLE],
+          method=fprop_fn,
+      )
+    return {**variables, **updated}
+
+  for _ in range(num_batches):
+    variables = _calibrate_step(variables, input_generator.get_next_padded())
+  return variables
@@ -0,0 +1,144 @@
+# coding=utf-8
+# Copyright 2022 The Pax Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for calibration of static activation quantization."""
+
+from absl.testing import absltest
+from absl.testing import parameterized
+import jax
+import numpy as np
+from praxis import base_layer
+from praxis import pax_fiddle
+from praxis import test_utils
+from praxis.layers.quantization import calibration
+from praxis.layers.quantization import linears as qlinears
+from praxis.layers.quantization import quantization_hparams
+from praxis.layers.quantization.tests import test_util as quantization_test_util
+
+instantiate = base_layer.instantiate
+QuantizationHParams = quantization_hparams.QuantizationHParams
+QuantizationMode = quantization_hparams.QuantizationMode
+QuantizationType = quantization_hparams.QuantizationType
+NON_TRAINABLE = base_layer.NON_TRAINABLE
+PARAMS = base_layer.PARAMS
+
+
+def _linear_fprop(layer, input_batch):
+  return layer(input_batch.inputs)
+
+
+class CalibrationTest(test_utils.TestCase):
+
+  def setUp(self):
+    super().setUp()
+    np.random.seed(123456)
+
+  def _linear_p(self, mode, stats_config):
+    return pax_fiddle.Config(
+        qlinears.Linear,
+        name='_linear',
+        mesh_axis_names=['replica', 'mdl', 'data'],
+        weight_split_dims_mapping=base_layer.BaseLayer.WeightSharding(
+            wt=['mdl', 'data']
+        ),
+        input_dims=8,
+        output_dims=4,
+        quantization=QuantizationHParams(
+            quantization_type=QuantizationType.PTQ,
+            mode=mode,
+            act_params=quantization_hparams.ActQuantizationParams(
+                precision=8, stats_config=stats_config
+            ),
+            weight_params=quantization_hparams.WeightQuantizationParams(),
+        ),
+    )
+
+  @parameterized.parameters(None, 0.5)
+  def test_calibrate_activation_ranges(self, ema_decay):
+    stats_config = quantization_hparams.ActStatsConfig(ema_decay=ema_decay)
+    layer = instantiate(
+        self._linear_p(QuantizationMode.TRAINING, stats_config)
+    )
+    batches = [
+        np.random.normal(0.0, scale, [2, 3, 8]).astype(np.float32)
+        for scale in (1.0, 3.0, 2.0)
+    ]
+    input_p = pax_fiddle.Config(quantization_test_util.FixedInput, batch_size=2, batches=batches)
+    input_generator = instantiate(input_p)
+
+    with base_layer.JaxContext.new_context():
+      initial_vars = layer.init(jax.random.PRNGKey(123), batches[0])
+    self.assertAllClose(initial_vars[NON_TRAINABLE]['act_max'], 0.0)
+
+    variables = calibration.calibrate_activation_ranges(
+        layer, initial_vars, input_generator, num_batches=3,
+        fprop_fn=_linear_fprop)
+
+    batch_maxes = [np.max(np.abs(b)) for b in batches]
+    if ema_decay is None:
+      expected = max(batch_maxes)
+    else:
+      expected = batch_maxes[0]
+      for batch_max in batch_maxes[1:]:
+        expected = ema_decay * expected + (1.0 - ema_decay) * batch_max
+    self.assertAllClose(variables[NON_TRAINABLE]['act_max'], expected)
+    # Calibration does not change the weights.
+    self.assertAllClose(variables[PARAMS]['w'], initial_vars[PARAMS]['w'])
+
+  def test_static_matches_dynamic_on_calibration_batch(self):
+    stats_config = quantization_hparams.ActStatsConfig()
+    train_layer = instantiate(
+        self._linear_p(QuantizationMode.TRAINING, stats_config)
+    )
+    static_layer = instantiate(
+        self._linear_p(QuantizationMode.INFERENCE, stats_config)
+    )
+    dynamic_layer = instantiate(
+        self._linear_p(QuantizationMode.INFERENCE, None)
+    )
+    inputs = np.random.normal(1.0, 2.0, [2, 3, 8]).astype(np.float32)
+    input_generator = instantiate(
+        pax_fiddle.Config(quantization_test_util.FixedInput, batch_size=2, batches=[inputs])
+    )
+
+    with base_layer.JaxContext.new_context():
+      initial_vars = train_layer.init(jax.random.PRNGKey(123), inputs)
+      variables = calibration.calibrate_activation_ranges(
+          train_layer, initial_vars, input_generator, num_batches=1,
+          fprop_fn=_linear_fprop)
+      quantized, _ = train_layer.apply(
+          variables, mutable=[], method=train_layer.quantize_weight
+      )
+      pspec, _ = train_layer.apply(
+          variables, mutable=[], method=train_layer.quantized_partition_specs
+      )
+      float_outputs = train_layer.apply(initial_vars, inputs)
+      static_outputs = static_layer.apply(quantized, inputs)
+      dynamic_outputs = dynamic_layer.apply(
+          {PARAMS: quantized[PARAMS]}, inputs
+      )
+
+    self.assertEqual(quantized[NON_TRAINABLE]['act_scale'].shape, ())
+    self.assertEqual(
+        pspec[NON_TRAINABLE]['act_scale'],
+        base_layer.BoxedPartitionSpec(meta=jax.sharding.PartitionSpec()),
+    )
+    # The calibrated range of a single batch is the dynamic range of it.
+    self.assertAllClose(static_outputs, dynamic_outputs)
+    self.assertAllClose(static_outputs, float_outputs, rtol=0.05, atol=0.2)
+
+
+if __name__ == '__main__':
+  absltest.main()
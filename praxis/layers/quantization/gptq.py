@@ -0,0 +1,767 @@
+# coding=utf-8
+# Copyright 2022 The Pax Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""GPTQ post-training weight quantization.
+
+GPTQ (https://arxiv.org/abs/2210.17323) quantizes the weight one input row at a
+time and compensates the quantization error of each row by updating the not yet
+quantized rows, using the Hessian of the layer reconstruction loss, i.e. the
+second moment of the layer inputs over calibration data.
+
+Example usage, for a model whose layers are quantized with
+QuantizationType.PTQ and QuantizationMode.TRAINING, e.g. by
+quantize.set_quantization():
+
+  variables = model.init(prng_key, input_batch)
+  quantized = gptq.quantize_weight_gptq(
+      model, variables, calibration_input, num_batches=128)
+
+The quantized variables have the same structure as the ones returned by
+model.quantize_weight(), and are used by the same model in
+QuantizationMode.INFERENCE.
+
+The model is processed block by block, in the order of the forward pass. A
+block is an outermost layer of one of the `block_types` (by default
+transformers.Transformer), one iteration of a repeats.Repeat (run on its slice
+of the stacked variables), or a supported layer called outside of any block.
+The inputs of a block are captured once per calibration batch: from the
+quantized outputs of the previous block when the block is called on them, and
+otherwise with a forward pass of the model. Within a block, layers are quantized
+one at a time on these inputs, so that only the Hessian of a single layer is
+kept in memory and every layer sees the quantization error of the layers before
+it. Padded batch rows and padded positions (`paddings` of the input batch) are
+not counted in the Hessian.
+
+Supported layers are quantization.Linear (which includes the feed-forward
+layers), the attention projections and the combined QKV projection. Other
+layers, and supported layers inside a Repeat nested in a block, keep
+round-to-nearest quantization. The positional and keyword inputs of blocks must
+be JAX arrays (or None).
+"""
+
+import dataclasses
+import functools
+from typing import Any, Dict, List, Optional, Sequence, Tuple, Type
+
+from absl import logging
+import flax.linen as nn
+import jax
+from jax import numpy as jnp
+import numpy as np
+from praxis import base_input
+from praxis import base_layer
+from praxis import py_utils
+from praxis import pytypes
+from praxis.layers import repeats
+from praxis.layers import transformers
+from praxis.layers.quantization import attentions
+from praxis.layers.quantization import calibration
+from praxis.layers.quantization import linears
+from praxis.layers.quantization import multi_query_attention
+from praxis.layers.quantization import operations
+from praxis.layers.quantization import quantization_hparams
+from praxis.layers.quantization import utils
+
+JTensor = pytypes.JTensor
+NestedJTensor = pytypes.NestedJTensor
+NestedMap = py_utils.NestedMap
+QuantizationMode = quantization_hparams.QuantizationMode
+QuantizationType = quantization_hparams.QuantizationType
+
+FpropFn = calibration.FpropFn
+ModulePath = Tuple[str, ...]
+# The positional and keyword inputs of a block call.
+BlockInputs = Tuple[Tuple[Any, ...], Dict[str, Any]]
+
+
+def gptq_quantize_matrix(
+    w: JTensor,
+    hessian: JTensor,
+    bits: int = 8,
+    use_symmetric: bool = True,
+    clipping_coeff: float = 1.0,
+    damping: float = 0.01,
+) -> Tuple[JTensor, JTensor, Optional[JTensor]]:
+  """Quantizes a [input, output] weight with per output channel scales.
+
+  The scales and zero points are computed as in round-to-nearest quantization
+  (see operations.reduce_einsum_weight_precision), only the rounding of the
+  weight changes.
+
+  Args:
+    w: [K, N] weight, where K is contracted with the layer inputs.
+    hessian: [K, K] second moment of the layer inputs.
+    bits: Target number of bits.
+    use_symmetric: If the weight is quantized symmetrically.
+    clipping_coeff: The coefficient to shrink the range of each channel.
+    damping: Dampening added to the Hessian diagonal, relative to its mean.
+
+  Returns:
+    A tuple (q_w, scale, zp): the [K, N] int8 quantized weight, [N] scale and
+    [N] zero point (None if use_symmetric), such that the dequantized weight is
+    q_w * scale - zp.
+  """
+  w = w.astype(jnp.float32)
+  hessian = hessian.astype(jnp.float32)
+  num_rows = w.shape[0]
+  min_value, max_value = operations.get_min_max(bits)
+
+  if use_symmetric:
+    scale = jnp.max(jnp.abs(w), axis=0) * clipping_coeff / max_value
+    scale = jnp.where(scale > 0.0, scale, jnp.ones_like(scale))
+    zp = jnp.zeros_like(scale)
+  else:
+    w_min = jnp.min(w, axis=0)
+    scale = (jnp.max(w, axis=0) - w_min) * clipping_coeff / (2**bits - 1.0)
+    scale = jnp.where(scale > 0.0, scale, jnp.ones_like(scale))
+    zp = min_value - w_min / scale
+
+  def _quantize(row):
+    return jnp.clip(jnp.round(row / scale + zp), min_value, max_value)
+
+  # Inputs which are always zero do not constrain their weight rows.
+  diag = jnp.diag(hessian)
+  dead = diag == 0.0
+  hessian = hessian + jnp.diag(jnp.where(dead, 1.0, 0.0))
+  w = jnp.where(dead[:, jnp.newaxis], 0.0, w)
+  hessian += damping * jnp.mean(jnp.diag(hessian)) * jnp.eye(num_rows)
+  # Upper Cholesky factor of the inverse Hessian.
+  hinv = jnp.linalg.cholesky(jnp.linalg.inv(hessian)).T
+
+  def _quantize_row(i, carry):
+    w, q_w = carry
+    row = w[i]
+    q_row = _quantize(row)
+    err = (row - (q_row - zp) * scale) / hinv[i, i]
+    # Compensate the error on the rows which are not quantized yet.
+    later = (jnp.arange(num_rows) > i).astype(w.dtype)
+    w -= jnp.outer(hinv[i] * later, err)
+    q_w = q_w.at[i].set(q_row)
+    return w, q_w
+
+  _, q_w = jax.lax.fori_loop(0, num_rows, _quantize_row,
+                             (w, jnp.zeros_like(w)))
+  if use_symmetric:
+    return q_w.astype(jnp.int8), scale, None
+  return q_w.astype(jnp.int8), scale, zp * scale
+
+
+def _weight_contract_dims(layer: base_layer.BaseLayer) -> Optional[List[int]]:
+  """Returns the dims of the weight `w` contracted with the layer inputs."""
+  if isinstance(layer, linears.Linear):
+    return [0]
+  if isinstance(layer, multi_query_attention.OneHeadedAttentionProjection):
+    return [0]
+  if isinstance(layer, attentions.CombinedQKVProjectionLayer):
+    return None if layer.attention_combine_dims else [1]
+  if isinstance(layer, attentions.AttentionProjection):
+    if layer.attention_combine_dims:
+      return None
+    if layer.is_output_projection:
+      return [0, 1] if layer.use_nhd_shape else [1, 2]
+    return [0]
+  return None
+
+
+def _is_target(layer: base_layer.BaseLayer) -> bool:
+  quantization = getattr(layer, 'quantization', None)
+  return (
+      quantization is not None
+      and quantization.mode == QuantizationMode.TRAINING
+      and quantization.quantization_type
+      in (QuantizationType.PTQ, QuantizationType.FQ)
+      and _weight_contract_dims(layer) is not None
+  )
+
+
+@dataclasses.dataclass
+class _Block:
+  """A part of the forward pass whose supported layers are quantized together.
+
+  Attributes:
+    path: Path of the block layer.
+    targets: The supported layers called by the block, in forward pass order.
+    repeat_shape: For a repeats.Repeat, the leading shape of its stacked
+      variables. Each iteration is quantized as a separate block.
+    sublayer_name: For a repeats.Repeat, the name of its sublayer.
+    positional_args_as_scan_carry: For a repeats.Repeat, if all positional
+      inputs are carried across iterations.
+  """
+
+  path: ModulePath
+  targets: Dict[ModulePath, base_layer.BaseLayer] = dataclasses.field(
+      default_factory=dict
+  )
+  repeat_shape: Optional[Tuple[int, ...]] = None
+  sublayer_name: str = ''
+  positional_args_as_scan_carry: bool = False
+
+  @property
+  def num_iterations(self) -> int:
+    return 1 if self.repeat_shape is None else int(np.prod(self.repeat_shape))
+
+  def iteration_index(self, i: int) -> Optional[Tuple[int, ...]]:
+    """Returns the index of iteration i into the stacked variables."""
+    if self.repeat_shape is None:
+      return None
+    return tuple(int(j) for j in np.unravel_index(i, self.repeat_shape))
+
+
+def _eval_apply(model, variables, *args, method, interceptor=None):
+  """Applies the model in eval mode, optionally intercepting layer calls."""
+  with base_layer.JaxContext.new_context(
+      hparams=base_layer.JaxContext.HParams(do_eval=True)
+  ):
+    if interceptor is None:
+      return model.apply(variables, *args, method=method)
+    with nn.intercept_methods(interceptor):
+      return model.apply(variables, *args, method=method)
+
+
+def _find_blocks(
+    model: base_layer.BaseLayer,
+    variables: NestedJTensor,
+    input_batch: NestedMap,
+    fprop_fn: FpropFn,
+    block_types: Sequence[Type[base_layer.BaseLayer]],
+) -> List[_Block]:
+  """Returns the blocks with supported layers, in forward pass order."""
+  blocks = {}
+  open_blocks = []
+  nested_repeats = []
+  unsupported = {}
+
+  def _interceptor(next_fun, args, kwargs, context):
+    module = context.module
+    if context.method_name != '__call__':
+      return next_fun(*args, **kwargs)
+    if isinstance(module, repeats.Repeat) and open_blocks:
+      nested_repeats.append(module.path)
+      try:
+        return next_fun(*args, **kwargs)
+      finally:
+        nested_repeats.pop()
+    if not open_blocks and isinstance(
+        module, (repeats.Repeat,) + tuple(block_types)
+    ):
+      block = blocks.setdefault(module.path, _Block(module.path))
+      if isinstance(module, repeats.Repeat):
+        block.repeat_shape = tuple(module.nd_prefix_shape or [module.x_times])
+        block.sublayer_name = module.sublayer_name
+        block.positional_args_as_scan_carry = (
+            module.positional_args_as_scan_carry
+        )
+      open_blocks.append(block)
+      try:
+        return next_fun(*args, **kwargs)
+      finally:
+        open_blocks.pop()
+    if _is_target(module):
+      if nested_repeats:
+        unsupported.setdefault(module.path, None)
+      elif open_blocks:
+        open_blocks[-1].targets.setdefault(module.path, module)
+      else:
+        block = blocks.setdefault(module.path, _Block(module.path))
+        block.targets.setdefault(module.path, module)
+    return next_fun(*args, **kwargs)
+
+  jax.eval_shape(
+      functools.partial(
+          _eval_apply, model, method=fprop_fn, interceptor=_interceptor
+      ),
+      variables,
+      input_batch,
+  )
+  for path in unsupported:
+    logging.warning(
+        'GPTQ does not support %s, which is inside a nested Repeat. It keeps '
+        'round-to-nearest quantization.',
+        '/'.join(path),
+    )
+  return [block for block in blocks.values() if block.targets]
+
+
+def _first_output(outputs: Any) -> Any:
+  return outputs[0] if isinstance(outputs, tuple) else outputs
+
+
+def _tree_equal(x: Any, y: Any) -> JTensor:
+  x_leaves, x_def = jax.tree_util.tree_flatten(x)
+  y_leaves, y_def = jax.tree_util.tree_flatten(y)
+  if x_def != y_def or any(
+      jnp.shape(a) != jnp.shape(b) for a, b in zip(x_leaves, y_leaves)
+  ):
+    return jnp.array(False)
+  return jnp.all(
+      jnp.array(
+          [True] + [jnp.array_equal(a, b) for a, b in zip(x_leaves, y_leaves)]
+      )
+  )
+
+
+def _chained_blocks(
+    model: base_layer.BaseLayer,
+    variables: NestedJTensor,
+    input_batch: NestedMap,
+    fprop_fn: FpropFn,
+    blocks: Sequence[_Block],
+) -> List[bool]:
+  """Returns if each block is called on the outputs of the previous block.
+
+  A block is chained to the previous one if its first input is the (first)
+  output of the previous block and its other inputs are the ones of the previous
+  block, e.g. the paddings and attention mask of stacked Transformer layers.
+
+  Args:
+    model: The model.
+    variables: The variables of the model.
+    input_batch: A calibration batch, on which the block inputs are compared.
+    fprop_fn: Function calling the model on an input batch.
+    blocks: The blocks, in forward pass order.
+
+  Returns:
+    A list with a bool for each block.
+  """
+  paths = {block.path for block in blocks}
+
+  def _fprop(variables, input_batch):
+    calls = {}
+
+    def _interceptor(next_fun, args, kwargs, context):
+      outputs = next_fun(*args, **kwargs)
+      if (
+          context.method_name == '__call__'
+          and context.module.path in paths
+      ):
+        calls.setdefault(context.module.path, (args, kwargs, outputs))
+      return outputs
+
+    _eval_apply(
+        model, variables, input_batch, method=fprop_fn, interceptor=_interceptor
+    )
+    chained = []
+    for prev, block in zip(blocks[:-1], blocks[1:]):
+      prev_args, prev_kwargs, prev_outputs = calls[prev.path]
+      args, kwargs, _ = calls[block.path]
+      chained.append(
+          _tree_equal(
+              (args[:1], args[1:], kwargs),
+              ((_first_output(prev_outputs),), prev_args[1:], prev_kwargs),
+          )
+      )
+    return chained
+
+  chained = jax.jit(_fprop)(variables, input_batch)
+  return [False] + [bool(c) for c in chained]
+
+
+def _capture_block_inputs_fn(
+    model: base_layer.BaseLayer, path: ModulePath, fprop_fn: FpropFn
+):
+  """Returns a function computing the inputs of a block on a batch."""
+
+  def _capture(variables, input_batch):
+    captured = []
+
+    def _interceptor(next_fun, args, kwargs, context):
+      if (
+          context.method_name == '__call__'
+          and context.module.path == path
+          and not captured
+      ):
+        captured.append((args, kwargs))
+      return next_fun(*args, **kwargs)
+
+    _eval_apply(
+        model, variables, input_batch, method=fprop_fn, interceptor=_interceptor
+    )
+    if not captured:
+      raise ValueError(f'Block {path} was not called.')
+    return captured[0]
+
+  return jax.jit(_capture)
+
+
+def _submodule(
+    module: base_layer.BaseLayer, path: ModulePath
+) -> base_layer.BaseLayer:
+  """Returns the child of module at path, see create_child/create_children."""
+  for name in path:
+    if hasattr(module, name):
+      module = getattr(module, name)
+    else:
+      prefix, index = name.rsplit('_', 1)
+      module = getattr(module, prefix)[int(index)]
+  return module
+
+
+def _slice_subtree(
+    tree: Dict[str, Any], path: Sequence[str], index: Tuple[int, ...]
+) -> Dict[str, Any]:
+  if not path:
+    return jax.tree_util.tree_map(lambda x: x[index], tree)
+  if path[0] not in tree:
+    return tree
+  return {**tree, path[0]: _slice_subtree(tree[path[0]], path[1:], index)}
+
+
+def _block_variables(
+    variables: NestedJTensor, block: _Block, index: Optional[Tuple[int, ...]]
+) -> NestedJTensor:
+  """Returns the variables of the model with a Repeat iteration unstacked."""
+  if index is None:
+    return variables
+  path = block.path + (block.sublayer_name,)
+  return {
+      collection: _slice_subtree(tree, path, index)
+      for collection, tree in variables.items()
+  }
+
+
+def _call_block(
+    model: base_layer.BaseLayer, args: Any, kwargs: Any, *, block: _Block
+) -> Any:
+  layer = _submodule(model, block.path)
+  if block.repeat_shape is not None:
+    layer = getattr(layer, block.sublayer_name)
+  return layer(*args, **kwargs)
+
+
+def _block_fn(model: base_layer.BaseLayer, block: _Block):
+  """Returns a function computing the outputs of a block on its inputs."""
+
+  def _fprop(variables, args, kwargs):
+    return _eval_apply(
+        model,
+        variables,
+        args,
+        kwargs,
+        method=functools.partial(_call_block, block=block),
+    )
+
+  return jax.jit(_fprop)
+
+
+def _token_weights(
+    row_weights: JTensor, token_weights: Optional[JTensor], shape: Sequence[int]
+) -> JTensor:
+  """Returns the weights of the tokens of a layer input with token dims shape.
+
+  Args:
+    row_weights: [B] weights of the batch rows, 0 for padded rows.
+    token_weights: Optional [B, T] weights of the positions, 0 for paddings.
+    shape: The token dims of the layer input.
+
+  Returns:
+    The weights broadcast to shape. Inputs whose leading dims are not the batch
+    (and time) dims of the input batch are all counted.
+  """
+  shape = tuple(shape)
+  if token_weights is not None and shape[:2] == token_weights.shape:
+    weights = token_weights
+  elif shape[:1] == row_weights.shape:
+    weights = row_weights
+  else:
+    return jnp.ones(shape, jnp.float32)
+  weights = jnp.reshape(
+      weights, weights.shape + (1,) * (len(shape) - weights.ndim)
+  )
+  return jnp.broadcast_to(weights, shape)
+
+
+def _layer_hessian_fn(
+    model: base_layer.BaseLayer,
+    block: _Block,
+    path: ModulePath,
+    num_contract_dims: int,
+):
+  """Returns a function computing the input Hessian of a layer of a block."""
+
+  def _hessian(variables, args, kwargs, row_weights, token_weights):
+    hessians = []
+
+    def _interceptor(next_fun, args, kwargs, context):
+      if context.method_name == '__call__' and context.module.path == path:
+        inputs = args[0]
+        contract_size = np.prod(inputs.shape[-num_contract_dims:])
+        weights = _token_weights(
+            row_weights, token_weights, inputs.shape[:-num_contract_dims]
+        )
+        weights = jnp.reshape(weights, [-1])
+        inputs = jnp.reshape(inputs, [-1, contract_size]).astype(jnp.float32)
+        hessians.append((
+            jnp.einsum('t,ti,tj->ij', weights, inputs, inputs),
+            jnp.sum(weights),
+        ))
+      return next_fun(*args, **kwargs)
+
+    _eval_apply(
+        model,
+        variables,
+        args,
+        kwargs,
+        method=functools.partial(_call_block, block=block),
+        interceptor=_interceptor,
+    )
+    if not hessians:
+      raise ValueError(f'Layer {path} was not called.')
+    return sum(h for h, _ in hessians), sum(n for _, n in hessians)
+
+  return jax.jit(_hessian)
+
+
+def _batch_weights(
+    input_batch: NestedMap, batch_padding_size: int
+) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+  """Returns the [B] row weights and optional [B, T] token weights of a batch."""
+  batch_size = jax.tree_util.tree_leaves(input_batch)[0].shape[0]
+  row_weights = (
+      np.arange(batch_size) < batch_size - batch_padding_size
+  ).astype(np.float32)
+  paddings = input_batch.get('paddings')
+  if paddings is None or paddings.ndim != 2 or paddings.shape[0] != batch_size:
+    return row_weights, None
+  token_weights = row_weights[:, np.newaxis] * (
+      1.0 - np.asarray(paddings, np.float32)
+  )
+  return row_weights, token_weights
+
+
+def _next_iteration_inputs(
+    block: _Block, inputs: BlockInputs, outputs: Any
+) -> BlockInputs:
+  """Returns the inputs of the next iteration of a Repeat, see Repeat."""
+  args, kwargs = inputs
+  if block.positional_args_as_scan_carry:
+    return tuple(outputs) if isinstance(outputs, tuple) else (outputs,), kwargs
+  return (outputs,) + tuple(args[1:]), kwargs
+
+
+def _get_path(tree: Dict[str, Any], path: Sequence[str]) -> Dict[str, Any]:
+  for name in path:
+    tree = tree[name]
+  return tree
+
+
+def _to_matrix(w: JTensor, contract_dims: Sequence[int]) -> JTensor:
+  perm = list(contract_dims) + [
+      i for i in range(w.ndim) if i not in contract_dims
+  ]
+  w = jnp.transpose(w, perm)
+  contract_size = np.prod(w.shape[:len(contract_dims)])
+  return jnp.reshape(w, [contract_size, -1])
+
+
+def _from_matrix(
+    m: JTensor, shape: Sequence[int], contract_dims: Sequence[int]
+) -> JTensor:
+  perm = list(contract_dims) + [
+      i for i in range(len(shape)) if i not in contract_dims
+  ]
+  m = jnp.reshape(m, [shape[i] for i in perm])
+  return jnp.transpose(m, np.argsort(perm))
+
+
+def _quantize_layer(
+    params: NestedJTensor,
+    path: ModulePath,
+    index: Optional[Tuple[int, ...]],
+    layer: base_layer.BaseLayer,
+    hessian: JTensor,
+    damping: float,
+) -> Tuple[np.ndarray, np.ndarray, Optional[np.ndarray]]:
+  """Quantizes the weight of a layer, or of one Repeat iteration of it.
+
+  The weight in params is replaced by its dequantized value, so that later
+  layers see its quantization error.
+
+  Args:
+    params: The float params of the model, updated in place.
+    path: Path of the layer.
+    index: Index of the Repeat iteration into the stacked weight, if any.
+    layer: The layer.
+    hessian: The input Hessian of the layer.
+    damping: Dampening added to the Hessian diagonal, relative to its mean.
+
+  Returns:
+    A tuple (q_w, scale, zp) of the quantized weight, as in quantize_weight().
+  """
+  contract_dims = _weight_contract_dims(layer)
+  weight_params = layer.quantization.weight_params
+  layer_params = _get_path(params, path)
+  w = layer_params['w'] if index is None else layer_params['w'][index]
+  q_w, scale, zp = jax.jit(
+      functools.partial(
+          gptq_quantize_matrix,
+          bits=weight_params.precision,
+          use_symmetric=weight_params.use_symmetric,
+          clipping_coeff=weight_params.clipping_coeff,
+          damping=damping,
+      )
+  )(_to_matrix(w, contract_dims), hessian)
+  logging.info(
+      'GPTQ quantized %s%s with shape %s.',
+      '/'.join(path),
+      '' if index is None else f' iteration {index}',
+      w.shape,
+  )
+
+  w_dequant = q_w.astype(jnp.float32) * scale
+  if zp is not None:
+    w_dequant -= zp
+  w_dequant = _from_matrix(w_dequant, w.shape, contract_dims).astype(w.dtype)
+  if index is None:
+    layer_params['w'] = w_dequant
+  else:
+    layer_params['w'] = layer_params['w'].at[index].set(w_dequant)
+
+  out_shape = [d for i, d in enumerate(w.shape) if i not in contract_dims]
+  q_w = _from_matrix(q_w, w.shape, contract_dims)
+  if weight_params.precision == 4:
+    q_w = utils.pack_4bit(q_w, layer._PACK_4BIT_DIM)  # pylint: disable=protected-access
+  return (
+      jax.device_get(q_w),
+      jax.device_get(jnp.reshape(scale, out_shape).astype(w.dtype)),
+      None
+      if zp is None
+      else jax.device_get(jnp.reshape(zp, out_shape).astype(w.dtype)),
+  )
+
+
+def _stack_iterations(
+    values: Sequence[np.ndarray], repeat_shape: Optional[Tuple[int, ...]]
+) -> np.ndarray:
+  if repeat_shape is None:
+    return values[0]
+  values = np.stack(values)
+  return np.reshape(values, tuple(repeat_shape) + values.shape[1:])
+
+
+def quantize_weight_gptq(
+    model: base_layer.BaseLayer,
+    variables: NestedJTensor,
+    input_generator: base_input.BaseInput,
+    num_batches: int,
+    fprop_fn: Optional[FpropFn] = None,
+    damping: float = 0.01,
+    block_types: Sequence[Type[base_layer.BaseLayer]] = (
+        transformers.Transformer,
+    ),
+) -> NestedJTensor:
+  """Quantizes the weights of a model with GPTQ.
+
+  Args:
+    model: The model, with its layers configured with QuantizationType.PTQ (or
+      FQ) and QuantizationMode.TRAINING.
+    variables: The float variables of the model.
+    input_generator: The calibration input. num_batches batches are read once
+      with get_next_padded(), after a reset().
+    num_batches: Number of calibration batches.
+    fprop_fn: Function calling the model on an input batch. Defaults to
+      `model(input_batch)`.
+    damping: Dampening added to the Hessian diagonal, relative to its mean.
+    block_types: Layer types quantized as blocks, see the module docstring.
+
+  Returns:
+    The quantized variables, as returned by model.quantize_weight(), with the
+    weights of the supported layers quantized by GPTQ.
+  """
+  fprop_fn = fprop_fn or calibration.default_fprop
+  variables = jax.tree_util.tree_map(lambda x: x, variables)
+  params = variables[base_layer.PARAMS]
+
+  input_generator.reset()
+  input_batches = [input_generator.get_next_padded() for _ in range(num_batches)]
+  batch_weights = [
+      _batch_weights(input_batch, input_generator.batch_padding_size)
+      for input_batch in input_batches
+  ]
+  blocks = _find_blocks(
+      model, variables, input_batches[0], fprop_fn, block_types
+  )
+  chained = _chained_blocks(
+      model, variables, input_batches[0], fprop_fn, blocks
+  )
+
+  results = {}
+  block_inputs = None
+  for block_id, block in enumerate(blocks):
+    if not chained[block_id]:
+      capture_fn = _capture_block_inputs_fn(model, block.path, fprop_fn)
+      block_inputs = [
+          capture_fn(variables, input_batch) for input_batch in input_batches
+      ]
+    block_fn = _block_fn(model, block)
+    hessian_fns = {
+        path: _layer_hessian_fn(
+            model, block, path, len(_weight_contract_dims(layer))
+        )
+        for path, layer in block.targets.items()
+    }
+    inputs = block_inputs
+    for i in range(block.num_iterations):
+      index = block.iteration_index(i)
+      for path, layer in block.targets.items():
+        block_vars = _block_variables(variables, block, index)
+        hessian, num_tokens = None, 0.0
+        for (args, kwargs), (row_weights, token_weights) in zip(
+            inputs, batch_weights
+        ):
+          batch_hessian, batch_tokens = hessian_fns[path](
+              block_vars, args, kwargs, row_weights, token_weights
+          )
+          hessian = (
+              batch_hessian if hessian is None else hessian + batch_hessian
+          )
+          num_tokens += batch_tokens
+        hessian = 2.0 * hessian / num_tokens
+        results.setdefault(path, []).append(
+            _quantize_layer(params, path, index, layer, hessian, damping)
+        )
+
+      next_iteration = i + 1 < block.num_iterations
+      next_chained = block_id + 1 < len(blocks) and chained[block_id + 1]
+      if not next_iteration and not next_chained:
+        continue
+      # The next iteration or block sees the quantization error of this one.
+      block_vars = _block_variables(variables, block, index)
+      outputs = [block_fn(block_vars, *block_input) for block_input in inputs]
+      if next_iteration:
+        inputs = [
+            _next_iteration_inputs(block, block_input, block_outputs)
+            for block_input, block_outputs in zip(inputs, outputs)
+        ]
+      else:
+        block_inputs = [
+            ((_first_output(block_outputs),) + tuple(args[1:]), kwargs)
+            for (args, kwargs), block_outputs in zip(block_inputs, outputs)
+        ]
+
+  quantized, _ = model.apply(variables, mutable=[], method=model.quantize_weight)
+  quantized = jax.tree_util.tree_map(lambda x: x, quantized)
+  for block in blocks:
+    for path in block.targets:
+      q_w, scale, zp = zip(*results[path])
+      layer_params = _get_path(quantized[base_layer.PARAMS], path)
+      layer_params['w'] = _stack_iterations(q_w, block.repeat_shape)
+      layer_params['w' + base_layer.QUANTIZED_SCALE_NAME_POSTFIX] = (
+          _stack_iterations(scale, block.repeat_shape)
+      )
+      if zp[0] is not None:
+        layer_params['w' + base_layer.QUANTIZED_ZP_NAME_POSTFIX] = (
+            _stack_iterations(zp, block.repeat_shape)
+        )
+  return quantized
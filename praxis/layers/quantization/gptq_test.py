@@ -0,0 +1,362 @@
+# coding=utf-8
+# Copyright 2022 The Pax Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for GPTQ post-training weight quantization."""
+
+import copy
+
+from absl.testing import absltest
+from absl.testing import parameterized
+import jax
+from jax import numpy as jnp
+import numpy as np
+from praxis import base_layer
+from praxis import pax_fiddle
+from praxis import py_utils
+from praxis import test_utils
+from praxis.layers import transformers
+from praxis.layers.quantization import gptq
+from praxis.layers.quantization import operations
+from praxis.layers.quantization import quantization_hparams
+from praxis.layers.quantization import quantize
+from praxis.layers.quantization.tests import test_util as quantization_test_util
+
+instantiate = base_layer.instantiate
+QuantizationMode = quantization_hparams.QuantizationMode
+QuantizationType = quantization_hparams.QuantizationType
+PARAMS = base_layer.PARAMS
+
+
+def _transformer_fprop(layer, input_batch):
+  batch_size, seq_len = input_batch.inputs.shape[:2]
+  paddings = jnp.zeros([batch_size, seq_len])
+  attention_mask = jnp.zeros([batch_size, 1, 1, seq_len])
+  return layer(input_batch.inputs, paddings, attention_mask)
+
+
+def _stack_fprop(layer, input_batch):
+  return layer(input_batch.inputs, input_batch.paddings)
+
+
+def _stack_p(stack_cls, num_bits=4):
+  p = pax_fiddle.Config(
+      transformers.StackedTransformer,
+      name='stack',
+      num_layers=2,
+      model_dims=16,
+      hidden_dims=32,
+      num_heads=2,
+  )
+  p.transformer_layer_params_tpl.tr_atten_tpl.combine_qkv = False
+  p.transformer_layer_params_tpl.tr_atten_tpl.use_bias = False
+  if stack_cls == transformers.StackedTransformerRepeated:
+    p = pax_fiddle.Config(
+        transformers.StackedTransformerRepeated, name='stack', block=p, x_times=2
+    )
+  quantize.set_quantization(
+      p,
+      transformers.Transformer,
+      quantization_type=QuantizationType.PTQ,
+      mode=QuantizationMode.TRAINING,
+      num_bits=num_bits,
+  )
+  return p
+
+
+def _correlated_inputs(num_tokens, dims):
+  # Inputs with a few dominant directions, where error compensation matters.
+  basis = np.random.normal(size=[4, dims])
+  inputs = np.random.normal(size=[num_tokens, 4]) @ basis
+  return (inputs + 0.1 * np.random.normal(size=[num_tokens, dims])).astype(
+      np.float32
+  )
+
+
+class GptqTest(test_utils.TestCase):
+
+  def setUp(self):
+    super().setUp()
+    np.random.seed(123456)
+
+  @parameterized.product(bits=[4, 8], use_symmetric=[True, False])
+  def test_identity_hessian_matches_round_to_nearest(self, bits, use_symmetric):
+    w = np.random.normal(size=[16, 8]).astype(np.float32)
+    q_w, scale, zp = gptq.gptq_quantize_matrix(
+        w, jnp.eye(16), bits=bits, use_symmetric=use_symmetric
+    )
+    expected_q_w, expected_scale, expected_zp = (
+        operations.reduce_einsum_weight_precision(
+            'xy,yz->xz',
+            w,
+            calculation_type=jnp.float32,
+            bits=bits,
+            use_symmetric=use_symmetric,
+        )
+    )
+    self.assertEqual(q_w.dtype, jnp.int8)
+    self.assertArraysEqual(q_w, expected_q_w)
+    self.assertAllClose(scale, expected_scale)
+    if use_symmetric:
+      self.assertIsNone(zp)
+    else:
+      self.assertAllClose(zp, expected_zp)
+
+  @parameterized.parameters(True, False)
+  def test_lower_output_error_than_round_to_nearest(self, use_symmetric):
+    w = np.random.normal(size=[32, 16]).astype(np.float32)
+    x = _correlated_inputs(256, 32)
+    hessian = 2.0 * x.T @ x / x.shape[0]
+
+    def _output_error(q_w, scale, zp):
+      w_dequant = q_w.astype(np.float32) * scale
+      if zp is not None:
+        w_dequant -= zp
+      return np.mean((x @ w - x @ w_dequant) ** 2)
+
+    gptq_error = _output_error(
+        *gptq.gptq_quantize_matrix(
+            w, hessian, bits=4, use_symmetric=use_symmetric
+        )
+    )
+    rtn_error = _output_error(
+        *operations.reduce_einsum_weight_precision(
+            'xy,yz->xz',
+            w,
+            calculation_type=jnp.float32,
+            bits=4,
+            use_symmetric=use_symmetric,
+        )
+    )
+    self.assertLess(gptq_error, 0.5 * rtn_error)
+
+  def test_dead_inputs(self):
+    w = np.random.normal(size=[8, 4]).astype(np.float32)
+    x = np.random.normal(size=[64, 8]).astype(np.float32)
+    x[:, 3] = 0.0
+    q_w, _, _ = gptq.gptq_quantize_matrix(w, x.T @ x, bits=4)
+    self.assertArraysEqual(q_w[3], np.zeros([4], np.int8))
+    self.assertTrue(np.all(np.isfinite(q_w)))
+
+  @parameterized.parameters(4, 8)
+  def test_quantize_transformer(self, bits):
+    p = pax_fiddle.Config(
+        transformers.Transformer,
+        name='transformer',
+        input_dims=16,
+        hidden_dims=32,
+        num_heads=2,
+    )
+    p.tr_atten_tpl.combine_qkv = False
+    p.tr_atten_tpl.use_bias = False
+    train_p = copy.deepcopy(p)
+    quantize.set_quantization(
+        train_p,
+        transformers.Transformer,
+        quantization_type=QuantizationType.PTQ,
+        mode=QuantizationMode.TRAINING,
+        num_bits=bits,
+    )
+    inference_p = copy.deepcopy(train_p)
+    quantize.set_inference_mode(inference_p)
+    train_layer = instantiate(train_p)
+    inference_layer = instantiate(inference_p)
+
+    batches = [
+        _correlated_inputs(2 * 8, 16).reshape([2, 8, 16]) for _ in range(2)
+    ]
+    input_generator = instantiate(
+        pax_fiddle.Config(
+            quantization_test_util.FixedInput, batch_size=2, batches=batches
+        )
+    )
+    paddings = np.zeros([2, 8], np.float32)
+    attention_mask = np.zeros([2, 1, 1, 8], np.float32)
+
+    with base_layer.JaxContext.new_context():
+      initial_vars = train_layer.init(
+          jax.random.PRNGKey(123), batches[0], paddings, attention_mask
+      )
+      float_w = np.array(
+          initial_vars[PARAMS]['ff_layer']['ffn_layer1']['linear']['w']
+      )
+      gptq_vars = gptq.quantize_weight_gptq(
+          train_layer,
+          initial_vars,
+          input_generator,
+          num_batches=2,
+          fprop_fn=_transformer_fprop,
+      )
+      rtn_vars, _ = train_layer.apply(
+          initial_vars, mutable=[], method=train_layer.quantize_weight
+      )
+      float_outputs, _ = train_layer.apply(
+          initial_vars, batches[1], paddings, attention_mask
+      )
+      gptq_outputs, _ = inference_layer.apply(
+          gptq_vars, batches[1], paddings, attention_mask
+      )
+      rtn_outputs, _ = inference_layer.apply(
+          rtn_vars, batches[1], paddings, attention_mask
+      )
+
+    self.assertEqual(
+        jax.tree_util.tree_structure(gptq_vars),
+        jax.tree_util.tree_structure(rtn_vars),
+    )
+    for gptq_var, rtn_var in zip(
+        jax.tree_util.tree_leaves(gptq_vars),
+        jax.tree_util.tree_leaves(rtn_vars),
+    ):
+      self.assertEqual(gptq_var.shape, rtn_var.shape)
+      self.assertEqual(gptq_var.dtype, rtn_var.dtype)
+    # The float variables are left unchanged.
+    self.assertArraysEqual(
+        initial_vars[PARAMS]['ff_layer']['ffn_layer1']['linear']['w'], float_w
+    )
+    gptq_error = np.mean((gptq_outputs - float_outputs) ** 2)
+    rtn_error = np.mean((rtn_outputs - float_outputs) ** 2)
+    self.assertLess(gptq_error, rtn_error)
+
+  @parameterized.parameters(
+      transformers.StackedTransformer, transformers.StackedTransformerRepeated
+  )
+  def test_quantize_stacked_transformer(self, stack_cls):
+    train_p = _stack_p(stack_cls)
+    inference_p = copy.deepcopy(train_p)
+    quantize.set_inference_mode(inference_p)
+    train_layer = instantiate(train_p)
+    inference_layer = instantiate(inference_p)
+
+    paddings = np.zeros([2, 8], np.float32)
+    batches = [
+        py_utils.NestedMap(
+            inputs=_correlated_inputs(2 * 8, 16).reshape([2, 8, 16]),
+            paddings=paddings,
+        )
+        for _ in range(2)
+    ]
+    input_generator = instantiate(
+        pax_fiddle.Config(
+            quantization_test_util.FixedInput, batch_size=2, batches=batches
+        )
+    )
+
+    with base_layer.JaxContext.new_context():
+      initial_vars = train_layer.init(
+          jax.random.PRNGKey(123), batches[0].inputs, paddings
+      )
+      blocks = gptq._find_blocks(
+          train_layer,
+          initial_vars,
+          batches[0],
+          _stack_fprop,
+          (transformers.Transformer,),
+      )
+      chained = gptq._chained_blocks(
+          train_layer, initial_vars, batches[0], _stack_fprop, blocks
+      )
+      gptq_vars = gptq.quantize_weight_gptq(
+          train_layer,
+          initial_vars,
+          input_generator,
+          num_batches=2,
+          fprop_fn=_stack_fprop,
+      )
+      rtn_vars, _ = train_layer.apply(
+          initial_vars, mutable=[], method=train_layer.quantize_weight
+      )
+      float_outputs = train_layer.apply(
+          initial_vars, batches[1].inputs, paddings
+      )
+      gptq_outputs = inference_layer.apply(
+          gptq_vars, batches[1].inputs, paddings
+      )
+      rtn_outputs = inference_layer.apply(rtn_vars, batches[1].inputs, paddings)
+
+    if stack_cls == transformers.StackedTransformer:
+      # Each layer is a block, called on the outputs of the previous one.
+      self.assertEqual(
+          [block.path for block in blocks],
+          [('x_layers_0',), ('x_layers_1',)],
+      )
+      self.assertEqual(chained, [False, True])
+    else:
+      # The Repeat is a single block, quantized one iteration at a time.
+      self.assertLen(blocks, 1)
+      self.assertEqual(blocks[0].repeat_shape, (2,))
+      self.assertLen(blocks[0].targets, 12)
+    self.assertEqual(
+        jax.tree_util.tree_structure(gptq_vars),
+        jax.tree_util.tree_structure(rtn_vars),
+    )
+    for gptq_var, rtn_var in zip(
+        jax.tree_util.tree_leaves(gptq_vars),
+        jax.tree_util.tree_leaves(rtn_vars),
+    ):
+      self.assertEqual(gptq_var.shape, rtn_var.shape)
+      self.assertEqual(gptq_var.dtype, rtn_var.dtype)
+    gptq_error = np.mean((gptq_outputs - float_outputs) ** 2)
+    rtn_error = np.mean((rtn_outputs - float_outputs) ** 2)
+    self.assertLess(gptq_error, rtn_error)
+
+  def test_padding_is_ignored(self):
+    train_layer = instantiate(_stack_p(transformers.StackedTransformer))
+    inputs = _correlated_inputs(2 * 8, 16).reshape([2, 8, 16])
+    paddings = np.zeros([2, 8], np.float32)
+    paddings[1, 5:] = 1.0
+    # Different values at the padded positions.
+    other_inputs = np.where(
+        paddings[..., np.newaxis] > 0.0,
+        np.random.normal(size=inputs.shape),
+        inputs,
+    ).astype(np.float32)
+
+    def _quantize(batch, batch_padding_size):
+      input_generator = instantiate(
+          pax_fiddle.Config(
+              quantization_test_util.FixedInput,
+              batch_size=2,
+              batch_padding_size=batch_padding_size,
+              batches=[batch],
+          )
+      )
+      return gptq.quantize_weight_gptq(
+          train_layer,
+          initial_vars,
+          input_generator,
+          num_batches=1,
+          fprop_fn=_stack_fprop,
+      )
+
+    with base_layer.JaxContext.new_context():
+      initial_vars = train_layer.init(
+          jax.random.PRNGKey(123), inputs, paddings
+      )
+      vars_a = _quantize(
+          py_utils.NestedMap(inputs=inputs, paddings=paddings), 0
+      )
+      # Padded rows, and padded positions, are not counted.
+      vars_b = _quantize(
+          py_utils.NestedMap(inputs=other_inputs, paddings=paddings), 2
+      )
+
+    for var_a, var_b in zip(
+        jax.tree_util.tree_leaves(vars_a), jax.tree_util.tree_leaves(vars_b)
+    ):
+      self.assertAllClose(var_a, var_b)
+
+
+if __name__ == '__main__':
+  absltest.main()
@@ -0,0 +1,108 @@
+# coding=utf-8
+# Copyright 2022 The Pax Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+r"""Benchmarks int4 weight inference of the quantized Linear layer.
+
+Compares the int8 weight path, the int4 path unpacking the whole weight before
+the einsum (int4_blockwise_unpack=False) and the int4 path unpacking it one
+nibble plane at a time inside the einsum (int4_blockwise_unpack=True).
+
+Example:
+  python -m praxis.layers.quantization.int4_benchmark --num_tokens=1,16,256
+"""
+
+import time
+from typing import Sequence
+
+from absl import app
+from absl import flags
+import jax
+from jax import numpy as jnp
+from praxis import base_layer
+from praxis import pax_fiddle
+from praxis.layers.quantization import linears
+from praxis.layers.quantization import quantization_hparams
+
+instantiate = base_layer.instantiate
+QuantizationHParams = quantization_hparams.QuantizationHParams
+QuantizationMode = quantization_hparams.QuantizationMode
+WeightQuantizationParams = quantization_hparams.WeightQuantizationParams
+
+_NUM_TOKENS = flags.DEFINE_list('num_tokens', ['1', '16', '256'],
+                                'Number of input tokens to benchmark.')
+_INPUT_DIMS = flags.DEFINE_integer('input_dims', 4096, 'Input dims.')
+_OUTPUT_DIMS = flags.DEFINE_integer('output_dims', 4096, 'Output dims.')
+_QUANTIZE_ACTIVATIONS = flags.DEFINE_bool(
+    'quantize_activations', False,
+    'If True, also quantize the activations to int8.')
+_NUM_ITERS = flags.DEFINE_integer('num_iters', 20, 'Timed iterations.')
+
+
+def _time_linear(precision: int, int4_blockwise_unpack: bool,
+                 num_tokens: int) -> float:
+  """Returns the average wall time in seconds of one Linear call."""
+  p = pax_fiddle.Config(
+      linears.Linear,
+      name='linear',
+      input_dims=_INPUT_DIMS.value,
+      output_dims=_OUTPUT_DIMS.value,
+      quantization=QuantizationHParams(
+          mode=QuantizationMode.INFERENCE,
+          act_params=(quantization_hparams.ActQuantizationParams()
+                      if _QUANTIZE_ACTIVATIONS.value else None),
+          weight_params=WeightQuantizationParams(
+              precision=precision,
+              int4_blockwise_unpack=int4_blockwise_unpack,
+          ),
+      ),
+  )
+  layer = instantiate(p)
+  prng_key = jax.random.PRNGKey(1234)
+  inputs = jax.random.normal(prng_key, [num_tokens, _INPUT_DIMS.value],
+                             dtype=jnp.float32)
+  with base_layer.JaxContext.new_context():
+    initial_vars = layer.init(prng_key, inputs)
+  # Random packed/int8 weights, the values do not matter for the timing.
+  initial_vars = jax.tree_map(
+      lambda x: jax.random.randint(prng_key, x.shape, -8, 8).astype(x.dtype)
+      if jnp.issubdtype(x.dtype, jnp.integer) else x, initial_vars)
+
+  @jax.jit
+  def _fprop(mdl_vars, inputs):
+    with base_layer.JaxContext.new_context():
+      return layer.apply(mdl_vars, inputs)
+
+  jax.block_until_ready(_fprop(initial_vars, inputs))
+  start = time.time()
+  for _ in range(_NUM_ITERS.value):
+    jax.block_until_ready(_fprop(initial_vars, inputs))
+  return (time.time() - start) / _NUM_ITERS.value
+
+
+def main(argv: Sequence[str]) -> None:
+  del argv
+  print(f'{"tokens":>8} {"int8 (ms)":>10} {"int4 (ms)":>10} '
+        f'{"int4 blockwise (ms)":>20}')
+  for num_tokens in _NUM_TOKENS.value:
+    num_tokens = int(num_tokens)
+    int8_time = _time_linear(8, False, num_tokens)
+    int4_time = _time_linear(4, False, num_tokens)
+    blockwise_time = _time_linear(4, True, num_tokens)
+    print(f'{num_tokens:>8} {int8_time * 1e3:>10.3f} {int4_time * 1e3:>10.3f} '
+          f'{blockwise_time * 1e3:>20.3f}')
+
+
+if __name__ == '__main__':
+  app.run(main)
@@ -16,8 +16,10 @@
 """Quantized Linear Layers."""
 
 import copy
+import functools
 from typing import Any
 
+import jax
 from jax import numpy as jnp
 from praxis import base_layer
 from praxis import pytypes
@@ -40,6 +42,13 @@ WeightInit = base_layer.WeightInit
 class Linear(linears.Linear):
   """Quantized Linear layer without bias.
 
+  Static activation quantization (act_params.stats_config set) works in two
+  steps. In TRAINING mode with PTQ or FQ, the forward pass records the
+  activation range into the non-trainable `act_max` variable, see
+  calibration.calibrate_activation_ranges(). quantize_weight() then converts it
+  into the non-trainable `act_scale` used by the INFERENCE mode, where the
+  activations are quantized without computing their range on the fly.
+
   Attributes:
     quantization: Information related to the quantization applied to this layer,
       such as the mode for the quantization.
@@ -81,11 +90,6 @@ class Linear(linears.Linear):
         )
         pc.shape = [self.input_dims // 8, self.output_dims]
         dtype = jnp.int32
-      if self._do_static_activation_quantization():
-        raise NotImplementedError(
-            'Static activation quantization is not supported yet.'
-        )
-        # Additionally add activation scale.
       self.create_quantized_variable(
           'w',
           pc,
@@ -93,16 +97,29 @@ class Linear(linears.Linear):
           dtype=dtype,
           use_symmetric=self.quantization.weight_params.use_symmetric,
       )
+      if self._do_static_activation_quantization():
+        # Additionally add activation scale.
+        self.create_variable(
+            'act_scale',
+            WeightHParams(shape=[], init=WeightInit.Constant(1.0)),
+            trainable=False,
+        )
     elif self.quantization.mode == QuantizationMode.TRAINING:
       # TODO(jihwanlee): Now, having many different branches and non-unified
       # quantization logic between PTQ, FQ, and AQT, the overall code is quite
       # complex. DO simplify.
+      self.create_variable('w', pc)
       if self._do_static_activation_quantization():
-        raise NotImplementedError(
-            'Static activation quantization is not supported yet.'
-        )
+        if self.quantization.quantization_type == QuantizationType.AQT:
+          raise NotImplementedError(
+              'Static activation quantization is not supported for AQT.'
+          )
         # Additionally add mutable tensor to record activation range.
-      self.create_variable('w', pc)
+        self.create_variable(
+            'act_max',
+            WeightHParams(shape=[], init=WeightInit.Constant(0.0)),
+            trainable=False,
+        )
     else:
       self.create_variable('w', pc)
 
@@ -117,6 +134,21 @@ class Linear(linears.Linear):
       )
       self.create_variable('step_count', step_count_pc, trainable=False)
 
+  def _record_activation_range(self, inputs: JTensor) -> None:
+    """Updates the recorded activation range with the range of inputs."""
+    act_max = self.get_var('act_max')
+    batch_max = jnp.max(jnp.abs(inputs)).astype(act_max.dtype)
+    ema_decay = self.quantization.act_params.stats_config.ema_decay
+    if ema_decay is None:
+      new_act_max = jnp.maximum(act_max, batch_max)
+    else:
+      new_act_max = jnp.where(
+          act_max > 0.0,
+          ema_decay * act_max + (1.0 - ema_decay) * batch_max,
+          batch_max,
+      )
+    self.update_var('act_max', jax.lax.stop_gradient(new_act_max))
+
   def __call__(self, inputs: JTensor) -> JTensor:
     """Apply projection to inputs.
 
@@ -144,25 +176,49 @@ class Linear(linears.Linear):
       w, s, zp = self.get_quantized_weight(
           'w', use_symmetric=self.quantization.weight_params.use_symmetric
       )
+      dequant_upfront = (
+          self.quantization.act_params is None
+          and operations.use_dequant_upfront(
+              eqn,
+              inputs,
+              self.quantization.weight_params.dequant_upfront,
+              self.quantization.weight_params.dequant_upfront_min_tokens,
+          )
+      )
+      einsum_fn = operations.einsum
       if self.quantization.weight_params.precision == 4:
-        w = utils.unpack_4bit(
-            w, self._PACK_4BIT_DIM, self.quantization.weight_params.dtype
-        )
+        if (
+            self.quantization.weight_params.int4_blockwise_unpack
+            and not dequant_upfront
+        ):
+          einsum_fn = functools.partial(
+              operations.einsum_4bit,
+              pack_dim=self._PACK_4BIT_DIM,
+              original_dtype=self.quantization.weight_params.dtype,
+          )
+        else:
+          w = utils.unpack_4bit(
+              w, self._PACK_4BIT_DIM, self.quantization.weight_params.dtype
+          )
       if self._do_static_activation_quantization():
-        raise NotImplementedError(
-            'Static activation quantization is not supported yet.'
+        act_scale = self.get_var('act_scale')
+        inputs = operations.quantize_activation_static(
+            inputs, act_scale, bits=self.quantization.act_params.precision
         )
+        s = jnp.multiply(act_scale, s)
       elif self.quantization.act_params is not None:
         inputs, act_scale = operations.reduce_precision_activation(inputs)
         s = jnp.multiply(jnp.squeeze(act_scale), s)
-      if self.quantization.weight_params.use_symmetric:
-        if self.quantization.weight_params.dequant_upfront:
-          raise NotImplementedError('Dequantize upfront not supported.')
-        else:
-          out = operations.einsum(eqn, inputs, w, s)
+      if dequant_upfront:
+        w = operations.dequantize_weight(eqn, w, s, zp, dtype=inputs.dtype)
+        out = linears.project_last_dim(inputs, w)
+      elif self.quantization.weight_params.use_symmetric:
+        out = einsum_fn(eqn, inputs, w, s)
       else:
-        out = operations.einsum(eqn, inputs, w, s, zp)
+        out = einsum_fn(eqn, inputs, w, s, zp)
     else:
+      if self._do_static_activation_quantization():
+        self._record_activation_range(inputs)
       w = self.theta.w
       if self.quantization.quantization_type == QuantizationType.AQT:
         out = operations.aqt_einsum(
@@ -215,12 +271,15 @@ class Linear(linears.Linear):
       zp_name = 'w' + base_layer.QUANTIZED_ZP_NAME_POSTFIX
       partitionspec[zp_name] = copy.deepcopy(scale_pspec)
 
+    res = {base_layer.PARAMS: partitionspec}
     # Activation variable partitioning is only needed for static quantization.
     if self._do_static_activation_quantization():
-      raise NotImplementedError(
-          'Static activation quantization is not supported yet.')
+      act_scale_pspec = base_layer._weight_hparam_to_pspec(  # pylint: disable=protected-access
+          WeightHParams(shape=()), self.mesh_axis_names
+      )
+      res[base_layer.NON_TRAINABLE] = {'act_scale': act_scale_pspec}
 
-    return {base_layer.PARAMS: partitionspec}
+    return res
 
   def quantize_weight(self) -> NestedJTensor:
     """Get quantized weight.
@@ -235,21 +294,16 @@ class Linear(linears.Linear):
         self.quantization.quantization_type == QuantizationType.PTQ
         or self.quantization.quantization_type == QuantizationType.FQ
     ):
-      if self._do_static_activation_quantization():
-        raise NotImplementedError(
-            'Static activation quantization is not supported yet.'
-        )
-      else:
-        q_w, q_s, zp = operations.reduce_einsum_weight_precision(
-            eqn,
-            theta.w,
-            calculation_type=self.dtype,
-            bits=self.quantization.weight_params.precision,
-            percentile=self.quantization.weight_params.clipping_coeff,
-            use_symmetric=self.quantization.weight_params.use_symmetric,
-        )
-        if self.quantization.weight_params.precision == 4:
-          q_w = utils.pack_4bit(q_w, self._PACK_4BIT_DIM)
+      q_w, q_s, zp = operations.reduce_einsum_weight_precision(
+          eqn,
+          theta.w,
+          calculation_type=self.dtype,
+          bits=self.quantization.weight_params.precision,
+          percentile=self.quantization.weight_params.clipping_coeff,
+          use_symmetric=self.quantization.weight_params.use_symmetric,
+      )
+      if self.quantization.weight_params.precision == 4:
+        q_w = utils.pack_4bit(q_w, self._PACK_4BIT_DIM)
     elif self.quantization.quantization_type == QuantizationType.AQT:
       if self._do_static_activation_quantization():
         raise NotImplementedError(
@@ -263,7 +317,16 @@ class Linear(linears.Linear):
         )
 
     if self.quantization.weight_params.use_symmetric:
-      return {base_layer.PARAMS: {'w': q_w, scale_name: q_s}}
+      res = {base_layer.PARAMS: {'w': q_w, scale_name: q_s}}
     else:
       zp_name = 'w' + base_layer.QUANTIZED_ZP_NAME_POSTFIX
-      return {base_layer.PARAMS: {'w': q_w, scale_name: q_s, zp_name: zp}}
+      res = {base_layer.PARAMS: {'w': q_w, scale_name: q_s, zp_name: zp}}
+    if self._do_static_activation_quantization():
+      act_params = self.quantization.act_params
+      act_scale = operations.compute_static_activation_scale(
+          self.get_var('act_max'),
+          bits=act_params.precision,
+          clipping_coeff=act_params.clipping_coeff,
+      )
+      res[base_layer.NON_TRAINABLE] = {'act_scale': act_scale}
+    return res
@@ -291,6 +291,48 @@ class QuantizedLinearsSyncTest(test_utils.TestCase):
       outputs_q = linear_q.apply(initial_vars_q, inputs)
     self.assertAllClose(outputs_f, outputs_q)
 
+  @parameterized.product(
+      use_symmetric=[True, False],
+      precision=[8, 4],
+      dequant_upfront_min_tokens=[None, 4, 100],
+  )
+  def test_linear_dequant_upfront(
+      self, use_symmetric, precision, dequant_upfront_min_tokens
+  ):
+    def _linear_p(dequant_upfront):
+      return pax_fiddle.Config(
+          qlinears.Linear,
+          name='_linear_q',
+          input_dims=16,
+          output_dims=8,
+          quantization=QuantizationHParams(
+              mode=QuantizationMode.INFERENCE,
+              weight_params=quantization_hparams.WeightQuantizationParams(
+                  precision=precision,
+                  use_symmetric=use_symmetric,
+                  dequant_upfront=dequant_upfront,
+                  dequant_upfront_min_tokens=dequant_upfront_min_tokens,
+              ),
+          ),
+      )
+
+    linear = instantiate(_linear_p(dequant_upfront=False))
+    linear_dequant = instantiate(_linear_p(dequant_upfront=True))
+    inputs = np.random.normal(1.5, 2.0, [2, 3, 16]).astype(np.float32)
+    with base_layer.JaxContext.new_context():
+      initial_vars = linear.init(jax.random.PRNGKey(123), inputs)
+      initial_vars = jax.tree_map(
+          lambda x: jax.random.randint(  # pylint: disable=g-long-lambda
+              jax.random.PRNGKey(1), x.shape, -8, 8, x.dtype
+          )
+          if jnp.issubdtype(x.dtype, jnp.integer)
+          else jax.random.uniform(jax.random.PRNGKey(2), x.shape, x.dtype),
+          initial_vars,
+      )
+      outputs = linear.apply(initial_vars, inputs)
+      outputs_dequant = linear_dequant.apply(initial_vars, inputs)
+    self.assertAllClose(outputs, outputs_dequant, rtol=1e-5, atol=1e-4)
+
 
 class QuantizeLinearTest(test_utils.TestCase):
   """Quantize Linear."""
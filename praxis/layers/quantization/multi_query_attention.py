@@ -16,6 +16,7 @@
 """Quantized Multi-Query Attention layers."""
 
 import copy
+import functools
 from typing import Any
 
 from jax import numpy as jnp
@@ -133,15 +134,38 @@ class OneHeadedAttentionProjection(
       w, s, zp = self.get_quantized_weight(
           'w', use_symmetric=self.quantization.weight_params.use_symmetric
       )
+      dequant_upfront = (
+          self.quantization.act_params is None
+          and operations.use_dequant_upfront(
+              eqn,
+              inputs,
+              self.quantization.weight_params.dequant_upfront,
+              self.quantization.weight_params.dequant_upfront_min_tokens,
+          )
+      )
+      einsum_fn = operations.einsum
       if self.quantization.weight_params.precision == 4:
-        w = utils.unpack_4bit(
-            w, self._PACK_4BIT_DIM, self.quantization.weight_params.dtype
-        )
-      if self.quantization.weight_params.use_symmetric:
-        ret = operations.einsum(eqn, inputs, w, s)
+        if (
+            self.quantization.weight_params.int4_blockwise_unpack
+            and not dequant_upfront
+        ):
+          einsum_fn = functools.partial(
+              operations.einsum_4bit,
+              pack_dim=self._PACK_4BIT_DIM,
+              original_dtype=self.quantization.weight_params.dtype,
+          )
+        else:
+          w = utils.unpack_4bit(
+              w, self._PACK_4BIT_DIM, self.quantization.weight_params.dtype
+          )
+      if dequant_upfront:
+        w = operations.dequantize_weight(eqn, w, s, zp, dtype=inputs.dtype)
+        ret = jnp.einsum(eqn, inputs, w)
+      elif self.quantization.weight_params.use_symmetric:
+        ret = einsum_fn(eqn, inputs, w, s)
       else:
         assert zp is not None, 'zp cannot be None when use_symmetric=False.'
-        ret = operations.einsum(eqn, inputs, w, s, zp)
+        ret = einsum_fn(eqn, inputs, w, s, zp)
     else:
       w = theta.w
       if self.quantization.quantization_type == QuantizationType.AQT:
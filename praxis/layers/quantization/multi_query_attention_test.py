@@ -73,9 +73,10 @@ class MultiQueryAttentionTest(test_utils.TestCase):
       quantization_type=[QuantizationType.PTQ, QuantizationType.AQT],
       use_symmetric=[True, False],
       precision=[8, 4],
+      dequant_upfront=[True, False],
   )
   def test_one_headed_projection_quantized(
-      self, quantization_type, use_symmetric, precision
+      self, quantization_type, use_symmetric, precision, dequant_upfront
   ):
     input_dim = 16
     output_dim = 3
@@ -95,7 +96,9 @@ class MultiQueryAttentionTest(test_utils.TestCase):
             quantization_type=QuantizationType.PTQ,
             mode=QuantizationMode.INFERENCE,
             weight_params=WeightQuantizationParams(
-                use_symmetric=use_symmetric, precision=precision
+                use_symmetric=use_symmetric,
+                precision=precision,
+                dequant_upfront=dequant_upfront,
             ),
         ),
     )
@@ -76,6 +76,22 @@ def get_min_max(bits: int, unsigned=False) -> Tuple[float, float]:
     return -1 * 2 ** (bits - 1), 2 ** (bits - 1) - 1
 
 
+def _expand_lhs_ellipsis(eqn: str, lhs_ndim: int) -> str:
+  """Names the dims of a leading '...' of the lhs, e.g. for dot_general.
+
+  Args:
+    eqn: The equation for einsum, with '...' in the lhs and output only.
+    lhs_ndim: The rank of the lhs.
+
+  Returns:
+    The equation without '...'.
+  """
+  lhs = eqn.split(',')[0]
+  num_dims = lhs_ndim - len(lhs.replace('...', ''))
+  unused = [c for c in string.ascii_letters if c not in eqn]
+  return eqn.replace('...', ''.join(unused[:num_dims]))
+
+
 def compute_offset(x: JTensor, zp: JTensor, eqn: str):
   """Computes offset: product of activation x with zero point of weight.
 
@@ -167,6 +183,54 @@ def dot_general_int_jvp(
   return y, y_tangent
 
 
+def _einsum_without_scale(eqn: str, x: JTensor, w: JTensor) -> JTensor:
+  """Einsum on lower precision types, using an int dot when possible."""
+  use_int_dot_general = (
+      x.dtype in QUANTIZED_TYPES and w.dtype in QUANTIZED_TYPES
+  )
+
+  if w.dtype == jnp.float8_e4m3fn or w.dtype == jnp.float8_e5m2:
+    w = w.astype(jnp.bfloat16)
+
+  if use_int_dot_general:
+    int_eqn = eqn
+    lhs_names, rhs_names = eqn.split('->')[0].split(',')
+    if '...' in lhs_names and '.' not in rhs_names:
+      int_eqn = _expand_lhs_ellipsis(eqn, x.ndim)
+    dimension_numbers, perm = utils.einsum_eqn_to_dimension_numbers(int_eqn)
+    ret = dot_general_int(
+        x,
+        w,
+        dimension_numbers=dimension_numbers,
+    )
+    if perm is not None:
+      ret = lax.transpose(ret, perm)
+  else:
+    ret = jnp.einsum(eqn, x, w)
+  return ret
+
+
+def _rescale(
+    eqn: str,
+    ret: JTensor,
+    x: JTensor,
+    scale: JTensor,
+    zp: Optional[JTensor],
+) -> JTensor:
+  """Applies the scale and zero point of the weight to the einsum output."""
+  # Potentially expand dimensions of scale to match einsum output.
+  filling_dims = _get_expand_dims(eqn)
+  if filling_dims:
+    scale = jnp.expand_dims(scale, filling_dims)
+
+  ret = jnp.multiply(ret, scale)
+
+  if zp is not None:
+    offset = compute_offset(x, zp, eqn)
+    ret = ret - offset
+  return ret
+
+
 def einsum(
     eqn: str,
     x: JTensor,
@@ -190,37 +254,153 @@ def einsum(
   Returns:
     A JTensor.
   """
+  ret = _einsum_without_scale(eqn, x, w)
+  return _rescale(eqn, ret, x, scale, zp)
 
-  use_int_dot_general = (
-      x.dtype in QUANTIZED_TYPES and w.dtype in QUANTIZED_TYPES
-  )
 
-  if w.dtype == jnp.float8_e4m3fn or w.dtype == jnp.float8_e5m2:
-    w = w.astype(jnp.bfloat16)
+def use_dequant_upfront(
+    eqn: str,
+    x: JTensor,
+    dequant_upfront: bool,
+    min_tokens: Optional[int] = None,
+) -> bool:
+  """Returns whether to dequantize the weight of einsum before it.
 
-  if use_int_dot_general:
-    dimension_numbers, perm = utils.einsum_eqn_to_dimension_numbers(eqn)
-    ret = dot_general_int(
-        x,
-        w,
-        dimension_numbers=dimension_numbers,
-    )
-    if perm is not None:
-      ret = lax.transpose(ret, perm)
-  else:
-    ret = jnp.einsum(eqn, x, w)
+  The choice is static: it depends on the number of tokens of x, i.e. its
+  number of elements divided by the size of the contracted dims.
 
-  # Potentially expand dimensions of scale to match einsum output.
-  filling_dims = _get_expand_dims(eqn)
-  if filling_dims:
-    scale = jnp.expand_dims(scale, filling_dims)
+  Args:
+    eqn: The equation for the einsum between x and w.
+    x: The input to the einsum.
+    dequant_upfront: Whether dequantizing upfront is enabled.
+    min_tokens: If set, the minimum number of tokens to dequantize upfront.
 
-  ret = jnp.multiply(ret, scale)
+  Returns:
+    A bool.
+  """
+  if not dequant_upfront:
+    return False
+  if min_tokens is None:
+    return True
+  lhs_names, rhs_names = eqn.split('->')[0].split(',')
+  contract_size = 1
+  for name in set(rhs_names) - {'.'}:
+    if name in lhs_names:
+      contract_size *= x.shape[_dim_index(lhs_names, name, x.ndim)]
+  return x.size // contract_size >= min_tokens
+
+
+def dequantize_weight(
+    eqn: str,
+    w: JTensor,
+    scale: JTensor,
+    zp: Optional[JTensor] = None,
+    dtype: jnp.dtype = jnp.bfloat16,
+) -> JTensor:
+  """Dequantizes the weight of a quantized einsum.
 
+  einsum(eqn, x, dequantize_weight(eqn, w, scale, zp)) is equivalent to
+  einsum(eqn, x, w, scale, zp), with a float einsum instead of rescaling its
+  output.
+
+  Args:
+    eqn: The equation for the einsum between x and w.
+    w: The quantized weight, unpacked if it is packed.
+    scale: The per-channel scale of w, over the dims of w in the output.
+    zp: Optional zero point tensor, with the same shape as scale.
+    dtype: The dtype of the dequantized weight.
+
+  Returns:
+    The dequantized weight, with the shape of w.
+  """
+  rhs_names, out_names = eqn.split(',')[1].split('->')
+  contract_dims = [i for i, name in enumerate(rhs_names) if name not in out_names]
+  scale = jnp.expand_dims(scale, contract_dims).astype(dtype)
+  w = jnp.multiply(w.astype(dtype), scale)
   if zp is not None:
-    offset = compute_offset(x, zp, eqn)
-    ret = ret - offset
-  return ret
+    w = w - jnp.expand_dims(zp, contract_dims).astype(dtype)
+  return w
+
+
+def _dim_index(names: str, name: str, ndim: int) -> int:
+  """Returns the non-negative index of dim name in einsum operand names."""
+  if '...' not in names:
+    return names.index(name)
+  prefix, suffix = names.split('...')
+  if name in prefix:
+    return prefix.index(name)
+  return ndim - len(suffix) + suffix.index(name)
+
+
+def einsum_4bit(
+    eqn: str,
+    x: JTensor,
+    packed_w: JTensor,
+    scale: JTensor,
+    zp: Optional[JTensor] = None,
+    *,
+    pack_dim: int,
+    original_dtype: jnp.dtype,
+) -> JTensor:
+  """Performs quantized einsum with a 4-bit weight packed by pack_4bit().
+
+  Equivalent to einsum(eqn, x, unpack_4bit(packed_w, ...), scale, zp), but
+  without materializing the unpacked weight, which is 8x larger than packed_w.
+  The contraction is scanned over the 8 nibbles of the packed int32 words: the
+  i-th step only unpacks the rows i, 8 + i, 16 + i, ... of the weight along
+  pack_dim, in original_dtype so that int8 inputs use an int dot.
+
+  Args:
+    eqn: The equation for the einsum between x and the unpacked weight. The
+      weight must not have '...' dims.
+    x: The input to the einsum; can be unquantized or quantized.
+    packed_w: The int32 packed weight.
+    scale: The rescaling factor for the einsum.
+    zp: Optional zero point tensor.
+    pack_dim: Dimension of the weight that was packed.
+    original_dtype: dtype of the weight before packing, int8 or uint8.
+
+  Returns:
+    A JTensor.
+  """
+  lhs_names, rhs_names = eqn.split('->')[0].split(',')
+  out_names = eqn.split('->')[1]
+  pack_name = rhs_names[pack_dim]
+  nibbles = jnp.arange(8, dtype=jnp.int32)
+
+  if pack_name in lhs_names:
+    # Contracting dim: x is split into the same 8 row planes as the weight, and
+    # the partial products are accumulated.
+    axis = _dim_index(lhs_names, pack_name, x.ndim)
+    x_shape = list(x.shape)
+    x_planes = jnp.reshape(
+        x, x_shape[:axis] + [x_shape[axis] // 8, 8] + x_shape[axis + 1:]
+    )
+    x_planes = jnp.moveaxis(x_planes, axis + 1, 0)
+
+    def _accumulate(acc, inputs):
+      nibble, x_plane = inputs
+      w_plane = utils.unpack_4bit_plane(packed_w, nibble, original_dtype)
+      return acc + _einsum_without_scale(eqn, x_plane, w_plane), None
+
+    acc_shape = jax.eval_shape(
+        functools.partial(_einsum_without_scale, eqn), x_planes[0],
+        jax.ShapeDtypeStruct(packed_w.shape, original_dtype))
+    ret, _ = lax.scan(
+        _accumulate, jnp.zeros(acc_shape.shape, acc_shape.dtype),
+        (nibbles, x_planes))
+  else:
+    # Output dim: each step computes the interleaved output rows of one plane.
+    def _project(carry, nibble):
+      w_plane = utils.unpack_4bit_plane(packed_w, nibble, original_dtype)
+      return carry, _einsum_without_scale(eqn, x, w_plane)
+
+    _, ret_planes = lax.scan(_project, None, nibbles)
+    axis = _dim_index(out_names, pack_name, ret_planes.ndim - 1)
+    ret_planes = jnp.moveaxis(ret_planes, 0, axis + 1)
+    ret = lax.collapse(ret_planes, axis, axis + 2)
+
+  return _rescale(eqn, ret, x, scale, zp)
 
 
 def pass_through(x: JTensor, fn: Any) -> JTensor:
@@ -406,6 +586,51 @@ def reduce_precision_activation(
   return qt, scale
 
 
+def compute_static_activation_scale(
+    act_max: JTensor,
+    bits: int = 8,
+    clipping_coeff: float = 1.0,
+) -> JTensor:
+  """Computes the activation scale from a calibrated activation range.
+
+  Args:
+    act_max: The recorded max of the absolute activation values.
+    bits: Target number of bits.
+    clipping_coeff: The coefficient to shrink the range with.
+
+  Returns:
+    The scaling factor, for use with quantize_activation_static().
+  """
+  _, max_value = get_min_max(bits)
+  bound = jnp.multiply(act_max, clipping_coeff)
+  # Avoid a zero scale for layers that never saw a non-zero activation.
+  bound = jnp.where(bound > 0.0, bound, jnp.ones_like(bound))
+  return bound / max_value
+
+
+def quantize_activation_static(
+    t: JTensor,
+    scale: JTensor,
+    bits: int = 8,
+) -> JTensor:
+  """Quantizes activation with a precomputed scale.
+
+  Unlike reduce_precision_activation(), no reduction over the activation is
+  needed to compute the scale.
+
+  Args:
+    t: Input tensor.
+    scale: The scaling factor from compute_static_activation_scale().
+    bits: Target number of bits.
+
+  Returns:
+    The quantized activation, in int8 as container.
+  """
+  min_value, max_value = get_min_max(bits)
+  t = jnp.round(jnp.divide(t, scale.astype(t.dtype)))
+  return jnp.clip(t, min_value, max_value).astype(jnp.int8)
+
+
 def fakequant_activation(t: JTensor, bits: int = 8) -> JTensor:
   """FakeQuant activation.
 
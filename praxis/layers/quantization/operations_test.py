@@ -27,6 +27,7 @@ from praxis import pax_fiddle
 from praxis import test_utils
 from praxis.layers.quantization import operations
 from praxis.layers.quantization import quantizer
+from praxis.layers.quantization import utils
 
 
 class QuantizationUtilsTest(test_utils.TestCase):
@@ -74,6 +75,91 @@ class QuantizationUtilsTest(test_utils.TestCase):
     expected = jnp.ones([A, H], dtype=jnp.int32) * D
     self.assertArraysEqual(ret, expected)
 
+  def test_int_einsum_with_dot(self):
+    x = jnp.ones([2, 3, 5], dtype=jnp.int8)
+    w = jnp.ones([5, 4], dtype=jnp.int8)
+    s = jnp.full([4], 0.5, dtype=jnp.float32)
+
+    ret = operations.einsum('...y,yz->...z', x, w, s)
+    expected = jnp.full([2, 3, 4], 2.5, dtype=jnp.float32)
+    self.assertArraysEqual(ret, expected)
+
+  @parameterized.named_parameters(
+      ('linear', '...y,yz->...z', (2, 3, 16), (16, 4), 0),
+      ('proj', 'ABD,DNH->ABNH', (2, 3, 16), (16, 2, 3), 0),
+      ('output_proj', 'ABNH,DNH->ABD', (2, 3, 2, 3), (16, 2, 3), 0),
+      ('combined_qkv', 'AD,KDNH->KANH', (2, 16), (3, 16, 2, 3), 1),
+  )
+  def test_einsum_4bit(self, eqn, x_shape, w_shape, pack_dim):
+    w = np.random.randint(-8, 8, size=w_shape).astype(np.int8)
+    packed_w = utils.pack_4bit(jnp.asarray(w), pack_dim)
+    unpacked_w = utils.unpack_4bit(packed_w, pack_dim, jnp.int8)
+    scale_shape = [d for i, d in enumerate(w_shape) if eqn.split(',')[1][i]
+                   in eqn.split('->')[1]]
+    s = np.random.uniform(0.5, 1.5, size=scale_shape).astype(np.float32)
+    x = np.random.normal(size=x_shape).astype(np.float32)
+    qx = np.random.randint(-128, 128, size=x_shape).astype(np.int8)
+
+    for inputs in (x, qx):
+      expected = operations.einsum(eqn, inputs, unpacked_w, s)
+      ret = operations.einsum_4bit(
+          eqn, inputs, packed_w, s, pack_dim=pack_dim, original_dtype=jnp.int8
+      )
+      self.assertAllClose(ret, expected, rtol=1e-5, atol=1e-4)
+
+  @parameterized.named_parameters(
+      ('linear', '...y,yz->...z', (2, 3, 16), (16, 4)),
+      ('output_proj', 'ABNH,DNH->ABD', (2, 3, 2, 3), (16, 2, 3)),
+      ('output_proj_nhd', 'ABNH,NHD->ABD', (2, 3, 2, 3), (2, 3, 16)),
+      ('combined_qkv', 'AD,KDNH->KANH', (2, 16), (3, 16, 2, 3)),
+  )
+  def test_dequantize_weight(self, eqn, x_shape, w_shape):
+    rhs, out = eqn.split(',')[1].split('->')
+    scale_shape = [d for name, d in zip(rhs, w_shape) if name in out]
+    w = np.random.randint(-128, 128, size=w_shape).astype(np.int8)
+    s = np.random.uniform(0.5, 1.5, size=scale_shape).astype(np.float32)
+    zp = np.random.uniform(-1.0, 1.0, size=scale_shape).astype(np.float32)
+    x = np.random.normal(size=x_shape).astype(np.float32)
+
+    # compute_offset() does not support the NHD weight layout.
+    zps = (None,) if eqn == 'ABNH,NHD->ABD' else (None, zp)
+    for w_zp in zps:
+      expected = operations.einsum(eqn, x, w, s, w_zp)
+      w_dequant = operations.dequantize_weight(
+          eqn, w, s, w_zp, dtype=jnp.float32
+      )
+      self.assertAllClose(
+          jnp.einsum(eqn, x, w_dequant), expected, rtol=1e-5, atol=1e-3
+      )
+
+  def test_use_dequant_upfront(self):
+    x = jnp.ones([2, 3, 4, 5])
+    self.assertFalse(operations.use_dequant_upfront('ABNH,DNH->ABD', x, False))
+    self.assertTrue(operations.use_dequant_upfront('ABNH,DNH->ABD', x, True))
+    # 6 tokens of 4 * 5.
+    self.assertTrue(
+        operations.use_dequant_upfront('ABNH,DNH->ABD', x, True, 6)
+    )
+    self.assertFalse(
+        operations.use_dequant_upfront('ABNH,DNH->ABD', x, True, 7)
+    )
+    # 24 tokens of 5.
+    self.assertTrue(
+        operations.use_dequant_upfront('...y,yz->...z', x, True, 24)
+    )
+
+  def test_quantize_activation_static(self):
+    x = jnp.array([[0.1, -1.0, 2.0], [4.0, -8.0, 0.5]], dtype=jnp.float32)
+    scale = operations.compute_static_activation_scale(
+        jnp.array(4.0), bits=8, clipping_coeff=1.0
+    )
+    qx = operations.quantize_activation_static(x, scale, bits=8)
+    self.assertEqual(qx.dtype, jnp.int8)
+    # Values out of the calibrated range are clipped.
+    self.assertArraysEqual(
+        qx, jnp.array([[3, -32, 64], [127, -128, 16]], dtype=jnp.int8)
+    )
+
   @parameterized.named_parameters(
       ('eqn_with_dot', '...y,yz->...z'),
   )
@@ -51,6 +51,21 @@ class QuantizationMode(str, enum.Enum):
   INFERENCE = 'inference'
 
 
+@dataclasses.dataclass
+class ActStatsConfig:
+  """Parameters for static (calibrated) activation quantization.
+
+  The activation range is recorded in a non-trainable variable while running a
+  calibration pass in TRAINING mode, and converted into a fixed activation scale
+  when the weights are quantized.
+
+  ema_decay: If None, the running max of the absolute activation values over all
+    calibration batches is recorded. Otherwise, an exponential moving average of
+    the per-batch max with this decay.
+  """
+  ema_decay: Optional[float] = None
+
+
 @dataclasses.dataclass
 class ActQuantizationParams:
   """Parameters for activation quantization.
@@ -68,8 +83,7 @@ class ActQuantizationParams:
   precision: int = 8
   unsigned_int_bounds: bool = False
   clipping_coeff: float = 1.0
-  # TODO(jihwanlee): Define stats config for static quantization
-  stats_config = None
+  stats_config: Optional[ActStatsConfig] = None
   stop_scale_gradient: bool = False
 
 
@@ -91,7 +105,12 @@ class WeightQuantizationParams:
   use_symmetric: Do symmetric quantization for weights.
   add_scale_eps: If True add epsilon to scale to avoid division by zero,
     else it will replace zero scale by 1.
-  dequant_upfront: Dequantize weights before it goes into matmul.
+  dequant_upfront: Dequantize weights before it goes into matmul. This is
+    faster than rescaling the output of the quantized matmul for compute bound
+    (e.g. prefill) calls. Only used without activation quantization.
+  dequant_upfront_min_tokens: If set, weights are only dequantized upfront for
+    calls with at least this many input tokens, e.g. prefill. Calls with fewer
+    tokens, e.g. decoding, use the quantized matmul.
   dtype: The datatype for weight quantization. Defaults to int8.
   quant_loss_weight: Weight for quantization loss.
   optimize_clipping_per_channel: If True choose the best clipping value
@@ -102,6 +121,9 @@ class WeightQuantizationParams:
   use_step_count: If True step_count non-trainable variable will added.
     It is used for counting forward propagation training steps.
     By default it is disabled for backward compatibility with prod.
+  int4_blockwise_unpack: If True, 4-bit weights are unpacked one nibble plane
+    at a time inside the inference einsum, instead of materializing the whole
+    unpacked int32 weight before it.
   """
   precision: int = 8
   unsigned_int_bounds: bool = False
@@ -112,12 +134,14 @@ class WeightQuantizationParams:
   use_symmetric: bool = True
   add_scale_eps: Optional[bool] = True
   dequant_upfront: bool = False
+  dequant_upfront_min_tokens: Optional[int] = None
   dtype: jnp.dtype = jnp.int8
   quant_loss_weight: Optional[float] = None
   optimize_clipping_per_channel: bool = False
   sub_channels: Optional[int] = None
   calculation_dtype: jnp.dtype = jnp.float32
   use_step_count: bool = False
+  int4_blockwise_unpack: bool = True
 
 
 class QuantizationHParams(base_hyperparams.BaseHyperParams):
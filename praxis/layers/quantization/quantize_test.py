@@ -17,6 +17,9 @@
 
 from absl.testing import absltest
 from absl.testing import parameterized
+import jax
+from jax import numpy as jnp
+from praxis import base_layer
 from praxis import layers
 from praxis import pax_fiddle
 from praxis import test_utils
@@ -146,6 +149,39 @@ class QuantizationTest(test_utils.TestCase):
           layers.attentions.CombinedQKVProjectionLayer,
       )
 
+  @parameterized.named_parameters(
+      ('all_layers', False),
+      ('linear_only', True),
+  )
+  def test_fold_norm_scale_rejects_quantized_transformer(self, linear_only):
+    p = pax_fiddle.Config(
+        layers.transformers.Transformer,
+        name='jax_transformer_layer',
+        input_dims=8,
+        hidden_dims=16,
+        num_heads=2,
+        fold_norm_scale=True,
+    )
+    p.tr_atten_tpl.combine_qkv = True
+    quantize.quantize_transformer_layer_weights(
+        p,
+        quantization_hparams.QuantizationType.PTQ,
+        quantization_hparams.QuantizationMode.INFERENCE,
+        quantization_hparams.WeightQuantizationParams(precision=8),
+        linear_only=linear_only,
+    )
+    layer = base_layer.instantiate(p)
+    inputs = jnp.zeros([1, 4, 8])
+    paddings = jnp.zeros([1, 4])
+    with base_layer.JaxContext.new_context():
+      with self.assertRaisesRegex(ValueError, 'quantized layers'):
+        layer.init(
+            jax.random.PRNGKey(seed=123),
+            inputs,
+            paddings,
+            attention_mask=layers.attentions.causal_mask(inputs),
+        )
+
   @parameterized.named_parameters(
       ('embedding_transposed', True),
       ('embedding_not_transposed', False),
@@ -14,9 +14,12 @@
 # limitations under the License.
 
 """Test utils for quantization test."""
+import dataclasses
 import itertools
 from typing import Any, Dict, List, Optional, Sequence
 
+from praxis import base_input
+from praxis import py_utils
 from praxis import test_utils
 
 
@@ -218,6 +221,25 @@ def generate_one_headed_attention_projection_test_config(
   return [dict(zip(keys, case)) for case in cases]
 
 
+class FixedInput(base_input.BaseInput):
+  """Returns the given batches in order.
+
+  Batches which are not NestedMaps are returned as NestedMap(inputs=batch).
+  """
+  batches: Any = None
+  _index: int = dataclasses.field(init=False, repr=False, default=0)
+
+  def get_next(self) -> py_utils.NestedMap:
+    batch = self.batches[self._index % len(self.batches)]
+    self._index += 1
+    if isinstance(batch, py_utils.NestedMap):
+      return batch
+    return py_utils.NestedMap(inputs=batch)
+
+  def reset(self) -> None:
+    self._index = 0
+
+
 class QuantizationTestCase(test_utils.TestCase):
   """Test case class for quantized layers.
   """
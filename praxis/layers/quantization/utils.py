@@ -189,6 +189,38 @@ def unpack_4bit(
     return lax.shift_right_logical(rep, 28)
 
 
+def unpack_4bit_plane(
+    packed: JTensor, index: JTensor, original_dtype: jnp.dtype
+) -> JTensor:
+  """Unpack one nibble of each int32 word of a tensor packed by pack_4bit().
+
+  Along the packed dimension, nibble `index` of word i holds row 8 * i + index
+  of the original tensor, so this returns every 8th row of it, starting at
+  `index`, with the shape of `packed`.
+
+  Args:
+    packed: int32 tensor that was packed by pack_4bit() function.
+    index: Scalar in [0, 8), the nibble to unpack. Can be traced.
+    original_dtype: dtype of the original tensor that was packed by pack_4bit()
+      function. Must be either int8 or uint8.
+
+  Returns:
+    A tensor of original_dtype with the same shape as packed.
+  """
+  if packed.dtype != jnp.int32:
+    raise ValueError(f'packed dtype must be either int32. Given {packed.dtype}')
+  if original_dtype == jnp.int8:
+    # Arithmetic shift to sign extend the nibble.
+    plane = jnp.right_shift(jnp.left_shift(packed, 28 - 4 * index), 28)
+  elif original_dtype == jnp.uint8:
+    plane = jnp.right_shift(packed, 4 * index) & 0x0F
+  else:
+    raise ValueError(
+        f'original_dtype must be either int8 or uint8. Given {original_dtype}'
+    )
+  return plane.astype(original_dtype)
+
+
 def get_packed_shape(shape: Sequence[int], pack_dim: int, packing_factor: int):
   """Get packed shape where the original shape's pack_dim size is dividened by packing_factor."""
   if shape[pack_dim] % packing_factor != 0:
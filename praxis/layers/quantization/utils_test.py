@@ -96,6 +96,23 @@ class UtilsTest(test_utils.TestCase):
     unpacked = utils.unpack_4bit(packed, pack_dim, x.dtype)
     self.assertArraysEqual(unpacked, x.astype(jnp.int32))
 
+  @parameterized.parameters(
+      dict(dtype=jnp.int8, pack_dim=0),
+      dict(dtype=jnp.int8, pack_dim=1),
+      dict(dtype=jnp.uint8, pack_dim=0),
+      dict(dtype=jnp.uint8, pack_dim=1),
+  )
+  def test_unpack_4bit_plane(self, dtype, pack_dim):
+    low, high = (-8, 8) if dtype == jnp.int8 else (0, 16)
+    x = np.random.randint(low, high, size=(16, 16, 3)).astype(dtype)
+    packed = utils.pack_4bit(jnp.asarray(x), pack_dim)
+    for index in range(8):
+      plane = utils.unpack_4bit_plane(packed, index, dtype)
+      self.assertEqual(plane.dtype, dtype)
+      self.assertArraysEqual(
+          plane, np.take(x, np.arange(index, 16, 8), axis=pack_dim)
+      )
+
   def test_get_packed_shape(self):
     self.assertSequenceEqual(utils.get_packed_shape((4, 8, 3), 1, 8), (4, 1, 3))
     self.assertRaises(ValueError, utils.get_packed_shape, (4, 7, 3), 1, 8)
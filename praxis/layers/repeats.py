@@ -25,6 +25,7 @@ from flax import linen as nn
 from flax.core import meta
 import jax
 from jax import numpy as jnp
+from jax.ad_checkpoint import checkpoint_name
 from praxis import asserts
 from praxis import base_layer
 from praxis import flax_utils
@@ -74,6 +75,13 @@ class Repeat(base_layer.BaseLayer):
       each loop iterations.
     checkpoint_policy: How to checkpoint residuals for BProp: save nothing, dot
       only or dot with no batch dimensions.
+    checkpoint_names: The `checkpoint_name` tags to save when checkpoint_policy
+      is SAVE_NAMES, e.g. the saved_names of a checkpoint_policy.CheckpointPlan,
+      or SAVE_AND_OFFLOAD_NAMES.
+    offloaded_checkpoint_names: The `checkpoint_name` tags to offload to host
+      memory when checkpoint_policy is SAVE_AND_OFFLOAD_NAMES. The input of
+      each iteration is tagged as 'iteration_input' when it is saved or
+      offloaded by name.
     unroll_in_decode: Whether to unroll the layers during extend_step. The scan
       loop within a decoding loop can cause large overheads for data
       copy/formatting.
@@ -93,6 +101,8 @@ class Repeat(base_layer.BaseLayer):
   x_times: int = 0
   unpack_summaries: bool = False
   checkpoint_policy: AutodiffCheckpointType = AutodiffCheckpointType.SAVE_NOTHING
+  checkpoint_names: Sequence[str] = ()
+  offloaded_checkpoint_names: Sequence[str] = ()
   unroll_in_decode: bool = False
   sublayer_name: str = 'sub'
   optimizer_dims_mapping: SplitDimsMapping = None
@@ -192,7 +202,18 @@ class Repeat(base_layer.BaseLayer):
       Output from the last sub layer.
     """
 
+    offloaded_names = checkpoint_policy.offloaded_names(
+        self.checkpoint_policy, self.offloaded_checkpoint_names
+    )
+    tag_iteration_input = 'iteration_input' in (
+        tuple(self.checkpoint_names) + offloaded_names
+    )
+
     def body_fn(sub, layer_in):
+      if tag_iteration_input:
+        layer_in = jax.tree_map(
+            lambda x: checkpoint_name(x, 'iteration_input'), layer_in
+        )
       if self.positional_args_as_scan_carry:
         layer_out = _ensure_tuple(sub(*layer_in, **kwargs))
       else:
@@ -208,7 +229,11 @@ class Repeat(base_layer.BaseLayer):
     rematted_body_fn = nn.remat(
         body_fn,
         prevent_cse=False,  # prevent_cse not required for scan.
-        policy=checkpoint_policy.custom_policy(self.checkpoint_policy),
+        policy=checkpoint_policy.custom_policy(
+            self.checkpoint_policy,
+            self.checkpoint_names,
+            self.offloaded_checkpoint_names,
+        ),
     )
 
     scan_fn = nn.scan(
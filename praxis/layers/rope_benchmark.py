@@ -0,0 +1,98 @@
+# coding=utf-8
+# Copyright 2022 The Pax Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+r"""Benchmarks decode steps of the rotary position embedding.
+
+Compares sin/cos recomputed at every call with sin/cos gathered from the
+precomputed tables (max_position set), applied to the query and key of every
+layer of a stack, as in one StackedTransformer decode step.
+
+Example:
+  python -m praxis.layers.rope_benchmark --batch_sizes=1,8,64
+"""
+
+import time
+from typing import Optional, Sequence
+
+from absl import app
+from absl import flags
+import jax
+from jax import numpy as jnp
+from praxis import base_layer
+from praxis import pax_fiddle
+from praxis.layers import embedding_softmax
+
+instantiate = base_layer.instantiate
+
+_BATCH_SIZES = flags.DEFINE_list('batch_sizes', ['1', '8', '64'],
+                                 'Decode batch sizes to benchmark.')
+_NUM_LAYERS = flags.DEFINE_integer('num_layers', 32, 'Number of layers.')
+_NUM_HEADS = flags.DEFINE_integer('num_heads', 32, 'Number of heads.')
+_DIM_PER_HEAD = flags.DEFINE_integer('dim_per_head', 128, 'Dims per head.')
+_MAX_POSITION = flags.DEFINE_integer('max_position', 8192,
+                                     'Size of the sin/cos tables.')
+_NUM_ITERS = flags.DEFINE_integer('num_iters', 50, 'Timed iterations.')
+
+
+def _time_decode_step(max_position: Optional[int], batch_size: int) -> float:
+  """Returns the average wall time of the RoPE work of one decode step."""
+  p = pax_fiddle.Config(
+      embedding_softmax.RotaryPositionalEmbedding,
+      name='rotary',
+      embedding_dims=_DIM_PER_HEAD.value,
+      max_position=max_position,
+  )
+  layer = instantiate(p)
+  prng_key = jax.random.PRNGKey(1234)
+  # Query and key of every layer, [L, 2, B, N, H].
+  inputs = jax.random.normal(
+      prng_key,
+      [_NUM_LAYERS.value, 2, batch_size, _NUM_HEADS.value,
+       _DIM_PER_HEAD.value],
+      dtype=jnp.float32)
+  position = jnp.full([batch_size], _MAX_POSITION.value // 2, jnp.int32)
+  initial_vars = layer.init(prng_key, inputs[0, 0, :, jnp.newaxis])
+
+  @jax.jit
+  def _decode_step(inputs, position):
+    with base_layer.JaxContext.new_context():
+      outputs = []
+      for i in range(_NUM_LAYERS.value):
+        for j in range(2):
+          outputs.append(
+              layer.apply(initial_vars, inputs[i, j], position,
+                          method=layer.extend_step))
+      return outputs
+
+  jax.block_until_ready(_decode_step(inputs, position))
+  start = time.time()
+  for _ in range(_NUM_ITERS.value):
+    jax.block_until_ready(_decode_step(inputs, position))
+  return (time.time() - start) / _NUM_ITERS.value
+
+
+def main(argv: Sequence[str]) -> None:
+  del argv
+  print(f'{"batch":>8} {"recompute (ms)":>15} {"tables (ms)":>12}')
+  for batch_size in _BATCH_SIZES.value:
+    batch_size = int(batch_size)
+    recompute_time = _time_decode_step(None, batch_size)
+    tables_time = _time_decode_step(_MAX_POSITION.value, batch_size)
+    print(f'{batch_size:>8} {recompute_time * 1e3:>15.3f} '
+          f'{tables_time * 1e3:>12.3f}')
+
+
+if __name__ == '__main__':
+  app.run(main)
@@ -15,6 +15,7 @@
 
 """Sparse Linear Layers."""
 
+from jax import numpy as jnp
 from praxis import base_layer
 from praxis import pytypes
 from praxis.layers import linears
@@ -25,11 +26,14 @@ SparsityMode = sparsity_hparams.SparsityMode
 SparsityType = sparsity_hparams.SparsityType
 SparsityHParams = sparsity_hparams.SparsityHParams
 WeightHParams = base_layer.WeightHParams
+WeightInit = base_layer.WeightInit
 
 sub_config_field = base_layer.sub_config_field
 JTensor = pytypes.JTensor
 NestedJTensor = pytypes.NestedJTensor
 
+_STEP_NAME = 'sparsity_step'
+
 
 class Linear(linears.Linear):
   """Sparsed Linear layer without bias.
@@ -41,6 +45,61 @@ class Linear(linears.Linear):
 
   sparsity: SparsityHParams = sub_config_field(SparsityHParams)
 
+  def _use_compressed_weight(self) -> bool:
+    return (
+        self.sparsity.mode == SparsityMode.INFERENCE
+        and self.sparsity.compressed_inference
+    )
+
+  def _use_pruning_schedule(self) -> bool:
+    return (
+        self.sparsity.mode == SparsityMode.TRAINING
+        and self.sparsity.schedule is not None
+    )
+
+  def _unstructured_mask(self, w: JTensor, mask: JTensor) -> JTensor:
+    """Returns the magnitude pruning mask of `w`, following the schedule.
+
+    Praxis layers do not see the global training step, so the schedule follows
+    the `sparsity_step` counter instead, which counts the training forward
+    passes of the layer. Its steps match the global steps only if the layer is
+    called once per training step, e.g. they advance `num_microbatches` times
+    faster with gradient accumulation, so the schedule steps must be scaled
+    accordingly.
+
+    Args:
+      w: The dense weight.
+      mask: The current sparsity mask of `w`.
+
+    Returns:
+      The updated sparsity mask.
+    """
+    prune_rate = self.sparsity.weight_params.prune_rate
+    if not self._use_pruning_schedule():
+      return sparsity.get_pruning_unstructured_mask(
+          w, prune_rate, self.sparsity.block_shape)
+    schedule = self.sparsity.schedule
+    step = self.get_var(_STEP_NAME)
+    new_mask = sparsity.get_pruning_unstructured_mask(
+        w,
+        sparsity.get_scheduled_prune_rate(
+            step,
+            prune_rate,
+            schedule.start_step,
+            schedule.end_step,
+            schedule.exponent,
+        ),
+        self.sparsity.block_shape,
+    )
+    should_update = (step <= schedule.end_step) & (
+        (step <= schedule.start_step)
+        | ((step - schedule.start_step) % schedule.update_freq == 0)
+        | (step == schedule.end_step)
+    )
+    if not self.do_eval and not self.is_initializing():
+      self.update_var(_STEP_NAME, step + 1)
+    return jnp.where(should_update, new_mask, mask)
+
   def setup(self) -> None:
     wp = self.weight_split_dims_mapping
     pc = WeightHParams(
@@ -48,10 +107,72 @@ class Linear(linears.Linear):
         mesh_shape=self.mesh_shape,
         tensor_split_dims_mapping=wp.wt,
     )
-    if self.sparsity.mode == SparsityMode.INFERENCE:
+    if (
+        self._use_compressed_weight()
+        and self.sparsity.sparsity_type == SparsityType.UNSTRUCTURED
+    ):
+      block_shape = self.sparsity.block_shape
+      num_blocks = sparsity.num_unpruned_blocks(
+          (self.input_dims, self.output_dims),
+          block_shape,
+          self.sparsity.weight_params.prune_rate,
+      )
+      self.create_variable(
+          'w_block_values',
+          WeightHParams(
+              shape=[num_blocks] + list(block_shape),
+              mesh_shape=self.mesh_shape,
+          ),
+      )
+      for name in ('w_block_rows', 'w_block_cols'):
+        self.create_variable(
+            name,
+            WeightHParams(
+                shape=[num_blocks],
+                dtype=jnp.int32,
+                init=WeightInit.Constant(0),
+                mesh_shape=self.mesh_shape,
+            ),
+            trainable=False,
+        )
+    elif self._use_compressed_weight():
+      n, m = self.sparsity.weight_params.prune_rate
+      assert self.output_dims % m == 0, (self.output_dims, m)
+      compressed_shape = [self.input_dims, self.output_dims // m, m - n]
+      compressed_split_dims_mapping = None
+      if wp.wt is not None:
+        compressed_split_dims_mapping = list(wp.wt) + [None]
+      self.create_variable(
+          'w_nm_values',
+          WeightHParams(
+              shape=compressed_shape,
+              mesh_shape=self.mesh_shape,
+              tensor_split_dims_mapping=compressed_split_dims_mapping,
+          ),
+      )
+      self.create_variable(
+          'w_nm_indices',
+          WeightHParams(
+              shape=compressed_shape,
+              dtype=jnp.int8,
+              init=WeightInit.Constant(0),
+              mesh_shape=self.mesh_shape,
+              tensor_split_dims_mapping=compressed_split_dims_mapping,
+          ),
+          trainable=False,
+      )
+    elif self.sparsity.mode == SparsityMode.INFERENCE:
       self.create_variable('w', pc)
     else:
       self.create_sparse_variable('w', pc)
+      if self._use_pruning_schedule():
+        self.create_variable(
+            _STEP_NAME,
+            WeightHParams(
+                shape=[], dtype=jnp.int32, init=WeightInit.Constant(0)
+            ),
+            trainable=False,
+        )
 
   def __call__(self, inputs: JTensor) -> JTensor:
     """Apply projection to inputs.
@@ -63,14 +184,34 @@ class Linear(linears.Linear):
       Projected inputs.
     """
     ap = self.activation_split_dims_mapping
-    if self.sparsity.mode == SparsityMode.INFERENCE:
+    if (
+        self._use_compressed_weight()
+        and self.sparsity.sparsity_type == SparsityType.UNSTRUCTURED
+    ):
+      out = sparsity.block_sparse_matmul(
+          inputs,
+          self.theta.w_block_values,
+          self.get_var('w_block_rows'),
+          self.get_var('w_block_cols'),
+          self.output_dims,
+      )
+    elif self._use_compressed_weight():
+      out = sparsity.nm_sparse_matmul(
+          inputs,
+          self.theta.w_nm_values,
+          self.get_var('w_nm_indices'),
+          m=self.sparsity.weight_params.prune_rate[1],
+          block_size=self.sparsity.compressed_block_size,
+      )
+    elif self.sparsity.mode == SparsityMode.INFERENCE:
       out = linears.project_last_dim(inputs, self.theta.w)
     else:
       w, m = self.get_sparse_weight('w')
       if self.sparsity.sparsity_type == SparsityType.UNSTRUCTURED:
-        raise NotImplementedError(
-            'Unstructured sparsity is not currently supported.'
-        )
+        m = self._unstructured_mask(w, m)
+        self.update_var('w' + base_layer.SPARSITY_NAME_POSTFIX, m)
+        w = sparsity.apply_sparsity(w, m)
+        out = linears.project_last_dim(inputs, w)
       elif self.sparsity.sparsity_type == SparsityType.STRUCTURED_NM:
         m = sparsity.get_sparsity_mask(
             w,
@@ -89,3 +230,39 @@ class Linear(linears.Linear):
       ap_out = [ap_out[0], ap_out[2]]
     out = base_layer.maybe_shard(out, ap_out, self.mesh_axis_names)
     return out
+
+  def compress_weight(self) -> NestedJTensor:
+    """Returns the variables of the compressed inference layer.
+
+    To be called on a TRAINING or MATERIALIZE mode layer with N:M structured
+    sparsity or unstructured `block_shape` sparsity, the result initializes the
+    same layer in INFERENCE mode with `compressed_inference`. Unstructured
+    weights are compressed according to their current sparsity mask.
+    """
+    assert self.sparsity.mode != SparsityMode.INFERENCE
+    if self.sparsity.sparsity_type == SparsityType.UNSTRUCTURED:
+      assert self.sparsity.block_shape is not None
+      w, mask = self.get_sparse_weight('w')
+      values, rows, cols = sparsity.compress_block_sparse_weight(
+          sparsity.apply_sparsity(w, mask),
+          self.sparsity.block_shape,
+          sparsity.num_unpruned_blocks(
+              w.shape,
+              self.sparsity.block_shape,
+              self.sparsity.weight_params.prune_rate,
+          ),
+      )
+      return {
+          base_layer.PARAMS: {'w_block_values': values},
+          base_layer.NON_TRAINABLE: {
+              'w_block_rows': rows,
+              'w_block_cols': cols,
+          },
+      }
+    assert self.sparsity.sparsity_type == SparsityType.STRUCTURED_NM
+    n, m = self.sparsity.weight_params.prune_rate
+    values, indices = sparsity.compress_nm_sparse_weight(self.theta.w, n, m)
+    return {
+        base_layer.PARAMS: {'w_nm_values': values},
+        base_layer.NON_TRAINABLE: {'w_nm_indices': indices},
+    }
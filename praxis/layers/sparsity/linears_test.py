@@ -35,6 +35,7 @@ WeightInit = base_layer.WeightInit
 WeightHParams = base_layer.WeightHParams
 SparsityHParams = sparsity_hparams.SparsityHParams
 WeightSparsityParams = sparsity_hparams.WeightSparsityParams
+PruningSchedule = sparsity_hparams.PruningSchedule
 SparsityMode = sparsity_hparams.SparsityMode
 SparsityType = sparsity_hparams.SparsityType
 
@@ -55,6 +56,24 @@ def _generate_sparsity_types_modes() -> Sequence[Dict[str, Any]]:
   return [dict(zip(keys, case)) for case in cases]
 
 
+def _compressible_linear_p(
+    sparsity_type, prune_rate, mode, compressed_inference=False, **kwargs
+):
+  return pax_fiddle.Config(
+      slinears.Linear,
+      name='_linear',
+      input_dims=16,
+      output_dims=24,
+      sparsity=SparsityHParams(
+          sparsity_type=sparsity_type,
+          weight_params=WeightSparsityParams(prune_rate=prune_rate),
+          mode=mode,
+          compressed_inference=compressed_inference,
+          **kwargs,
+      ),
+  )
+
+
 class SparseLinearTest(test_utils.TestCase):
   """Check the functionality of structured sparsity."""
 
@@ -62,6 +81,57 @@ class SparseLinearTest(test_utils.TestCase):
     super().setUp()
     np.random.seed(123456)
 
+  def _check_compressed_inference(self, sparsity_type, prune_rate, **kwargs):
+    """Checks compress_weight() against the TRAINING layer outputs.
+
+    Args:
+      sparsity_type: The SparsityType of the layers.
+      prune_rate: The prune rate of the layers.
+      **kwargs: Additional SparsityHParams fields of the layers.
+
+    Returns:
+      The variables of the TRAINING layer after one step, and the compressed
+      variables.
+    """
+    train_linear = instantiate(
+        _compressible_linear_p(
+            sparsity_type, prune_rate, SparsityMode.TRAINING, **kwargs
+        )
+    )
+    compressed_linear = instantiate(
+        _compressible_linear_p(
+            sparsity_type,
+            prune_rate,
+            SparsityMode.INFERENCE,
+            compressed_inference=True,
+            **kwargs,
+        )
+    )
+    inputs = np.random.normal(size=[2, 3, 16]).astype(np.float32)
+    with base_layer.JaxContext.new_context():
+      prng_key = jax.random.PRNGKey(seed=123)
+      train_vars = train_linear.init(prng_key, inputs)
+      train_outputs, state = train_linear.apply(
+          train_vars, inputs, mutable=True)
+      train_vars['non_trainable'] = state['non_trainable']
+      compressed_vars = train_linear.apply(
+          train_vars, method=train_linear.compress_weight)
+      compressed_outputs = compressed_linear.apply(compressed_vars, inputs)
+      init_compressed_vars = compressed_linear.init(prng_key, inputs)
+
+    self.assertEqual(
+        jax.tree_util.tree_structure(compressed_vars),
+        jax.tree_util.tree_structure(init_compressed_vars),
+    )
+    for var, init_var in zip(
+        jax.tree_util.tree_leaves(compressed_vars),
+        jax.tree_util.tree_leaves(init_compressed_vars),
+    ):
+      self.assertEqual(var.shape, init_var.shape)
+      self.assertEqual(var.dtype, init_var.dtype)
+    self.assertAllClose(compressed_outputs, train_outputs)
+    return train_vars, compressed_vars
+
   @parameterized.named_parameters(_generate_sparsity_types_modes())
   def test_linear_sparse(self, sparsity_type, mode):
     p = pax_fiddle.Config(
@@ -108,6 +178,94 @@ class SparseLinearTest(test_utils.TestCase):
           outputs, jnp.array([[-8.0, 1.0, 1.0, -2.0], [-18.0, 1.0, 11.0, 18.0]])
       )
 
+  @parameterized.parameters((2, 4, 4), (1, 4, 16), (4, 8, 8))
+  def test_linear_compressed_inference(self, n, m, block_size):
+    train_vars, compressed_vars = self._check_compressed_inference(
+        SparsityType.STRUCTURED_NM,
+        (n, m),
+        compressed_block_size=block_size,
+    )
+    compressed_bytes = sum(
+        x.nbytes for x in jax.tree_util.tree_leaves(compressed_vars))
+    dense_bytes = train_vars['params']['w'].nbytes
+    self.assertLess(compressed_bytes, dense_bytes * (m - n) / m * 1.25 + 1)
+
+  @parameterized.parameters(SparsityMode.TRAINING, SparsityMode.MATERIALIZE)
+  def test_linear_unstructured(self, mode):
+    p = pax_fiddle.Config(
+        slinears.Linear,
+        name='_linear',
+        input_dims=8,
+        output_dims=16,
+        sparsity=SparsityHParams(
+            sparsity_type=SparsityType.UNSTRUCTURED,
+            weight_params=WeightSparsityParams(prune_rate=0.75),
+            mode=mode,
+        ),
+    )
+    linear = instantiate(p)
+    inputs = np.random.normal(size=[3, 8]).astype(np.float32)
+    with base_layer.JaxContext.new_context():
+      initial_vars = linear.init(jax.random.PRNGKey(seed=123), inputs)
+      outputs, state = linear.apply(initial_vars, inputs, mutable=True)
+
+    w = np.array(initial_vars['params']['w'])
+    mask = state['non_trainable']['w' + base_layer.SPARSITY_NAME_POSTFIX]
+    self.assertEqual(np.sum(mask), 32)
+    # The kept weights are the largest ones.
+    self.assertGreaterEqual(
+        np.min(np.abs(w)[mask]), np.max(np.abs(w)[~np.array(mask)]))
+    self.assertAllClose(outputs, inputs @ np.where(mask, w, 0.0))
+
+  def test_linear_unstructured_schedule(self):
+    p = pax_fiddle.Config(
+        slinears.Linear,
+        name='_linear',
+        input_dims=8,
+        output_dims=16,
+        sparsity=SparsityHParams(
+            sparsity_type=SparsityType.UNSTRUCTURED,
+            weight_params=WeightSparsityParams(prune_rate=0.5),
+            mode=SparsityMode.TRAINING,
+            schedule=PruningSchedule(
+                start_step=2, end_step=6, update_freq=2, exponent=1.0
+            ),
+        ),
+    )
+    linear = instantiate(p)
+    inputs = np.random.normal(size=[3, 8]).astype(np.float32)
+    mask_name = 'w' + base_layer.SPARSITY_NAME_POSTFIX
+    with base_layer.JaxContext.new_context():
+      mdl_vars = linear.init(jax.random.PRNGKey(seed=123), inputs)
+      self.assertEqual(mdl_vars['non_trainable']['sparsity_step'], 0)
+      num_pruned = []
+      for _ in range(9):
+        _, state = linear.apply(mdl_vars, inputs, mutable=True)
+        mdl_vars['non_trainable'] = state['non_trainable']
+        num_pruned.append(128 - int(np.sum(state['non_trainable'][mask_name])))
+
+    self.assertEqual(mdl_vars['non_trainable']['sparsity_step'], 9)
+    # Linear ramp from step 2 to 6, updated every 2 steps.
+    self.assertEqual(num_pruned, [0, 0, 0, 0, 32, 32, 64, 64, 64])
+
+  @parameterized.parameters(((2, 4), 0.75), ((4, 4), 0.5), ((8, 4), 0.75))
+  def test_linear_block_sparse_inference(self, block_shape, prune_rate):
+    train_vars, compressed_vars = self._check_compressed_inference(
+        SparsityType.UNSTRUCTURED, prune_rate, block_shape=block_shape
+    )
+    mask = np.array(
+        train_vars['non_trainable']['w' + base_layer.SPARSITY_NAME_POSTFIX])
+    # Whole blocks are pruned.
+    blocks = mask.reshape(
+        16 // block_shape[0], block_shape[0], 24 // block_shape[1],
+        block_shape[1])
+    self.assertArraysEqual(blocks.all(axis=(1, 3)), blocks.any(axis=(1, 3)))
+    self.assertAllClose(np.mean(mask), 1.0 - prune_rate)
+    self.assertEqual(
+        compressed_vars['params']['w_block_values'].size,
+        int(round(16 * 24 * (1.0 - prune_rate))),
+    )
+
   def test_sparsity_hparams_asserts(self):
     with self.assertRaises(AssertionError):
       SparsityHParams(
@@ -123,6 +281,21 @@ class SparseLinearTest(test_utils.TestCase):
           mode=SparsityMode.INFERENCE,
       )
 
+    with self.assertRaises(AssertionError):
+      SparsityHParams(
+          sparsity_type=SparsityType.UNSTRUCTURED,
+          weight_params=WeightSparsityParams(prune_rate=0.5),
+          mode=SparsityMode.INFERENCE,
+          compressed_inference=True,
+      )
+
+    with self.assertRaises(AssertionError):
+      SparsityHParams(
+          sparsity_type=SparsityType.STRUCTURED_NM,
+          weight_params=WeightSparsityParams(prune_rate=(2, 4)),
+          schedule=PruningSchedule(end_step=10),
+      )
+
 
 class LinearLayersConsistencyTest(test_utils.TestCase):
   """Consistency check fo sparse linear and base Praxis linear layers.
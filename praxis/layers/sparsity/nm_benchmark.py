@@ -0,0 +1,103 @@
+# coding=utf-8
+# Copyright 2022 The Pax Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+r"""Benchmarks compressed N:M sparse inference of the sparse Linear layer.
+
+Compares the weight memory and latency of the dense INFERENCE weight with the
+compressed one (compressed_inference=True) storing only the kept values and
+their int8 indices.
+
+Example:
+  python -m praxis.layers.sparsity.nm_benchmark --num_tokens=1,16,256
+"""
+
+import time
+from typing import Sequence, Tuple
+
+from absl import app
+from absl import flags
+import jax
+from jax import numpy as jnp
+from praxis import base_layer
+from praxis import pax_fiddle
+from praxis.layers.sparsity import linears
+from praxis.layers.sparsity import sparsity_hparams
+
+instantiate = base_layer.instantiate
+SparsityHParams = sparsity_hparams.SparsityHParams
+SparsityMode = sparsity_hparams.SparsityMode
+WeightSparsityParams = sparsity_hparams.WeightSparsityParams
+
+_NUM_TOKENS = flags.DEFINE_list('num_tokens', ['1', '16', '256'],
+                                'Number of input tokens to benchmark.')
+_INPUT_DIMS = flags.DEFINE_integer('input_dims', 4096, 'Input dims.')
+_OUTPUT_DIMS = flags.DEFINE_integer('output_dims', 4096, 'Output dims.')
+_PRUNE_RATE = flags.DEFINE_list('prune_rate', ['2', '4'], 'N:M prune rate.')
+_BLOCK_SIZE = flags.DEFINE_integer(
+    'block_size', 256, 'Weight rows decompressed at a time.')
+_NUM_ITERS = flags.DEFINE_integer('num_iters', 20, 'Timed iterations.')
+
+
+def _time_linear(compressed_inference: bool,
+                 num_tokens: int) -> Tuple[float, int]:
+  """Returns the average wall time of one Linear call and the weight bytes."""
+  p = pax_fiddle.Config(
+      linears.Linear,
+      name='linear',
+      input_dims=_INPUT_DIMS.value,
+      output_dims=_OUTPUT_DIMS.value,
+      sparsity=SparsityHParams(
+          weight_params=WeightSparsityParams(
+              prune_rate=tuple(int(x) for x in _PRUNE_RATE.value)),
+          mode=SparsityMode.INFERENCE,
+          compressed_inference=compressed_inference,
+          compressed_block_size=_BLOCK_SIZE.value,
+      ),
+  )
+  layer = instantiate(p)
+  prng_key = jax.random.PRNGKey(1234)
+  inputs = jax.random.normal(prng_key, [num_tokens, _INPUT_DIMS.value],
+                             dtype=jnp.float32)
+  with base_layer.JaxContext.new_context():
+    initial_vars = layer.init(prng_key, inputs)
+  weight_bytes = sum(x.nbytes for x in jax.tree_util.tree_leaves(initial_vars))
+
+  @jax.jit
+  def _fprop(mdl_vars, inputs):
+    with base_layer.JaxContext.new_context():
+      return layer.apply(mdl_vars, inputs)
+
+  jax.block_until_ready(_fprop(initial_vars, inputs))
+  start = time.time()
+  for _ in range(_NUM_ITERS.value):
+    jax.block_until_ready(_fprop(initial_vars, inputs))
+  return (time.time() - start) / _NUM_ITERS.value, weight_bytes
+
+
+def main(argv: Sequence[str]) -> None:
+  del argv
+  print(f'{"tokens":>8} {"dense (ms)":>11} {"compressed (ms)":>16} '
+        f'{"dense (MiB)":>12} {"compressed (MiB)":>17}')
+  for num_tokens in _NUM_TOKENS.value:
+    num_tokens = int(num_tokens)
+    dense_time, dense_bytes = _time_linear(False, num_tokens)
+    compressed_time, compressed_bytes = _time_linear(True, num_tokens)
+    print(f'{num_tokens:>8} {dense_time * 1e3:>11.3f} '
+          f'{compressed_time * 1e3:>16.3f} {dense_bytes / 2**20:>12.2f} '
+          f'{compressed_bytes / 2**20:>17.2f}')
+
+
+if __name__ == '__main__':
+  app.run(main)
@@ -20,7 +20,7 @@ import enum
 import functools
 import math
 import typing
-from typing import Tuple, Union
+from typing import Optional, Tuple, Union
 
 from absl import logging
 from flax import linen as nn
@@ -318,3 +318,240 @@ def get_pruning_n_m_mask(inputs: jnp.ndarray, n: int, m: int) -> jnp.ndarray:
   return jax.vmap(lambda x, i: x.at[i].set(True))(mask, top_k_indices).reshape(
       inputs.shape
   )
+
+
+def compress_nm_sparse_weight(
+    inputs: jnp.ndarray, n: int, m: int
+) -> Tuple[jnp.ndarray, jnp.ndarray]:
+  """Compresses an N:M pruned weight into packed values and indices.
+
+  The N:M groups are the blocks of M consecutive values along the last axis, as
+  in `get_pruning_n_m_mask`. The M - N kept values of each group are stored
+  with their int8 position in the group, in increasing order.
+
+  Args:
+    inputs: Weight of shape [..., K] to compress; K must be divisible by m.
+      Values pruned by `get_pruning_n_m_mask(inputs, n, m)` are dropped.
+    n: Number of pruned values in each block.
+    m: Number of values in each block.
+
+  Returns:
+    A tuple (values, indices), both of shape [..., K // m, m - n].
+  """
+  if inputs.shape[-1] % m != 0:
+    raise ValueError(
+        f'Last dimension {inputs.shape[-1]} must be divisible by m={m}.')
+  mask = get_pruning_n_m_mask(inputs, n=n, m=m)
+  groups = jnp.reshape(inputs, inputs.shape[:-1] + (-1, m))
+  mask = jnp.reshape(mask, groups.shape)
+  # A stable sort of the pruned flags lists the kept positions first, in order.
+  indices = jnp.argsort(~mask, axis=-1, kind='stable')[..., :m - n]
+  values = jnp.take_along_axis(
+      jnp.where(mask, groups, jnp.zeros_like(groups)), indices, axis=-1)
+  return values, indices.astype(jnp.int8)
+
+
+def decompress_nm_sparse_weight(
+    values: jnp.ndarray, indices: jnp.ndarray, m: int
+) -> jnp.ndarray:
+  """Inverse of `compress_nm_sparse_weight`, returns the dense weight."""
+  positions = jnp.arange(m, dtype=indices.dtype)
+  dense = jnp.sum(
+      jnp.where(indices[..., jnp.newaxis] == positions, values[..., jnp.newaxis],
+                jnp.zeros_like(values[..., jnp.newaxis])),
+      axis=-2)
+  return jnp.reshape(dense, dense.shape[:-2] + (-1,))
+
+
+def nm_sparse_matmul(
+    inputs: jnp.ndarray,
+    values: jnp.ndarray,
+    indices: jnp.ndarray,
+    m: int,
+    block_size: int = 256,
+) -> jnp.ndarray:
+  """Multiplies inputs with a weight compressed by `compress_nm_sparse_weight`.
+
+  Only `block_size` rows of the weight are decompressed at a time, inside a
+  scan over the contraction dimension, so the dense [K, N] weight is never
+  materialized.
+
+  Args:
+    inputs: JTensor of shape [..., K].
+    values: Packed weight values of shape [K, N // m, m - n].
+    indices: int8 positions of the values of shape [K, N // m, m - n].
+    m: Number of values in each N:M block.
+    block_size: Number of weight rows decompressed at a time. Must divide K.
+
+  Returns:
+    JTensor of shape [..., N], the product of inputs and the dense weight.
+  """
+  k = values.shape[0]
+  block_size = min(block_size, k)
+  if k % block_size != 0:
+    raise ValueError(f'block_size={block_size} must divide K={k}.')
+  batch_shape = inputs.shape[:-1]
+  # [K / block_size, B, block_size]
+  x = jnp.reshape(inputs, (-1, k // block_size, block_size)).transpose(1, 0, 2)
+  values = jnp.reshape(values, (k // block_size, block_size) + values.shape[1:])
+  indices = jnp.reshape(indices,
+                        (k // block_size, block_size) + indices.shape[1:])
+
+  def _block(out, xs):
+    x_block, values_block, indices_block = xs
+    w_block = decompress_nm_sparse_weight(values_block, indices_block, m)
+    return out + jnp.einsum('bk,kn->bn', x_block, w_block), None
+
+  num_outputs = values.shape[2] * m
+  out_dtype = jnp.result_type(inputs.dtype, values.dtype)
+  out, _ = jax.lax.scan(
+      _block, jnp.zeros([x.shape[1], num_outputs], out_dtype),
+      (x, values, indices))
+  return jnp.reshape(out, batch_shape + (num_outputs,))
+
+
+def get_scheduled_prune_rate(
+    step: jnp.ndarray,
+    prune_rate: float,
+    start_step: int,
+    end_step: int,
+    exponent: float = 3.0,
+) -> jnp.ndarray:
+  """Returns the gradual pruning rate at `step`.
+
+  Follows https://arxiv.org/abs/1710.01878: the rate ramps from 0 at
+  `start_step` to `prune_rate` at `end_step` as
+  `prune_rate * (1 - (1 - progress) ** exponent)`.
+
+  Args:
+    step: Scalar integer step.
+    prune_rate: Final fraction of pruned values.
+    start_step: Step at which pruning starts.
+    end_step: Step at which `prune_rate` is reached.
+    exponent: Exponent of the ramp, larger values prune faster early on.
+
+  Returns:
+    A float32 scalar prune rate.
+  """
+  progress = jnp.clip(
+      (step - start_step) / max(end_step - start_step, 1), 0.0, 1.0
+  ).astype(jnp.float32)
+  return prune_rate * (1.0 - (1.0 - progress) ** exponent)
+
+
+def _block_scores(
+    inputs: jnp.ndarray, block_shape: Tuple[int, int]
+) -> jnp.ndarray:
+  """Returns the mean magnitude of each [rows, cols] block of a 2D array."""
+  rows, cols = inputs.shape
+  block_rows, block_cols = block_shape
+  if rows % block_rows != 0 or cols % block_cols != 0:
+    raise ValueError(
+        f'Block shape {block_shape} must divide inputs shape {inputs.shape}.')
+  blocks = jnp.reshape(
+      jnp.abs(inputs),
+      (rows // block_rows, block_rows, cols // block_cols, block_cols))
+  return jnp.mean(blocks, axis=(1, 3))
+
+
+def get_pruning_unstructured_mask(
+    inputs: jnp.ndarray,
+    prune_rate: Union[float, jnp.ndarray],
+    block_shape: Optional[Tuple[int, int]] = None,
+) -> jnp.ndarray:
+  """Returns a mask for unstructured magnitude pruning.
+
+  Exactly `round(prune_rate * size)` values (or blocks) with the smallest
+  magnitude are pruned, ties are broken by position. `prune_rate` may be traced,
+  e.g. when it follows `get_scheduled_prune_rate`.
+
+  Args:
+    inputs: Input array for which the pruning mask is computed.
+    prune_rate: Fraction of values to prune.
+    block_shape: If set, `inputs` must be 2D and its [rows, cols] blocks are
+      pruned as a whole, ranked by their mean magnitude.
+
+  Returns:
+    A mask that indicates the kept locations (`1`: no pruning, `0`: pruned).
+  """
+  if block_shape is None:
+    scores = jnp.abs(inputs)
+  else:
+    scores = _block_scores(inputs, block_shape)
+  num_pruned = jnp.round(prune_rate * scores.size)
+  ranks = jnp.argsort(jnp.argsort(jnp.ravel(scores), kind='stable'))
+  mask = jnp.reshape(ranks >= num_pruned, scores.shape)
+  if block_shape is not None:
+    mask = jnp.repeat(jnp.repeat(mask, block_shape[0], axis=0), block_shape[1],
+                      axis=1)
+  return mask
+
+
+def num_unpruned_blocks(
+    shape: Tuple[int, int], block_shape: Tuple[int, int], prune_rate: float
+) -> int:
+  """Number of blocks kept by `get_pruning_unstructured_mask`."""
+  num_blocks = (shape[0] // block_shape[0]) * (shape[1] // block_shape[1])
+  return num_blocks - int(round(prune_rate * num_blocks))
+
+
+def compress_block_sparse_weight(
+    inputs: jnp.ndarray, block_shape: Tuple[int, int], num_blocks: int
+) -> Tuple[jnp.ndarray, jnp.ndarray, jnp.ndarray]:
+  """Compresses a block pruned [K, N] weight into its non-zero blocks.
+
+  Args:
+    inputs: Pruned weight of shape [K, N].
+    block_shape: The [rows, cols] shape of the blocks, must divide [K, N].
+    num_blocks: Number of blocks to keep, the ones with the largest mean
+      magnitude.
+
+  Returns:
+    A tuple (values, rows, cols): the blocks of shape [num_blocks, *block_shape]
+    in row major order, and their int32 block row and column indices of shape
+    [num_blocks].
+  """
+  scores = _block_scores(inputs, block_shape)
+  _, indices = jax.lax.top_k(jnp.ravel(scores), k=num_blocks)
+  indices = jnp.sort(indices)
+  num_col_blocks = scores.shape[1]
+  rows = (indices // num_col_blocks).astype(jnp.int32)
+  cols = (indices % num_col_blocks).astype(jnp.int32)
+  blocks = jnp.reshape(
+      inputs,
+      (scores.shape[0], block_shape[0], num_col_blocks, block_shape[1]),
+  ).transpose(0, 2, 1, 3)
+  return blocks[rows, cols], rows, cols
+
+
+def block_sparse_matmul(
+    inputs: jnp.ndarray,
+    values: jnp.ndarray,
+    rows: jnp.ndarray,
+    cols: jnp.ndarray,
+    output_dims: int,
+) -> jnp.ndarray:
+  """Multiplies inputs with a weight compressed by `compress_block_sparse_weight`.
+
+  Only the stored blocks are multiplied, so the FLOPs scale with the number of
+  non-zero blocks rather than with the dense weight size.
+
+  Args:
+    inputs: JTensor of shape [..., K].
+    values: Weight blocks of shape [num_blocks, block_rows, block_cols].
+    rows: int32 block row indices of shape [num_blocks].
+    cols: int32 block column indices of shape [num_blocks].
+    output_dims: N, the number of columns of the dense weight.
+
+  Returns:
+    JTensor of shape [..., N], the product of inputs and the dense weight.
+  """
+  _, block_rows, block_cols = values.shape
+  batch_shape = inputs.shape[:-1]
+  x = jnp.reshape(inputs, (-1, inputs.shape[-1] // block_rows, block_rows))
+  partial = jnp.einsum('bjk,jkn->bjn', x[:, rows], values)
+  out_dtype = jnp.result_type(inputs.dtype, values.dtype)
+  out = jnp.zeros(
+      [x.shape[0], output_dims // block_cols, block_cols], out_dtype
+  ).at[:, cols].add(partial.astype(out_dtype))
+  return jnp.reshape(out, batch_shape + (output_dims,))
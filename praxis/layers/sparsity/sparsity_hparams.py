@@ -62,18 +62,79 @@ class WeightSparsityParams:
   prune_rate: Union[None, float, Tuple[int, int]]
 
 
+@dataclasses.dataclass
+class PruningSchedule:
+  """Gradual pruning schedule for unstructured sparsity.
+
+  The prune rate ramps from 0 at `start_step` to `prune_rate` at `end_step`
+  following https://arxiv.org/abs/1710.01878, and the mask is recomputed every
+  `update_freq` steps in between. The mask is frozen after `end_step`. The steps
+  count the training forward passes of the pruned layer, see
+  `sparsity.linears.Linear._unstructured_mask`.
+
+  start_step: Step at which pruning starts.
+  end_step: Step at which the target prune rate is reached.
+  update_freq: Number of steps between two mask updates.
+  exponent: Exponent of the ramp, larger values prune faster early on.
+  """
+
+  start_step: int = 0
+  end_step: int = 0
+  update_freq: int = 1
+  exponent: float = 3.0
+
+
 class SparsityHParams(base_hyperparams.BaseHyperParams):
   """Collection of hyper-parameters for sparsity.
 
   Attributes:
     sparsity_type: Defines sparsity types.
+    compressed_inference: If True, INFERENCE mode stores N:M sparse weights as
+      packed non-zero values and their indices within each group instead of a
+      dense weight. See `sparsity.compress_nm_sparse_weight`. With unstructured
+      `block_shape` sparsity, only the non-zero blocks and their block indices
+      are stored instead. See `sparsity.compress_block_sparse_weight`.
+    compressed_block_size: Number of weight rows decompressed at a time by the
+      compressed N:M inference kernel.
+    schedule: Unstructured sparsity only, the gradual pruning schedule. If None,
+      the target prune rate is applied from the first step.
+    block_shape: Unstructured sparsity only, if set [rows, cols] blocks of the
+      weight are pruned as a whole, ranked by their mean magnitude.
   """
 
   sparsity_type: SparsityType = SparsityType.STRUCTURED_NM
   weight_params: Optional[WeightSparsityParams] = None
   mode: SparsityMode = SparsityMode.INFERENCE
+  compressed_inference: bool = False
+  compressed_block_size: int = 256
+  schedule: Optional[PruningSchedule] = None
+  block_shape: Optional[Tuple[int, int]] = None
 
   def __post_init__(self):
+    if self.compressed_inference:
+      assert self.weight_params is not None and (
+          (
+              self.sparsity_type == SparsityType.STRUCTURED_NM
+              and isinstance(self.weight_params.prune_rate, Tuple)
+          )
+          or (
+              self.sparsity_type == SparsityType.UNSTRUCTURED
+              and isinstance(self.weight_params.prune_rate, float)
+              and self.block_shape is not None
+          )
+      ), (
+          'Compressed inference requires N:M structured sparsity or block '
+          'unstructured sparsity.'
+      )
+    if self.schedule is not None or self.block_shape is not None:
+      assert self.sparsity_type == SparsityType.UNSTRUCTURED, (
+          'Pruning schedule and block shape require unstructured sparsity.'
+      )
+    if self.schedule is not None:
+      assert 0 <= self.schedule.start_step <= self.schedule.end_step, (
+          'Invalid pruning schedule steps.'
+      )
+      assert self.schedule.update_freq > 0, 'update_freq must be positive.'
     if self.weight_params is not None:
       if self.weight_params.prune_rate is not None:
         if self.sparsity_type == SparsityType.STRUCTURED_NM:
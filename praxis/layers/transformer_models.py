@@ -619,6 +619,15 @@ class TransformerLm(base_layer.BaseLayer):
       inputs = input_emb
     return inputs
 
+  def _uses_implicit_attention_mask(self) -> bool:
+    """Whether the transformer stack builds an implicit self attention mask."""
+    xformer_params = self.stacked_transformer_tpl
+    if xformer_params.cls == transformers.PipelinedTransformer:
+      return False
+    if issubclass(xformer_params.cls, transformers.StackedTransformerRepeated):
+      xformer_params = xformer_params.block
+    return xformer_params.use_implicit_attention_mask
+
   def __call__(self,
                inputs: JTensor,
                paddings: JTensor,
@@ -679,17 +688,27 @@ class TransformerLm(base_layer.BaseLayer):
     inputs = self._prepare_input(inputs, paddings, segment_pos=segment_pos,
                                  **input_kwargs)
 
-    if segment_mask is None:
-      if self.model_type == LanguageModelType.BIDIRECTIONAL:
-        segment_mask = attentions.segment_mask(segment_ids, segment_ids,
-                                               inputs.dtype)
-      else:
-        segment_mask = attentions.causal_segment_mask(segment_ids, inputs.dtype,
-                                                      causal_attention_mask)
+    if (
+        segment_mask is None
+        and causal_attention_mask is None
+        and self.model_type != LanguageModelType.PREFIX
+        and self._uses_implicit_attention_mask()
+    ):
+      # The transformer stack builds the mask from the segment ids on the fly.
+      transformer_kwargs = dict(segment_ids=segment_ids)
+    else:
+      if segment_mask is None:
+        if self.model_type == LanguageModelType.BIDIRECTIONAL:
+          segment_mask = attentions.segment_mask(segment_ids, segment_ids,
+                                                 inputs.dtype)
+        else:
+          segment_mask = attentions.causal_segment_mask(
+              segment_ids, inputs.dtype, causal_attention_mask)
+      transformer_kwargs = dict(segment_mask=segment_mask)
 
     self.update_decode_state('time_step', start_time_step)  # pytype: disable=wrong-arg-types  # jax-ndarray
     output = self.transformer(
-        inputs, paddings, segment_mask=segment_mask, segment_pos=segment_pos)
+        inputs, paddings, segment_pos=segment_pos, **transformer_kwargs)
 
     # Final layer norm
     if self.final_ln_tpl is not None:
@@ -15,6 +15,7 @@
 
 """Tests for Praxis transformer layers."""
 
+import copy
 import itertools
 
 from absl import logging
@@ -185,6 +186,55 @@ class TransformerModelsTest(test_utils.TestCase):
         # check that logits at position i are changed
         self.assertNotAllClose(logits[:, i], new_logits[:, i])
 
+  @parameterized.parameters(
+      transformer_models.LanguageModelType.CAUSAL,
+      transformer_models.LanguageModelType.BIDIRECTIONAL,
+  )
+  def test_lm_implicit_attention_mask(self, model_type):
+    vocab_size = 8
+    num_heads = 2
+    dim_per_head = 4
+    p = pax_fiddle.Config(
+        transformer_models.TransformerLm,
+        name='jax_lm_layer',
+        model_dims=num_heads * dim_per_head,
+        model_type=model_type,
+        packed_input=True,
+        vocab_size=vocab_size,
+    )
+    stacked_transformer_tpl = p.stacked_transformer_tpl
+    stacked_transformer_tpl.model_dims = num_heads * dim_per_head
+    stacked_transformer_tpl.hidden_dims = 2 * num_heads * dim_per_head
+    stacked_transformer_tpl.num_heads = num_heads
+    stacked_transformer_tpl.num_layers = 2
+    implicit_p = copy.deepcopy(p)
+    implicit_p.stacked_transformer_tpl.use_implicit_attention_mask = True
+    batch_size, seq_len = 3, 12
+    inputs = np.random.randint(vocab_size, size=(batch_size, seq_len))
+    paddings = np.zeros([batch_size, seq_len], np.float32)
+    paddings[:, 10:] = 1.0
+    segment_ids = np.array([[1] * 4 + [2] * 6 + [0] * 2] * batch_size)
+    segment_pos = np.array([list(range(4)) + list(range(6)) + [0] * 2] *
+                           batch_size)
+    labels = py_utils.NestedMap(
+        class_ids=inputs, class_weights=1.0 - paddings)
+
+    dense_lm = instantiate(p)
+    implicit_lm = instantiate(implicit_p)
+    with base_layer.JaxContext.new_context():
+      initial_vars = dense_lm.init(
+          jax.random.PRNGKey(seed=123), inputs, paddings, labels=labels,
+          segment_ids=segment_ids, segment_pos=segment_pos)
+      dense_outputs = dense_lm.apply(
+          initial_vars, inputs, paddings, labels=labels,
+          segment_ids=segment_ids, segment_pos=segment_pos)
+      implicit_outputs = implicit_lm.apply(
+          initial_vars, inputs, paddings, labels=labels,
+          segment_ids=segment_ids, segment_pos=segment_pos)
+
+    self.assertAllClose(dense_outputs.logits, implicit_outputs.logits)
+    self.assertAllClose(dense_outputs.total_loss, implicit_outputs.total_loss)
+
   @parameterized.parameters(*list(itertools.product([True, False], repeat=5)))
   def test_ngrammer_lm_extendstep(self, use_vq_ngrams, use_rotary_position_emb,
                                   use_post_attention_ngrammer,
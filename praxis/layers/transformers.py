@@ -17,9 +17,11 @@
 
 from __future__ import annotations
 
+import dataclasses
 from typing import Any, Optional, Sequence, Tuple, Union
 
 from absl import logging
+from flax.core import frozen_dict
 import jax
 from jax import numpy as jnp
 from jax.ad_checkpoint import checkpoint_name
@@ -47,6 +49,7 @@ LayerTpl = pax_fiddle.Config[base_layer.BaseLayer]
 
 JTensor = pytypes.JTensor
 NestedJTensor = pytypes.NestedJTensor
+PARAMS = base_layer.PARAMS
 
 SplitDimsMapping = pytypes.SplitDimsMapping
 AutodiffCheckpointType = checkpoint_policy.AutodiffCheckpointType
@@ -57,6 +60,40 @@ def _rms(x):
   return (x**2.).mean().astype(jnp.float32)**.5
 
 
+def _check_foldable_norm(norm_policy: str, ln_tpl: LayerTpl) -> None:
+  """Checks the norm can be folded into the following projections."""
+  if norm_policy != 'pre':
+    raise ValueError(
+        f'fold_norm_scale requires norm_policy=pre, got {norm_policy}'
+    )
+  if not issubclass(
+      ln_tpl.cls, (normalizations.LayerNorm, normalizations.RmsNorm)
+  ):
+    raise ValueError(
+        f'fold_norm_scale requires a LayerNorm or RmsNorm, got {ln_tpl.cls}'
+    )
+
+
+def _check_not_quantized(layer_tpl: LayerTpl) -> None:
+  """Checks the layer the norm is folded into is not quantized."""
+  if any(f.name == 'quantization' for f in dataclasses.fields(layer_tpl.cls)):
+    raise ValueError(
+        'fold_norm_scale does not support quantized layers, got '
+        f'{layer_tpl.cls}'
+    )
+
+
+def _check_foldable_fflayer(tr_fflayer_tpl: Optional[LayerTpl]) -> None:
+  """Checks the feedforward layer can fold the layer norm of the Transformer."""
+  if tr_fflayer_tpl is None or not issubclass(
+      tr_fflayer_tpl.cls, TransformerFeedForward
+  ):
+    raise ValueError(
+        'fold_norm_scale requires a TransformerFeedForward tr_fflayer_tpl, '
+        f'got {tr_fflayer_tpl.cls if tr_fflayer_tpl else None}'
+    )
+
+
 def _rel_cos(x, y):
   """Computes cosine similarity between residual x and layer output y."""
   xx = (x * x).sum(-1)
@@ -126,28 +163,100 @@ def compute_attention_masks_for_fprop(
     causal_mask = attentions.causal_mask(inputs)
     attention_mask = jnp.minimum(attention_mask, causal_mask)
 
-  # Compute cross attention mask if applicable
-  cross_attention_mask = None
-  if cross_inputs is not None:
-    assert cross_paddings is not None
+  cross_attention_mask = _compute_cross_attention_mask(
+      cross_inputs, cross_paddings, cross_segment_mask)
+  return attention_mask, cross_attention_mask
 
-    # Compute paddings
-    cross_attention_mask = attentions.convert_paddings_to_mask(
-        cross_paddings, dtype=cross_inputs.dtype)
 
-    # Packed inputs
-    if cross_segment_mask is not None:
-      cross_attention_mask = jnp.minimum(cross_attention_mask,
-                                         cross_segment_mask)
+def compute_implicit_attention_masks(
+    paddings: Optional[JTensor] = None,
+    causal_attention: Optional[bool] = False,
+    segment_ids: Optional[JTensor] = None,
+    cross_inputs: Optional[JTensor] = None,
+    cross_paddings: Optional[JTensor] = None,
+    cross_segment_mask: Optional[JTensor] = None,
+    fold_padding_with_segment_mask: Optional[bool] = False,
+    local_window: Optional[int] = None,
+) -> Tuple[attentions.ImplicitAttentionMask, Union[JTensor, None]]:
+  """Same as compute_attention_masks_for_fprop with an implicit self mask.
+
+  Args:
+    paddings: Input paddings JTensor of shape [B, T] (optional). Note that one
+      of paddings or segment_ids must be provided.
+    causal_attention: Boolean to apply causal masking (optional).
+    segment_ids: Segment ids JTensor for packed input of shape [B, T]
+      (optional).
+    cross_inputs: Output JTensor of the encoder, to be used for cross attention,
+      of shape [B, S, H].
+    cross_paddings: Paddings JTensor for cross atention of shape [B, S].
+    cross_segment_mask: Segment mask JTensor for encoder-decoder in packed input
+      case of shape [B, 1, T, S].
+    fold_padding_with_segment_mask: If True then segment ids are supposed to
+      include the padding as well, i.e. treating PADs as one sequence and
+      non-PADs as another.
+    local_window: If not None, tokens only attend to tokens less than this many
+      positions away.
+
+  Returns:
+    attention_mask: An attentions.ImplicitAttentionMask for self attention.
+    cross_attention_mask: Attention mask ready to add to logits for cross
+      attention of shape [1|B, 1, 1|T, S]. This will be None if cross_inputs
+      are None.
+  """
+  if fold_padding_with_segment_mask:
+    assert segment_ids is not None
+    paddings = None
+  else:
+    assert paddings is not None
+  attention_mask = attentions.ImplicitAttentionMask(
+      paddings=paddings,
+      segment_ids=segment_ids,
+      causal=bool(causal_attention),
+      local_window=local_window,
+  )
+  cross_attention_mask = _compute_cross_attention_mask(
+      cross_inputs, cross_paddings, cross_segment_mask)
   return attention_mask, cross_attention_mask
 
 
+def _compute_cross_attention_mask(
+    cross_inputs: Optional[JTensor],
+    cross_paddings: Optional[JTensor],
+    cross_segment_mask: Optional[JTensor]) -> Union[JTensor, None]:
+  """Computes the cross attention mask if cross_inputs are given."""
+  if cross_inputs is None:
+    return None
+  assert cross_paddings is not None
+
+  # Compute paddings
+  cross_attention_mask = attentions.convert_paddings_to_mask(
+      cross_paddings, dtype=cross_inputs.dtype)
+
+  # Packed inputs
+  if cross_segment_mask is not None:
+    cross_attention_mask = jnp.minimum(cross_attention_mask,
+                                       cross_segment_mask)
+  return cross_attention_mask
+
+
+def _local_window_padding(
+    time_step: JTensor, seq_len: int, local_window: int
+) -> JTensor:
+  """Returns the [1, T] paddings out of the local window of time_step."""
+  # Compared in int32, as time_step - local_window may be negative.
+  return jnp.less_equal(
+      jnp.arange(seq_len)[jnp.newaxis, :] + local_window,
+      jnp.asarray(time_step, dtype=jnp.int32),
+  )
+
+
 def compute_attention_masks_for_extend_step(
     time_step: JTensor,
     seq_len: int,
     segment_mask: Optional[JTensor] = None,
     cross_paddings: Optional[JTensor] = None,
-    cross_segment_mask: Optional[JTensor] = None
+    cross_segment_mask: Optional[JTensor] = None,
+    local_window: Optional[int] = None,
 ) -> Tuple[JTensor, Union[JTensor, None]]:
   """Computes attention mask from paddings, segment masks etc for extend_step.
 
@@ -159,6 +268,8 @@ def compute_attention_masks_for_extend_step(
     cross_paddings: Source paddings JTensor of shape [B, S].
     cross_segment_mask: if not None, cross_segment_mask JTensor for this time
       step, of shape [B, 1, S].
+    local_window: If not None, also masks the steps `local_window` or more
+      positions before time_step.
 
   Returns:
     attention_mask: Attention mask JTensor ready to add to logits for self
@@ -175,6 +286,10 @@ def compute_attention_masks_for_extend_step(
   # [1, T], 0 for non-pad and 1 for pad.
   causal_padding = jnp.greater(
       jnp.expand_dims(jnp.arange(seq_len), 0), batch_time_step)
+  if local_window is not None:
+    causal_padding = jnp.logical_or(
+        causal_padding, _local_window_padding(time_step, seq_len, local_window)
+    )
 
   # Create attention mask from padding of shape [1|B, 1, T]
   attention_mask = jnp.squeeze(
@@ -276,6 +391,10 @@ class TransformerFeedForward(base_layer.BaseLayer):
       transformation, (4) "post_skip", applied after the skip connection.
     internal_gshard_variance_scaling_fan_in_init: Feedforward weight init
       follows uniform distribution withbound = 1.0 / sqrt(3 / dim_0).
+    fold_norm_scale: If True, the scale and bias of the layer norm are folded
+      into the first feedforward layer(s) by `fold_norm_scale_vars` and only
+      the normalizing factor is applied at runtime, to the projected
+      activations. Requires norm_policy='pre' and a LayerNorm or RmsNorm.
   """
   input_dims: int = 0
   output_dims: int = 0
@@ -297,6 +416,7 @@ class TransformerFeedForward(base_layer.BaseLayer):
   residual_droppath_prob: float = 0.0
   norm_policy: str = 'pre'
   internal_gshard_variance_scaling_fan_in_init: bool = False
+  fold_norm_scale: bool = False
 
   class WeightSharding(base_layer.BaseLayer.WeightSharding):
     """Represents how layer's learned parameters are partitioned across a mesh.
@@ -346,6 +466,10 @@ class TransformerFeedForward(base_layer.BaseLayer):
       self.create_child('layer_norm', ln_p)
     else:
       raise ValueError('Unrecognized norm_policy: %s' % self.norm_policy)
+    if self.fold_norm_scale:
+      _check_foldable_norm(self.norm_policy, self.ln_tpl)
+      _check_not_quantized(self.fflayer_tpl)
+      _check_not_quantized(self.fflayer_tpl.linear_tpl)
 
     self._is_ffn1_gated = self.use_gated_activation
     if self._is_ffn1_gated:
@@ -431,22 +555,37 @@ class TransformerFeedForward(base_layer.BaseLayer):
     self.add_summary('input_rms', _rms(inputs), verbosity=4)
     residual = inputs
 
+    normalizing_factor = None
     if self.norm_policy == 'primer_hybrid':
       inputs = self.pre_layer_norm(inputs)
+    elif self.norm_policy == 'pre' and self.fold_norm_scale:
+      # The norm is applied by the first FFN layer(s).
+      inputs = self.layer_norm.fused_projection_inputs(inputs)
+      normalizing_factor = normalizations.rms_normalizing_factor(
+          inputs, self.layer_norm.epsilon
+      ).astype(inputs.dtype)
     elif self.norm_policy == 'pre':
       inputs = self.layer_norm(inputs)
 
-    if self.norm_policy in ('primer_hybrid', 'pre'):
+    if self.norm_policy == 'primer_hybrid' or (
+        self.norm_policy == 'pre' and not self.fold_norm_scale
+    ):
       self.add_summary('input_norm_rms', _rms(inputs), verbosity=4)
 
     # Apply first FFN layer
     if self._is_ffn1_gated:
       # theta.ffn_layer1_gate corresponds to gshard_builder's wi0
-      gate_value = self.ffn_layer1_gate(inputs)
+      gate_value = self._ffn_layer1(
+          self.ffn_layer1_gate, inputs, normalizing_factor
+      )
       # theta.ffn_layer1 corresponds to gshard_builder's wi1
-      activations = gate_value * self.ffn_layer1(inputs)
+      activations = gate_value * self._ffn_layer1(
+          self.ffn_layer1, inputs, normalizing_factor
+      )
     else:
-      activations = self.ffn_layer1(inputs)
+      activations = self._ffn_layer1(
+          self.ffn_layer1, inputs, normalizing_factor
+      )
       activations = checkpoint_name(activations, 'ffn1')
 
     # Apply paddings if not None
@@ -503,6 +642,54 @@ class TransformerFeedForward(base_layer.BaseLayer):
     del time_step  # Not used.
     return self.__call__(inputs)
 
+  def _ffn_layer1(
+      self,
+      layer: linears.FeedForward,
+      inputs: JTensor,
+      normalizing_factor: Optional[JTensor],
+  ) -> JTensor:
+    """Applies a first FFN layer, with the folded norm if any."""
+    if normalizing_factor is None:
+      return layer(inputs)
+    projected_inputs = layer.linear(inputs) * normalizing_factor
+    if layer.has_bias:
+      projected_inputs = layer.bias(projected_inputs)
+    return layer.activation(projected_inputs)
+
+  def fold_norm_scale_vars(self) -> NestedJTensor:
+    """Returns the variables with the layer norm folded into the FFN layer(s).
+
+    The scale and bias of the layer norm are folded into the weights and biases
+    of the first FFN layer(s) and reset to the identity, to be used with
+    fold_norm_scale=True. Typically called once when loading the model for
+    serving.
+    """
+    _check_foldable_norm(self.norm_policy, self.ln_tpl)
+    _check_not_quantized(self.fflayer_tpl)
+    _check_not_quantized(self.fflayer_tpl.linear_tpl)
+    scale, bias = self.layer_norm.scale_and_bias()
+    params = frozen_dict.unfreeze(self.variables[PARAMS])
+    params['layer_norm'] = self.layer_norm.folded_vars()
+    names = ['ffn_layer1']
+    if self._is_ffn1_gated:
+      names.append('ffn_layer1_gate')
+    for name in names:
+      layer = getattr(self, name)
+      w = layer.linear.theta.w
+      w_f32 = w.astype(jnp.float32)
+      if scale is not None:
+        params[name]['linear']['w'] = (
+            w_f32 * scale.astype(jnp.float32)[:, jnp.newaxis]
+        ).astype(w.dtype)
+      if bias is not None:
+        if not layer.has_bias:
+          raise ValueError('Folding a norm bias requires has_bias=True.')
+        b = layer.bias.theta.b
+        params[name]['bias']['b'] = (
+            b.astype(jnp.float32) + bias.astype(jnp.float32) @ w_f32
+        ).astype(b.dtype)
+    return params
+
 
 class TransformerFeedForwardMoe(base_layer.BaseLayer):
   """A sharded MoE Layer.
@@ -583,6 +770,19 @@ class TransformerFeedForwardMoe(base_layer.BaseLayer):
           calculated by taking the average token representation, to route.
     use_gated_activation: Boolean indicating whether to use a gated activation
       function for the input projection layer or not.
+    dispatch_mode: How tokens are dispatched to and combined from experts. Only
+      used by 'top2' gating. Options are:
+      (1) "einsum" -> Einsums with the one-hot G`SEC dispatch and combine
+          tensors.
+      (2) "sort" -> Tokens are sorted by expert and gathered/scattered into
+          the expert capacity slots, avoiding the O(S*E*C) tensors. Capacity
+          dropping is the same as for "einsum".
+    sparse_decode: If True, extend_step routes each token to its top-2 experts
+      without capacity limits and only computes the selected experts, by
+      gathering their weights per token. This avoids spending most of the
+      expert FLOPs on capacity padding when decoding a few tokens per step.
+      The second expert is always picked greedily. Only supported by 'top2'
+      and 'dense_top2' gating with token level gating embeddings.
   """
   input_dims: int = 0
   hidden_dims: int = 0
@@ -613,6 +813,8 @@ class TransformerFeedForwardMoe(base_layer.BaseLayer):
   gating_logit_cap: float = 0.0
   moe_gating_embedding_level: str = 'token'
   use_gated_activation: bool = False
+  dispatch_mode: str = 'einsum'
+  sparse_decode: bool = False
 
   # SPMD partition related params.
   # M - model_dim, for both inputs and outputs
@@ -670,6 +872,21 @@ class TransformerFeedForwardMoe(base_layer.BaseLayer):
     assert (
         self.expert_weight_shards == 1
     ), f'[Deprecated] Should be removed {self.expert_weight_shards} != 1'
+    if self.dispatch_mode not in ('einsum', 'sort'):
+      raise ValueError(f'Unsupported dispatch_mode: {self.dispatch_mode}')
+    if self.dispatch_mode == 'sort' and self.gating_func != 'top2':
+      raise ValueError(
+          'dispatch_mode="sort" is only supported by top2 gating, got: '
+          f'{self.gating_func}')
+    if self.sparse_decode:
+      if self.gating_func not in ('top2', 'dense_top2'):
+        raise ValueError(
+            'sparse_decode is only supported by top2 and dense_top2 gating, '
+            f'got: {self.gating_func}')
+      if self.moe_gating_embedding_level != 'token':
+        raise ValueError(
+            'sparse_decode requires token level gating embeddings, got: '
+            f'{self.moe_gating_embedding_level}')
 
     if self.norm_policy == 'primer_hybrid':
       params = self.ln_tpl.clone()
@@ -783,7 +1000,15 @@ class TransformerFeedForwardMoe(base_layer.BaseLayer):
     """Get the expert weights."""
     return self.theta['wi_0'], self.theta['wo_0']
 
-  def _count_dead_neurons(self, hidden, dispatch_tensor):
+  def _count_dead_neurons(self, hidden, nonpadding_indicator):
+    """Adds a summary of the number of dead neurons.
+
+    Args:
+      hidden: EGCH tensor, the hidden activations before the activation
+        function.
+      nonpadding_indicator: EC tensor, the number of tokens dispatched to each
+        expert capacity slot across all groups.
+    """
     threshold = 0
     activation_class_name = self.activation_tpl.cls.__name__
     if isinstance(self.activation_tpl.cls, activations_lib.GELU):
@@ -793,7 +1018,6 @@ class TransformerFeedForwardMoe(base_layer.BaseLayer):
       )
       threshold = -3.0
 
-    nonpadding_indicator = jnp.einsum('gsec->ec', dispatch_tensor)
     nonpadding_indicator = nonpadding_indicator[:, jnp.newaxis, :, jnp.newaxis]
     padding_indicator = 1 - nonpadding_indicator
     hidden_minus_ten_padding_indicator = hidden - 10 * padding_indicator
@@ -863,10 +1087,6 @@ class TransformerFeedForwardMoe(base_layer.BaseLayer):
     output_dims = self.input_dims
     assert self.gating_func != 'dense_top2'
 
-    theta_wi, theta_wo = self.theta['wi_0'], self.theta['wo_0']
-    if self._is_ffn1_gated:
-      theta_wi_gated = self.theta['wi_gate_0']
-
     token_shape = inputs.shape[:-1]
     num_tokens = np.prod(token_shape)
     m_dim = inputs.shape[-1]
@@ -943,8 +1163,13 @@ class TransformerFeedForwardMoe(base_layer.BaseLayer):
         capacity_factor=self.unadjusted_expert_capacity_factor,
         mask_dtype=jnp.int32,
         gating_logit_cap=self.gating_logit_cap,
+        sparse_dispatch=self.dispatch_mode == 'sort',
     )
 
+    if self.dispatch_mode == 'sort':
+      return self._sort_dispatch_and_combine_expert_outputs(
+          reshaped_inputs, gating, token_shape)
+
     if self.gating_func == 'top2':
       aux_loss, combine_tensor, dispatch_tensor, summary = gating
       over_capacity_1_ratio, over_capacity_2_ratio = summary
@@ -971,18 +1196,52 @@ class TransformerFeedForwardMoe(base_layer.BaseLayer):
       raise ValueError('Unsupported gating function: %s ' % self.gating_func)
     expert_inputs = self._split(expert_inputs, ap.egcm)
 
+    if self.gating_func in ['top2', 'expert_choice_v2']:
+      nonpadding_indicator = jnp.einsum('gsec->ec', dispatch_tensor)
+    else:
+      nonpadding_indicator = None
+    transposed_expert_output = self._expert_ffn(expert_inputs,
+                                                nonpadding_indicator)
+    if self.gating_func in ['top2', 'expert_choice_v2']:
+      combined_output = jnp.einsum('gecm,gsec->gsm', transposed_expert_output,
+                                   combine_tensor)
+    elif self.gating_func == 'expert_choice':
+      combined_output = jnp.einsum('gecm,gecs,gec->gsm',
+                                   transposed_expert_output, dispatch_tensor,
+                                   combine_tensor)
+    else:
+      raise ValueError('Unsupported gating function: %s ' % self.gating_func)
+    combined_output = self._split(combined_output, ap.gsm)
+
+    combined_output = combined_output.reshape(token_shape + (output_dims,))
+    return combined_output, aux_loss
+
+  def _expert_ffn(self, expert_inputs, nonpadding_indicator):
+    """Applies the expert feed-forward layers to dispatched inputs.
+
+    Args:
+      expert_inputs: [e, g, c, m], the inputs dispatched to each expert slot.
+      nonpadding_indicator: Optional [e, c], the number of tokens in each
+        expert slot used to count dead neurons. Not counted if None.
+
+    Returns:
+      The expert outputs transposed to [g, e, c, m].
+    """
+    ap = self.activation_split_dims_mapping
+    theta_wi, theta_wo = self.theta['wi_0'], self.theta['wo_0']
     if self._is_ffn1_gated:
       hidden0 = jnp.einsum('egcm,emh->egch', expert_inputs, theta_wi)
-      hidden1 = jnp.einsum('egcm,emh->egch', expert_inputs, theta_wi_gated)
-      if self.gating_func in ['top2', 'expert_choice_v2']:
-        self._count_dead_neurons(hidden1, dispatch_tensor)
+      hidden1 = jnp.einsum('egcm,emh->egch', expert_inputs,
+                           self.theta['wi_gate_0'])
+      if nonpadding_indicator is not None:
+        self._count_dead_neurons(hidden1, nonpadding_indicator)
       hidden1 = self.activation(hidden1)
       hidden = hidden1 * hidden0
     else:
       hidden = jnp.einsum('egcm,emh->egch', expert_inputs, theta_wi)
       hidden = self._split(hidden, ap.egch)
-      if self.gating_func in ['top2', 'expert_choice_v2']:
-        self._count_dead_neurons(hidden, dispatch_tensor)
+      if nonpadding_indicator is not None:
+        self._count_dead_neurons(hidden, nonpadding_indicator)
       hidden = self.activation(hidden)
 
     # Dropout.
@@ -992,21 +1251,121 @@ class TransformerFeedForwardMoe(base_layer.BaseLayer):
     expert_output = self._split(expert_output, ap.egcm)
     # Now transpose and reshard.
     transposed_expert_output = jnp.einsum('egcm->gecm', expert_output)
-    transposed_expert_output = self._split(transposed_expert_output, ap.gecm)
-    if self.gating_func in ['top2', 'expert_choice_v2']:
-      combined_output = jnp.einsum('gecm,gsec->gsm', transposed_expert_output,
-                                   combine_tensor)
-    elif self.gating_func == 'expert_choice':
-      combined_output = jnp.einsum('gecm,gecs,gec->gsm',
-                                   transposed_expert_output, dispatch_tensor,
-                                   combine_tensor)
-    else:
-      raise ValueError('Unsupported gating function: %s ' % self.gating_func)
+    return self._split(transposed_expert_output, ap.gecm)
+
+  def _sort_dispatch_and_combine_expert_outputs(self, reshaped_inputs, gating,
+                                                token_shape):
+    """Dispatches and combines expert outputs by sorting tokens by expert."""
+    ap = self.activation_split_dims_mapping
+    num_experts = self.num_experts
+
+    aux_loss, sparse, summary = gating
+    over_capacity_1_ratio, over_capacity_2_ratio = summary
+    self.add_summary('over_capacity_1_ratio', over_capacity_1_ratio)
+    self.add_summary('over_capacity_2_ratio', over_capacity_2_ratio)
+
+    # [g, e, c, m]
+    dispatched, slot = gshard_utils.sort_based_dispatch(
+        reshaped_inputs, sparse, num_experts)
+    expert_inputs = jnp.einsum('gecm->egcm', dispatched)
+    expert_inputs = self._split(expert_inputs, ap.egcm)
+
+    capacity = sparse.expert_capacity_dim
+    # Number of tokens in each [e, c] slot across all groups.
+    nonpadding_indicator = jnp.zeros(
+        [num_experts * capacity], dtype=reshaped_inputs.dtype
+    ).at[slot.reshape([-1])].add(1, mode='drop')
+    nonpadding_indicator = nonpadding_indicator.reshape(
+        [num_experts, capacity])
+
+    transposed_expert_output = self._expert_ffn(expert_inputs,
+                                                nonpadding_indicator)
+    combined_output = gshard_utils.sort_based_combine(transposed_expert_output,
+                                                      sparse, slot)
     combined_output = self._split(combined_output, ap.gsm)
 
-    combined_output = combined_output.reshape(token_shape + (output_dims,))
+    combined_output = combined_output.reshape(token_shape +
+                                              (self.input_dims,))
     return combined_output, aux_loss
 
+  def _sparse_decode_expert_outputs(self, inputs):
+    """Computes the outputs of the top-2 experts of each token.
+
+    Unlike _dispatch_and_combine_expert_outputs, there is no capacity limit and
+    no capacity padding. When the number of selected (token, expert) pairs is
+    smaller than the number of experts, the weights of the selected experts are
+    gathered for each token, so only 2 experts are read and computed per token.
+    Otherwise gathering would read more weights than there are, so all experts
+    are computed densely and combined with the top-2 gates.
+
+    Args:
+      inputs: [..., model].
+
+    Returns:
+      A tuple (outputs, aux_loss), outputs has the same shape as inputs.
+    """
+    fprop_dtype = self.fprop_dtype
+    token_shape = inputs.shape[:-1]
+    m_dim = inputs.shape[-1]
+    # [t, m]
+    reshaped_inputs = inputs.reshape([-1, m_dim])
+
+    logits = jnp.einsum('tm,me->te', reshaped_inputs, self.theta.gate)
+    logits = logits.astype(jnp.float32)
+    if self.gating_func == 'top2' and self.gating_logit_cap > 0.0:
+      cap = jnp.array(self.gating_logit_cap, dtype=logits.dtype)
+      logits = cap * jnp.tanh(logits / cap)
+    raw_gates = jax.nn.softmax(logits, axis=-1)
+    # [t, k]
+    gates, expert_index = jax.lax.top_k(raw_gates, 2)
+    if self.gating_func == 'top2':
+      # Same renormalization as top2_gating_on_logits(legacy_mtf_behavior).
+      gates /= jnp.sum(gates, axis=-1, keepdims=True) + 1e-9
+    else:
+      gates /= jnp.sum(gates, axis=-1, keepdims=True) + 1e-12
+    gates = gates.astype(fprop_dtype)
+
+    num_tokens, top_k = expert_index.shape
+    if num_tokens * top_k >= self.num_experts:
+      # [t, e]
+      combine = jnp.einsum(
+          'tke,tk->te',
+          jax.nn.one_hot(expert_index, self.num_experts, dtype=fprop_dtype),
+          gates)
+      if self._is_ffn1_gated:
+        hidden0 = jnp.einsum('tm,emh->teh', reshaped_inputs,
+                             self.theta['wi_0'])
+        hidden1 = jnp.einsum('tm,emh->teh', reshaped_inputs,
+                             self.theta['wi_gate_0'])
+        hidden = self.activation(hidden1) * hidden0
+      else:
+        hidden = jnp.einsum('tm,emh->teh', reshaped_inputs, self.theta['wi_0'])
+        hidden = self.activation(hidden)
+      hidden = self.relu_dropout(hidden)
+      expert_output = jnp.einsum('teh,ehm->tem', hidden, self.theta['wo_0'])
+      combined_output = jnp.einsum('tem,te->tm', expert_output, combine)
+      combined_output = combined_output.reshape(token_shape + (m_dim,))
+      return combined_output, jnp.array(0.0)
+
+    # [t, k, m, h]
+    theta_wi = jnp.take(self.theta['wi_0'], expert_index, axis=0)
+    # [t, k, h, m]
+    theta_wo = jnp.take(self.theta['wo_0'], expert_index, axis=0)
+    if self._is_ffn1_gated:
+      theta_wi_gated = jnp.take(
+          self.theta['wi_gate_0'], expert_index, axis=0)
+      hidden0 = jnp.einsum('tm,tkmh->tkh', reshaped_inputs, theta_wi)
+      hidden1 = jnp.einsum('tm,tkmh->tkh', reshaped_inputs, theta_wi_gated)
+      hidden = self.activation(hidden1) * hidden0
+    else:
+      hidden = jnp.einsum('tm,tkmh->tkh', reshaped_inputs, theta_wi)
+      hidden = self.activation(hidden)
+    hidden = self.relu_dropout(hidden)
+    expert_output = jnp.einsum('tkh,tkhm->tkm', hidden, theta_wo)
+    combined_output = jnp.einsum('tkm,tk->tm', expert_output, gates)
+    combined_output = combined_output.reshape(token_shape + (m_dim,))
+    return combined_output, jnp.array(0.0)
+
   def __call__(self,  # pytype: disable=annotation-type-mismatch  # jax-ndarray
                inputs: JTensor,
                paddings: JTensor = None,
@@ -1022,6 +1381,14 @@ class TransformerFeedForwardMoe(base_layer.BaseLayer):
     Returns:
       Tensor of the same shape as inputs.
     """
+    return self._fprop(inputs, paddings, segment_ids, is_decode=False)
+
+  def _fprop(self,
+             inputs: JTensor,
+             paddings: Optional[JTensor],
+             segment_ids: Optional[JTensor],
+             is_decode: bool) -> JTensor:
+    """Implements __call__ and extend_step, see __call__ for the args."""
     # Assume output_dims == input_dims
     fprop_dtype = self.fprop_dtype
 
@@ -1043,7 +1410,9 @@ class TransformerFeedForwardMoe(base_layer.BaseLayer):
 
     assert len(inputs.shape) in [2, 3]
 
-    if self.gating_func == 'dense_top2':
+    if is_decode and self.sparse_decode:
+      outputs, aux_loss = self._sparse_decode_expert_outputs(inputs)
+    elif self.gating_func == 'dense_top2':
       outputs, aux_loss = self._combine_top2_expert_outputs(
           inputs, paddings, segment_ids)
     else:
@@ -1094,7 +1463,7 @@ class TransformerFeedForwardMoe(base_layer.BaseLayer):
                   time_step: JTensor) -> JTensor:
     """Fprop FFN extend step layer."""
     del time_step  # Not used.
-    return self.__call__(inputs)
+    return self._fprop(inputs, paddings=None, segment_ids=None, is_decode=True)
 
 
 class Transformer(base_layer.BaseLayer):
@@ -1136,6 +1505,13 @@ class Transformer(base_layer.BaseLayer):
     ngrammer_tpl: Params for the Ngrammer layer. This param must correspond to
       the VQNgrammer layer. If this is None, then there is no NGrammer layer
       present in this layer.
+    fold_norm_scale: If True, the scale and bias of the layer norms are folded
+      into the combined QKV projection and the first FFN layer(s) by
+      `fold_norm_scale_vars`, and only the normalizing factor is applied at
+      runtime, to the projected outputs. This saves the memory-bound norm ops
+      of each decode step. Requires norm_policy='pre', a LayerNorm or RmsNorm
+      ln_tpl, combine_qkv=True self-attention and a TransformerFeedForward
+      tr_fflayer_tpl, none of their projections being quantized.
   """
   input_dims: int = 0
   hidden_dims: int = 0
@@ -1155,6 +1531,7 @@ class Transformer(base_layer.BaseLayer):
   packed_input: bool = False
   tr_fflayer_tpl: LayerTpl = template_field(TransformerFeedForward)
   ngrammer_tpl: Optional[LayerTpl] = template_field(None)
+  fold_norm_scale: bool = False
 
   # This function can be overridden by subclasses.
   def _setup_attention(self, atten_tpl: LayerTpl, name: str)-> None:
@@ -1191,7 +1568,18 @@ class Transformer(base_layer.BaseLayer):
       raise ValueError('Unrecognized norm_policy: %s' % self.norm_policy)
 
     # Initialize multi-headed self-attention
-    self._setup_attention(self.tr_atten_tpl, 'self_attention')
+    atten_tpl = self.tr_atten_tpl
+    if self.fold_norm_scale:
+      _check_foldable_norm(self.norm_policy, self.ln_tpl)
+      if not getattr(atten_tpl, 'combine_qkv', False):
+        raise ValueError('fold_norm_scale requires combine_qkv=True.')
+      _check_foldable_fflayer(self.tr_fflayer_tpl)
+      _check_not_quantized(atten_tpl.combined_qkv_proj_tpl)
+      atten_tpl = atten_tpl.clone()
+      atten_tpl.combined_qkv_proj_tpl.folded_norm_epsilon = (
+          self.ln_tpl.epsilon
+      )
+    self._setup_attention(atten_tpl, 'self_attention')
 
     # Initialize residual dropout.
     params = self.dropout_tpl.clone()
@@ -1246,6 +1634,8 @@ class Transformer(base_layer.BaseLayer):
       params.residual_dropout_prob = self.residual_dropout_prob
       params.residual_droppath_prob = self.residual_droppath_prob
       params.norm_policy = self.norm_policy
+      if self.fold_norm_scale:
+        params.fold_norm_scale = True
       self.create_child('ff_layer', params)
 
   def init_states(self, target_batch_size: int, target_max_length: int) -> None:
@@ -1307,6 +1697,9 @@ class Transformer(base_layer.BaseLayer):
 
     if self.norm_policy == 'primer_hybrid':
       inputs_normalized = self.pre_layer_norm(inputs)
+    elif self.norm_policy == 'pre' and self.fold_norm_scale:
+      # The norm is applied by the combined QKV projection.
+      inputs_normalized = self.layer_norm.fused_projection_inputs(inputs)
     elif self.norm_policy == 'pre':
       inputs_normalized = self.layer_norm(inputs)
     else:
@@ -1430,6 +1823,9 @@ class Transformer(base_layer.BaseLayer):
     # Layer normalize input
     if self.norm_policy == 'primer_hybrid':
       inputs_normalized = self.pre_layer_norm(inputs)
+    elif self.norm_policy == 'pre' and self.fold_norm_scale:
+      # The norm is applied by the combined QKV projection.
+      inputs_normalized = self.layer_norm.fused_projection_inputs(inputs)
     elif self.norm_policy == 'pre':
       inputs_normalized = self.layer_norm(inputs)
 
@@ -1485,6 +1881,28 @@ class Transformer(base_layer.BaseLayer):
     """Transforms all decode state variables based on transform_fn."""
     self.self_attention.transform_decode_state(transform_fn)
 
+  def fold_norm_scale_vars(self) -> NestedJTensor:
+    """Returns the variables with the layer norms folded into projections.
+
+    The scale and bias of the layer norms are folded into the weights and
+    biases of the combined QKV projection and of the first FFN layer(s), and
+    reset to the identity. The result is to be used with fold_norm_scale=True
+    and gives the same outputs as the original variables without it. Typically
+    called once when loading the model for serving, e.g.
+    `layer.apply(mdl_vars, method=layer.fold_norm_scale_vars)`.
+    """
+    _check_foldable_norm(self.norm_policy, self.ln_tpl)
+    _check_foldable_fflayer(self.tr_fflayer_tpl)
+    _check_not_quantized(self.tr_atten_tpl.combined_qkv_proj_tpl)
+    scale, bias = self.layer_norm.scale_and_bias()
+    params = frozen_dict.unfreeze(self.variables[PARAMS])
+    params['layer_norm'] = self.layer_norm.folded_vars()
+    params['self_attention']['combined_qkv'] = (
+        self.self_attention.combined_qkv.fold_norm_scale(scale, bias)
+    )
+    params['ff_layer'] = self.ff_layer.fold_norm_scale_vars()
+    return params
+
   def lazy_broadcast_prefix(self, num_suffix_samples: int,
                             suffix_length: int) -> None:
     """Performs lazy prefix broadcast on the decoding states.
@@ -1552,6 +1970,14 @@ class StackedTransformer(base_layer.BaseLayer):
       length of the sequence must match the number of attention layers. If an
       entry in the sequence is None, then there is no NGrammer layer present in
       that corresponding layer.
+    use_implicit_attention_mask: If True, the self attention mask is passed to
+      the layers as an `attentions.ImplicitAttentionMask` built from the
+      paddings, segment ids and causal flag instead of a dense [B, 1, T, T]
+      JTensor. This requires segment_ids instead of segment_mask for packed
+      inputs; a segment_mask passed anyway falls back to the dense mask.
+    local_attention_window: If not None, tokens only self attend to tokens less
+      than this many positions away, in fprop and in extend_step. Requires
+      use_implicit_attention_mask.
   """
   use_cross_attention: bool = False
   mask_self_attention: bool = False
@@ -1579,6 +2005,8 @@ class StackedTransformer(base_layer.BaseLayer):
   min_group_size: Optional[int] = None
   moe_layers: Optional[Sequence[int]] = ()
   ngrammer_tpls: Optional[Sequence[LayerTpl]] = template_field(None)
+  use_implicit_attention_mask: bool = False
+  local_attention_window: Optional[int] = None
 
   def _clone_layer_params(self, layer_tpl: LayerTpl) -> LayerTpl:
     """Useful to let sublasses switch the class (e.g. Streaming version)."""
@@ -1592,6 +2020,9 @@ class StackedTransformer(base_layer.BaseLayer):
     assert self.num_heads > 0
     assert 0.0 <= self.dropout_prob < 1.0
     assert 0.0 <= self.input_dropout_prob < 1.0
+    if self.local_attention_window is not None:
+      assert self.use_implicit_attention_mask
+      assert self.local_attention_window > 0
 
     def _layer_params(i):
       """Construct i-th layer params."""
@@ -1671,7 +2102,8 @@ class StackedTransformer(base_layer.BaseLayer):
                cross_inputs: Optional[JTensor] = None,
                cross_paddings: Optional[JTensor] = None,
                cross_segment_mask: Optional[JTensor] = None,
-               segment_pos: Optional[JTensor] = None) -> JTensor:
+               segment_pos: Optional[JTensor] = None,
+               segment_ids: Optional[JTensor] = None) -> JTensor:
     """Stacked Transformer layer.
 
     Args:
@@ -1685,12 +2117,18 @@ class StackedTransformer(base_layer.BaseLayer):
       cross_segment_mask: Segment mask for encoder-decoder in packed input case
         of shape [B, 1, T, S].
       segment_pos: Segment pos for packed input of shape [B, T].
+      segment_ids: Segment ids for packed input of shape [B, T]. Only used with
+        use_implicit_attention_mask, in place of segment_mask.
 
     Returns:
       Output vector with shape [B, T, D].
     """
+    implicit_mask = self.use_implicit_attention_mask and segment_mask is None
     if self.packed_input:
-      assert segment_mask is not None
+      if implicit_mask:
+        assert segment_ids is not None
+      else:
+        assert segment_mask is not None
 
     if self.use_cross_attention:
       assert cross_inputs is not None
@@ -1698,16 +2136,28 @@ class StackedTransformer(base_layer.BaseLayer):
       if self.packed_input:
         assert cross_segment_mask is not None
 
-    attention_mask, cross_attention_mask = compute_attention_masks_for_fprop(
-        inputs,
-        paddings,
-        self.mask_self_attention,
-        segment_mask,
-        cross_inputs,
-        cross_paddings,
-        cross_segment_mask,
-        fold_padding_with_segment_mask=self.fold_padding_with_segment_mask,
-    )
+    if implicit_mask:
+      attention_mask, cross_attention_mask = compute_implicit_attention_masks(
+          paddings,
+          self.mask_self_attention,
+          segment_ids,
+          cross_inputs,
+          cross_paddings,
+          cross_segment_mask,
+          fold_padding_with_segment_mask=self.fold_padding_with_segment_mask,
+          local_window=self.local_attention_window,
+      )
+    else:
+      attention_mask, cross_attention_mask = compute_attention_masks_for_fprop(
+          inputs,
+          paddings,
+          self.mask_self_attention,
+          segment_mask,
+          cross_inputs,
+          cross_paddings,
+          cross_segment_mask,
+          fold_padding_with_segment_mask=self.fold_padding_with_segment_mask,
+      )
 
     x_out = inputs
     if self.input_dropout_prob > 0.0:
@@ -1785,9 +2235,15 @@ class StackedTransformer(base_layer.BaseLayer):
         segment_mask = jnp.squeeze(segment_mask, 1)
 
       attention_mask, cross_attention_mask = (
-          compute_attention_masks_for_extend_step(time_step, max_t,
-                                                  segment_mask, cross_paddings,
-                                                  cross_segment_mask))
+          compute_attention_masks_for_extend_step(
+              time_step,
+              max_t,
+              segment_mask,
+              cross_paddings,
+              cross_segment_mask,
+              local_window=self.local_attention_window,
+          )
+      )
     else:
       if self.use_cross_attention:
         raise NotImplementedError('cross attention does not support customized '
@@ -1795,6 +2251,23 @@ class StackedTransformer(base_layer.BaseLayer):
 
       attention_mask = atten_mask
       cross_attention_mask = None
+      if self.local_attention_window is not None:
+        if atten_mask.ndim != 3:
+          raise NotImplementedError(
+              'local_attention_window only supports [B, 1, S] customized '
+              f'attention_mask, got shape {atten_mask.shape}.'
+          )
+        # [1, 1, S]
+        local_mask = jnp.squeeze(
+            attentions.convert_paddings_to_mask(
+                _local_window_padding(
+                    time_step, atten_mask.shape[-1], self.local_attention_window
+                ),
+                dtype=atten_mask.dtype,
+            ),
+            axis=1,
+        )
+        attention_mask = jnp.minimum(attention_mask, local_mask)
 
     decoder_input = inputs
     for layer in self.x_layers:
@@ -1848,6 +2321,10 @@ class StackedTransformerRepeated(base_layer.BaseLayer):
     x_times: Num times to repeat a block.
     checkpoint_policy: How to checkpoint residuals for BProp: save nothing, dot
       only or dot with no batch dimensions.
+    checkpoint_names: The `checkpoint_name` tags to save when checkpoint_policy
+      is SAVE_NAMES or SAVE_AND_OFFLOAD_NAMES.
+    offloaded_checkpoint_names: The `checkpoint_name` tags to offload to host
+      memory when checkpoint_policy is SAVE_AND_OFFLOAD_NAMES.
     unroll_in_decode: Whether to unroll the layers during extend_step.
     repeat_optimizer_dims_mapping: Tensor split dims mapping used for the
       optimizer state variables corresponding to the repeat prefix dims.
@@ -1857,6 +2334,8 @@ class StackedTransformerRepeated(base_layer.BaseLayer):
   block: LayerTpl = template_field(StackedTransformer)
   x_times: int = 0
   checkpoint_policy: repeats.AutodiffCheckpointType = repeats.AutodiffCheckpointType.SAVE_NOTHING
+  checkpoint_names: Sequence[str] = ()
+  offloaded_checkpoint_names: Sequence[str] = ()
   unroll_in_decode: bool = True
   repeat_layer_name: str = 'repeat'
   sublayer_name: str = 'sub'
@@ -1879,6 +2358,8 @@ class StackedTransformerRepeated(base_layer.BaseLayer):
         sub_tpl=self.block,
         x_times=self.x_times,
         checkpoint_policy=self.checkpoint_policy,
+        checkpoint_names=self.checkpoint_names,
+        offloaded_checkpoint_names=self.offloaded_checkpoint_names,
         unpack_summaries=True,
         unroll_in_decode=self.unroll_in_decode,
         sublayer_name=self.sublayer_name,
@@ -1900,7 +2381,8 @@ class StackedTransformerRepeated(base_layer.BaseLayer):
                cross_inputs: Optional[JTensor] = None,
                cross_paddings: Optional[JTensor] = None,
                cross_segment_mask: Optional[JTensor] = None,
-               segment_pos: Optional[JTensor] = None) -> JTensor:
+               segment_pos: Optional[JTensor] = None,
+               segment_ids: Optional[JTensor] = None) -> JTensor:
     """Stacked Transformer layer.
 
     Args:
@@ -1914,6 +2396,8 @@ class StackedTransformerRepeated(base_layer.BaseLayer):
       cross_segment_mask: Segment mask for encoder-decoder in packed input case
         of shape [B, 1, T, S].
       segment_pos: Segment position of shape [B, T].
+      segment_ids: Segment ids for packed input of shape [B, T], used when the
+        block uses an implicit attention mask.
 
     Returns:
       Output vector with shape [B, T, D].
@@ -1921,7 +2405,8 @@ class StackedTransformerRepeated(base_layer.BaseLayer):
 
     # TODO(zhangqiaorjc): Use positional args until nn.scan supports kwargs.
     out = self.repeat_layer(inputs, paddings, segment_mask, cross_inputs,
-                            cross_paddings, cross_segment_mask, segment_pos)
+                            cross_paddings, cross_segment_mask, segment_pos,
+                            segment_ids)
 
     return out
 
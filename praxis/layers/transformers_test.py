@@ -17,6 +17,7 @@
 
 import copy
 import itertools
+import re
 
 from absl import logging
 from absl.testing import absltest
@@ -33,6 +34,7 @@ from praxis import py_utils
 from praxis import test_utils
 from praxis.layers import activations
 from praxis.layers import attentions
+from praxis.layers import normalizations
 from praxis.layers import transformers
 import tensorflow.compat.v2 as tf
 
@@ -278,6 +280,107 @@ class TransformersTest(test_utils.TestCase):
     np_decoder_outputs = test_utils.to_np(decoder_out_transposed)
     self.assertAllClose(np_fprop_outputs, np_decoder_outputs, atol=1e-5)
 
+  @parameterized.parameters(
+      itertools.product(
+          [normalizations.LayerNorm, normalizations.RmsNorm], [True, False]
+      )
+  )
+  def test_transformer_layer_fold_norm_scale(self, ln_cls, gated):
+    p = pax_fiddle.Config(
+        transformers.Transformer,
+        name='jax_transformer_layer',
+        input_dims=8,
+        hidden_dims=32,
+        num_heads=4,
+        ln_tpl=pax_fiddle.Config(ln_cls),
+    )
+    p.tr_atten_tpl.combine_qkv = True
+    p.tr_fflayer_tpl.ln_tpl = pax_fiddle.Config(ln_cls)
+    p.tr_fflayer_tpl.use_gated_activation = gated
+    fused_p = p.clone().set(fold_norm_scale=True)
+    transformer_layer = instantiate(p)
+    fused_layer = instantiate(fused_p)
+    seq_len = 4
+    batch_size = 2
+    npy_inputs = np.random.normal(
+        1.0, 0.5, [batch_size, seq_len, p.input_dims]).astype('float32')
+    inputs = jnp.asarray(npy_inputs)
+    paddings = jnp.zeros([batch_size, seq_len])
+    attention_mask = attentions.causal_mask(inputs)
+
+    with base_layer.JaxContext.new_context():
+      initial_vars = transformer_layer.init(
+          jax.random.PRNGKey(seed=123),
+          inputs,
+          paddings,
+          attention_mask=attention_mask)
+      # Norm scales and biases are the identity at init.
+      initial_vars = jax.tree_map(
+          lambda x: x + np.random.normal(0.0, 0.5, x.shape).astype(x.dtype),
+          initial_vars)
+      folded_vars = {
+          PARAMS: transformer_layer.apply(
+              initial_vars, method=transformer_layer.fold_norm_scale_vars)
+      }
+      self.assertEqual(
+          jax.tree_util.tree_structure(folded_vars),
+          jax.tree_util.tree_structure(initial_vars))
+      outputs, _ = transformer_layer.apply(
+          initial_vars, inputs, paddings, attention_mask=attention_mask)
+      fused_outputs, _ = fused_layer.apply(
+          folded_vars, inputs, paddings, attention_mask=attention_mask)
+      self.assertAllClose(outputs, fused_outputs, atol=1e-5)
+      # The folded variables also give the same outputs without fusion.
+      unfused_outputs, _ = transformer_layer.apply(
+          folded_vars, inputs, paddings, attention_mask=attention_mask)
+      self.assertAllClose(outputs, unfused_outputs, atol=1e-5)
+
+      _, decoder_state = fused_layer.apply(
+          folded_vars,
+          jnp.zeros_like(inputs),
+          jnp.ones_like(paddings),
+          attention_mask=attention_mask,
+          mutable=[DECODE_CACHE])
+      updated_vars = py_utils.merge_dict(decoder_state, folded_vars)
+      for t in range(seq_len):
+        encoded, decoder_state = fused_layer.apply(
+            updated_vars,
+            inputs=inputs[:, t, :],
+            time_step=t,
+            attention_mask=attention_mask[:, :, t, :],
+            method=fused_layer.extend_step,
+            mutable=[DECODE_CACHE])
+        updated_vars = py_utils.merge_dict(decoder_state, folded_vars)
+        self.assertAllClose(outputs[:, t, :], encoded, atol=1e-5)
+
+  @parameterized.parameters(
+      pax_fiddle.Config(
+          transformers.TransformerFeedForwardMoe, num_experts=4, num_groups=1
+      ),
+      None,
+  )
+  def test_transformer_layer_fold_norm_scale_requires_ff(self, fflayer_tpl):
+    p = pax_fiddle.Config(
+        transformers.Transformer,
+        name='jax_transformer_layer',
+        input_dims=8,
+        hidden_dims=32,
+        num_heads=4,
+        fold_norm_scale=True,
+        tr_fflayer_tpl=fflayer_tpl,
+    )
+    p.tr_atten_tpl.combine_qkv = True
+    transformer_layer = instantiate(p)
+    inputs = jnp.zeros([2, 4, p.input_dims])
+    paddings = jnp.zeros([2, 4])
+    with base_layer.JaxContext.new_context():
+      with self.assertRaisesRegex(ValueError, 'TransformerFeedForward'):
+        transformer_layer.init(
+            jax.random.PRNGKey(seed=123),
+            inputs,
+            paddings,
+            attention_mask=attentions.causal_mask(inputs))
+
   @parameterized.parameters(True, False)
   def test_transformer_layer_cross_attention_ln(self, packed_input):
     input_dims = 8
@@ -1038,6 +1141,239 @@ class TransformersTest(test_utils.TestCase):
 
     self.assertAllClose(outputs_1, outputs_2, atol=1e-5)
 
+  @parameterized.product(
+      mask_self_attention=[True, False],
+      packed_input=[True, False],
+      repeated=[True, False],
+  )
+  def test_stacked_transformer_implicit_attention_mask(
+      self, mask_self_attention, packed_input, repeated):
+    model_dims = 16
+    p1 = pax_fiddle.Config(
+        transformers.StackedTransformer,
+        name='jax_stacked_transformer_layer',
+        model_dims=model_dims,
+        hidden_dims=64,
+        num_heads=4,
+        mask_self_attention=mask_self_attention,
+        num_layers=2,
+        packed_input=packed_input,
+    )
+    if repeated:
+      p1 = pax_fiddle.Config(
+          transformers.StackedTransformerRepeated,
+          name='jax_stacked_transformer_layer_repeated',
+          block=p1,
+          x_times=2,
+      )
+    p2 = copy.deepcopy(p1)
+    (p2.block if repeated else p2).use_implicit_attention_mask = True
+    batch_size, seq_len = 3, 12
+    inputs = np.random.normal(
+        1.0, 0.5, [batch_size, seq_len, model_dims]).astype('float32')
+    paddings = np.zeros([batch_size, seq_len], np.float32)
+    paddings[1, 8:] = 1.0
+    segment_ids = None
+    segment_mask = None
+    if packed_input:
+      segment_ids = np.random.randint(1, 4, [batch_size, seq_len])
+      segment_ids = np.sort(segment_ids, axis=-1).astype(np.int32)
+      segment_mask = attentions.segment_mask(segment_ids)
+
+    with base_layer.JaxContext.new_context():
+      dense_layer = instantiate(p1)
+      implicit_layer = instantiate(p2)
+      initial_vars = dense_layer.init(
+          jax.random.PRNGKey(seed=123), inputs, paddings,
+          segment_mask=segment_mask)
+      dense_outputs = dense_layer.apply(
+          initial_vars, inputs, paddings, segment_mask=segment_mask)
+      implicit_outputs = implicit_layer.apply(
+          initial_vars, inputs, paddings, segment_ids=segment_ids)
+
+    self.assertAllClose(dense_outputs, implicit_outputs, atol=1e-5)
+
+  def test_stacked_transformer_local_attention_window(self):
+    model_dims = 16
+    p = pax_fiddle.Config(
+        transformers.StackedTransformer,
+        name='jax_stacked_transformer_layer',
+        model_dims=model_dims,
+        hidden_dims=64,
+        num_heads=4,
+        mask_self_attention=True,
+        num_layers=1,
+        use_implicit_attention_mask=True,
+        local_attention_window=3,
+    )
+    batch_size, seq_len = 2, 12
+    inputs = np.random.normal(
+        1.0, 0.5, [batch_size, seq_len, model_dims]).astype('float32')
+    paddings = np.zeros([batch_size, seq_len], np.float32)
+
+    with base_layer.JaxContext.new_context():
+      layer = instantiate(p)
+      initial_vars = layer.init(jax.random.PRNGKey(seed=123), inputs, paddings)
+      outputs = layer.apply(initial_vars, inputs, paddings)
+      # Tokens only see the two previous tokens.
+      perturbed_inputs = inputs.copy()
+      perturbed_inputs[:, :4] = np.random.normal(
+          size=[batch_size, 4, model_dims])
+      perturbed_outputs = layer.apply(initial_vars, perturbed_inputs, paddings)
+
+    self.assertAllClose(outputs[:, 6:], perturbed_outputs[:, 6:])
+    self.assertNotAllClose(outputs[:, 4:6], perturbed_outputs[:, 4:6])
+
+  def test_stacked_transformer_shares_rotary_tables(self):
+    max_position, dim_per_head = 256, 8
+
+    def _num_table_constants(num_layers):
+      p = pax_fiddle.Config(
+          transformers.StackedTransformer,
+          name='jax_stacked_transformer_layer',
+          model_dims=16,
+          hidden_dims=32,
+          num_heads=2,
+          mask_self_attention=True,
+          num_layers=num_layers,
+      )
+      atten_p = p.transformer_layer_params_tpl.tr_atten_tpl
+      atten_p.use_rotary_position_emb = True
+      atten_p.rotary_position_emb_tpl.max_position = max_position
+      inputs = np.zeros([1, 4, 16], np.float32)
+      paddings = np.zeros([1, 4], np.float32)
+      segment_pos = np.arange(4, dtype=np.int32)[np.newaxis]
+      with base_layer.JaxContext.new_context():
+        layer = instantiate(p)
+        initial_vars = layer.init(
+            jax.random.PRNGKey(seed=123), inputs, paddings,
+            segment_pos=segment_pos)
+        hlo = jax.jit(
+            lambda mdl_vars: layer.apply(
+                mdl_vars, inputs, paddings, segment_pos=segment_pos)
+        ).lower(initial_vars).as_text()
+      return len(
+          re.findall(
+              rf'constant dense<[^>]*> : tensor<{max_position}x'
+              rf'{dim_per_head}xf32>',
+              hlo,
+          )
+      )
+
+    # The cos and sin tables are embedded once, whatever the number of layers.
+    self.assertEqual(_num_table_constants(1), 2)
+    self.assertEqual(_num_table_constants(3), 2)
+
+  @parameterized.parameters(False, True)
+  def test_stacked_transformer_local_attention_window_extend_step(
+      self, custom_atten_mask
+  ):
+    model_dims = 16
+    p = pax_fiddle.Config(
+        transformers.StackedTransformer,
+        name='jax_stacked_transformer_layer',
+        model_dims=model_dims,
+        hidden_dims=64,
+        num_heads=4,
+        mask_self_attention=True,
+        num_layers=2,
+        use_implicit_attention_mask=True,
+        local_attention_window=3,
+    )
+    batch_size, seq_len = 2, 8
+    inputs = np.random.normal(
+        1.0, 0.5, [batch_size, seq_len, model_dims]).astype('float32')
+    paddings = np.zeros([batch_size, seq_len], np.float32)
+
+    with base_layer.JaxContext.new_context():
+      layer = instantiate(p)
+      initial_vars = layer.init(jax.random.PRNGKey(seed=123), inputs, paddings)
+      fprop_outputs = layer.apply(initial_vars, inputs, paddings)
+      _, decoder_state = layer.apply(
+          initial_vars,
+          jnp.zeros_like(inputs),
+          jnp.ones_like(paddings),
+          mutable=[DECODE_CACHE])
+      updated_vars = py_utils.merge_dict(decoder_state, initial_vars)
+      decoder_outputs = []
+      for t in range(seq_len):
+        atten_mask = None
+        if custom_atten_mask:
+          # A causal mask without the local window, which the layer adds.
+          atten_mask, _ = transformers.compute_attention_masks_for_extend_step(
+              t, seq_len)
+          atten_mask = jnp.tile(atten_mask, [batch_size, 1, 1])
+        encoded, decoder_state = layer.apply(
+            updated_vars,
+            inputs=inputs[:, t, :],
+            time_step=t,
+            atten_mask=atten_mask,
+            method=layer.extend_step,
+            mutable=[DECODE_CACHE])
+        updated_vars = py_utils.merge_dict(decoder_state, initial_vars)
+        decoder_outputs.append(encoded)
+
+    self.assertAllClose(
+        fprop_outputs, jnp.stack(decoder_outputs, axis=1), atol=1e-5)
+
+  @parameterized.parameters(False, True)
+  def test_stacked_transformer_ring_buffer_extend_step(
+      self, use_rotary_position_emb
+  ):
+    model_dims = 16
+    left_context = 3
+    p = pax_fiddle.Config(
+        transformers.StackedTransformer,
+        name='jax_stacked_transformer_layer',
+        model_dims=model_dims,
+        hidden_dims=64,
+        num_heads=4,
+        mask_self_attention=True,
+        num_layers=2,
+    )
+    p.transformer_layer_params_tpl.tr_atten_tpl = pax_fiddle.Config(
+        attentions.LocalSelfAttention,
+        left_context=left_context,
+        right_context=0,
+        ring_buffer_decode_cache=True,
+        use_rotary_position_emb=use_rotary_position_emb,
+    )
+    # Decodes well past left_context steps.
+    batch_size, seq_len = 2, 4 * left_context
+    inputs = np.random.normal(
+        1.0, 0.5, [batch_size, seq_len, model_dims]).astype('float32')
+    paddings = np.zeros([batch_size, seq_len], np.float32)
+
+    with base_layer.JaxContext.new_context():
+      layer = instantiate(p)
+      initial_vars = layer.init(jax.random.PRNGKey(seed=123), inputs, paddings)
+      fprop_outputs = layer.apply(initial_vars, inputs, paddings)
+      _, decoder_state = layer.apply(
+          initial_vars,
+          jnp.zeros_like(inputs),
+          jnp.ones_like(paddings),
+          mutable=[DECODE_CACHE])
+      updated_vars = py_utils.merge_dict(decoder_state, initial_vars)
+      decoder_outputs = []
+      for t in range(seq_len):
+        encoded, decoder_state = layer.apply(
+            updated_vars,
+            inputs=inputs[:, t, :],
+            time_step=t,
+            method=layer.extend_step,
+            mutable=[DECODE_CACHE])
+        updated_vars = py_utils.merge_dict(decoder_state, initial_vars)
+        decoder_outputs.append(encoded)
+
+    self.assertEqual(
+        decoder_state[DECODE_CACHE]['x_layers_0']['self_attention'][
+            'key_state'
+        ].shape[1],
+        left_context,
+    )
+    self.assertAllClose(
+        fprop_outputs, jnp.stack(decoder_outputs, axis=1), atol=1e-5)
+
   @parameterized.parameters(*list(itertools.product([True, False], repeat=5)))
   def test_stacked_transformer_layer_extendstep(self, packed_input,
                                                 cross_attention, combine_qkv,
@@ -1339,6 +1675,100 @@ class TransformersTest(test_utils.TestCase):
     tf_np_outputs = test_utils.to_np(tf_output)
     self.assertAllClose(tf_np_outputs, np_outputs, atol=1e-5)
 
+  @parameterized.parameters(False, True)
+  def test_transformer_moe_sort_dispatch(self, use_gated_activation):
+    p = pax_fiddle.Config(
+        transformers.TransformerFeedForwardMoe,
+        name='moe',
+        input_dims=8,
+        hidden_dims=16,
+        num_experts=4,
+        num_groups=2,
+        # Small capacity so that some assignments are dropped.
+        expert_capacity_dim=2,
+        unadjusted_expert_capacity_factor=0,
+        use_gated_activation=use_gated_activation,
+    )
+    sort_p = p.clone().set(dispatch_mode='sort')
+    batch_size = 4
+    seq_len = 6
+
+    npy_inputs = np.random.normal(
+        1.0, 0.5, [batch_size, seq_len, p.input_dims]).astype('float32')
+    inputs = jnp.asarray(npy_inputs)
+    npy_paddings = np.random.randint(0, 2, [batch_size, seq_len]).astype(
+        'float32')
+    paddings = jnp.asarray(npy_paddings)
+
+    with base_layer.JaxContext.new_context():
+      moe = instantiate(p)
+      sort_moe = instantiate(sort_p)
+      prng_key = jax.random.PRNGKey(seed=123)
+      initial_vars = moe.init(prng_key, inputs, paddings)
+
+      def _loss(mdl_vars, layer):
+        outputs = layer.apply(mdl_vars, inputs, paddings)
+        return jnp.sum(outputs**2), outputs
+
+      (_, outputs), grads = jax.value_and_grad(
+          _loss, has_aux=True)(initial_vars, moe)
+      (_, sort_outputs), sort_grads = jax.value_and_grad(
+          _loss, has_aux=True)(initial_vars, sort_moe)
+
+    self.assertAllClose(outputs, sort_outputs, atol=1e-5)
+    for g, sort_g in zip(jax.tree_util.tree_leaves(grads),
+                         jax.tree_util.tree_leaves(sort_grads)):
+      self.assertAllClose(g, sort_g, atol=1e-5)
+
+  # The dense_top2 fprop only supports [batch, seq_len, model] inputs without
+  # gated activations. With 8 tokens, 4 experts are computed densely while the
+  # weights of 32 experts are gathered per token.
+  @parameterized.parameters(
+      ('top2', False, 2, 4),
+      ('top2', False, 3, 4),
+      ('top2', True, 2, 4),
+      ('top2', True, 3, 4),
+      ('dense_top2', False, 3, 4),
+      ('top2', False, 2, 32),
+      ('top2', True, 3, 32),
+      ('dense_top2', False, 3, 32),
+  )
+  def test_transformer_moe_sparse_decode(self, gating_func,
+                                         use_gated_activation, input_rank,
+                                         num_experts):
+    p = pax_fiddle.Config(
+        transformers.TransformerFeedForwardMoe,
+        name='moe',
+        input_dims=8,
+        hidden_dims=16,
+        num_experts=num_experts,
+        num_groups=1,
+        gating_func=gating_func,
+        # Enough capacity so that no assignment is dropped.
+        expert_capacity_dim=16,
+        unadjusted_expert_capacity_factor=0,
+        use_gated_activation=use_gated_activation,
+        gating_logit_cap=2.0,
+    )
+    sparse_p = p.clone().set(sparse_decode=True)
+    input_shape = [8, p.input_dims] if input_rank == 2 else [4, 2, p.input_dims]
+    npy_inputs = np.random.normal(1.0, 0.5, input_shape).astype('float32')
+    inputs = jnp.asarray(npy_inputs)
+
+    with base_layer.JaxContext.new_context():
+      moe = instantiate(p)
+      sparse_moe = instantiate(sparse_p)
+      prng_key = jax.random.PRNGKey(seed=123)
+      initial_vars = moe.init(prng_key, inputs)
+      outputs = moe.apply(initial_vars, inputs)
+      sparse_outputs = sparse_moe.apply(
+          initial_vars, inputs, time_step=0, method=sparse_moe.extend_step)
+      # fprop is unchanged by sparse_decode.
+      sparse_fprop_outputs = sparse_moe.apply(initial_vars, inputs)
+
+    self.assertAllClose(outputs, sparse_outputs, atol=1e-5)
+    self.assertAllClose(outputs, sparse_fprop_outputs)
+
   @parameterized.parameters(['pre', 'primer_hybrid', 'post', 'post_skip'])
   def test_transformer_layer_norm_policies(self, norm_policy):
     p = pax_fiddle.Config(
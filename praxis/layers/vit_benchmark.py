@@ -0,0 +1,150 @@
+# coding=utf-8
+# Copyright 2022 The Pax Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+r"""Benchmarks ViT inference with token reduction.
+
+Reports the latency of a VisionTransformer forward pass for several token
+reduction configurations and how close their pooled features are to the ones of
+the full model (cosine similarity), a proxy of the accuracy loss when no trained
+checkpoint is at hand.
+
+Example:
+  python -m praxis.layers.vit_benchmark --keep_rates=0.9,0.7,0.5
+"""
+
+import time
+from typing import Sequence, Tuple
+
+from absl import app
+from absl import flags
+import jax
+from jax import numpy as jnp
+import numpy as np
+from praxis import base_layer
+from praxis import pax_fiddle
+from praxis.layers import activations
+from praxis.layers import embedding_softmax
+from praxis.layers import poolings
+from praxis.layers import transformers
+from praxis.layers import vits
+
+instantiate = base_layer.instantiate
+
+_BATCH_SIZE = flags.DEFINE_integer('batch_size', 8, 'Batch size.')
+_IMAGE_SIZE = flags.DEFINE_integer('image_size', 224, 'Image size.')
+_PATCH_SIZE = flags.DEFINE_integer('patch_size', 16, 'Patch size.')
+_MODEL_DIMS = flags.DEFINE_integer('model_dims', 384, 'Model dims.')
+_NUM_HEADS = flags.DEFINE_integer('num_heads', 6, 'Number of heads.')
+_NUM_LAYERS = flags.DEFINE_integer('num_layers', 12, 'Number of layers.')
+_REDUCTION_LAYERS = flags.DEFINE_list(
+    'token_reduction_layers', ['4', '8'],
+    'Layers before which the tokens are reduced.')
+_KEEP_RATES = flags.DEFINE_list('keep_rates', ['0.9', '0.7', '0.5'],
+                                'Token keep rates to benchmark.')
+_METHODS = flags.DEFINE_list('methods', ['prune', 'merge'],
+                             'Token reduction methods to benchmark.')
+_NUM_ITERS = flags.DEFINE_integer('num_iters', 5, 'Timed iterations.')
+
+
+def _vit_p() -> pax_fiddle.Config[vits.VisionTransformer]:
+  num_patches = (_IMAGE_SIZE.value // _PATCH_SIZE.value)**2
+  stacked_p = pax_fiddle.Config(
+      transformers.StackedTransformer,
+      model_dims=_MODEL_DIMS.value,
+      hidden_dims=_MODEL_DIMS.value * 4,
+      num_heads=_NUM_HEADS.value,
+      mask_self_attention=False,
+      num_layers=_NUM_LAYERS.value,
+  )
+  stacked_p.transformer_layer_params_tpl.norm_policy = 'pre'
+  stacked_p.transformer_layer_params_tpl.tr_fflayer_tpl.activation_tpl = (
+      pax_fiddle.Config(activations.GELU))
+  return pax_fiddle.Config(
+      vits.VisionTransformer,
+      name='vit',
+      entry_layers_tpl=pax_fiddle.Config(
+          vits.VitEntryLayers,
+          pos_emb_shapes=(num_patches,),
+          patch_size=_PATCH_SIZE.value,
+          input_dims=_PATCH_SIZE.value**2 * 3,
+          output_dims=_MODEL_DIMS.value,
+          prepend_cls_tokens=1,
+          pos_emb_tpl=pax_fiddle.Config(
+              embedding_softmax.TrainablePositionalEmbedding,
+              max_seq_length=num_patches,
+              embedding_dims=_MODEL_DIMS.value,
+          ),
+      ),
+      transformer_layers_tpl=stacked_p,
+      exit_layers_tpl=pax_fiddle.Config(
+          vits.VitExitLayers,
+          hidden_dim=_MODEL_DIMS.value,
+          output_dim=_MODEL_DIMS.value,
+          pooling_tpl=pax_fiddle.Config(
+              poolings.GlobalPooling, pooling_dims=[1], keepdims=False),
+      ),
+  )
+
+
+def _run(vit_p, mdl_vars, inputs) -> Tuple[float, jnp.ndarray]:
+  """Returns the average wall time of a forward pass and its features."""
+  model = instantiate(vit_p)
+  context_p = base_layer.JaxContext.HParams(do_eval=True)
+
+  @jax.jit
+  def _fprop(mdl_vars, inputs):
+    with base_layer.JaxContext.new_context(hparams=context_p):
+      return model.apply(mdl_vars, inputs)
+
+  features = jax.block_until_ready(_fprop(mdl_vars, inputs))
+  start = time.time()
+  for _ in range(_NUM_ITERS.value):
+    jax.block_until_ready(_fprop(mdl_vars, inputs))
+  return (time.time() - start) / _NUM_ITERS.value, features
+
+
+def main(argv: Sequence[str]) -> None:
+  del argv
+  vit_p = _vit_p()
+  prng_key = jax.random.PRNGKey(1234)
+  inputs = jax.random.normal(
+      prng_key,
+      [_BATCH_SIZE.value, _IMAGE_SIZE.value, _IMAGE_SIZE.value, 3])
+  with base_layer.JaxContext.new_context():
+    mdl_vars = instantiate(vit_p).init(prng_key, inputs)
+  base_time, base_features = _run(vit_p, mdl_vars, inputs)
+  print(f'{"method":>8} {"keep rate":>10} {"latency (ms)":>13} {"speedup":>8} '
+        f'{"cosine sim":>11}')
+  print(f'{"none":>8} {1.0:>10.2f} {base_time * 1e3:>13.2f} {1.0:>8.2f} '
+        f'{1.0:>11.4f}')
+  for method in _METHODS.value:
+    for keep_rate in _KEEP_RATES.value:
+      reduced_p = vit_p.clone().set(
+          token_reduction_layers=[int(x) for x in _REDUCTION_LAYERS.value])
+      reduced_p.token_reduction_tpl.set(
+          method=method, keep_rate=float(keep_rate))
+      reduced_vars = instantiate(reduced_p).split_transformer_stack_vars(
+          mdl_vars)
+      reduced_time, features = _run(reduced_p, reduced_vars, inputs)
+      similarity = np.mean(
+          np.sum(base_features * features, axis=-1) /
+          (np.linalg.norm(base_features, axis=-1) *
+           np.linalg.norm(features, axis=-1)))
+      print(f'{method:>8} {float(keep_rate):>10.2f} {reduced_time * 1e3:>13.2f} '
+            f'{base_time / reduced_time:>8.2f} {similarity:>11.4f}')
+
+
+if __name__ == '__main__':
+  app.run(main)
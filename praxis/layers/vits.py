@@ -32,9 +32,12 @@ D = hidden dims
 
 from __future__ import annotations
 
-from typing import Optional, Sequence, Tuple
+import math
+from typing import List, Optional, Sequence, Tuple
 
 import einops
+import fiddle as fdl
+from flax import linen as nn
 import jax
 from jax import numpy as jnp
 import numpy as np
@@ -53,6 +56,7 @@ from praxis.layers import transformers
 
 NestedMap = py_utils.NestedMap
 JTensor = pytypes.JTensor
+NestedJTensor = pytypes.NestedJTensor
 LayerTpl = pax_fiddle.Config[base_layer.BaseLayer]
 WeightHParams = base_layer.WeightHParams
 WeightInit = base_layer.WeightInit
@@ -377,6 +381,117 @@ class VitExitLayers(base_layer.BaseLayer):
     return inputs
 
 
+class TokenReduction(base_layer.BaseLayer):
+  """Reduces the number of tokens between the transformer layers of a ViT.
+
+  The number of kept tokens only depends on the number of input tokens, so the
+  following layers still run with static shapes. The CLS tokens are always
+  kept.
+
+  Attributes:
+    keep_rate: Fraction of the non CLS tokens to keep, rounded up.
+    method: 'prune' keeps the tokens with the largest L2 norm, in their original
+      order. 'merge' averages the most similar tokens together by bipartite
+      soft matching (https://arxiv.org/abs/2210.09461), it removes at most half
+      of the tokens.
+    num_prepended_tokens: Number of leading CLS tokens.
+    num_appended_tokens: Number of trailing CLS tokens.
+  """
+  keep_rate: float = 0.5
+  method: str = 'prune'
+  num_prepended_tokens: int = 0
+  num_appended_tokens: int = 0
+
+  def setup(self) -> None:
+    if not 0.0 < self.keep_rate <= 1.0:
+      raise ValueError(f'keep_rate ({self.keep_rate}) must be in (0, 1].')
+    if self.method not in ('prune', 'merge'):
+      raise ValueError(f'Unknown token reduction method {self.method}.')
+    if self.method == 'merge' and self.keep_rate < 0.5:
+      raise ValueError('Token merging keeps at least half of the tokens.')
+
+  @nn.nowrap
+  def num_output_tokens(self, num_tokens: int) -> int:
+    """Returns the number of tokens kept out of `num_tokens` input tokens."""
+    num_cls_tokens = self.num_prepended_tokens + self.num_appended_tokens
+    return num_cls_tokens + math.ceil(
+        self.keep_rate * (num_tokens - num_cls_tokens))
+
+  def __call__(self, inputs: JTensor,
+               paddings: JTensor) -> Tuple[JTensor, JTensor]:
+    """Reduces the tokens.
+
+    Args:
+      inputs: Input tensor of shape [B, N, D].
+      paddings: Paddings of shape [B, N]. Padded tokens are dropped first.
+
+    Returns:
+      A tuple (outputs, paddings) of shapes [B, K, D] and [B, K], where
+      K = num_output_tokens(N).
+    """
+    num_tokens = inputs.shape[1]
+    start = self.num_prepended_tokens
+    end = num_tokens - self.num_appended_tokens
+    num_keep = self.num_output_tokens(num_tokens) - (num_tokens - end + start)
+    tokens, token_paddings = inputs[:, start:end], paddings[:, start:end]
+    if self.method == 'prune':
+      tokens, token_paddings = self._prune(tokens, token_paddings, num_keep)
+    else:
+      tokens, token_paddings = self._merge(tokens, token_paddings, num_keep)
+    outputs = jnp.concatenate(
+        [inputs[:, :start], tokens, inputs[:, end:]], axis=1)
+    paddings = jnp.concatenate(
+        [paddings[:, :start], token_paddings, paddings[:, end:]], axis=1)
+    return outputs, paddings
+
+  def _prune(self, tokens: JTensor, paddings: JTensor,
+             num_keep: int) -> Tuple[JTensor, JTensor]:
+    scores = jnp.linalg.norm(tokens.astype(jnp.float32), axis=-1)
+    scores = jnp.where(paddings > 0.0, -jnp.inf, scores)
+    _, indices = jax.lax.top_k(scores, num_keep)
+    indices = jnp.sort(indices, axis=-1)
+    return (jnp.take_along_axis(tokens, indices[..., jnp.newaxis], axis=1),
+            jnp.take_along_axis(paddings, indices, axis=1))
+
+  def _merge(self, tokens: JTensor, paddings: JTensor,
+             num_keep: int) -> Tuple[JTensor, JTensor]:
+    num_merged = tokens.shape[1] - num_keep
+    # Tokens of set a are merged into their most similar token of set b.
+    a, b = tokens[:, ::2], tokens[:, 1::2]
+    weight_a = 1.0 - paddings[:, ::2]
+    weight_b = 1.0 - paddings[:, 1::2]
+
+    def _normalize(x):
+      x = x.astype(jnp.float32)
+      return x / jnp.maximum(jnp.linalg.norm(x, axis=-1, keepdims=True), 1e-6)
+
+    similarity = jnp.einsum('bid,bjd->bij', _normalize(a), _normalize(b))
+    similarity = jnp.where(weight_b[:, jnp.newaxis, :] > 0.0, similarity,
+                           -jnp.inf)
+    best_match = jnp.argmax(similarity, axis=-1)
+    best_similarity = jnp.max(similarity, axis=-1)
+    # Padded tokens of set a are merged first, with a zero weight.
+    best_similarity = jnp.where(weight_a > 0.0, best_similarity, jnp.inf)
+    order = jnp.argsort(-best_similarity, axis=-1)
+    merged, kept = order[:, :num_merged], jnp.sort(order[:, num_merged:], -1)
+
+    dst = jnp.take_along_axis(best_match, merged, axis=1)
+    merged_weight = jnp.take_along_axis(weight_a, merged, axis=1)
+    merged_a = jnp.take_along_axis(a, merged[..., jnp.newaxis], axis=1)
+    scatter_add = jax.vmap(lambda x, i, y: x.at[i].add(y))
+    b_sum = scatter_add(b * weight_b[..., jnp.newaxis], dst,
+                        merged_a * merged_weight[..., jnp.newaxis])
+    b_weight = scatter_add(weight_b, dst, merged_weight)
+    b = (b_sum / jnp.maximum(b_weight, 1e-6)[..., jnp.newaxis]).astype(
+        tokens.dtype)
+    b_paddings = (b_weight == 0.0).astype(paddings.dtype)
+
+    a = jnp.take_along_axis(a, kept[..., jnp.newaxis], axis=1)
+    a_paddings = jnp.take_along_axis(paddings[:, ::2], kept, axis=1)
+    return (jnp.concatenate([a, b], axis=1),
+            jnp.concatenate([a_paddings, b_paddings], axis=1))
+
+
 class VisionTransformer(base_layer.BaseLayer):
   """Vision transformer model.
 
@@ -392,6 +507,15 @@ class VisionTransformer(base_layer.BaseLayer):
     full_data_parallel_on_entry_exit: Whether to apply data parallelism over all
       devices on the entry and exit layers. This is a convenient way to shard
       small entry/exit layers.
+    token_reduction_layers: Indices of the transformer layers before which the
+      tokens are reduced by token_reduction_tpl, e.g. (4, 8) to reduce the
+      tokens after the 4th and the 8th layers. The transformer stack is then
+      split into one copy of transformer_layers_tpl per segment of layers, with
+      its per-layer fields (e.g. moe_layers and ngrammer_tpls) restricted to the
+      segment, see `split_transformer_stack_vars` to convert the variables of a
+      model without token reduction.
+    token_reduction_tpl: Parameterization of the token reduction layers. The CLS
+      tokens of entry_layers_tpl are always kept.
   """
   entry_layers_tpl: LayerTpl = template_field(VitEntryLayers)
   transformer_layers_tpl: LayerTpl = template_field(
@@ -399,6 +523,8 @@ class VisionTransformer(base_layer.BaseLayer):
   )
   exit_layers_tpl: LayerTpl = template_field(VitExitLayers)
   full_data_parallel_on_entry_exit: bool = False
+  token_reduction_layers: Sequence[int] = ()
+  token_reduction_tpl: LayerTpl = template_field(TokenReduction)
 
   class ActivationSharding(base_layer.BaseLayer.ActivationSharding):
     """Represents how intermediate values should be partitioned across a mesh.
@@ -417,11 +543,128 @@ class VisionTransformer(base_layer.BaseLayer):
 
     if self.transformer_layers_tpl is None:
       raise ValueError('transformer_layers_tpl should not be None')
-    self.create_child('transformers_stack', self.transformer_layers_tpl)
+    if self.token_reduction_layers:
+      self._create_reduced_transformer_stacks()
+    else:
+      self.create_child('transformers_stack', self.transformer_layers_tpl)
 
     if self.exit_layers_tpl is not None:
       self.create_child('exit_stack', self.exit_layers_tpl)
 
+  def _num_layers_field(self) -> str:
+    if issubclass(
+        fdl.get_callable(self.transformer_layers_tpl),
+        transformers.StackedTransformerRepeated,
+    ):
+      return 'x_times'
+    return 'num_layers'
+
+  def _layer_segments(self) -> List[Tuple[int, int]]:
+    """Returns the [start, end) transformer layers of each stack."""
+    num_layers = getattr(self.transformer_layers_tpl, self._num_layers_field())
+    boundaries = [0] + list(self.token_reduction_layers) + [num_layers]
+    if any(start >= end for start, end in zip(boundaries, boundaries[1:])):
+      raise ValueError(
+          f'token_reduction_layers {self.token_reduction_layers} must be '
+          f'increasing and in (0, {num_layers}).'
+      )
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+  def _segment_stack_p(self, start: int, end: int) -> LayerTpl:
+    """Returns the stack of the [start, end) transformer layers.
+
+    The per-layer fields of a StackedTransformer are sliced, or re-indexed, to
+    the segment. The blocks of a StackedTransformerRepeated are all the same.
+
+    Args:
+      start: The first layer of the segment.
+      end: The layer after the last one of the segment.
+
+    Returns:
+      The parameterization of the stack of the segment.
+    """
+    stack_p = self.transformer_layers_tpl.clone()
+    if self._num_layers_field() == 'x_times':
+      stack_p.x_times = end - start
+      return stack_p
+
+    num_layers = stack_p.num_layers
+    layer_tpls = stack_p.transformer_layer_params_tpl
+    if isinstance(layer_tpls, Sequence):
+      factor = num_layers // len(layer_tpls)
+      layer_tpls = [layer_tpls[j // factor].clone() for j in range(start, end)]
+    if stack_p.residual_droppath_prob > 0.0:
+      # The droppath probability increases with the index of the layer in the
+      # whole stack, so it is set on each layer.
+      if not isinstance(layer_tpls, Sequence):
+        layer_tpls = [layer_tpls.clone() for _ in range(start, end)]
+      for j, layer_tpl in zip(range(start, end), layer_tpls):
+        layer_tpl.residual_droppath_prob = (
+            stack_p.residual_droppath_prob * j / max(1, num_layers)
+        )
+      stack_p.residual_droppath_prob = 0.0
+    stack_p.transformer_layer_params_tpl = layer_tpls
+    if stack_p.moe_layers:
+      stack_p.moe_layers = [
+          j - start for j in stack_p.moe_layers if start <= j < end
+      ]
+    if stack_p.ngrammer_tpls is not None:
+      stack_p.ngrammer_tpls = list(stack_p.ngrammer_tpls[start:end])
+    stack_p.num_layers = end - start
+    return stack_p
+
+  def _create_reduced_transformer_stacks(self) -> None:
+    stacks_p = [
+        self._segment_stack_p(start, end)
+        for start, end in self._layer_segments()
+    ]
+    self.create_children('transformers_stacks', stacks_p)
+
+    reduction_p = self.token_reduction_tpl.clone()
+    if self.entry_layers_tpl is not None:
+      reduction_p.num_prepended_tokens = self.entry_layers_tpl.prepend_cls_tokens
+      reduction_p.num_appended_tokens = self.entry_layers_tpl.append_cls_tokens
+    self.create_children(
+        'token_reductions',
+        [reduction_p.clone() for _ in self.token_reduction_layers],
+    )
+
+  @nn.nowrap
+  def split_transformer_stack_vars(
+      self, mdl_vars: NestedJTensor) -> NestedJTensor:
+    """Converts the variables of the model without token reduction.
+
+    Splits the `transformers_stack` variables of the same model configured
+    without token_reduction_layers into the variables of the stacks of this one,
+    e.g. to serve a model trained without token reduction.
+
+    Args:
+      mdl_vars: Variables of the model without token reduction.
+
+    Returns:
+      The variables of this model.
+    """
+    segments = self._layer_segments()
+    repeated = self._num_layers_field() == 'x_times'
+    new_vars = {}
+    for collection, collection_vars in mdl_vars.items():
+      collection_vars = dict(collection_vars)
+      stack_vars = collection_vars.pop('transformers_stack', None)
+      if stack_vars is not None:
+        for i, (start, end) in enumerate(segments):
+          if repeated:
+            # The layer variables are stacked along their leading axis.
+            segment_vars = jax.tree_util.tree_map(
+                lambda x: x[start:end], stack_vars)  # pylint: disable=cell-var-from-loop
+          else:
+            segment_vars = {
+                f'x_layers_{j - start}': stack_vars[f'x_layers_{j}']
+                for j in range(start, end)
+            }
+          collection_vars[f'transformers_stacks_{i}'] = segment_vars
+      new_vars[collection] = collection_vars
+    return new_vars
+
   def shard_entry_exit(self, x: JTensor) -> JTensor:
     # Fully data parallel on all mesh axes.
     if (
@@ -459,7 +702,13 @@ class VisionTransformer(base_layer.BaseLayer):
       )
     if paddings is None:
       paddings = jnp.zeros(features.shape[:-1], dtype=features.dtype)
-    features = self.transformers_stack(features, paddings)  # [B, N, D]
+    if self.token_reduction_layers:
+      for i, token_reduction in enumerate(self.token_reductions):
+        features = self.transformers_stacks[i](features, paddings)
+        features, paddings = token_reduction(features, paddings)
+      features = self.transformers_stacks[-1](features, paddings)
+    else:
+      features = self.transformers_stack(features, paddings)  # [B, N, D]
     if self.exit_layers_tpl:
       features = base_layer.maybe_shard(
           features, ap.network_inputs, self.mesh_axis_names
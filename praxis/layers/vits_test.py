@@ -249,6 +249,153 @@ class VitTest(test_utils.TestCase, parameterized.TestCase):
           features.shape,
           (exp_params.batch_size, num_patches, exp_params.hidden_dim))
 
+  @parameterized.parameters(('prune', 0.5), ('prune', 0.25), ('merge', 0.5),
+                            ('merge', 0.75))
+  def test_token_reduction(self, method, keep_rate):
+    p = pax_fiddle.Config(
+        vits.TokenReduction,
+        name='token_reduction',
+        keep_rate=keep_rate,
+        method=method,
+        num_prepended_tokens=1,
+        num_appended_tokens=1,
+    )
+    layer = instantiate(p)
+    # Each of the 6 distinct tokens appears twice, at an even and odd position.
+    distinct_tokens = np.random.normal(size=[2, 6, 8]).astype(np.float32)
+    distinct_tokens *= np.arange(1, 7)[np.newaxis, :, np.newaxis]
+    tokens = np.repeat(distinct_tokens, 2, axis=1)
+    cls_tokens = np.random.normal(size=[2, 1, 8]).astype(np.float32)
+    inputs = np.concatenate([cls_tokens, tokens, -cls_tokens], axis=1)
+    paddings = np.zeros([2, 14], np.float32)
+
+    with base_layer.JaxContext.new_context():
+      initial_vars = layer.init(jax.random.PRNGKey(seed=123), inputs, paddings)
+      outputs, out_paddings = layer.apply(initial_vars, inputs, paddings)
+
+    num_outputs = layer.num_output_tokens(14)
+    self.assertEqual(num_outputs, 2 + int(np.ceil(keep_rate * 12)))
+    self.assertEqual(outputs.shape, (2, num_outputs, 8))
+    self.assertArraysEqual(out_paddings, np.zeros([2, num_outputs]))
+    self.assertAllClose(outputs[:, :1], cls_tokens)
+    self.assertAllClose(outputs[:, -1:], -cls_tokens)
+    if method == 'prune':
+      # The tokens with the largest norms are kept, in order.
+      norms = np.linalg.norm(tokens, axis=-1)
+      for i in range(2):
+        indices = np.sort(np.argsort(-norms[i])[:num_outputs - 2])
+        self.assertAllClose(outputs[i, 1:-1], tokens[i, indices])
+    elif keep_rate == 0.5:
+      # The duplicates are merged.
+      self.assertAllClose(outputs[:, 1:-1], distinct_tokens, atol=1e-5)
+
+  def test_token_reduction_paddings(self):
+    p = pax_fiddle.Config(
+        vits.TokenReduction, name='token_reduction', keep_rate=0.5)
+    layer = instantiate(p)
+    inputs = np.random.normal(size=[1, 8, 4]).astype(np.float32)
+    inputs[0, 0] *= 100.0
+    paddings = np.array([[1, 0, 0, 0, 0, 0, 1, 1]], np.float32)
+    with base_layer.JaxContext.new_context():
+      initial_vars = layer.init(jax.random.PRNGKey(seed=123), inputs, paddings)
+      outputs, out_paddings = layer.apply(initial_vars, inputs, paddings)
+    # The padded token is pruned first despite its large norm.
+    self.assertArraysEqual(out_paddings, np.zeros([1, 4]))
+    self.assertLess(np.max(np.abs(outputs)), 50.0)
+
+  @parameterized.parameters(
+      ('prune', False), ('merge', False), ('prune', True), ('merge', True))
+  def test_vit_token_reduction(self, method, repeated):
+    exp_params = self._exp_params()
+    exp_params.pos_emb_shapes = (4, 4)
+    exp_params.prepend_cls_tokens = 1
+    exp_params.pooled = False
+    transformer_p = self._vit_transformer_layers(exp_params)
+    if repeated:
+      transformer_p.num_layers = 1
+      transformer_p = pax_fiddle.Config(
+          transformers.StackedTransformerRepeated,
+          block=transformer_p,
+          x_times=exp_params.num_xformer_layers,
+      )
+    p_vit = pax_fiddle.Config(vits.VisionTransformer).set(
+        name='vit',
+        entry_layers_tpl=self._vit_entry_layers(exp_params),
+        transformer_layers_tpl=transformer_p,
+        exit_layers_tpl=self._vit_exit_layers(exp_params),
+    )
+    reduced_p = p_vit.clone().set(token_reduction_layers=(1, 3))
+    reduced_p.token_reduction_tpl.set(method=method, keep_rate=0.5)
+    vit_model = instantiate(p_vit)
+    reduced_model = instantiate(reduced_p)
+    # The identity token reduction.
+    identity_model = instantiate(reduced_p.clone().set(
+        token_reduction_tpl=pax_fiddle.Config(
+            vits.TokenReduction, method='prune', keep_rate=1.0)))
+    inputs = np.random.normal(size=[exp_params.batch_size, 16, 16, 3])
+
+    context_p = base_layer.JaxContext.HParams(do_eval=True)
+    with base_layer.JaxContext.new_context(hparams=context_p):
+      initial_vars = vit_model.init(jax.random.PRNGKey(seed=123), inputs)
+      features = vit_model.apply(initial_vars, inputs)
+      reduced_vars = reduced_model.split_transformer_stack_vars(initial_vars)
+      self.assertEqual(
+          jax.tree_util.tree_structure(reduced_vars),
+          jax.tree_util.tree_structure(
+              reduced_model.init(jax.random.PRNGKey(seed=123), inputs)))
+      reduced_features = reduced_model.apply(reduced_vars, inputs)
+      identity_features = identity_model.apply(reduced_vars, inputs)
+
+    # 1 + 16 tokens, reduced to 1 + 8 and then 1 + 4.
+    self.assertEqual(reduced_features.shape,
+                     (exp_params.batch_size, 5, exp_params.hidden_dim))
+    self.assertAllClose(identity_features, features)
+
+  def test_vit_token_reduction_per_layer_fields(self):
+    exp_params = self._exp_params()
+    exp_params.pos_emb_shapes = (4, 4)
+    exp_params.pooled = False
+    transformer_p = self._vit_transformer_layers(exp_params)
+    # Layers 0 and 1 use GELU, layers 2 and 3 ReLU.
+    relu_p = transformer_p.transformer_layer_params_tpl.clone()
+    relu_p.tr_fflayer_tpl.activation_tpl = pax_fiddle.Config(activations.ReLU)
+    transformer_p.transformer_layer_params_tpl = [
+        transformer_p.transformer_layer_params_tpl, relu_p]
+    transformer_p.moe_layers = [1, 2]
+    transformer_p.num_experts = 2
+    p_vit = pax_fiddle.Config(vits.VisionTransformer).set(
+        name='vit',
+        entry_layers_tpl=self._vit_entry_layers(exp_params),
+        transformer_layers_tpl=transformer_p,
+        exit_layers_tpl=self._vit_exit_layers(exp_params),
+    )
+    # The identity token reduction, after layers 0 and 2.
+    reduced_p = p_vit.clone().set(
+        token_reduction_layers=(1, 3),
+        token_reduction_tpl=pax_fiddle.Config(
+            vits.TokenReduction, method='prune', keep_rate=1.0))
+    vit_model = instantiate(p_vit)
+    reduced_model = instantiate(reduced_p)
+    inputs = np.random.normal(size=[exp_params.batch_size, 16, 16, 3])
+
+    context_p = base_layer.JaxContext.HParams(do_eval=True)
+    with base_layer.JaxContext.new_context(hparams=context_p):
+      initial_vars = vit_model.init(jax.random.PRNGKey(seed=123), inputs)
+      features = vit_model.apply(initial_vars, inputs)
+      reduced_vars = reduced_model.split_transformer_stack_vars(initial_vars)
+      self.assertEqual(
+          jax.tree_util.tree_structure(reduced_vars),
+          jax.tree_util.tree_structure(
+              reduced_model.init(jax.random.PRNGKey(seed=123), inputs)))
+      reduced_features = reduced_model.apply(reduced_vars, inputs)
+      # The droppath probability still increases with the layer index.
+      last_layer = reduced_model.bind(reduced_vars).transformers_stacks[1]
+      self.assertAllClose(
+          last_layer.x_layers[1].residual_droppath_prob,
+          exp_params.stochastic_depth_dropout_prob * 2 / 4)
+
+    self.assertAllClose(reduced_features, features)
+
   def test_patch_image_conversion(self):
     batch, height, width, patch_size, channels = 8, 12, 16, 4, 3
     expected_image = np.random.normal(size=[batch, height, width, channels])
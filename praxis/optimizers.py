@@ -230,32 +230,140 @@ def sharded_adagrad(learning_rate_fn: optax.Schedule,
 
 class _AdamOptState:
 
-  def __init__(self, *, m, v):
+  def __init__(self, *, m, v, m_scale=None, v_scale=None):
     self.m = m
     self.v = v
+    self.m_scale = m_scale
+    self.v_scale = v_scale
+
+
+# Companding powers of the blockwise quantized moments. The first moment is
+# quantized in the square root domain and the second moment, which has a much
+# larger dynamic range, in the fourth root domain.
+_M_QUANTIZATION_POWER = 2.0
+_V_QUANTIZATION_POWER = 4.0
 
 
 class _ShardedAdamHelper:
   """A helper class facilitates the creation of sharded_adam_optimizer."""
 
-  def __init__(self, maybe_inf_to_nan: bool = True):
+  def __init__(self,
+               maybe_inf_to_nan: bool = True,
+               quantize_moments: bool = False,
+               quantization_block_size: int = 256):
     self._maybe_inf_to_nan = maybe_inf_to_nan
+    self._quantize_moments = quantize_moments
+    self._quantization_block_size = quantization_block_size
+
+  def should_quantize(self, shape: Sequence[int]) -> bool:
+    """Whether to store the moments of a variable in 8 bits."""
+    return self._quantize_moments and len(shape) >= 1
+
+  def quantized_state_sharding_spec(
+      self, var_hparams: WeightHParams,
+      quantized_dtype: jnp.dtype) -> Tuple[WeightHParams, WeightHParams]:
+    """Returns the sharding specs of a quantized moment and its block scale."""
+    if var_hparams.repeat_prefix:
+      raise ValueError(
+          'Quantized moments: repeat_prefix is not empty. Consider using '
+          'get_transformations_with_vectorized_repeat_prefix to vectorize '
+          'prefix dimensions.')
+    shape = list(var_hparams.shape)
+    q_var_hparams = var_hparams.clone()
+    q_var_hparams.init = None
+    q_var_hparams.dtype = quantized_dtype
+    # The block scales are much smaller than the moments, they are replicated
+    # along the blocked dim.
+    tensor_split_dims_mapping = var_hparams.tensor_split_dims_mapping
+    if tensor_split_dims_mapping is not None:
+      tensor_split_dims_mapping = list(tensor_split_dims_mapping)
+      tensor_split_dims_mapping[_block_axis(shape)] = None
+    scale_var_hparams = WeightHParams(
+        shape=_block_scale_shape(shape, self._quantization_block_size),
+        init=None,
+        dtype=jnp.float32,
+        collections=None,
+        mesh_shape=var_hparams.mesh_shape,
+        tensor_split_dims_mapping=tensor_split_dims_mapping)
+    return q_var_hparams, scale_var_hparams
 
   def opt_state_sharding_spec(self,
                               var_hparams: WeightHParams) -> _AdamOptState:
     """Returns optimizer sharding spec for one particular variable."""
+    if self.should_quantize(var_hparams.shape):
+      m_var_hparams, m_scale_var_hparams = self.quantized_state_sharding_spec(
+          var_hparams, jnp.int8)
+      v_var_hparams, v_scale_var_hparams = self.quantized_state_sharding_spec(
+          var_hparams, jnp.uint8)
+      return _AdamOptState(
+          m=m_var_hparams,
+          v=v_var_hparams,
+          m_scale=m_scale_var_hparams,
+          v_scale=v_scale_var_hparams)
     m_var_hparams = var_hparams.clone()
     m_var_hparams.init = None
     v_var_hparams = var_hparams.clone()
     v_var_hparams.init = None
+    if self._quantize_moments:
+      # Placeholders for the block scales of variables kept in float.
+      return _AdamOptState(
+          m=m_var_hparams,
+          v=v_var_hparams,
+          m_scale=WeightHParams((1,)),
+          v_scale=WeightHParams((1,)))
     # m and v simply share the same sharding.
     return _AdamOptState(m=m_var_hparams, v=v_var_hparams)
 
   def init_opt_state(self, var_hparams: WeightHParams) -> _AdamOptState:
     """Returns optimizer state for one particular variable."""
+    shape = var_hparams.shape
+    if self.should_quantize(shape):
+      scale_shape = _block_scale_shape(shape, self._quantization_block_size)
+      return _AdamOptState(
+          m=jnp.zeros(shape, dtype=jnp.int8),
+          v=jnp.zeros(shape, dtype=jnp.uint8),
+          m_scale=jnp.zeros(scale_shape, dtype=jnp.float32),
+          v_scale=jnp.zeros(scale_shape, dtype=jnp.float32))
+    if self._quantize_moments:
+      return _AdamOptState(
+          m=jnp.zeros_like(var_hparams),
+          v=jnp.zeros_like(var_hparams),
+          m_scale=jnp.zeros((1,)),
+          v_scale=jnp.zeros((1,)))
     return _AdamOptState(
         m=jnp.zeros_like(var_hparams), v=jnp.zeros_like(var_hparams))
 
+  def dequantize_moments(self, moments: _AdamOptState,
+                         dtype: jnp.dtype) -> _AdamOptState:
+    """Returns the float moments of one particular variable."""
+    if not self.should_quantize(moments.m.shape):
+      return moments
+    return _AdamOptState(
+        m=to_blockwise_float(moments.m, moments.m_scale,
+                             self._quantization_block_size,
+                             _M_QUANTIZATION_POWER).astype(dtype),
+        v=to_blockwise_float(moments.v, moments.v_scale,
+                             self._quantization_block_size,
+                             _V_QUANTIZATION_POWER).astype(dtype))
+
+  def quantize_moments(self, moments: _AdamOptState) -> _AdamOptState:
+    """Returns the moments of one particular variable as stored in the state."""
+    if not self.should_quantize(moments.m.shape):
+      if self._quantize_moments:
+        return _AdamOptState(
+            m=moments.m,
+            v=moments.v,
+            m_scale=jnp.zeros((1,)),
+            v_scale=jnp.zeros((1,)))
+      return moments
+    m, m_scale = to_blockwise_quantized(moments.m, jnp.int8,
+                                        self._quantization_block_size,
+                                        _M_QUANTIZATION_POWER)
+    v, v_scale = to_blockwise_quantized(moments.v, jnp.uint8,
+                                        self._quantization_block_size,
+                                        _V_QUANTIZATION_POWER)
+    return _AdamOptState(m=m, v=v, m_scale=m_scale, v_scale=v_scale)
+
   def inf_to_nan(self, array: JTensor):
     """Converting Infinity values to the more sticky NaN."""
     if not self._maybe_inf_to_nan:
@@ -304,18 +412,28 @@ class _ShardedAdamHelper:
 
 class _LionOptState:
 
-  def __init__(self, *, m):
+  def __init__(self, *, m, m_scale=None):
     self.m = m
+    self.m_scale = m_scale
 
 
 class _ShardedLionHelper(_ShardedAdamHelper):
   """A helper class facilitates the creation of sharded_lion_optimizer."""
 
   def opt_state_sharding_spec(self,  # pytype: disable=signature-mismatch  # overriding-return-type-checks
-                              var_hparams: WeightHParams) -> _LionOptState:
+                              var_hparams: WeightHParams,
+                              m_dtype: jnp.dtype = jnp.float32
+                              ) -> _LionOptState:
     """Returns optimizer sharding spec for one particular variable."""
+    if self.should_quantize(var_hparams.shape):
+      m_var_hparams, m_scale_var_hparams = self.quantized_state_sharding_spec(
+          var_hparams, jnp.int8)
+      return _LionOptState(m=m_var_hparams, m_scale=m_scale_var_hparams)
     m_var_hparams = var_hparams.clone()
     m_var_hparams.init = None
+    if self._quantize_moments:
+      m_var_hparams.dtype = m_dtype
+      return _LionOptState(m=m_var_hparams, m_scale=WeightHParams((1,)))
     # m simply share the same sharding.
     return _LionOptState(m=m_var_hparams)
 
@@ -323,8 +441,42 @@ class _ShardedLionHelper(_ShardedAdamHelper):
                      var_hparams: WeightHParams,
                      m_dtype: jnp.dtype = jnp.float32) -> _LionOptState:
     """Returns optimizer state for one particular variable."""
+    shape = var_hparams.shape
+    if self.should_quantize(shape):
+      return _LionOptState(
+          m=jnp.zeros(shape, dtype=jnp.int8),
+          m_scale=jnp.zeros(
+              _block_scale_shape(shape, self._quantization_block_size),
+              dtype=jnp.float32))
+    if self._quantize_moments:
+      return _LionOptState(
+          m=jnp.zeros_like(var_hparams, dtype=m_dtype),
+          m_scale=jnp.zeros((1,)))
     return _LionOptState(m=jnp.zeros_like(var_hparams, dtype=m_dtype))
 
+  def dequantize_moments(self, moments: _LionOptState,  # pytype: disable=signature-mismatch  # overriding-return-type-checks
+                         dtype: jnp.dtype) -> _LionOptState:
+    """Returns the float moment of one particular variable."""
+    if not self.should_quantize(moments.m.shape):
+      return _LionOptState(m=moments.m.astype(dtype))
+    return _LionOptState(
+        m=to_blockwise_float(moments.m, moments.m_scale,
+                             self._quantization_block_size,
+                             _M_QUANTIZATION_POWER).astype(dtype))
+
+  def quantize_moments(self, moments: _LionOptState,  # pytype: disable=signature-mismatch  # overriding-return-type-checks
+                       m_dtype: jnp.dtype = jnp.float32) -> _LionOptState:
+    """Returns the moment of one particular variable as stored in the state."""
+    if not self.should_quantize(moments.m.shape):
+      m = moments.m.astype(m_dtype)
+      if self._quantize_moments:
+        return _LionOptState(m=m, m_scale=jnp.zeros((1,)))
+      return _LionOptState(m=m)
+    m, m_scale = to_blockwise_quantized(moments.m, jnp.int8,
+                                        self._quantization_block_size,
+                                        _M_QUANTIZATION_POWER)
+    return _LionOptState(m=m, m_scale=m_scale)
+
   def update_moments(self, step: JTensor, update: JTensor,  # pytype: disable=signature-mismatch  # overriding-return-type-checks
                      moments: _LionOptState,
                      beta2: float) -> _LionOptState:
@@ -551,7 +703,9 @@ def sharded_adam(
     epsilon_root: float,
     update_capping: float,
     weight_decay: float,
-    maybe_inf_to_nan: bool = True) -> ShardedGradientTransformation:
+    maybe_inf_to_nan: bool = True,
+    quantize_moments: bool = False,
+    quantization_block_size: int = 256) -> ShardedGradientTransformation:
   """Standard Adam optimizer that also supports sharding.
 
   This Adam optimizer supports optional update capping when update_capping is >
@@ -559,6 +713,11 @@ def sharded_adam(
   updates when gradient variance estimate is stale (e.g. when data distribution
   suddenly shifts).
 
+  When quantize_moments is True, the moments of non-scalar variables are stored
+  in 8 bits with a float scale per block of quantization_block_size entries
+  along their largest dim (see to_blockwise_quantized), and the optimizer state
+  has two additional fields m_scale and v_scale.
+
   Args:
     learning_rate_fn: a callable that given the current training step, returns
       the learning rate to apply.
@@ -571,6 +730,8 @@ def sharded_adam(
     update_capping: If > 0, cap mean update to at most this value.
     weight_decay: If > 0, weight decay to apply.
     maybe_inf_to_nan: Will use jax.nan_to_num during update when True
+    quantize_moments: Whether to store the moments in 8 bits.
+    quantization_block_size: Number of entries sharing a quantization scale.
 
   Returns:
     A `ShardedGradientTransformation`.
@@ -578,25 +739,31 @@ def sharded_adam(
   if weight_decay:
     logging.warning(_WEIGHT_DECAY_DEPRECATION)
 
-  helper = _ShardedAdamHelper(maybe_inf_to_nan=maybe_inf_to_nan)
+  helper = _ShardedAdamHelper(
+      maybe_inf_to_nan=maybe_inf_to_nan,
+      quantize_moments=quantize_moments,
+      quantization_block_size=quantization_block_size)
 
-  def init_fn(mdl_vars):
-    slot_vars = jax.tree_map(helper.init_opt_state, mdl_vars)
-    count = jnp.array(0, dtype=jnp.int32)
-    return NestedMap(
+  def _to_state(count, slot_vars):
+    state = NestedMap(
         count=count,
         m=jax.tree_map(lambda x: x.m, slot_vars),
         v=jax.tree_map(lambda x: x.v, slot_vars))
+    if quantize_moments:
+      state.m_scale = jax.tree_map(lambda x: x.m_scale, slot_vars)
+      state.v_scale = jax.tree_map(lambda x: x.v_scale, slot_vars)
+    return state
+
+  def init_fn(mdl_vars):
+    slot_vars = jax.tree_map(helper.init_opt_state, mdl_vars)
+    count = jnp.array(0, dtype=jnp.int32)
+    return _to_state(count, slot_vars)
 
   def init_partition_spec_fn(mdl_params):
     slot_vars = jax.tree_map(helper.opt_state_sharding_spec, mdl_params)
     count = WeightHParams(
         shape=[], init=None, dtype=jnp.int32, collections=None)
-
-    return NestedMap(
-        count=count,
-        m=jax.tree_map(lambda x: x.m, slot_vars),
-        v=jax.tree_map(lambda x: x.v, slot_vars))
+    return _to_state(count, slot_vars)
 
   def update_fn(updates, state, params=None):
     # Sanitize updates just in case.
@@ -605,11 +772,17 @@ def sharded_adam(
     updates = jax.tree_map(helper.inf_to_nan, updates)
     count = state.count
 
-    def _update_momentum(g, m, v):
-      return helper.update_moments(count, g, _AdamOptState(m=m, v=v), beta1,
-                                   beta2)
+    def _update_momentum(g, m, v, m_scale=None, v_scale=None):
+      moments = helper.dequantize_moments(
+          _AdamOptState(m=m, v=v, m_scale=m_scale, v_scale=v_scale), g.dtype)
+      return helper.update_moments(count, g, moments, beta1, beta2)
 
-    updated_moments = jax.tree_map(_update_momentum, updates, state.m, state.v)
+    if quantize_moments:
+      updated_moments = jax.tree_map(_update_momentum, updates, state.m,
+                                     state.v, state.m_scale, state.v_scale)
+    else:
+      updated_moments = jax.tree_map(_update_momentum, updates, state.m,
+                                     state.v)
 
     m = jax.tree_map(lambda x: x.m, updated_moments)
     v = jax.tree_map(lambda x: x.v, updated_moments)
@@ -628,7 +801,8 @@ def sharded_adam(
     # Finally, fold in step size.
     updates = jax.tree_map(lambda x: step_size * x, updates)
 
-    updated_states = NestedMap(count=count + 1, m=m, v=v)
+    updated_states = _to_state(
+        count + 1, jax.tree_map(helper.quantize_moments, updated_moments))
     return updates, updated_states
 
   return ShardedGradientTransformation(
@@ -639,7 +813,10 @@ def sharded_adam(
 
 def sharded_lion(learning_rate_fn: optax.Schedule, beta1: float,
                  beta2: float, m_dtype: jnp.dtype, update_capping: float,
-                 weight_decay: float) -> ShardedGradientTransformation:
+                 weight_decay: float,
+                 quantize_moments: bool = False,
+                 quantization_block_size: int = 256
+                 ) -> ShardedGradientTransformation:
   """Standard Lion optimizer that also supports sharding.
 
   This Lion optimizer supports optional update capping when update_capping
@@ -647,6 +824,11 @@ def sharded_lion(learning_rate_fn: optax.Schedule, beta1: float,
   updates when gradient variance estimate is stale (e.g. when data distribution
   suddenly shifts).
 
+  When quantize_moments is True, the moment of non-scalar variables is stored
+  in 8 bits with a float scale per block of quantization_block_size entries
+  along their largest dim (see to_blockwise_quantized), and the optimizer state
+  has an additional field m_scale.
+
   Args:
     learning_rate_fn: a callable that given the current training step, returns
       the learning rate to apply.
@@ -655,6 +837,8 @@ def sharded_lion(learning_rate_fn: optax.Schedule, beta1: float,
     m_dtype: momentum's dtype.
     update_capping: If > 0, cap mean update to at most this value.
     weight_decay: If > 0, weight decay to apply.
+    quantize_moments: Whether to store the moment in 8 bits.
+    quantization_block_size: Number of entries sharing a quantization scale.
 
   Returns:
     A `ShardedGradientTransformation`.
@@ -662,20 +846,31 @@ def sharded_lion(learning_rate_fn: optax.Schedule, beta1: float,
   if weight_decay:
     logging.warn(_WEIGHT_DECAY_DEPRECATION)
 
-  helper = _ShardedLionHelper()
+  helper = _ShardedLionHelper(
+      quantize_moments=quantize_moments,
+      quantization_block_size=quantization_block_size)
   init_opt_state = functools.partial(helper.init_opt_state, m_dtype=m_dtype)
+  opt_state_sharding_spec = helper.opt_state_sharding_spec
+  if quantize_moments:
+    opt_state_sharding_spec = functools.partial(
+        helper.opt_state_sharding_spec, m_dtype=m_dtype)
+
+  def _to_state(count, slot_vars):
+    state = NestedMap(count=count, m=jax.tree_map(lambda x: x.m, slot_vars))
+    if quantize_moments:
+      state.m_scale = jax.tree_map(lambda x: x.m_scale, slot_vars)
+    return state
 
   def init_fn(mdl_vars):
     slot_vars = jax.tree_map(init_opt_state, mdl_vars)
     count = jnp.array(0, dtype=jnp.int32)
-    return NestedMap(count=count, m=jax.tree_map(lambda x: x.m, slot_vars))
+    return _to_state(count, slot_vars)
 
   def init_partition_spec_fn(mdl_params):
-    slot_vars = jax.tree_map(helper.opt_state_sharding_spec, mdl_params)
+    slot_vars = jax.tree_map(opt_state_sharding_spec, mdl_params)
     count = WeightHParams(
         shape=[], init=None, dtype=jnp.int32, collections=None)
-
-    return NestedMap(count=count, m=jax.tree_map(lambda x: x.m, slot_vars))
+    return _to_state(count, slot_vars)
 
   def update_fn(updates, state, params=None):
     # Sanitize updates just in case.
@@ -684,7 +879,13 @@ def sharded_lion(learning_rate_fn: optax.Schedule, beta1: float,
     updates = jax.tree_map(helper.inf_to_nan, updates)
     count = state.count
 
-    m_casted = jax.tree_map(lambda u, x: x.astype(u.dtype), updates, state.m)
+    if quantize_moments:
+      m_casted = jax.tree_map(
+          lambda u, x, s: helper.dequantize_moments(  # pylint: disable=g-long-lambda
+              _LionOptState(m=x, m_scale=s), u.dtype).m,
+          updates, state.m, state.m_scale)
+    else:
+      m_casted = jax.tree_map(lambda u, x: x.astype(u.dtype), updates, state.m)
 
     def _update_momentum(g, m):
       return helper.update_moments(count, g, _LionOptState(m=m), beta2)
@@ -705,9 +906,11 @@ def sharded_lion(learning_rate_fn: optax.Schedule, beta1: float,
     # Finally, fold in step size.
     updates = jax.tree_map(lambda x: step_size * x, updates)
 
-    updated_states = NestedMap(
-        count=count + 1,
-        m=jax.tree_map(lambda x: x.m.astype(m_dtype), updated_moments))
+    updated_states = _to_state(
+        count + 1,
+        jax.tree_map(
+            functools.partial(helper.quantize_moments, m_dtype=m_dtype),
+            updated_moments))
     return updates, updated_states
 
   return ShardedGradientTransformation(
@@ -1143,6 +1346,10 @@ class Adam(BaseOptimizer):
     weight_decay: Decoupled weight decay to apply.
     sharded_adam: whether or not to use sharded_adam
     maybe_inf_to_nan: Will use jax.nan_to_num during update when True.
+    quantize_moments: Whether to store the moments in 8 bits, with a float scale
+      per block of quantization_block_size entries. Only supported by
+      sharded_adam.
+    quantization_block_size: Number of entries sharing a quantization scale.
   """
   beta1: float = 0.9
   beta2: float = 0.999
@@ -1152,6 +1359,8 @@ class Adam(BaseOptimizer):
   weight_decay: float = 0.0
   sharded_adam: bool = True
   maybe_inf_to_nan: bool = True
+  quantize_moments: bool = False
+  quantization_block_size: int = 256
 
   @classmethod
   def HParamsA(cls) -> pax_fiddle.Config[Adam]:  # pylint: disable=invalid-name
@@ -1179,8 +1388,12 @@ class Adam(BaseOptimizer):
           update_capping=self.clip_threshold,
           weight_decay=self.weight_decay,
           maybe_inf_to_nan=self.maybe_inf_to_nan,
+          quantize_moments=self.quantize_moments,
+          quantization_block_size=self.quantization_block_size,
       )
     else:
+      if self.quantize_moments:
+        raise ValueError('quantize_moments requires sharded_adam.')
       logging.info('Using optax.adam.')
       return optax.adam(
           learning_rate=lr,
@@ -1201,12 +1414,19 @@ class Lion(BaseOptimizer):
     beta2: Exponential decay rate to track the moment of past gradients.
     clip_threshold: An optional float to clip raw Lion updates to.
     weight_decay: Decoupled weight decay to apply.
+    m_dtype: Dtype of the moment. Unused for the moments stored in 8 bits when
+      quantize_moments is True.
+    quantize_moments: Whether to store the moment in 8 bits, with a float scale
+      per block of quantization_block_size entries.
+    quantization_block_size: Number of entries sharing a quantization scale.
   """
   beta1: float = 0.9
   beta2: float = 0.99
   clip_threshold: float = 1.0
   weight_decay: float = 0.0
   m_dtype: jnp.dtype = jnp.bfloat16
+  quantize_moments: bool = False
+  quantization_block_size: int = 256
 
   def _get_raw_grad_transformation(
       self, lr: optax.Schedule) -> ShardedGradientTransformation:
@@ -1218,6 +1438,8 @@ class Lion(BaseOptimizer):
         m_dtype=self.m_dtype,
         update_capping=self.clip_threshold,
         weight_decay=self.weight_decay,
+        quantize_moments=self.quantize_moments,
+        quantization_block_size=self.quantization_block_size,
     )
 
 
@@ -1751,6 +1973,118 @@ def to_float(quantized: JTensor, bucket_size: JTensor) -> JTensor:
   return quantized.astype(float_dtype) * bucket_size
 
 
+def _block_axis(shape: Sequence[int]) -> int:
+  """Returns the dim split into blocks by blockwise quantization.
+
+  The largest dim is blocked, so that the block scales stay much smaller than
+  the tensor whatever its layout, e.g. for [1, N] or [8, N] tensors.
+
+  Args:
+    shape: The shape of the tensor.
+
+  Returns:
+    The index of the first largest dim.
+  """
+  return max(range(len(shape)), key=lambda i: shape[i])
+
+
+def _block_scale_shape(shape: Sequence[int], block_size: int) -> List[int]:
+  """Returns the shape of the block scales of a blockwise quantized tensor."""
+  axis = _block_axis(shape)
+  block_size = min(block_size, shape[axis])
+  scale_shape = list(shape)
+  scale_shape[axis] = -(-shape[axis] // block_size)
+  return scale_shape
+
+
+def to_blockwise_quantized(fvalue: JTensor, quantized_dtype: jnp.dtype,
+                           block_size: int,
+                           power: float = 1.0) -> Tuple[JTensor, JTensor]:
+  """Converts floating point values to blockwise quantized values.
+
+  The largest dim of `fvalue` (the first one on ties) is split into blocks of
+  `block_size` entries (the last block may be smaller), and every block of every
+  other index is quantized with its own scale, the max absolute value of the
+  block. Within a block, the values are companded before rounding, i.e. x is
+  mapped to sign(x) * |x / scale|^(1 / power) * num_buckets, which keeps more
+  precision for the small values when power > 1.
+
+  Args:
+    fvalue: Values in floating point, of rank >= 1.
+    quantized_dtype: Quantized dtype, can be either jnp.int8, or jnp.uint8 for
+      non-negative values.
+    block_size: Number of entries of the blocked dim sharing a scale.
+    power: Companding power.
+
+  Returns:
+    A (quantized_values, block_scale) 2-tuple, where block_scale has the shape
+    of fvalue with the blocked dim of size ceil(size / block_size).
+  """
+  if quantized_dtype == jnp.int8:
+    num_buckets = 127.0
+  elif quantized_dtype == jnp.uint8:
+    num_buckets = 255.0
+  else:
+    raise ValueError(f'Quantized dtype {quantized_dtype} not supported.')
+  if fvalue.ndim < 1:
+    raise ValueError(
+        f'Input array {fvalue} must have a strictly positive number of '
+        'dimensions.')
+
+  axis = _block_axis(fvalue.shape)
+  # Blocks along the first dim, which is moved back at the end.
+  fvalue = jnp.moveaxis(fvalue, axis, 0)
+  shape = fvalue.shape
+  block_size = min(block_size, shape[0])
+  num_blocks = -(-shape[0] // block_size)
+  padding = num_blocks * block_size - shape[0]
+  fvalue = fvalue.astype(jnp.float32)
+  blocks = jnp.pad(fvalue, [(0, padding)] + [(0, 0)] * (fvalue.ndim - 1))
+  blocks = jnp.reshape(blocks, [num_blocks, block_size] + list(shape[1:]))
+  block_scale = jnp.max(jnp.abs(blocks), axis=1)
+  # To avoid divide by 0.0
+  scale_nonzero = jnp.where(block_scale > 0.0, block_scale,
+                            jnp.ones_like(block_scale))
+  ratio = blocks / scale_nonzero[:, jnp.newaxis, ...]
+  ratio = jnp.sign(ratio) * jnp.power(jnp.abs(ratio), 1.0 / power)
+  quantized = jnp.round(ratio * num_buckets)
+  if quantized_dtype == jnp.uint8:
+    quantized = jnp.maximum(quantized, 0.0)
+  quantized = jnp.reshape(quantized, [num_blocks * block_size] +
+                          list(shape[1:]))[:shape[0]]
+  return (
+      jnp.moveaxis(quantized.astype(quantized_dtype), 0, axis),
+      jnp.moveaxis(block_scale, 0, axis),
+  )
+
+
+def to_blockwise_float(quantized: JTensor,
+                       block_scale: JTensor,
+                       block_size: int,
+                       power: float = 1.0) -> JTensor:
+  """Converts blockwise quantized values to float values.
+
+  Args:
+    quantized: Quantized values, of type either jnp.int8 or jnp.uint8.
+    block_scale: The scale of each block, as returned by to_blockwise_quantized.
+    block_size: The block size used in to_blockwise_quantized.
+    power: Companding power used in to_blockwise_quantized.
+
+  Returns:
+    Unquantized values of type block_scale.dtype.
+  """
+  num_buckets = 255.0 if quantized.dtype == jnp.uint8 else 127.0
+  shape = quantized.shape
+  axis = _block_axis(shape)
+  block_size = min(block_size, shape[axis])
+  ratio = quantized.astype(block_scale.dtype) / num_buckets
+  ratio = jnp.sign(ratio) * jnp.power(jnp.abs(ratio), power)
+  scale = lax.slice_in_dim(
+      jnp.repeat(block_scale, block_size, axis=axis), 0, shape[axis], axis=axis
+  )
+  return ratio * scale
+
+
 def adafactor_decay_rate_adam(beta2: float, step_counter: JTensor) -> JTensor:
   """Second-moment decay rate like Adam, subsuming the correction factor.
 
@@ -16,8 +16,12 @@
 """Unit tests for optimizers."""
 
 from absl.testing import absltest
+from absl.testing import parameterized
+import jax
 from jax import numpy as jnp
+import numpy as np
 import optax
+from praxis import base_layer
 from praxis import optimizers
 from praxis import schedules
 from praxis import test_utils
@@ -72,5 +76,117 @@ class OptimizersTest(test_utils.TestCase):
     self.assertEqual(
         mdl_vars['var'], jnp.array(expected_var_value, dtype=jnp.float32))
 
+  @parameterized.parameters(
+      (jnp.int8, 1.0), (jnp.int8, 2.0), (jnp.uint8, 4.0))
+  def test_blockwise_quantization(self, quantized_dtype, power):
+    np.random.seed(1234)
+    fvalue = np.random.normal(size=[10, 3]).astype(np.float32)
+    if quantized_dtype == jnp.uint8:
+      fvalue = np.abs(fvalue)
+    # The last block has 2 entries.
+    fvalue[8:, 0] = 0.0
+    quantized, block_scale = optimizers.to_blockwise_quantized(
+        fvalue, quantized_dtype, block_size=4, power=power)
+    self.assertEqual(quantized.shape, (10, 3))
+    self.assertEqual(quantized.dtype, quantized_dtype)
+    self.assertEqual(block_scale.shape, (3, 3))
+    self.assertAllClose(block_scale[0], np.max(np.abs(fvalue[:4]), axis=0))
+    self.assertAllClose(block_scale[2, 0], 0.0)
+
+    dequantized = optimizers.to_blockwise_float(
+        quantized, block_scale, block_size=4, power=power)
+    self.assertAllClose(dequantized[8:, 0], np.zeros([2]))
+    # The max of each block is exact.
+    self.assertAllClose(
+        np.max(np.abs(dequantized[:4]), axis=0), block_scale[0])
+    num_buckets = 255.0 if quantized_dtype == jnp.uint8 else 127.0
+    max_error = power * np.repeat(block_scale, 4, axis=0)[:10] / num_buckets
+    self.assertTrue(np.all(np.abs(dequantized - fvalue) <= max_error))
+    # Quantization is idempotent.
+    requantized, _ = optimizers.to_blockwise_quantized(
+        dequantized, quantized_dtype, block_size=4, power=power)
+    self.assertArraysEqual(requantized, quantized)
+
+  def test_blockwise_quantization_largest_dim(self):
+    np.random.seed(1234)
+    fvalue = np.random.normal(size=[2, 10, 3]).astype(np.float32)
+    quantized, block_scale = optimizers.to_blockwise_quantized(
+        fvalue, jnp.int8, block_size=4)
+    # The largest dim is blocked, whatever its position.
+    self.assertEqual(quantized.shape, (2, 10, 3))
+    self.assertEqual(block_scale.shape, (2, 3, 3))
+    self.assertAllClose(
+        block_scale[:, 1], np.max(np.abs(fvalue[:, 4:8]), axis=1))
+    expected, _ = optimizers.to_blockwise_quantized(
+        np.transpose(fvalue, [1, 0, 2]), jnp.int8, block_size=4)
+    self.assertArraysEqual(quantized, np.transpose(expected, [1, 0, 2]))
+    dequantized = optimizers.to_blockwise_float(
+        quantized, block_scale, block_size=4)
+    self.assertAllClose(dequantized, fvalue, atol=np.max(block_scale) / 127.0)
+
+  @parameterized.parameters('adam', 'lion')
+  def test_quantized_moments(self, optimizer):
+    if optimizer == 'adam':
+      opt_tpl = optimizers.Adam.HParams(clip_threshold=0.0)
+    else:
+      opt_tpl = optimizers.Lion.HParams(m_dtype=jnp.float32)
+    opt_tpl.lr_schedule = schedules.Constant.HParams(value=1.0)
+    opt_tpl.learning_rate = 0.01
+    quantized_opt_tpl = opt_tpl.clone()
+    quantized_opt_tpl.quantize_moments = True
+    quantized_opt_tpl.quantization_block_size = 8
+
+    mdl_vars = {
+        'w': jnp.array(np.random.normal(size=[20, 4]), dtype=jnp.float32),
+        'b': jnp.array(0.5, dtype=jnp.float32),
+    }
+    var_hparams = {
+        'w': base_layer.WeightHParams(
+            shape=[20, 4],
+            mesh_shape=[2, 1],
+            tensor_split_dims_mapping=['data', 'mdl']),
+        'b': base_layer.WeightHParams(shape=[]),
+    }
+
+    def _loss(mdl_vars):
+      return jnp.sum(jnp.sin(mdl_vars['w'])**2) + mdl_vars['b']**2
+
+    def _train(opt_tpl):
+      tx = optimizers.instantiate(opt_tpl).get_grad_transformation()
+      variables = mdl_vars
+      opt_state = tx.init(variables)
+      for _ in range(10):
+        grads = jax.grad(_loss)(variables)
+        updates, opt_state = tx.update(grads, opt_state, variables)
+        variables = optax.apply_updates(variables, updates)
+      return variables, opt_state, tx.init_partition_spec(var_hparams)
+
+    float_vars, _, _ = _train(opt_tpl)
+    quantized_vars, opt_state, partition_spec = _train(quantized_opt_tpl)
+    self.assertAllClose(quantized_vars['w'], float_vars['w'], atol=5e-3)
+    self.assertAllClose(quantized_vars['b'], float_vars['b'], atol=1e-6)
+
+    state = [s for s in opt_state if 'm' in s][0]
+    spec = [s for s in partition_spec.inner_state if 'm' in s][0]
+    self.assertEqual(state.m['w'].dtype, jnp.int8)
+    self.assertEqual(state.m_scale['w'].shape, (3, 4))
+    self.assertEqual(state.m['b'].dtype, jnp.float32)
+    self.assertEqual(spec.m['w'].dtype, jnp.int8)
+    self.assertEqual(spec.m['w'].tensor_split_dims_mapping, ['data', 'mdl'])
+    self.assertEqual(spec.m_scale['w'].shape, [3, 4])
+    self.assertEqual(spec.m_scale['w'].tensor_split_dims_mapping,
+                     [None, 'mdl'])
+    if optimizer == 'adam':
+      self.assertEqual(state.v['w'].dtype, jnp.uint8)
+      self.assertEqual(spec.v['w'].dtype, jnp.uint8)
+      self.assertEqual(spec.v_scale['w'].shape, [3, 4])
+    # The state matches its partition spec.
+    self.assertEqual(
+        jax.tree_util.tree_structure(jax.tree_map(lambda x: 0, state)),
+        jax.tree_util.tree_structure(
+            jax.tree_map(lambda x: 0, spec,
+                         is_leaf=lambda x: isinstance(
+                             x, base_layer.WeightHParams))))
+
 if __name__ == '__main__':
   absltest.main()
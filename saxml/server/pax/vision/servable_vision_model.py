@@ -14,9 +14,13 @@
 """Wraps a model with VisionService APIs."""
 
 import copy
-from typing import Any, Callable, Dict, List, Optional, Tuple, Union
+import dataclasses
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple, Union
 
+from fiddle import daglish
+import jax
 from jax import numpy as jnp
+from jax.experimental import pjit
 from lingvo.core import cluster_factory
 import numpy as np
 from paxml import base_task
@@ -25,6 +29,8 @@ from praxis import base_model
 from praxis import pax_fiddle
 from praxis import py_utils
 from praxis import pytypes
+from praxis.layers import vits
+from praxis.layers.quantization import quantization_hparams
 from saxml.server.pax import servable_model
 from saxml.server.pax import servable_model_params
 from saxml.server.services import vision_service
@@ -211,6 +217,16 @@ class VisionModelParamsBase(servable_model_params.ServableModelParams):
   def video_to_text(self) -> Optional[VideoToTextHParams]:
     return None
 
+  def token_reduction_vit_path(self) -> Optional[Sequence[str]]:
+    """Variable path of a VisionTransformer to serve with token reduction.
+
+    If not None, the checkpoint is expected to come from the same model
+    configured without the token_reduction_layers of the VisionTransformer at
+    this path, e.g. ('backbone', 'vit'). Its `transformers_stack` variables are
+    split into the stacks of the token reduction model when loading.
+    """
+    return None
+
   def create_model(self, primary_process_id: int) -> 'VisionModel':
     return VisionModel(
         self,
@@ -707,9 +723,153 @@ class VideoBytesToText(ImageBytesToText):
     return image_data
 
 
+def remove_token_reduction(
+    model_p: pax_fiddle.Config[base_model.BaseModel],
+) -> Tuple[
+    pax_fiddle.Config[base_model.BaseModel],
+    pax_fiddle.Config[vits.VisionTransformer],
+]:
+  """Returns a copy of model_p without token reduction, and the reduced ViT.
+
+  Args:
+    model_p: A model config holding exactly one VisionTransformer config with
+      token_reduction_layers.
+
+  Returns:
+    A tuple of the model config with the token_reduction_layers of that
+    VisionTransformer cleared, and the original VisionTransformer config.
+  """
+  unreduced_p = copy.deepcopy(model_p)
+  vit_ps = {}
+  for value, _ in daglish.iterate(unreduced_p):
+    if (
+        isinstance(value, pax_fiddle.Config)
+        and isinstance(value.__fn_or_cls__, type)
+        and issubclass(value.__fn_or_cls__, vits.VisionTransformer)
+        and value.token_reduction_layers
+    ):
+      vit_ps[id(value)] = value
+  if len(vit_ps) != 1:
+    raise ValueError(
+        'Expected exactly one VisionTransformer with token_reduction_layers, '
+        f'got {len(vit_ps)}.'
+    )
+  (vit_p,) = vit_ps.values()
+  reduced_vit_p = copy.deepcopy(vit_p)
+  vit_p.token_reduction_layers = ()
+  return unreduced_p, reduced_vit_p
+
+
+def split_token_reduction_vars(
+    mdl_vars: NestedJTensor,
+    vit: vits.VisionTransformer,
+    vit_path: Sequence[str],
+) -> NestedJTensor:
+  """Splits the ViT stack variables of a model trained without token reduction.
+
+  Args:
+    mdl_vars: Variables of the model without token reduction.
+    vit: The VisionTransformer with token reduction; it does not need to be
+      bound.
+    vit_path: Variable path of the VisionTransformer within each collection.
+
+  Returns:
+    The variables of the model with token reduction.
+  """
+
+  new_vars = {}
+  for collection, collection_vars in mdl_vars.items():
+    vit_vars = collection_vars
+    for name in vit_path:
+      vit_vars = vit_vars.get(name) if vit_vars is not None else None
+    if vit_vars is None:
+      new_vars[collection] = collection_vars
+      continue
+    split_vars = vit.split_transformer_stack_vars({collection: vit_vars})
+    new_vars[collection] = _set_path(
+        collection_vars, vit_path, split_vars[collection]
+    )
+  return new_vars
+
+
+def _set_path(tree: Dict[str, Any], path: Sequence[str], value: Any) -> Any:
+  """Returns a copy of the nested dict tree with value at path."""
+  if not path:
+    return value
+  tree = dict(tree)
+  tree[path[0]] = _set_path(tree[path[0]], path[1:], value)
+  return tree
+
+
 class VisionModel(servable_model.ServableModel):
   """Model for vision tasks."""
 
+  def load_state(
+      self,
+      checkpoint_path: Optional[str],
+      prng_key: PRNGKey,
+      precompile: bool = True,
+  ) -> Tuple[base_model.BaseModel, servable_model.ServableModelState]:
+    """Initializes the model state, splitting unreduced ViT checkpoints."""
+    model_config = self.model_config
+    assert isinstance(model_config, VisionModelParamsBase)
+    vit_path = model_config.token_reduction_vit_path()
+    if vit_path is None:
+      return super().load_state(checkpoint_path, prng_key, precompile)
+    if (
+        model_config.quant_mode
+        == quantization_hparams.QuantizationMode.MATERIALIZE
+    ):
+      raise NotImplementedError(
+          'token_reduction_vit_path does not support materialized quantization.'
+      )
+
+    task_p = model_config.task()
+    unreduced_model_p, reduced_vit_p = remove_token_reduction(task_p.model)  # pytype: disable=attribute-error
+    unreduced_task_p = copy.deepcopy(task_p)
+    unreduced_task_p.model = unreduced_model_p  # pytype: disable=not-writable
+
+    # Restore the checkpoint with the model it was trained with.
+    unreduced_config = copy.copy(model_config)
+    unreduced_config.task = lambda: copy.deepcopy(unreduced_task_p)
+    self._model_config = unreduced_config
+    try:
+      _, model_state = super().load_state(
+          checkpoint_path, prng_key, precompile
+      )
+    finally:
+      self._model_config = model_config
+
+    jax_task = task_p.Instantiate()
+    discard_opt_states = not model_config.load_ema()
+    with model_state.global_mesh:
+      vars_weight_params = jax_task.model.abstract_init_with_metadata(
+          model_config.input_for_model_init()
+      )
+      mdl_var_pspecs = jax_task.create_train_state_partition_specs(
+          vars_weight_params, discard_opt_states=discard_opt_states
+      ).mdl_vars
+      mdl_var_unpadded_shapes = jax.tree_map(
+          lambda x: x.shape,
+          jax_task.create_train_state_unpadded_shapes(
+              vars_weight_params, discard_opt_states=discard_opt_states
+          ).mdl_vars,
+      )
+      vit = reduced_vit_p.Instantiate()
+      split_fn = pjit.pjit(
+          lambda mdl_vars: split_token_reduction_vars(mdl_vars, vit, vit_path),
+          in_shardings=(model_state.mdl_var_pspecs,),
+          out_shardings=mdl_var_pspecs,
+      )
+      mdl_vars = split_fn(model_state.mdl_vars)
+    model_state = dataclasses.replace(
+        model_state,
+        mdl_vars=mdl_vars,
+        mdl_var_pspecs=mdl_var_pspecs,
+        mdl_var_unpadded_shapes=mdl_var_unpadded_shapes,
+    )
+    return jax_task.model, model_state
+
   def init_method(
       self,
       method: str,
@@ -0,0 +1,100 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Tests for servable_vision_model."""
+
+from absl.testing import absltest
+import jax
+import numpy as np
+from praxis import base_layer
+from praxis import pax_fiddle
+from praxis import test_utils
+from praxis.layers import vits
+from saxml.server.pax.vision import servable_vision_model
+
+LayerTpl = pax_fiddle.Config[base_layer.BaseLayer]
+template_field = base_layer.template_field
+
+
+class ImageEncoder(base_layer.BaseLayer):
+  """Wraps a VisionTransformer to test variable paths."""
+
+  vit_tpl: LayerTpl = template_field(vits.VisionTransformer)
+
+  def setup(self) -> None:
+    self.create_child('vit', self.vit_tpl)
+
+  def __call__(self, inputs):
+    return self.vit(inputs)
+
+
+class ServableVisionModelTest(test_utils.TestCase):
+
+  def _encoder_p(self, token_reduction_layers):
+    vit_p = vits.build_vision_transformer_hparams_for_test(
+        pos_emb_shapes=(4, 4),
+        patch_size=4,
+        image_channels=3,
+        model_dims=24,
+        mlp_dims=96,
+        num_xformer_layers=4,
+        num_heads=4,
+    )
+    vit_p.exit_layers_tpl.pooled = False
+    vit_p.token_reduction_layers = token_reduction_layers
+    return pax_fiddle.Config(ImageEncoder, name='encoder', vit_tpl=vit_p)
+
+  def test_remove_token_reduction(self):
+    model_p = self._encoder_p(token_reduction_layers=(1, 3))
+    unreduced_p, reduced_vit_p = servable_vision_model.remove_token_reduction(
+        model_p
+    )
+    self.assertEqual(unreduced_p.vit_tpl.token_reduction_layers, ())
+    self.assertEqual(reduced_vit_p.token_reduction_layers, (1, 3))
+    # The input config is left unchanged.
+    self.assertEqual(model_p.vit_tpl.token_reduction_layers, (1, 3))
+
+  def test_remove_token_reduction_requires_reduced_vit(self):
+    with self.assertRaisesRegex(ValueError, 'got 0'):
+      servable_vision_model.remove_token_reduction(
+          self._encoder_p(token_reduction_layers=())
+      )
+
+  def test_split_token_reduction_vars(self):
+    model_p = self._encoder_p(token_reduction_layers=(1, 3))
+    unreduced_p, reduced_vit_p = servable_vision_model.remove_token_reduction(
+        model_p
+    )
+    inputs = np.random.normal(size=[2, 16, 16, 3]).astype(np.float32)
+    unreduced_model = pax_fiddle.instantiate(unreduced_p)
+    reduced_model = pax_fiddle.instantiate(model_p)
+
+    context_p = base_layer.JaxContext.HParams(do_eval=True)
+    with base_layer.JaxContext.new_context(hparams=context_p):
+      unreduced_vars = unreduced_model.init(jax.random.PRNGKey(123), inputs)
+      reduced_vars = servable_vision_model.split_token_reduction_vars(
+          unreduced_vars, pax_fiddle.instantiate(reduced_vit_p), ('vit',)
+      )
+      self.assertEqual(
+          jax.tree_util.tree_structure(reduced_vars),
+          jax.tree_util.tree_structure(
+              reduced_model.init(jax.random.PRNGKey(123), inputs)
+          ),
+      )
+      outputs = reduced_model.apply(reduced_vars, inputs)
+    # 16 tokens, reduced to 8 and then 4.
+    self.assertEqual(outputs.shape, (2, 4, 24))
+
+
+if __name__ == '__main__':
+  absltest.main()